@@ -7,10 +7,19 @@
 
 """AzureVMInstanceMetadata module."""
 
-import urllib2
+import os
+import time
 import json
+import errno
+import logging
+import threading
 from .backupexception import BackupException
 
+# How long cached metadata may be used when the metadata endpoint cannot be reached
+MAX_STALE_SECONDS = 24 * 3600
+# Do not hang forever if the metadata endpoint does not answer
+REQUEST_TIMEOUT_SECONDS = 10
+
 def lazy_property(fn):
     """Decorator that makes a property lazy-evaluated."""
     attr_name = '_lazy_' + fn.__name__
@@ -22,6 +31,83 @@ def lazy_property(fn):
         return getattr(self, attr_name)
     return _lazy_property
 
+class MetadataCache(object):
+    """
+    Keep a copy of the instance metadata in a local file. Fresh copies are
+    used without contacting the metadata endpoint; copies older than half
+    the TTL are refreshed in the background; expired copies are refreshed
+    synchronously but still used if the endpoint is unavailable.
+    """
+
+    def __init__(self, filename, ttl_seconds, request, max_stale_seconds=MAX_STALE_SECONDS):
+        self.filename = filename
+        self.ttl_seconds = ttl_seconds
+        self.request = request
+        self.max_stale_seconds = max_stale_seconds
+        self.refresh_thread = None
+
+    def read(self):
+        """Return a tuple (age in seconds, metadata) from the cache file, or None."""
+        try:
+            age = time.time() - os.stat(self.filename).st_mtime
+            with open(self.filename, 'rt') as cache_file:
+                return (age, json.load(cache_file))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write(self, data):
+        """Atomically replace the cache file; failures only disable caching."""
+        tmp_filename = "{}.{}.tmp".format(self.filename, os.getpid())
+        try:
+            directory = os.path.dirname(self.filename)
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+            fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wt') as cache_file:
+                json.dump(data, cache_file)
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError) as ex:
+            logging.debug("Cannot write instance metadata cache %s: %s", self.filename, ex)
+
+    def refresh(self):
+        """Request the metadata from the endpoint and update the cache."""
+        data = self.request()
+        self.write(data)
+        return data
+
+    def refresh_in_background(self):
+        """Refresh the cache in a daemon thread."""
+        def run():
+            """Thread body; errors are not fatal since we still have a cached copy."""
+            try:
+                self.refresh()
+            except BackupException as ex:
+                logging.debug("Background refresh of instance metadata failed: %s", ex)
+        self.refresh_thread = threading.Thread(target=run, name="metadata-refresh")
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+
+    def get(self):
+        """Return metadata from the cache or the endpoint."""
+        cached = self.read()
+        if cached is not None:
+            (age, data) = cached
+            if 0 <= age < self.ttl_seconds:
+                if age > self.ttl_seconds / 2.0:
+                    self.refresh_in_background()
+                return data
+        try:
+            return self.refresh()
+        except BackupException:
+            if cached is not None and cached[0] < self.max_stale_seconds:
+                logging.warning("Instance metadata endpoint unavailable, using cached copy from %d seconds ago",
+                                cached[0])
+                return cached[1]
+            raise
+
 class AzureVMInstanceMetadata(object):
     """AzureVMInstanceMetadata class."""
 
@@ -31,24 +117,35 @@ class AzureVMInstanceMetadata(object):
         Read instance metadata from private endpoint, parse the JSON,
         and return a Python object.
         """
+        import urllib2
         url = "http://169.254.169.254/metadata/instance?api-version={v}".format(v=api_version)
         try:
             return json.loads(
                 urllib2.urlopen(
-                    urllib2.Request(url, None, {'metadata': 'true'})).read())
+                    urllib2.Request(url, None, {'metadata': 'true'}),
+                    timeout=REQUEST_TIMEOUT_SECONDS).read())
         except Exception as ex:
             raise BackupException("Failed to connect to Azure instance metadata endpoint {}:\n{}"
                                   .format(url, ex.message))
 
     @staticmethod
-    def create_instance():
+    def create_instance(cache_filename=None, cache_ttl_seconds=0):
         """
+        Create an instance reading from the metadata endpoint, through a
+        local cache file when cache_filename and a TTL are given.
+
         >>> json_meta = '{ "compute": { "subscriptionId": "724467b5-bee4-484b-bf13-d6a5505d2b51", "resourceGroupName": "backuptest", "name": "somevm", "tags":"fs_backup_interval_min:24h;fs_backup_interval_max:3d;db_backup_window_1:111111 111000 000000 011111;db_backup_window_2:111111 111000 000000 011111;db_backup_window_3:111111 111000 000000 011111;db_backup_window_4:111111 111000 000000 011111;db_backup_window_5:111111 111000 000000 011111;db_backup_window_6:111111 111111 111111 111111;db_backup_window_7:111111 111111 111111 111111" } }'
         >>> meta = AzureVMInstanceMetadata(lambda: (json.JSONDecoder()).decode(json_meta))
         >>> meta.vm_name
         'somevm'
         """
         # return AzureVMInstanceMetadata(lambda: (json.JSONDecoder()).decode('{ "compute": { "subscriptionId": "724467b5-bee4-484b-bf13-d6a5505d2b51", "resourceGroupName": "backuptest", "name": "somevm", "tags":"fs_backup_interval_min:24h;fs_backup_interval_max:3d;db_backup_window_1:111111 111000 000000 011111;db_backup_window_2:111111 111000 000000 011111;db_backup_window_3:111111 111000 000000 011111;db_backup_window_4:111111 111000 000000 011111;db_backup_window_5:111111 111000 000000 011111;db_backup_window_6:111111 111111 111111 111111;db_backup_window_7:111111 111111 111111 111111" } }'))
+        if cache_filename and cache_ttl_seconds > 0:
+            cache = MetadataCache(
+                filename=cache_filename,
+                ttl_seconds=cache_ttl_seconds,
+                request=AzureVMInstanceMetadata.request_metadata)
+            return AzureVMInstanceMetadata(cache.get)
         return AzureVMInstanceMetadata(AzureVMInstanceMetadata.request_metadata)
 
     def __init__(self, req):
@@ -60,7 +157,12 @@ class AzureVMInstanceMetadata(object):
         return self.req()
 
     def get_tags(self):
-        """Retrieve tags from instance metadata."""
+        """Retrieve tags from instance metadata (parsed once)."""
+        return self.tags
+
+    @lazy_property
+    def tags(self):
+        """Parse tags from instance metadata."""
         try:
             tags_value = str(self.json['compute']['tags'])
             if tags_value is None or not tags_value:
@@ -6,17 +6,29 @@
 # --------------------------------------------------------------------------
 
 import sys
+import errno
 import logging
 import os
 import datetime
 import json
-import subprocess
 import shlex
+import pipes
+import subprocess
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 import azfilebak
 from azfilebak.naming import Naming
+from azfilebak.azurevminstancemetadata import lazy_property
 from azfilebak.timing import Timing
 from azfilebak.executableconnector import ExecutableConnector
+from azfilebak.striping import Striping
+from azfilebak.fileorder import Readahead
+from azfilebak.fanout import write_file
+from azfilebak.compression import GzipWriter, is_adaptive, HEADER_SIZE as COMPRESSION_HEADER_SIZE
+from azfilebak.fingerprint import Fingerprint, METADATA_KEY as FINGERPRINT_KEY
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.uploader import MAX_BLOCK_SIZE
 from azfilebak.backupexception import BackupException
 
 class BackupAgent(object):
@@ -32,56 +44,77 @@ class BackupAgent(object):
     # Listing methods.
     #
 
+    @staticmethod
+    def logical_backups(blobs):
+        """
+        Return tuples (name, datetime, length) of the backups among the
+        blobs, sorted by name. The stripes of a striped backup are listed
+        as one backup, under the name of an unstriped one, once all the
+        stripes and the manifest exist.
+
+        >>> from azfilebak.storagebackend import BlobInfo
+        >>> BackupAgent.logical_backups([
+        ...     BlobInfo('fs_vm1_full_20180601_112429.1of2.tar.gz', 10, 1),
+        ...     BlobInfo('fs_vm1_full_20180601_112429.2of2.tar.gz', 20, 2),
+        ...     BlobInfo('fs_vm1_full_20180601_112429.manifest.json', 1, 3),
+        ...     BlobInfo('fs_vm1_full_20180602_112429.1of2.tar.gz', 10, 1),
+        ...     BlobInfo('fs_vm1_full_20180603_112429.tar.gz', 5, 4),
+        ...     BlobInfo('notes.txt', 5, 4)])
+        [('fs_vm1_full_20180601_112429.tar.gz', 1, 30), ('fs_vm1_full_20180603_112429.tar.gz', 4, 5)]
+        """
+        backups = []
+        striped = dict()
+        for blob in blobs:
+            if Naming.parse_blobname(blob.name) is None:
+                continue
+            stripe = Naming.parse_stripe(blob.name)
+            if stripe is None and not Naming.is_manifest(blob.name):
+                backups.append((blob.name, blob.created, blob.size))
+                continue
+            group = striped.setdefault(Naming.logical_blobname(blob.name),
+                                       {'created': None, 'size': 0, 'stripes': 0, 'count': None, 'manifest': False})
+            if stripe is None:
+                group['manifest'] = True
+            else:
+                group['stripes'] += 1
+                group['count'] = stripe[1]
+                group['size'] += blob.size or 0
+                if group['created'] is None or blob.created < group['created']:
+                    group['created'] = blob.created
+        for (name, group) in striped.items():
+            # Stripes without a manifest are an unfinished (or failed) backup
+            if group['manifest'] and group['stripes'] == group['count']:
+                backups.append((name, group['created'], group['size']))
+        return sorted(backups)
+
     def existing_backups_for_fileset(self, fileset, is_full):
         """Retrieve list of existing backups for a single fileset."""
         existing_blobs_dict = dict()
-        marker = None
-        while True:
-            results = self.backup_configuration.storage_client.list_blobs(
-                container_name=self.backup_configuration.azure_storage_container_name,
-                prefix=Naming.construct_blobname_prefix(
-                    fileset=fileset,
-                    is_full=is_full,
-                    vmname=self.backup_configuration.get_vm_name()),
-                marker=marker)
-            for blob in results:
-                blob_name = blob.name
-                parts = Naming.parse_blobname(blob_name)
-                if parts is None:
-                    continue
-                start_timestamp = parts[2]
-                if not existing_blobs_dict.has_key(start_timestamp):
-                    existing_blobs_dict[start_timestamp] = []
-                existing_blobs_dict[start_timestamp].append(blob_name)
-            if results.next_marker:
-                marker = results.next_marker
-            else:
-                break
+        blobs = self.backup_configuration.storage_backend.iter_blobs(
+            container_name=self.backup_configuration.azure_storage_container_name,
+            prefix=Naming.construct_blobname_prefix(
+                fileset=fileset,
+                is_full=is_full,
+                vmname=self.backup_configuration.get_vm_name()))
+        for (blob_name, _created, _size) in BackupAgent.logical_backups(blobs):
+            start_timestamp = Naming.parse_blobname(blob_name)[2]
+            if not existing_blobs_dict.has_key(start_timestamp):
+                existing_blobs_dict[start_timestamp] = []
+            existing_blobs_dict[start_timestamp].append(blob_name)
         return existing_blobs_dict
 
     def existing_backups(self, filesets=None, container=None):
         """Retrieve list of existing backups. Returns tuples (name, datetime, length)"""
         existing_blobs_list = list()
-        marker = None
-
-        results = list(
-            self.backup_configuration.storage_client.list_blobs(
-                container_name=container or self.backup_configuration.azure_storage_container_name,
-                marker=marker)
-        )
 
-        results = sorted(results, key=lambda x: x.name)
+        results = self.backup_configuration.storage_backend.iter_blobs(
+            container_name=container or self.backup_configuration.azure_storage_container_name)
 
-        for blob in results:
-            blob_name = blob.name
-            parts = Naming.parse_blobname(blob_name)
-            if parts is None:
-                continue
-
-            (fileset_of_existing_blob, _is_full, _start_timestamp, _vmname) = parts
+        for (blob_name, created, size) in BackupAgent.logical_backups(results):
+            (fileset_of_existing_blob, _is_full, _start_timestamp, _vmname) = Naming.parse_blobname(blob_name)
 
             if not filesets or fileset_of_existing_blob in filesets:
-                existing_blobs_list.append((blob_name, blob.properties.creation_time,blob.properties.content_length))
+                existing_blobs_list.append((blob_name, created, size))
 
         return existing_blobs_list
 
@@ -89,6 +122,13 @@ class BackupAgent(object):
     # Scheduling methods.
     #
 
+    def latest_backup(self, fileset, is_full):
+        """Return the name of the latest backup of a fileset, None if there is none."""
+        existing_blobs_dict = self.existing_backups_for_fileset(fileset=fileset, is_full=is_full)
+        if not existing_blobs_dict.keys():
+            return None
+        return existing_blobs_dict[Timing.sort(existing_blobs_dict.keys())[-1]][0]
+
     def latest_backup_timestamp(self, fileset, is_full):
         """Return the timestamp for the latest backup for a given fileset."""
         existing_blobs_dict = self.existing_backups_for_fileset(fileset=fileset, is_full=is_full)
@@ -96,6 +136,51 @@ class BackupAgent(object):
             return "19000101_000000"
         return Timing.sort(existing_blobs_dict.keys())[-1:][0]
 
+    def checked_timestamp(self, fileset, blob_name):
+        """
+        Return the timestamp of the latest check that found the fileset
+        unchanged since the backup blob_name, or the timestamp of the
+        backup itself. The backups are scheduled from it, so that an
+        unchanged fileset is checked once per interval.
+        """
+        timestamp = Naming.parse_blobname(blob_name)[2]
+        try:
+            with open(self.backup_configuration.get_unchanged_checks_file(fileset), 'rt') as checks_file:
+                checked = json.load(checks_file).get(blob_name)
+        except (IOError, ValueError, AttributeError):
+            checked = None
+        if checked is None:
+            return timestamp
+        return max(timestamp, checked)
+
+    def latest_checked_timestamp(self, fileset, is_full):
+        """Return the checked timestamp (see checked_timestamp) of the latest backup for a given fileset."""
+        latest = self.latest_backup(fileset, is_full)
+        if latest is None:
+            return "19000101_000000"
+        return self.checked_timestamp(fileset, latest)
+
+    def save_unchanged_check(self, fileset, blob_name, timestamp):
+        """Record that the fileset was found unchanged since the backup blob_name at timestamp."""
+        filename = self.backup_configuration.get_unchanged_checks_file(fileset)
+        try:
+            with open(filename, 'rt') as checks_file:
+                checks = json.load(checks_file)
+        except (IOError, ValueError):
+            checks = {}
+        # Keep one check for the full backups and one for the incremental backups
+        is_full = Naming.parse_blobname(blob_name)[1]
+        checks = dict((name, checked) for (name, checked) in checks.items()
+                      if Naming.parse_blobname(name)[1] != is_full)
+        checks[blob_name] = timestamp
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wt') as checks_file:
+                json.dump(checks, checks_file, indent=2, sort_keys=True)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError) as ex:
+            logging.debug("Cannot write unchanged checks %s: %s", filename, ex)
+
     @staticmethod
     def should_run_full_backup(now_time, force, latest_full_backup_timestamp,
                                business_hours, db_backup_interval_min, db_backup_interval_max):
@@ -117,6 +202,33 @@ class BackupAgent(object):
 
         return perform_full_backup
 
+    @staticmethod
+    def next_full_backup_time(latest_full_backup_timestamp, business_hours,
+                              db_backup_interval_min, db_backup_interval_max):
+        """
+        Return the datetime at which should_run_full_backup will first return True:
+        the first allowed time after the minimum interval, but no later than the
+        maximum interval.
+
+        >>> from azfilebak.businesshours import BusinessHours
+        >>> from azfilebak.scheduleparser import ScheduleParser
+        >>> business_hours = BusinessHours.parse_tag_str(BusinessHours._BusinessHours__sample_data())
+        >>> BackupAgent.next_full_backup_time("20180604_220000", business_hours,
+        ...     ScheduleParser.parse_timedelta("1d"), ScheduleParser.parse_timedelta("3d"))
+        datetime.datetime(2018, 6, 5, 22, 0, 1)
+        >>> BackupAgent.next_full_backup_time("20180604_100000", business_hours,
+        ...     ScheduleParser.parse_timedelta("1d"), ScheduleParser.parse_timedelta("3d"))
+        datetime.datetime(2018, 6, 5, 19, 0)
+        """
+        latest = Timing.to_datetime(latest_full_backup_timestamp)
+        # The intervals are compared with '>', so one more second is needed
+        one_second = datetime.timedelta(seconds=1)
+        forced = latest + db_backup_interval_max + one_second
+        allowed = business_hours.next_allowed_time(latest + db_backup_interval_min + one_second)
+        if allowed is None:
+            return forced
+        return min(allowed, forced)
+
     @staticmethod
     def should_run_tran_backup(now_time, force, latest_tran_backup_timestamp,
                                log_backup_interval_min):
@@ -132,18 +244,26 @@ class BackupAgent(object):
     def should_run_backup(self, fileset, is_full, force, start_timestamp):
         """Determine if a backup can be performed according to backup window rules."""
         if is_full:
+            latest_full_backup_timestamp = self.latest_checked_timestamp(fileset=fileset, is_full=is_full)
             result = BackupAgent.should_run_full_backup(
                 now_time=start_timestamp,
                 force=force,
-                latest_full_backup_timestamp=self.latest_backup_timestamp(fileset=fileset, is_full=is_full),
+                latest_full_backup_timestamp=latest_full_backup_timestamp,
                 business_hours=self.backup_configuration.get_business_hours(),
                 db_backup_interval_min=self.backup_configuration.get_fs_backup_interval_min(),
                 db_backup_interval_max=self.backup_configuration.get_fs_backup_interval_max())
+            if not result:
+                logging.info("Next full backup of fileset %s is due at %s", fileset,
+                             BackupAgent.next_full_backup_time(
+                                 latest_full_backup_timestamp=latest_full_backup_timestamp,
+                                 business_hours=self.backup_configuration.get_business_hours(),
+                                 db_backup_interval_min=self.backup_configuration.get_fs_backup_interval_min(),
+                                 db_backup_interval_max=self.backup_configuration.get_fs_backup_interval_max()))
         else:
             result = BackupAgent.should_run_tran_backup(
                 now_time=start_timestamp,
                 force=force,
-                latest_tran_backup_timestamp=self.latest_backup_timestamp(fileset=fileset, is_full=is_full),
+                latest_tran_backup_timestamp=self.latest_checked_timestamp(fileset=fileset, is_full=is_full),
                 log_backup_interval_min=self.backup_configuration.get_log_backup_interval_min())
 
         return result
@@ -169,12 +289,31 @@ class BackupAgent(object):
         # Get the sources and exclude
         sources = self.backup_configuration.get_fileset_sources(fs)
         exclude = self.backup_configuration.get_fileset_exclude(fs)
-        # Assemble the tar command
-        command = self.executable_connector.assemble_backup_command(sources, exclude)
+        stripes = self.backup_configuration.get_fileset_stripes(fs)
+        order = self.backup_configuration.get_fileset_order(fs)
+        if stripes > 1:
+            return self.backup_striped('fs', sources, exclude, stripes, is_full, force, rate, order)
+        files = None
+        # With adaptive compression, azfilebak compresses the archive
+        compress = self.backup_configuration.get_compression('fs') == 'gzip'
+        if order == 'readdir':
+            # Assemble the tar command
+            command = self.executable_connector.assemble_backup_command(sources, exclude, compress=compress)
+        else:
+            # List the files only if the backup is due
+            if not self.should_run_backup(fileset='fs', is_full=is_full, force=force,
+                                          start_timestamp=Timing.now_localtime()):
+                logging.warn("Skipping backup of fileset %s", 'fs')
+                return
+            force = True
+            source_list = shlex.split(sources)
+            excluded = self.executable_connector.excluded_paths(source_list, exclude)
+            (files_from, files) = self.executable_connector.prepare_file_list('fs', source_list, excluded, order)
+            command = self.executable_connector.assemble_backup_command(
+                sources, exclude, excluded=excluded, files_from=files_from, compress=compress)
         # Run it
         # Note: the default backup blob name always starts with 'fs'
-        self.backup_single_fileset('fs', is_full, force, command, rate)
-        return
+        return self.backup_single_fileset('fs', is_full, force, command, rate, readahead_files=files)
 
     def backup_all_filesets(self, is_full, force):
         """Backup all the filesets."""
@@ -182,10 +321,21 @@ class BackupAgent(object):
         for fileset in filesets_to_backup:
             self.backup_single_fileset(fileset=fileset, is_full=is_full, force=force)
 
-    def backup_single_fileset(self, fileset, is_full, force, command=None, rate=None):
+    def start_readahead(self, files, proc):
+        """Start reading the files ahead of the backup command, None if disabled."""
+        window = self.backup_configuration.get_readahead_window()
+        if not files or window <= 0:
+            return None
+        # With a rate limit, proc is pv, reading from the backup command
+        readahead = Readahead(files, getattr(proc, 'backup_command', proc).pid, window)
+        readahead.start()
+        return readahead
+
+    def backup_single_fileset(self, fileset, is_full, force, command=None, rate=None, readahead_files=None):
         """
         Backup a single fileset using the specified command.
         If no command is provided, it will be looked up in the config file.
+        The files in 'readahead_files' are read ahead of the command.
         """
         logging.info("Backup request for fileset: %s", fileset)
 
@@ -211,21 +361,56 @@ class BackupAgent(object):
         if not command:
             command = self.backup_configuration.get_backup_command(fileset)
 
+        # Skip the backup if the files did not change since the previous one
+        metadata = None
+        fingerprint_sources = self.backup_configuration.get_fingerprint_sources(fileset)
+        if fingerprint_sources:
+            fingerprint = Fingerprint.compute(fingerprint_sources, salt=command)
+            previous = self.unchanged_backup(fileset, is_full, fingerprint, start_timestamp)
+            if previous:
+                return self.record_unchanged(fileset, is_full, start_timestamp, previous, blob_name, fingerprint)
+            metadata = {FINGERPRINT_KEY: fingerprint}
+
+        compressor = None
+        proc = None
+        readahead = None
         try:
             # Run the backup command
             proc = self.executable_connector.run_backup_command(
                 command, rate)
+            readahead = self.start_readahead(readahead_files, proc)
+            stream = proc.stdout
+            if self.backup_configuration.get_compression(fileset) == 'adaptive':
+                # The command writes an uncompressed archive
+                compressor = self.backup_configuration.get_compressor(stream)
+                stream = compressor
+            stream = self.backup_configuration.throttled_reader(stream, 'backup')
 
             logging.info(
                 "Streaming backup to blob: %s in container: %s",
                 blob_name, dest_container_name)
 
             # Stream backup command stdout to the blob
-            storage_client = self.backup_configuration.storage_client
-            storage_client.create_blob_from_stream(
-                container_name=dest_container_name,
-                blob_name=blob_name, stream=proc.stdout,
-                use_byte_buffer=True, max_connections=1)
+            storage_backend = self.backup_configuration.storage_backend
+            if self.backup_configuration.get_delta(fileset):
+                uploader = self.backup_configuration.get_delta_uploader(
+                    fileset, self.latest_backup(fileset, is_full=True))
+            else:
+                uploader = self.backup_configuration.get_stream_uploader(fileset)
+            targets = self.backup_targets(fileset, is_full, start_timestamp, blob_name, metadata)
+            if targets:
+                # The files are read once, whatever the number of targets
+                fanout = self.backup_configuration.get_fanout(stream)
+                fanout.add_sink(dest_container_name, lambda stream: uploader.upload(
+                    container_name=dest_container_name,
+                    blob_name=blob_name, stream=stream, metadata=metadata), required=True)
+                for (name, consume) in targets:
+                    fanout.add_sink(name, consume)
+                fanout.run()
+            else:
+                uploader.upload(
+                    container_name=dest_container_name,
+                    blob_name=blob_name, stream=stream, metadata=metadata)
 
             # Wait for the command to terminate
             retcode = proc.wait()
@@ -237,8 +422,12 @@ class BackupAgent(object):
             elif retcode != 0:
                 raise BackupException("tar command failed with return code {}".format(retcode))
 
+            if compressor:
+                compressor.save_stats(self.backup_configuration.get_compression_stats_file(fileset), blob_name)
         except Exception as ex:
             logging.error("Failed to stream blob: %s", ex.message)
+            if proc is not None:
+                self.stop_backup_command(proc)
             end_timestamp = Timing.now_localtime()
             self.send_notification(
                 is_full=is_full,
@@ -249,13 +438,19 @@ class BackupAgent(object):
                 blob_path='/' + dest_container_name + '/' + blob_name,
                 error_msg=ex.message)
             raise ex
+        finally:
+            if readahead:
+                readahead.stop()
+            if compressor:
+                compressor.close()
+            self.backup_configuration.release_bandwidth()
 
         logging.info("Finished streaming blob: %s", blob_name)
         end_timestamp = Timing.now_localtime()
 
         # Get blob size
         try:
-            blob_props = storage_client.get_blob_properties(dest_container_name, blob_name)
+            blob_props = storage_backend.get_blob_properties(dest_container_name, blob_name)
         except Exception as ex:
             logging.error("Failed to get blob size: %s", ex.message)
 
@@ -275,13 +470,334 @@ class BackupAgent(object):
             start_timestamp=start_timestamp,
             end_timestamp=end_timestamp,
             success=True,
-            blob_size=blob_props.properties.content_length,
+            blob_size=blob_props.size,
             blob_path='/' + dest_container_name + '/' + blob_name,
             error_msg=None)
 
         # Return name of new blob
         return blob_name
 
+    @staticmethod
+    def stop_backup_command(proc):
+        """
+        Kill and reap a backup command that is still running after a failed
+        upload, and the command pv reads from, so that a long-running daemon
+        does not keep them blocked on a full pipe.
+        """
+        for process in [proc, getattr(proc, 'backup_command', None)]:
+            if process is None:
+                continue
+            if process.poll() is None:
+                try:
+                    process.kill()
+                except OSError:
+                    # It exited meanwhile
+                    pass
+            process.wait()
+
+    def backup_targets(self, fileset, is_full, start_timestamp, blob_name, metadata):
+        """
+        The targets a backup is written to besides its blob, as (name,
+        consume(stream)): the fanout_targets storage accounts, and the
+        local backup directory of the fileset.
+        """
+        targets = []
+        storage_targets = self.backup_configuration.storage_targets(self.backup_configuration.get_fanout_targets())
+        for (i, (name, backend, container_name)) in enumerate(storage_targets):
+            uploader = self.backup_configuration.get_stream_uploader(
+                "{}.target{}".format(fileset, i + 1), storage_backend=backend)
+            targets.append((name, lambda stream, uploader=uploader, container_name=container_name: uploader.upload(
+                container_name=container_name, blob_name=blob_name, stream=stream, metadata=metadata)))
+        directory = self.backup_configuration.get_local_backup_directory(fileset)
+        if directory:
+            targets.append((directory, write_file(Naming.local_filesystem_name(
+                directory, fileset, is_full, start_timestamp, self.backup_configuration.get_vm_name()))))
+        return targets
+
+    def unchanged_backup(self, fileset, is_full, fingerprint, start_timestamp):
+        """
+        Return the latest backup of the fileset if it has the same
+        fingerprint and can stand for a new backup, otherwise None. Unless
+        it is copied, a full backup is still taken once the latest one is
+        older than the maximum interval, so that it is not pruned.
+        """
+        latest = self.latest_backup(fileset, is_full)
+        if latest is None:
+            return None
+        latest_timestamp = Naming.parse_blobname(latest)[2]
+        try:
+            metadata = self.backup_configuration.storage_backend.get_blob_properties(
+                self.backup_configuration.azure_storage_container_name, latest).metadata or {}
+        except Exception as ex:
+            logging.debug("Cannot read the fingerprint of %s: %s", latest, ex)
+            return None
+        if metadata.get(FINGERPRINT_KEY) != fingerprint:
+            logging.info("Fileset %s changed since %s", fileset, latest)
+            return None
+        if (is_full and not self.backup_configuration.get_fingerprint_copy() and
+                Timing.time_diff(latest_timestamp, start_timestamp) >
+                self.backup_configuration.get_fs_backup_interval_max()):
+            logging.info("Fileset %s did not change, but %s is older than the maximum interval", fileset, latest)
+            return None
+        return latest
+
+    def record_unchanged(self, fileset, is_full, start_timestamp, previous, blob_name, fingerprint):
+        """
+        Record that a fileset did not change since its previous backup, by
+        copying it inside the storage service if configured, otherwise in
+        the cache directory (see checked_timestamp). Returns the name of
+        the backup that holds the current content.
+        """
+        container_name = self.backup_configuration.azure_storage_container_name
+        storage_backend = self.backup_configuration.storage_backend
+        if self.backup_configuration.get_fingerprint_copy():
+            logging.info("No change since %s, copying it to %s", previous, blob_name)
+            storage_backend.copy_blob(container_name, blob_name, previous, metadata={FINGERPRINT_KEY: fingerprint})
+            current = blob_name
+        else:
+            logging.info("No change since %s, skipping backup", previous)
+            self.save_unchanged_check(fileset, previous, start_timestamp)
+            current = previous
+        Instrumentation.incr('backup.unchanged')
+        self.send_notification(
+            is_full=is_full,
+            start_timestamp=start_timestamp,
+            end_timestamp=Timing.now_localtime(),
+            success=True,
+            blob_size=storage_backend.get_blob_properties(container_name, current).size,
+            blob_path='/' + container_name + '/' + current,
+            error_msg=None)
+        return current
+
+    def synthesize_fulls(self, filesets):
+        """Build synthetic full backups of a list of filesets (the default fileset if empty)."""
+        for fileset in filesets or ['fs']:
+            self.synthesize_full(fileset)
+
+    def synthesize_full(self, fileset):
+        """
+        Build a synthetic full backup of a fileset inside the storage
+        service: the latest full backup followed by the incremental
+        backups taken after it, copied block by block (Put Block From
+        URL) into one blob. The result is a multi-member gzip file of
+        concatenated tar archives, extracted with 'tar xzif'. The chain
+        ends before the first backup whose compression (adaptive or not)
+        differs from the full backup. It is named
+        as a full backup at the time of the last incremental backup, so
+        that listing, restore and scheduling count it as a full backup.
+        Returns its name, or None if there is nothing to compact.
+        """
+        container_name = self.backup_configuration.azure_storage_container_name
+        storage_backend = self.backup_configuration.storage_backend
+        base = self.latest_backup(fileset, is_full=True)
+        if base is None:
+            logging.warn("No full backup of fileset %s to start from", fileset)
+            return None
+        base_timestamp = Naming.parse_blobname(base)[2]
+        incrementals = self.existing_backups_for_fileset(fileset=fileset, is_full=False)
+        chain = [base] + [incrementals[t][0] for t in Timing.sort(incrementals.keys())
+                          if Timing.time_diff(base_timestamp, t) > datetime.timedelta(0)]
+        # Restore detects adaptive compression from the first member only, so the
+        # chain ends before the first backup compressed differently than the base
+        for (i, name) in enumerate(chain):
+            try:
+                header = storage_backend.get_blob_range(container_name, name, 0, COMPRESSION_HEADER_SIZE - 1)
+            except Exception as ex:
+                raise BackupException("Cannot synthesize a full backup from {}: {}".format(name, ex))
+            if i == 0:
+                adaptive = is_adaptive(header)
+            elif is_adaptive(header) != adaptive:
+                logging.info("Compression of fileset %s changed in %s, the chain ends before it", fileset, name)
+                chain = chain[:i]
+                break
+        if len(chain) == 1:
+            logging.info("No incremental backup of fileset %s after %s", fileset, base)
+            return None
+
+        start_timestamp = Timing.now_localtime()
+        end_timestamp = Naming.parse_blobname(chain[-1])[2]
+        blob_name = Naming.construct_blobname(fileset, True, end_timestamp, self.backup_configuration.get_vm_name())
+        logging.info("Synthesizing %s from %s", blob_name, ", ".join(chain))
+
+        # Ranges of at most one block of each backup of the chain
+        ranges = []
+        for name in chain:
+            try:
+                size = storage_backend.get_blob_properties(container_name, name).size
+            except Exception as ex:
+                raise BackupException("Cannot synthesize a full backup from {}: {}".format(name, ex))
+            ranges.extend((name, offset, min(offset + MAX_BLOCK_SIZE, size) - 1)
+                          for offset in range(0, size, MAX_BLOCK_SIZE))
+        if storage_backend.max_blocks is not None and len(ranges) > storage_backend.max_blocks:
+            raise BackupException("Cannot synthesize {}: more than {} blocks".format(blob_name, storage_backend.max_blocks))
+        block_ids = ['{:05d}'.format(i) for i in range(len(ranges))]
+
+        def copy_block(i):
+            """Stage one block from a backup of the chain."""
+            (name, start_range, end_range) = ranges[i]
+            with Instrumentation.timer('synthetic.put_block_from_url'):
+                storage_backend.put_block_from_blob(container_name, blob_name, block_ids[i],
+                                                    name, start_range, end_range)
+
+        connections = self.backup_configuration.get_upload_max_connections()
+        storage_backend.set_concurrency(connections)
+        pool = ThreadPool(processes=connections)
+        try:
+            pool.map(copy_block, range(len(ranges)))
+        finally:
+            pool.close()
+            pool.join()
+        storage_backend.put_block_list(container_name, blob_name, block_ids, metadata={
+            'synthetic_base': base,
+            'synthetic_count': str(len(chain))
+        })
+
+        size = sum(end_range - start_range + 1 for (_name, start_range, end_range) in ranges)
+        logging.info("Synthesized %s (%d bytes) from %d backups", blob_name, size, len(chain))
+        self.send_notification(
+            is_full=True,
+            start_timestamp=start_timestamp,
+            end_timestamp=Timing.now_localtime(),
+            success=True,
+            blob_size=size,
+            blob_path='/' + container_name + '/' + blob_name,
+            error_msg=None)
+        return blob_name
+
+    def backup_striped(self, fileset, sources, exclude, stripes, is_full, force, rate=None, order='readdir'):
+        """
+        Backup the sources of a fileset with several tar processes in
+        parallel, each one into its own stripe blob. The manifest listing
+        the stripes is written last, so that only complete striped backups
+        are listed and restored. Returns the logical blob name.
+        """
+        logging.info("Striped backup request for fileset: %s", fileset)
+
+        start_timestamp = Timing.now_localtime()
+        if not self.should_run_backup(
+                fileset=fileset, is_full=is_full,
+                force=force, start_timestamp=start_timestamp):
+            logging.warn("Skipping backup of fileset %s", fileset)
+            return
+
+        dest_container_name = self.backup_configuration.azure_storage_container_name
+        vmname = self.backup_configuration.get_vm_name()
+        blob_name = Naming.construct_blobname(fileset, is_full, start_timestamp, vmname)
+        storage_backend = self.backup_configuration.storage_backend
+        procs = []
+        readaheads = []
+
+        try:
+            source_list = shlex.split(sources)
+            excluded = self.executable_connector.excluded_paths(source_list, exclude)
+            shards = Striping.partition(source_list, excluded, stripes)
+            if not shards:
+                raise BackupException("Nothing to backup in {}".format(sources))
+            count = len(shards)
+            # The rate limit applies to the whole backup
+            if rate is not None and float(rate) > 0:
+                rate = str(float(rate) / count)
+
+            stripe_names = [Naming.construct_stripe_blobname(fileset, is_full, start_timestamp, vmname, i, count)
+                            for i in range(1, count + 1)]
+            adaptive = self.backup_configuration.get_compression(fileset) == 'adaptive'
+            for (i, shard) in enumerate(shards):
+                files_from = files = None
+                if order != 'readdir':
+                    (files_from, files) = self.executable_connector.prepare_file_list(
+                        "{}.{}of{}".format(fileset, i + 1, count), shard.paths, excluded, order, shard.directories)
+                command = self.executable_connector.assemble_backup_command(
+                    " ".join(pipes.quote(p) for p in shard.paths), exclude,
+                    directories=shard.directories, excluded=excluded, files_from=files_from,
+                    compress=not adaptive)
+                procs.append(self.executable_connector.run_backup_command(command, rate))
+                readaheads.append(self.start_readahead(files, procs[-1]))
+
+            def upload(i):
+                """Stream one tar process to its stripe blob."""
+                stream = procs[i].stdout
+                try:
+                    if adaptive:
+                        stream = self.backup_configuration.get_compressor(stream, stripes=count)
+                    uploader = self.backup_configuration.get_stream_uploader(
+                        "{}.{}of{}".format(fileset, i + 1, count), stripes=count)
+                    uploader.upload(container_name=dest_container_name, blob_name=stripe_names[i],
+                                    stream=self.backup_configuration.throttled_reader(stream, 'backup'))
+                    if adaptive:
+                        stream.save_stats(self.backup_configuration.get_compression_stats_file(
+                            "{}.{}of{}".format(fileset, i + 1, count)), stripe_names[i])
+                    return None
+                except Exception as ex:
+                    return ex
+                finally:
+                    if adaptive and stream is not procs[i].stdout:
+                        stream.close()
+
+            logging.info("Streaming backup to %d stripes of %s in container: %s",
+                         count, blob_name, dest_container_name)
+            pool = ThreadPool(processes=count)
+            try:
+                errors = [ex for ex in pool.map(upload, range(count)) if ex is not None]
+            finally:
+                pool.close()
+                pool.join()
+            if errors:
+                raise errors[0]
+
+            for proc in procs:
+                retcode = proc.wait()
+                # Ignore return code 1 (files changed during backup)
+                if retcode == 1:
+                    logging.warning("ignoring tar command return code 1")
+                elif retcode != 0:
+                    raise BackupException("tar command failed with return code {}".format(retcode))
+
+            manifest = {
+                'fileset': fileset,
+                'vmname': vmname,
+                'is_full': is_full,
+                'start_timestamp': start_timestamp,
+                'sources': sources,
+                'stripes': [{
+                    'name': name,
+                    'size': storage_backend.get_blob_properties(dest_container_name, name).size,
+                    'paths': shard.paths,
+                    'directories': shard.directories
+                } for (name, shard) in zip(stripe_names, shards)]
+            }
+            storage_backend.create_blob_from_bytes(
+                dest_container_name, Naming.construct_manifest_name(blob_name),
+                json.dumps(manifest, indent=2, sort_keys=True))
+        except Exception as ex:
+            logging.error("Failed to stream striped backup: %s", ex.message)
+            for proc in procs:
+                self.stop_backup_command(proc)
+            self.send_notification(
+                is_full=is_full,
+                start_timestamp=start_timestamp,
+                end_timestamp=Timing.now_localtime(),
+                success=False,
+                blob_size=0,
+                blob_path='/' + dest_container_name + '/' + blob_name,
+                error_msg=ex.message)
+            raise ex
+        finally:
+            for readahead in readaheads:
+                if readahead:
+                    readahead.stop()
+            self.backup_configuration.release_bandwidth()
+
+        logging.info("Finished streaming %d stripes of %s", count, blob_name)
+        self.send_notification(
+            is_full=is_full,
+            start_timestamp=start_timestamp,
+            end_timestamp=Timing.now_localtime(),
+            success=True,
+            blob_size=sum(stripe['size'] for stripe in manifest['stripes']),
+            blob_path='/' + dest_container_name + '/' + blob_name,
+            error_msg=None)
+        return blob_name
+
     #
     # List methods.
     #
@@ -297,10 +813,11 @@ class BackupAgent(object):
     # Prune methods.
     #
 
-    def prune_old_backups(self, older_than, filesets):
+    def prune_old_backups(self, older_than, filesets, container=None):
         """
         Delete (prune) old backups from Azure storage.
         """
+        container_name = container or self.backup_configuration.azure_storage_container_name
         minimum_deletable_age = datetime.timedelta(7, 0)
         logging.warn("Deleting files older than %s", older_than)
         if older_than < minimum_deletable_age:
@@ -308,41 +825,36 @@ class BackupAgent(object):
             logging.warn(msg)
             return
 
-        marker = None
-        while True:
-            results = self.backup_configuration.storage_client.list_blobs(
-                container_name=self.backup_configuration.azure_storage_container_name,
-                marker=marker)
-            for blob in results:
-                parts = Naming.parse_blobname(blob.name)
-                if parts is None:
-                    continue
-
-                (fileset, _is_full, start_timestamp, _vmname) = parts
-                if (fileset != None) and not fileset in filesets:
-                    continue
-
-                diff = Timing.time_diff(start_timestamp, Timing.now_localtime())
-                delete = diff > older_than
-
-                if delete:
-                    logging.warn("Deleting %s", blob.name)
-                    self.backup_configuration.storage_client.delete_blob(
-                        container_name=self.backup_configuration.azure_storage_container_name,
-                        blob_name=blob.name)
-                else:
-                    logging.warn("Keeping %s", blob.name)
-
-            if results.next_marker:
-                marker = results.next_marker
+        storage_backend = self.backup_configuration.storage_backend
+        # Delete manifests before their stripes, so that an interrupted
+        # prune does not leave a manifest of missing stripes
+        blobs = sorted(storage_backend.iter_blobs(container_name=container_name),
+                       key=lambda blob: not Naming.is_manifest(blob.name))
+        for blob in blobs:
+            parts = Naming.parse_blobname(blob.name)
+            if parts is None:
+                continue
+
+            (fileset, _is_full, start_timestamp, _vmname) = parts
+            if (fileset != None) and not fileset in filesets:
+                continue
+
+            diff = Timing.time_diff(start_timestamp, Timing.now_localtime())
+            delete = diff > older_than
+
+            if delete:
+                logging.warn("Deleting %s", blob.name)
+                storage_backend.delete_blob(
+                    container_name=container_name,
+                    blob_name=blob.name)
             else:
-                break
+                logging.warn("Keeping %s", blob.name)
 
     #
     # Restore methods.
     #
 
-    def restore(self, restore_point, output_dir, filesets, stream=False, container=None):
+    def restore(self, restore_point, output_dir, filesets, stream=False, container=None, extract=False):
         """ Restore backups."""
         if not filesets:
             logging.info("Retrieving point-in-time backup for default fileset")
@@ -350,7 +862,8 @@ class BackupAgent(object):
                             output_dir=output_dir,
                             restore_point=restore_point,
                             stream=stream,
-                            container=container)
+                            container=container,
+                            extract=extract)
         else:
             logging.info("Retrieving point-in-time backup %s for filesets %s",
                         restore_point, str(filesets))
@@ -359,53 +872,151 @@ class BackupAgent(object):
                                             output_dir=output_dir,
                                             restore_point=restore_point,
                                             stream=stream,
-                                            container=container)
+                                            container=container,
+                                            extract=extract)
 
-    def restore_blob(self, blobname, output_dir, stream=False, container=None):
-        """Restore backup given the full blob name."""
+    def stripes_of(self, container_name, blobname):
+        """
+        Return the stripe blob names of a striped backup, from its
+        manifest, or None if blobname is not a striped backup.
+        """
+        prefix = blobname[:-len('.tar.gz')]
+        storage_backend = self.backup_configuration.storage_backend
+        names = set(blob.name for blob in storage_backend.iter_blobs(container_name=container_name, prefix=prefix))
+        manifest_name = Naming.construct_manifest_name(blobname)
+        if blobname in names or manifest_name not in names:
+            return None
+        manifest_stream = StringIO()
+        storage_backend.get_blob_to_stream(container_name, manifest_name, manifest_stream)
+        stripes = [stripe['name'] for stripe in json.loads(manifest_stream.getvalue())['stripes']]
+        missing = [name for name in stripes if name not in names]
+        if missing:
+            raise BackupException("Striped backup {} is incomplete, missing {}".format(blobname, ", ".join(missing)))
+        return stripes
+
+    def restore_blob(self, blobname, output_dir, stream=False, container=None, extract=False):
+        """
+        Restore backup given the full blob name. The stripes of a striped
+        backup are downloaded in parallel into separate files, or streamed
+        one after the other (extract with 'tar xzif -'). With extract, the
+        backup is decompressed by azfilebak and extracted into output_dir,
+        or streamed uncompressed (extract with 'tar xif -').
+        """
         logging.info("Retrieving backup archive %s", blobname)
 
-        file_path = os.path.join(output_dir, blobname)
-        storage_client = self.backup_configuration.storage_client
+        container_name = container or self.backup_configuration.azure_storage_container_name
+        storage_backend = self.backup_configuration.storage_backend
+        stripes = self.stripes_of(container_name, blobname) if blobname.endswith('.tar.gz') else None
 
-        if stream:
-            storage_client.get_blob_to_stream(
-                container_name=container or self.backup_configuration.azure_storage_container_name,
-                blob_name=blobname,
-                stream=sys.stdout,
-                max_connections=1
-            )
+        if stripes is None:
+            stripes = [blobname]
         else:
-            storage_client.get_blob_to_path(
-                container_name=container or self.backup_configuration.azure_storage_container_name,
-                blob_name=blobname,
-                file_path=file_path,
-                max_connections=1
-            )
+            logging.info("Backup %s has %d stripes", blobname, len(stripes))
+
+        try:
+            if extract:
+                self.extract_archive(container_name, stripes, None if stream else output_dir)
+            elif stream:
+                for name in stripes:
+                    self.download_archive(container_name, name, None)
+            elif len(stripes) == 1:
+                self.download_archive(container_name, stripes[0], os.path.join(output_dir, stripes[0]))
+            else:
+                storage_backend.set_concurrency(len(stripes))
+                pool = ThreadPool(processes=len(stripes))
+                try:
+                    pool.map(lambda name: self.download_archive(
+                        container_name, name, os.path.join(output_dir, name)), stripes)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            self.backup_configuration.release_bandwidth()
 
         logging.debug("Finished downloading %s", blobname)
 
-    def restore_single_fileset(self, fileset, restore_point, output_dir, stream=False, container=None):
+    def download_archive(self, container_name, blob_name, file_path):
+        """
+        Download a backup to a file, or to stdout if file_path is None.
+        Archives of adaptive compression are converted to standard gzip
+        on the way (see GzipWriter).
+        """
+        storage_backend = self.backup_configuration.storage_backend
+        header = storage_backend.get_blob_range(container_name, blob_name, 0, COMPRESSION_HEADER_SIZE - 1)
+        adaptive = is_adaptive(header)
+        if not adaptive and self.backup_configuration.get_bandwidth_governor('restore') is None:
+            if file_path is None:
+                storage_backend.get_blob_to_stream(container_name=container_name, blob_name=blob_name,
+                                                   stream=sys.stdout)
+            else:
+                storage_backend.get_blob_to_path(container_name=container_name, blob_name=blob_name,
+                                                 file_path=file_path)
+            return
+        if adaptive:
+            logging.info("Converting %s from adaptive compression", blob_name)
+        output = sys.stdout if file_path is None else open(file_path, 'wb')
+        try:
+            writer = self.backup_configuration.throttled_writer(GzipWriter(output) if adaptive else output, 'restore')
+            storage_backend.get_blob_to_stream(container_name=container_name, blob_name=blob_name, stream=writer)
+            writer.flush()
+        finally:
+            if file_path is not None:
+                output.close()
+
+    def extract_archive(self, container_name, blob_names, output_dir):
+        """
+        Decompress archives one after the other, to stdout if output_dir is
+        None, otherwise to 'tar xpif -' in output_dir. The members of
+        adaptive archives are decompressed in parallel, other archives on
+        one thread (see ParallelDecompressor).
+        """
+        storage_backend = self.backup_configuration.storage_backend
+        proc = None
+        if output_dir is None:
+            output = sys.stdout
+        else:
+            proc = subprocess.Popen(['tar', 'xpif', '-', '-C', output_dir], stdin=subprocess.PIPE)
+            output = proc.stdin
+        try:
+            for blob_name in blob_names:
+                decompressor = self.backup_configuration.get_decompressor(output)
+                try:
+                    with Instrumentation.timer('restore.extract'):
+                        storage_backend.get_blob_to_stream(
+                            container_name=container_name, blob_name=blob_name,
+                            stream=self.backup_configuration.throttled_writer(decompressor, 'restore'))
+                        decompressor.flush()
+                finally:
+                    decompressor.close()
+                Instrumentation.incr('restore.members', decompressor.members)
+                logging.info("Extracted %s: %d members decompressed on %d threads", blob_name,
+                             decompressor.members, decompressor.threads if decompressor.adaptive else 1)
+        except IOError as ex:
+            if proc is None or ex.errno != errno.EPIPE:
+                raise
+            # tar stopped reading, its exit code says why
+            proc.stdin.close()
+            proc.wait()
+            raise BackupException("Extracting into {} failed (tar exit code {})".format(output_dir, proc.returncode))
+        finally:
+            if proc is not None and proc.returncode is None:
+                proc.stdin.close()
+                proc.wait()
+        if proc is not None and proc.returncode != 0:
+            raise BackupException("Extracting into {} failed (tar exit code {})".format(output_dir, proc.returncode))
+
+    def restore_single_fileset(self, fileset, restore_point, output_dir, stream=False, container=None,
+                               extract=False):
         """ Restore backup for a single fileset."""
         vmname = self.backup_configuration.get_vm_name()
         blob_to_restore = Naming.construct_blobname(fileset, True, restore_point, vmname)
-        self.restore_blob(blob_to_restore, output_dir, stream, container)
+        self.restore_blob(blob_to_restore, output_dir, stream, container, extract)
 
     def list_restore_blobs(self, fileset):
         """Determine list of blobs needed to restore a backup."""
-        existing_blobs = []
-        marker = None
-        while True:
-            results = self.backup_configuration.storage_client.list_blobs(
-                container_name=self.backup_configuration.azure_storage_container_name,
-                prefix="{fileset}_".format(fileset=fileset),
-                marker=marker)
-            for blob in results:
-                existing_blobs.append(blob.name)
-            if results.next_marker:
-                marker = results.next_marker
-            else:
-                break
+        existing_blobs = [blob.name for blob in self.backup_configuration.storage_backend.iter_blobs(
+            container_name=self.backup_configuration.azure_storage_container_name,
+            prefix="{fileset}_".format(fileset=fileset))]
         # Keep tar files
         return [b for b in existing_blobs if b.endswith('.tar.gz')]
 
@@ -444,47 +1055,62 @@ class BackupAgent(object):
     # Integration commands. (e.g. TIC)
     #
 
-    def get_notification_message(self, is_full, start_timestamp, end_timestamp, success, blob_size, blob_path, error_msg):
-        """Assemble JSON message for notification."""
-        data = {
+    @lazy_property
+    def notification_template(self):
+        """
+        The fields of the notification message that do not change between
+        messages, serialized once. Looking them up may need the instance
+        metadata, the configuration file and dmidecode.
+        """
+        static = {
             "cloud" :"azure",
             "hostname": self.backup_configuration.get_vm_name(),
             "instance-id": self.backup_configuration.get_system_uuid(),
-            "state": {True: "success", False:"fail"}[success],
             "type": "fs",
             "method": "file",
-            "level": {True: "full", False: "incr"}[is_full],
             "account-id": self.backup_configuration.get_subscription_id(),
             "customer-id": self.backup_configuration.cfg_file_value("DEFAULT.CID"),
             "system-id": self.backup_configuration.cfg_file_value("DEFAULT.SID"),
             "database-name": "",
             "database-id": "",
-            "s3-path": self.backup_configuration.get_azure_storage_account_name() +
-                       '.blob.core.windows.net' + blob_path,
+            "dbtype": "",
+            "script-version": azfilebak.__version__
+        }
+        blob_host = self.backup_configuration.get_azure_storage_account_name() + '.blob.core.windows.net'
+        # Keep the JSON object members without the closing brace
+        return (json.dumps(static, sort_keys=True)[:-1], blob_host)
+
+    def get_notification_message(self, is_full, start_timestamp, end_timestamp, success, blob_size, blob_path, error_msg):
+        """
+        Assemble JSON message for notification. Only the fields that change
+        between messages are serialized here.
+        """
+        (static_json, blob_host) = self.notification_template
+        start_epoch = Timing.local_string_to_utc_epoch(start_timestamp)
+        data = {
+            "state": {True: "success", False:"fail"}[success],
+            "level": {True: "full", False: "incr"}[is_full],
+            "s3-path": blob_host + blob_path,
             "timestamp-send": Timing.local_string_to_utc_epoch(Timing.now_localtime()),
-            "timestamp-last-successful": Timing.local_string_to_utc_epoch(start_timestamp),
-            "timestamp-bkp-begin": Timing.local_string_to_utc_epoch(start_timestamp),
+            "timestamp-last-successful": start_epoch,
+            "timestamp-bkp-begin": start_epoch,
             "timestamp-bkp-end": Timing.local_string_to_utc_epoch(end_timestamp),
             "backup-size": blob_size,
-            "dbtype": "",
-            "error-message": error_msg or '',
-            "script-version": azfilebak.__version__
+            "error-message": error_msg or ''
         }
-        return json.dumps(data)
+        return static_json + ', ' + json.dumps(data)[1:]
 
     def send_notification(self, is_full, start_timestamp, end_timestamp, success, blob_size, blob_path, error_msg=None):
-        """Send a notification to TIC."""
+        """
+        Send a notification to TIC. The message is spooled and delivered in the
+        background, so that a slow notification command does not delay the backup.
+        """
         json_str = self.get_notification_message(
             is_full, start_timestamp, end_timestamp, success,
             blob_size, blob_path, error_msg)
-        cmd = self.backup_configuration.get_notification_command()
+        spool = self.backup_configuration.notification_spool
         try:
-            proc = subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE)
-            proc.communicate(json_str)
-        except OSError as ex:
-            # Silently ignore error if notification command does not exist
-            if ex.errno == os.errno.ENOENT:
-                logging.debug("Notification command %s not found", shlex.split(cmd)[0])
-            else:
-                raise
-        return
+            spool.enqueue(json_str)
+        except (IOError, OSError) as ex:
+            logging.warning("Cannot spool notification in %s (%s), sending it now", spool.directory, ex)
+            spool.send([json_str])
@@ -8,17 +8,34 @@
 """BackupConfiguration module."""
 
 import os
+import shlex
 import logging
 import subprocess
-from azure.storage.blob import BlockBlobService
-from msrestazure.azure_active_directory import MSIAuthentication
-from azfilebak.azurevminstancemetadata import AzureVMInstanceMetadata
+import multiprocessing
+from azfilebak.azurevminstancemetadata import AzureVMInstanceMetadata, lazy_property
 from azfilebak.backupconfigurationfile import BackupConfigurationFile
 from azfilebak.businesshours import BusinessHours
 from azfilebak.scheduleparser import ScheduleParser
+from azfilebak.tokencache import TokenCache
+from azfilebak.storagebackend import AzureStorageBackend, LocalStorageBackend
+from azfilebak.httpsession import HttpSession, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from azfilebak.uploader import StreamUploader, DeltaUploader, DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_MEMORY, \
+    DEFAULT_DELTA_BLOCK_SIZE
+from azfilebak.fileorder import ORDERS, DEFAULT_READAHEAD_WINDOW
+from azfilebak.replication import DEFAULT_REPLICATION_WORKERS
+from azfilebak.compression import AdaptiveCompressor, ParallelDecompressor, POLICIES as COMPRESSION_POLICIES, \
+    DEFAULT_POLICY as DEFAULT_COMPRESSION_POLICY
+from azfilebak.fanout import FanOut, POLICIES as FANOUT_POLICIES, DEFAULT_POLICY as DEFAULT_FANOUT_POLICY, \
+    DEFAULT_QUEUE_SIZE as DEFAULT_FANOUT_QUEUE_SIZE
+from azfilebak.bandwidth import BandwidthGovernor
+from azfilebak.notificationspool import NotificationSpool, DEFAULT_BATCH_SIZE, DEFAULT_MAX_IN_FLIGHT
 from azfilebak.backupexception import BackupException
 
 DEFAULT_NOTIFICATION_COMMAND = "/usr/sbin/ticmcmc --stdin"
+DEFAULT_CACHE_DIRECTORY = "/var/cache/azfilebak"
+DEFAULT_INSTANCE_METADATA_CACHE_TTL = "5m"
+DEFAULT_NOTIFICATION_TIMEOUT = "1m"
+DEFAULT_FANOUT_MAX_WAIT = "1m"
 
 class BackupConfiguration(object):
     """Access configuration values."""
@@ -35,8 +52,39 @@ class BackupConfiguration(object):
         True
         """
         self.cfg_file = BackupConfigurationFile(filename=config_filename)
-        self.instance_metadata = AzureVMInstanceMetadata.create_instance()
+        self.instance_metadata = AzureVMInstanceMetadata.create_instance(
+            cache_filename=os.path.join(self.get_cache_directory(), "instance_metadata.json"),
+            cache_ttl_seconds=self.get_instance_metadata_cache_ttl().total_seconds())
         self._block_blob_service = None
+        self._bandwidth_governors = {}
+        self.token_cache = None
+
+    def validate(self):
+        """
+        Check the configuration file for missing or inconsistent values.
+        All the problems found are reported together in a single exception;
+        syntax errors are already reported when the file is parsed.
+        """
+        snapshot = self.cfg_file.snapshot
+        errors = []
+
+        for key in ["DEFAULT.CID", "DEFAULT.SID", "DEFAULT.dbtype"]:
+            if not snapshot.key_exists(key):
+                errors.append("missing value {}".format(key))
+
+        if snapshot.key_exists("DEFAULT.dbtype"):
+            fileset = self.get_default_fileset()
+            for key in ["fs.{}.sources".format(fileset), "fs.{}.exclude".format(fileset)]:
+                if not snapshot.key_exists(key):
+                    errors.append("missing value {} for default fileset".format(key))
+
+        for key in snapshot.get_keys_prefix("command.backup."):
+            if not snapshot.get_value(key):
+                errors.append("empty backup command {}".format(key))
+
+        if errors:
+            raise BackupException("Invalid configuration file '{}':\n{}".format(
+                self.cfg_file.filename, "\n".join(errors)))
 
     # Retrieve config values from different sources: config file, environment, metadata
 
@@ -95,30 +143,51 @@ class BackupConfiguration(object):
 
     # These values come from the instance metadata tags
 
+    # The schedule is parsed once per process.
+
+    @lazy_property
+    def business_hours(self):
+        """Parse business hours from the instance metadata tags."""
+        return BusinessHours(
+            self.instance_metadata.get_tags()
+        )
+
+    @lazy_property
+    def fs_backup_interval_min(self):
+        """Parse minimum backup interval."""
+        return ScheduleParser.parse_timedelta(self.business_hours.min)
+
+    @lazy_property
+    def fs_backup_interval_max(self):
+        """Parse maximum backup interval."""
+        return ScheduleParser.parse_timedelta(self.business_hours.max)
+
     def get_fs_backup_interval_min(self):
         """Get minimum backup interval."""
-        return ScheduleParser.parse_timedelta(
-            BusinessHours(
-                self.instance_metadata.get_tags()
-            ).min
-        )
+        return self.fs_backup_interval_min
 
     def get_fs_backup_interval_max(self):
         """Get maximum backup interval."""
-        return ScheduleParser.parse_timedelta(
-            BusinessHours(
-                self.instance_metadata.get_tags()
-            ).max
-        )
+        return self.fs_backup_interval_max
 
     def get_business_hours(self):
         """Get business hours."""
-        return BusinessHours(
-            self.instance_metadata.get_tags()
-        )
+        return self.business_hours
 
     # These values come from the configuration file
 
+    def get_cache_directory(self):
+        """Get the directory for local caches (instance metadata, tokens, ...)."""
+        if self.cfg_file.key_exists('cache_directory'):
+            return self.cfg_file_value('cache_directory')
+        return DEFAULT_CACHE_DIRECTORY
+
+    def get_instance_metadata_cache_ttl(self):
+        """Get how long the instance metadata may be cached; zero disables the cache."""
+        if self.cfg_file.key_exists('instance_metadata_cache_ttl'):
+            return ScheduleParser.parse_timedelta(self.cfg_file_value('instance_metadata_cache_ttl'))
+        return ScheduleParser.parse_timedelta(DEFAULT_INSTANCE_METADATA_CACHE_TTL)
+
     def get_standard_local_directory(self):
         """Get temporary directory."""
         if self.cfg_file.key_exists('local_temp_directory'):
@@ -140,24 +209,233 @@ class BackupConfiguration(object):
         """Get fileset sources."""
         return self.cfg_file_value("fs.{}.exclude".format(fileset))
 
+    def get_fileset_stripes(self, fileset):
+        """Get the number of parallel streams of a fileset backup (1 is not striped)."""
+        key = "fs.{}.stripes".format(fileset)
+        if self.cfg_file.key_exists(key):
+            return max(1, int(self.cfg_file_value(key)))
+        return 1
+
+    def get_fileset_order(self, fileset):
+        """Get the order in which tar reads the files of a fileset: 'readdir' (default), 'inode' or 'extent'."""
+        key = "fs.{}.order".format(fileset)
+        if not self.cfg_file.key_exists(key):
+            return 'readdir'
+        order = self.cfg_file_value(key).lower()
+        if order not in ORDERS:
+            raise BackupException("Invalid {} {}, use one of {}".format(key, order, ", ".join(ORDERS)))
+        return order
+
+    def get_local_backup_directory(self, fileset):
+        """
+        Get the directory where backups of a fileset are also written, None
+        if they are only uploaded. The default fileset 'fs' uses
+        fs.<dbtype>.local_backup_dir_fs, others local_backup_dir.<fileset>.
+        """
+        if fileset == 'fs':
+            key = "fs.{}.local_backup_dir_fs".format(self.get_default_fileset())
+        else:
+            key = "local_backup_dir.{}".format(fileset)
+        if self.cfg_file.key_exists(key) and self.cfg_file_value(key):
+            return self.cfg_file_value(key)
+        return None
+
+    def get_compression(self, fileset):
+        """
+        Get how backups of a fileset are compressed: 'gzip' (default) by the
+        backup command, or 'adaptive' by azfilebak, block by block, from the
+        uncompressed output of the command. The default fileset 'fs' uses
+        fs.<dbtype>.compression, others compression.<fileset>.
+        """
+        if fileset == 'fs':
+            key = "fs.{}.compression".format(self.get_default_fileset())
+        else:
+            key = "compression.{}".format(fileset)
+        if not self.cfg_file.key_exists(key):
+            return 'gzip'
+        compression = self.cfg_file_value(key).lower()
+        if compression not in ('gzip', 'adaptive'):
+            raise BackupException("Invalid {} {}, use gzip or adaptive".format(key, compression))
+        return compression
+
+    def get_compression_policy(self):
+        """Get the codecs and levels of adaptive compression: 'fast', 'balanced' (default), 'small' or 'smallest'."""
+        if not self.cfg_file.key_exists('compression_policy'):
+            return DEFAULT_COMPRESSION_POLICY
+        policy = self.cfg_file_value('compression_policy').lower()
+        if policy not in COMPRESSION_POLICIES:
+            raise BackupException("Invalid compression_policy {}, use one of {}".format(
+                policy, ", ".join(sorted(COMPRESSION_POLICIES))))
+        return policy
+
+    def get_compression_threads(self):
+        """Get the threads of adaptive compression, None for one per CPU."""
+        if self.cfg_file.key_exists('compression_threads'):
+            return int(self.cfg_file_value('compression_threads'))
+        return None
+
+    def get_compressor(self, stream, stripes=1):
+        """AdaptiveCompressor of a backup stream; the stripes of a backup share the threads."""
+        threads = self.get_compression_threads() or multiprocessing.cpu_count()
+        return AdaptiveCompressor(stream, policy=self.get_compression_policy(), threads=max(1, threads // stripes))
+
+    def get_compression_stats_file(self, fileset):
+        """File where the compression statistics of the backups of a fileset are kept."""
+        return os.path.join(self.get_cache_directory(), "compression_{}.json".format(fileset))
+
+    def get_unchanged_checks_file(self, fileset):
+        """File where the times at which a fileset was found unchanged are kept."""
+        return os.path.join(self.get_cache_directory(), "unchanged_{}.json".format(fileset))
+
+    def get_restore_threads(self):
+        """Get the threads that decompress an extracted backup, None for one per CPU."""
+        if self.cfg_file.key_exists('restore_threads'):
+            return int(self.cfg_file_value('restore_threads'))
+        return None
+
+    def get_decompressor(self, output):
+        """ParallelDecompressor writing the uncompressed content of a backup to output."""
+        return ParallelDecompressor(output, threads=self.get_restore_threads())
+
+    def get_host_rate_limit(self):
+        """
+        Get the bandwidth shared by all the azfilebak processes of the host,
+        in bytes per second (configured in MB/s), None if unlimited.
+        """
+        if not self.cfg_file.key_exists('host_rate_limit'):
+            return None
+        limit = float(self.cfg_file_value('host_rate_limit'))
+        return limit * 1024 * 1024 if limit > 0 else None
+
+    def get_bandwidth_state_file(self):
+        """File where the processes of the host share their bandwidth allocations."""
+        return os.path.join(self.get_cache_directory(), "bandwidth.json")
+
+    def get_bandwidth_governor(self, priority):
+        """BandwidthGovernor of this process for transfers of a priority, None without host_rate_limit."""
+        limit = self.get_host_rate_limit()
+        if limit is None:
+            return None
+        if priority not in self._bandwidth_governors:
+            self._bandwidth_governors[priority] = BandwidthGovernor(
+                self.get_bandwidth_state_file(), limit, priority)
+        return self._bandwidth_governors[priority]
+
+    def throttled_reader(self, stream, priority):
+        """Stream read within the host bandwidth limit."""
+        governor = self.get_bandwidth_governor(priority)
+        return governor.reader(stream) if governor else stream
+
+    def throttled_writer(self, output, priority):
+        """Output written within the host bandwidth limit."""
+        governor = self.get_bandwidth_governor(priority)
+        return governor.writer(output) if governor else output
+
+    def release_bandwidth(self):
+        """Leave the bandwidth of this process to the other processes of the host."""
+        for governor in self._bandwidth_governors.values():
+            governor.release()
+
+    def get_readahead_window(self):
+        """Get how far ahead of tar files are read when they are ordered, in bytes (configured in MB, 0 disables)."""
+        if self.cfg_file.key_exists('readahead_window_mb'):
+            return int(self.cfg_file_value('readahead_window_mb')) * 1024 * 1024
+        return DEFAULT_READAHEAD_WINDOW
+
+    def get_fingerprint_sources(self, fileset):
+        """Get the paths whose metadata tells if a fileset changed, [] if backups are never skipped."""
+        key = "fingerprint.{}".format(fileset)
+        if self.cfg_file.key_exists(key):
+            return shlex.split(self.cfg_file_value(key))
+        return []
+
+    def get_fingerprint_copy(self):
+        """Get whether an unchanged fileset is backed up with a server-side copy of its previous backup."""
+        if self.cfg_file.key_exists('fingerprint_copy'):
+            return self.cfg_file_value('fingerprint_copy').lower() in ('true', 'yes', '1')
+        return False
+
+    def get_include_fstypes(self):
+        """Get file system types to back up even though they are pseudo or network file systems."""
+        if self.cfg_file.key_exists('include_fstypes'):
+            return [t.strip() for t in self.cfg_file_value('include_fstypes').split(',') if t.strip()]
+        return []
+
+    def get_exclude_fstypes(self):
+        """Get file system types to exclude in addition to pseudo and network file systems."""
+        if self.cfg_file.key_exists('exclude_fstypes'):
+            return [t.strip() for t in self.cfg_file_value('exclude_fstypes').split(',') if t.strip()]
+        return []
+
+    def get_one_file_system(self):
+        """Get whether the default fileset stays on the file systems of its sources."""
+        if self.cfg_file.key_exists('one_file_system'):
+            return self.cfg_file_value('one_file_system').lower() in ('true', 'yes', '1')
+        return False
+
     def get_notification_command(self):
         """Get notification command with fall back to default."""
         if self.cfg_file.key_exists('notification_command'):
             return self.cfg_file_value("notification_command")
         return DEFAULT_NOTIFICATION_COMMAND
 
+    def get_notification_spool_directory(self):
+        """Get the directory where notifications wait for delivery."""
+        if self.cfg_file.key_exists('notification_spool_directory'):
+            return self.cfg_file_value('notification_spool_directory')
+        return os.path.join(self.get_cache_directory(), 'notifications')
+
+    def get_notification_batch_size(self):
+        """Get how many notifications are passed to one notification command."""
+        if self.cfg_file.key_exists('notification_batch_size'):
+            return int(self.cfg_file_value('notification_batch_size'))
+        return DEFAULT_BATCH_SIZE
+
+    def get_notification_max_in_flight(self):
+        """Get how many notification commands may run at the same time."""
+        if self.cfg_file.key_exists('notification_max_in_flight'):
+            return int(self.cfg_file_value('notification_max_in_flight'))
+        return DEFAULT_MAX_IN_FLIGHT
+
+    def get_notification_timeout(self):
+        """Get how long a notification command may run before it is killed."""
+        if self.cfg_file.key_exists('notification_timeout'):
+            return ScheduleParser.parse_timedelta(self.cfg_file_value('notification_timeout'))
+        return ScheduleParser.parse_timedelta(DEFAULT_NOTIFICATION_TIMEOUT)
+
+    @lazy_property
+    def notification_spool(self):
+        """Spool for asynchronous notification delivery."""
+        return NotificationSpool(
+            directory=self.get_notification_spool_directory(),
+            command=self.get_notification_command(),
+            batch_size=self.get_notification_batch_size(),
+            max_in_flight=self.get_notification_max_in_flight(),
+            timeout_seconds=self.get_notification_timeout().total_seconds())
+
     # These values are obtained from various system configuration or tools
 
+    # The VM identifier does not change, dmidecode is run at most once per process
+    _dmi_system_uuid = None
+
+    @staticmethod
+    def get_dmi_system_uuid():
+        """Get system-uuid property from dmidecode, where Azure puts a unique VM identifier."""
+        if BackupConfiguration._dmi_system_uuid is None:
+            # TODO: this is system dependent, should check dmidecode exists and fall back
+            BackupConfiguration._dmi_system_uuid = subprocess.check_output(
+                ["sudo", "dmidecode", "--string", "system-uuid"]).strip()
+        return BackupConfiguration._dmi_system_uuid
+
     def get_system_uuid(self):
         """
         Try to get a Serial property from the instance metadata tags. If that fails,
-        get system-uuid property from dmidecode, where Azure puts a unique VM identifier.
+        get system-uuid property from dmidecode.
         """
         try:
             uuid = self.instance_metadata_tag_value('Serial')
         except BackupException:
-            # TODO: this is system dependent, should check dmidecode exists and fall back
-            uuid = subprocess.check_output(["sudo", "dmidecode", "--string", "system-uuid"])
+            uuid = BackupConfiguration.get_dmi_system_uuid()
         return uuid.strip()
 
     # These are should be computed unless they are
@@ -189,29 +467,228 @@ class BackupConfiguration(object):
             return self.cfg_file_value('azure.blob.container_name')
         return self.get_vm_name()
 
+    def get_azure_storage_endpoint(self):
+        """
+        Get the blob service endpoint (such as 'https://host:port'), when
+        it is not the default one of the storage account, or None.
+        """
+        if self.cfg_file.key_exists('azure.blob.endpoint'):
+            return self.cfg_file_value('azure.blob.endpoint')
+        return None
+
+    def get_storage_max_connections(self):
+        """Get the initial size of the connection pool to the storage service."""
+        if self.cfg_file.key_exists('storage_max_connections'):
+            return int(self.cfg_file_value('storage_max_connections'))
+        return DEFAULT_POOL_SIZE
+
+    def get_storage_timeouts(self):
+        """Get the connect and read timeouts of storage requests, in seconds."""
+        timeouts = []
+        for (key, default) in [('storage_connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+                               ('storage_read_timeout', DEFAULT_READ_TIMEOUT)]:
+            value = self.cfg_file_value(key) if self.cfg_file.key_exists(key) else default
+            timeouts.append(ScheduleParser.parse_timedelta(value).total_seconds())
+        return tuple(timeouts)
+
+    def get_storage_socket_buffer_size(self):
+        """Get the socket buffer size in bytes for storage connections, None to let the kernel size them."""
+        if self.cfg_file.key_exists('storage_socket_buffer_size'):
+            return int(self.cfg_file_value('storage_socket_buffer_size'))
+        return None
+
+    def get_storage_backend_type(self):
+        """Get where backups are stored: 'azure' (default) or 'local'."""
+        if self.cfg_file.key_exists('storage_backend'):
+            return self.cfg_file_value('storage_backend').lower()
+        return 'azure'
+
+    def get_local_storage_directory(self):
+        """Get the directory used by the 'local' storage backend."""
+        return self.cfg_file_value('local_storage_directory')
+
+    @lazy_property
+    def storage_backend(self):
+        """The StorageBackend where backups are stored."""
+        backend_type = self.get_storage_backend_type()
+        if backend_type == 'azure':
+            return AzureStorageBackend(self)
+        if backend_type == 'local':
+            return LocalStorageBackend(self.get_local_storage_directory())
+        raise BackupException("Unknown storage backend '{}'".format(backend_type))
+
+    def get_upload_max_connections(self):
+        """Get how many blocks of a backup are uploaded in parallel."""
+        if self.cfg_file.key_exists('upload_max_connections'):
+            return int(self.cfg_file_value('upload_max_connections'))
+        return DEFAULT_MAX_CONNECTIONS
+
+    def get_upload_max_memory(self):
+        """Get the memory for blocks being uploaded, in bytes (configured in MB)."""
+        if self.cfg_file.key_exists('upload_max_memory_mb'):
+            return int(self.cfg_file_value('upload_max_memory_mb')) * 1024 * 1024
+        return DEFAULT_MAX_MEMORY
+
+    def get_stream_uploader(self, fileset, stripes=1, storage_backend=None):
+        """
+        StreamUploader for a fileset, which remembers its previous upload in
+        the cache directory. The stripes of a backup share the memory budget.
+        The storage backend defaults to the one of the backups.
+        """
+        return StreamUploader(
+            storage_backend or self.storage_backend,
+            state_file=os.path.join(self.get_cache_directory(), "upload_{}.json".format(fileset)),
+            max_connections=self.get_upload_max_connections(),
+            max_memory=self.get_upload_max_memory() // stripes)
+
+    def get_delta(self, fileset):
+        """Get whether backups of a fileset reuse the unchanged blocks of its previous full backup."""
+        key = "delta.{}".format(fileset)
+        if self.cfg_file.key_exists(key):
+            return self.cfg_file_value(key).lower() in ('true', 'yes', '1')
+        return False
+
+    def get_delta_block_size(self):
+        """Get the block size of delta uploads, in bytes (configured in MB)."""
+        if self.cfg_file.key_exists('delta_block_size_mb'):
+            return int(self.cfg_file_value('delta_block_size_mb')) * 1024 * 1024
+        return DEFAULT_DELTA_BLOCK_SIZE
+
+    def get_delta_uploader(self, fileset, previous_blob):
+        """DeltaUploader for a fileset, reusing the blocks of previous_blob (if not None)."""
+        return DeltaUploader(
+            self.storage_backend,
+            previous_blob=previous_blob,
+            block_size=self.get_delta_block_size(),
+            state_file=os.path.join(self.get_cache_directory(), "upload_{}.json".format(fileset)),
+            max_connections=self.get_upload_max_connections(),
+            max_memory=self.get_upload_max_memory())
+
+    def get_replication_targets(self):
+        """
+        Get where backups are replicated, a list of 'account' or
+        'account/container' (the container defaults to that of the
+        backups), or 'local:directory' for a local storage directory.
+        """
+        if self.cfg_file.key_exists('replication_targets'):
+            return [t.strip() for t in self.cfg_file_value('replication_targets').split(',') if t.strip()]
+        return []
+
+    def get_replication_workers(self):
+        """Get how many server-side copies of a replication run at once."""
+        if self.cfg_file.key_exists('replication_workers'):
+            return int(self.cfg_file_value('replication_workers'))
+        return DEFAULT_REPLICATION_WORKERS
+
+    def get_replication_backends(self):
+        """The replication targets, as (name, StorageBackend, container name)."""
+        targets = self.storage_targets(self.get_replication_targets())
+        if not targets:
+            raise BackupException("No replication_targets in the configuration")
+        return targets
+
+    def get_fanout_targets(self):
+        """
+        Get the storage accounts where backups are also uploaded while they
+        are taken, in the format of replication_targets.
+        """
+        if self.cfg_file.key_exists('fanout_targets'):
+            return [t.strip() for t in self.cfg_file_value('fanout_targets').split(',') if t.strip()]
+        return []
+
+    def get_fanout_policy(self):
+        """Get what happens when a backup target other than the backup blob is slow or fails."""
+        if not self.cfg_file.key_exists('fanout_policy'):
+            return DEFAULT_FANOUT_POLICY
+        policy = self.cfg_file_value('fanout_policy').lower()
+        if policy not in FANOUT_POLICIES:
+            raise BackupException("Invalid fanout_policy {}, use one of {}".format(policy, ", ".join(FANOUT_POLICIES)))
+        return policy
+
+    def get_fanout_queue_size(self):
+        """Get the data queued for each backup target, in bytes (configured in MB)."""
+        if self.cfg_file.key_exists('fanout_queue_mb'):
+            return int(self.cfg_file_value('fanout_queue_mb')) * 1024 * 1024
+        return DEFAULT_FANOUT_QUEUE_SIZE
+
+    def get_fanout_max_wait(self):
+        """Get how long a slow backup target may hold the backup with the 'drop' policy."""
+        if self.cfg_file.key_exists('fanout_max_wait'):
+            return ScheduleParser.parse_timedelta(self.cfg_file_value('fanout_max_wait'))
+        return ScheduleParser.parse_timedelta(DEFAULT_FANOUT_MAX_WAIT)
+
+    def get_fanout(self, stream):
+        """FanOut of a backup stream to several targets."""
+        return FanOut(stream, policy=self.get_fanout_policy(), queue_size=self.get_fanout_queue_size(),
+                      max_wait=self.get_fanout_max_wait().total_seconds())
+
+    def storage_targets(self, names):
+        """
+        Storage backends of 'account', 'account/container' or
+        'local:directory' targets, as (name, StorageBackend, container name).
+        """
+        targets = []
+        for target in names:
+            if target.startswith('local:'):
+                targets.append((target, LocalStorageBackend(target[len('local:'):]),
+                                self.azure_storage_container_name))
+                continue
+            (account_name, _sep, container_name) = target.partition('/')
+            (client, _token_cache) = self.create_storage_client(account_name)
+            targets.append((target, AzureStorageBackend(self, client=client),
+                            container_name or self.azure_storage_container_name))
+        return targets
+
     # The storage client is exposed as a property of the configuration.
 
     @property
     def storage_client(self):
         """Create or return BlockBlobService client."""
         if not self._block_blob_service:
-            account_name = self.get_azure_storage_account_name()
-            if os.environ.has_key('STORAGE_KEY'):
+            (self._block_blob_service, self.token_cache) = self.create_storage_client(
+                self.get_azure_storage_account_name(),
+                self.get_azure_storage_endpoint(),
                 # We got the storage key through an environment variable
-                # (mostly for testing purposes)
-                self._block_blob_service = BlockBlobService(
-                    account_name=account_name,
-                    account_key=os.environ['STORAGE_KEY'])
-            else:
-                #
-                # Use the Azure Managed Service Identity ('MSI') to fetch an
-                # Azure AD token to talk to Azure Storage (PREVIEW!!!)
-                #
-                token_credential = MSIAuthentication(
-                    resource='https://{account_name}.blob.core.windows.net'.format(
-                        account_name=account_name))
-                self._block_blob_service = BlockBlobService(
-                    account_name=account_name,
-                    token_credential=token_credential)
-
+                # (mostly for testing purposes)
+                account_key=os.environ.get('STORAGE_KEY'))
         return self._block_blob_service
+
+    def create_storage_client(self, account_name, endpoint=None, account_key=None):
+        """Create a BlockBlobService client of a storage account, and its TokenCache (or None)."""
+        # The storage SDK is slow to import, only load it when needed
+        from azure.storage.blob import BlockBlobService
+        from azure.storage.common import TokenCredential
+
+        # All the storage clients of the process share one connection pool,
+        # each one with its own session headers
+        session = HttpSession.client_session(pool_size=self.get_storage_max_connections(),
+                                             socket_buffer_size=self.get_storage_socket_buffer_size())
+        timeouts = self.get_storage_timeouts()
+        if account_key:
+            client = BlockBlobService(
+                account_name=account_name,
+                account_key=account_key,
+                custom_domain=endpoint,
+                request_session=session,
+                socket_timeout=timeouts)
+            return (client, None)
+
+        #
+        # Use the Azure Managed Service Identity ('MSI') to fetch an
+        # Azure AD token to talk to Azure Storage. The token is shared
+        # with other azfilebak processes through a cache file, and
+        # renewed in the background before it expires.
+        #
+        token_cache = TokenCache(
+            filename=os.path.join(self.get_cache_directory(), "token_{}.json".format(account_name)),
+            resource='https://{account_name}.blob.core.windows.net'.format(
+                account_name=account_name))
+        token_credential = TokenCredential(token_cache.get_token())
+        token_cache.start_refresh_thread(token_credential)
+        client = BlockBlobService(
+            account_name=account_name,
+            token_credential=token_credential,
+            custom_domain=endpoint,
+            request_session=session,
+            socket_timeout=timeouts)
+        return (client, token_cache)
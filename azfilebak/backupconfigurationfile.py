@@ -8,9 +8,70 @@
 """BackupConfigurationFile module."""
 
 import re
+import os
 import os.path
+import logging
 from .backupexception import BackupException
 
+class ConfigurationSnapshot(object):
+    """
+    Immutable view of a parsed configuration file. Values are looked up
+    in a dictionary, and key prefixes are answered from an index built
+    at parse time.
+    """
+
+    __slots__ = ('values', 'mtime', 'size', '_prefix_index')
+
+    def __init__(self, values, mtime=None, size=None):
+        self.values = values
+        self.mtime = mtime
+        self.size = size
+
+        # Index every dot-separated prefix of every key, e.g. 'command.backup.tmpdir'
+        # is reachable from 'command', 'command.backup' and 'command.backup.tmpdir'.
+        index = dict()
+        for key in sorted(values.keys()):
+            parts = key.split('.')
+            for i in range(1, len(parts) + 1):
+                index.setdefault('.'.join(parts[0:i]), []).append(key)
+        self._prefix_index = dict((k, tuple(v)) for (k, v) in index.items())
+
+    def __setattr__(self, name, value):
+        if hasattr(self, '_prefix_index'):
+            raise AttributeError("ConfigurationSnapshot is immutable")
+        object.__setattr__(self, name, value)
+
+    def is_current(self, mtime, size):
+        """Return True if the snapshot was taken from a file with this mtime and size."""
+        return self.mtime == mtime and self.size == size
+
+    def get_value(self, key):
+        """Return a single value."""
+        return self.values[key]
+
+    def key_exists(self, key):
+        """Return True if the key exists."""
+        return key in self.values
+
+    def get_keys_prefix(self, prefix):
+        """
+        Return all the keys starting with the given prefix.
+
+        >>> s = ConfigurationSnapshot({'command.backup.a': '1', 'command.backup.b': '2', 'command.restore.a': '3'})
+        >>> s.get_keys_prefix('command.backup')
+        ('command.backup.a', 'command.backup.b')
+        >>> s.get_keys_prefix('command.back')
+        ('command.backup.a', 'command.backup.b')
+        >>> s.get_keys_prefix('fs')
+        ()
+        """
+        if prefix in self._prefix_index:
+            return self._prefix_index[prefix]
+        # Prefix does not end on a dot boundary, scan the parent's keys
+        parent = prefix.rsplit('.', 1)[0] if '.' in prefix else None
+        candidates = self._prefix_index.get(parent, ()) if parent else sorted(self.values.keys())
+        return tuple(k for k in candidates if k.startswith(prefix))
+
 class BackupConfigurationFile(object):
     """Parse the backup configuration file."""
 
@@ -18,27 +79,84 @@ class BackupConfigurationFile(object):
         if not os.path.isfile(filename):
             raise BackupException("Cannot find configuration file {}:".format(filename))
         self.filename = filename
+        self._snapshot = None
+
+        # Parse the file once at load time; this reports all syntax errors.
+        self.reload()
 
+    def reload(self):
+        """Parse the configuration file into a new snapshot."""
         try:
-            BackupConfigurationFile.read_key_value_file(filename=self.filename)
-            #logging.debug("Configuration %s", str(vals))
+            stat = os.stat(self.filename)
+            with open(self.filename, mode='rt') as config_file:
+                lines = config_file.readlines()
         except Exception as ex:
-            raise BackupException("Error parsing config file {}:\n{}".format(filename, ex.message))
+            raise BackupException("Error reading config file {}:\n{}".format(self.filename, ex))
+
+        (values, errors) = BackupConfigurationFile.parse_lines(lines)
+        if errors:
+            raise BackupException("Error parsing config file {}:\n{}".format(
+                self.filename, "\n".join(errors)))
+
+        self._snapshot = ConfigurationSnapshot(
+            values=values, mtime=stat.st_mtime, size=stat.st_size)
+        logging.debug("Parsed configuration file %s (%d keys)", self.filename, len(values))
+        return self._snapshot
+
+    @property
+    def snapshot(self):
+        """Return the current snapshot, reparsing the file only if it has changed on disk."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            # File went away; keep serving the values we have
+            return self._snapshot
+        if not self._snapshot.is_current(stat.st_mtime, stat.st_size):
+            logging.info("Configuration file %s changed, reloading", self.filename)
+            return self.reload()
+        return self._snapshot
 
     def get_value(self, key):
-        """ Parse a configuration file and return a single value."""
-        values = BackupConfigurationFile.read_key_value_file(filename=self.filename)
-        return values[key]
+        """Return a single value."""
+        return self.snapshot.get_value(key)
 
     def get_keys_prefix(self, prefix):
         """Retrieve all keys that match a certain prefix."""
-        values = BackupConfigurationFile.read_key_value_file(filename=self.filename)
-        return [i for i in values.keys() if re.match(prefix, i)]
+        return list(self.snapshot.get_keys_prefix(prefix))
 
     def key_exists(self, key):
         """Return True if a key exists in the configuration file."""
-        values = BackupConfigurationFile.read_key_value_file(filename=self.filename)
-        return values.has_key(key)
+        return self.snapshot.key_exists(key)
+
+    @staticmethod
+    def parse_lines(lines):
+        """
+        Parse configuration lines. Returns a dictionary of key/values and
+        a list with every error found, so that they can all be reported at once.
+
+        >>> BackupConfigurationFile.parse_lines(['# comment', 'a="1"', 'b: 2', ' ', 'c'])
+        ({'a': '1', 'b': '2'}, ['line 5: missing separator in "c"'])
+        >>> BackupConfigurationFile.parse_lines(['=1'])
+        ({}, ['line 1: empty key in "=1"'])
+        """
+        values = dict()
+        errors = []
+        for (number, line) in enumerate(lines, 1):
+            # skip comments and empty lines
+            if re.match(r"^\s*#|^\s*$", line):
+                continue
+            parts = re.split(":|=", line, maxsplit=1)
+            if len(parts) != 2:
+                errors.append('line {}: missing separator in "{}"'.format(number, line.strip()))
+                continue
+            key = parts[0].strip()
+            if not key:
+                errors.append('line {}: empty key in "{}"'.format(number, line.strip()))
+                continue
+            if key in values:
+                logging.warning("Configuration key %s defined more than once, using last value", key)
+            values[key] = parts[1].strip().strip('\"')
+        return (values, errors)
 
     @staticmethod
     def read_key_value_file(filename):
@@ -51,8 +169,7 @@ class BackupConfigurationFile(object):
         """
 
         with open(filename, mode='rt') as config_file:
-            lines = config_file.readlines()
-            # skip comments and empty lines
-            content_lines = [line for line in lines if not re.match(r"^\s*#|^\s*$", line)]
-            content = dict(re.split(":|=", line, maxsplit=1) for line in content_lines)
-            return dict([(x[0].strip(), x[1].strip().strip('\"')) for x in content.iteritems()])
+            (values, errors) = BackupConfigurationFile.parse_lines(config_file.readlines())
+            if errors:
+                raise BackupException("\n".join(errors))
+            return values
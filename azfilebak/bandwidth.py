@@ -0,0 +1,229 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Bandwidth module."""
+
+import os
+import json
+import time
+import errno
+import fcntl
+import logging
+import threading
+
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.backupexception import BackupException
+
+# Share of the host limit of each priority, relative to the other active processes
+WEIGHTS = {'restore': 3, 'backup': 1}
+# How often a process records its demand and reads its allocation
+ALLOCATION_INTERVAL_SECONDS = 1.0
+# Processes that did not record their demand for this long are gone or idle
+STALE_SECONDS = 5.0
+# Tokens a process can save up, in seconds of its allocation
+BURST_SECONDS = 0.5
+# A process that was not throttled may grow this much above its rate in each interval
+HEADROOM = 1.25
+MB = 1024 * 1024
+
+def fair_shares(limit, processes):
+    """
+    Divide limit between processes, {key: (weight, demand)}, by weight.
+    Processes whose demand (None when unbounded) is below their share get
+    it, the rest is divided between the others: max-min fairness.
+
+    >>> shares = fair_shares(100, {'restore': (3, None), 'backup': (1, None)})
+    >>> shares['restore'], shares['backup']
+    (75.0, 25.0)
+    >>> shares = fair_shares(100, {'restore': (3, 10), 'backup': (1, None), 'prune': (1, 5)})
+    >>> shares['restore'], shares['backup'], shares['prune']
+    (10, 85.0, 5)
+    """
+    shares = {}
+    pending = dict(processes)
+    remaining = float(limit)
+    while pending:
+        total = sum(weight for (weight, _demand) in pending.values())
+        satisfied = [(key, demand) for (key, (weight, demand)) in pending.items()
+                     if demand is not None and demand < remaining * weight / total]
+        if not satisfied:
+            for (key, (weight, _demand)) in pending.items():
+                shares[key] = remaining * weight / total
+            break
+        for (key, demand) in satisfied:
+            shares[key] = demand
+            remaining -= demand
+            del pending[key]
+    return shares
+
+def is_alive(pid):
+    """Whether a process exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+class BandwidthGovernor(object):
+    """
+    Host-wide bandwidth limit shared by the azfilebak processes of a VM,
+    such as a backup from cron and a manual restore. Each process throttles
+    its transfers with a token bucket filled at its allocation. Once per
+    ALLOCATION_INTERVAL_SECONDS it records its priority and demand in a
+    state file shared by the processes, under an exclusive lock, and
+    computes its allocation from the entries of the active processes
+    (see fair_shares): processes that use less than their share leave the
+    rest to the others, and restores get a larger share than backups.
+    Without access to the state file, a process keeps its last allocation.
+    """
+
+    def __init__(self, state_file, limit, priority):
+        if priority not in WEIGHTS:
+            raise BackupException("Unknown bandwidth priority {}, use one of {}".format(
+                priority, ", ".join(sorted(WEIGHTS))))
+        self.state_file = state_file
+        self.limit = float(limit)
+        self.priority = priority
+        self.key = "{}-{}".format(os.getpid(), priority)
+        self.lock = threading.Lock()
+        self.rate = self.limit * WEIGHTS[priority] / sum(WEIGHTS.values())
+        self.tokens = 0.0
+        self.last = time.time()
+        self.allocated = 0.0
+        # Transfers since the last allocation
+        self.interval_bytes = 0
+        self.throttled = False
+        self.bytes = 0
+        self.allocations = {}
+        Instrumentation.register('bandwidth', self.report)
+
+    def allocate(self, now):
+        """Record the demand of this process in the state file, and update its allocation."""
+        # Unbounded while throttled or unknown, otherwise what the process used with some headroom
+        demand = None
+        if self.allocated and not self.throttled and now > self.allocated:
+            demand = HEADROOM * self.interval_bytes / (now - self.allocated)
+        try:
+            with open(self.state_file, 'a+') as state:
+                fcntl.flock(state.fileno(), fcntl.LOCK_EX)
+                state.seek(0)
+                try:
+                    processes = json.loads(state.read() or '{}')
+                except ValueError:
+                    processes = {}
+                processes = dict((key, entry) for (key, entry) in processes.items()
+                                 if now - entry['updated'] < STALE_SECONDS and is_alive(int(key.split('-')[0])))
+                processes[self.key] = {'priority': self.priority, 'updated': now, 'demand': demand}
+                # The file is opened for appending: truncated, it is written from the start
+                state.truncate(0)
+                state.seek(0)
+                json.dump(processes, state)
+        except (IOError, OSError, KeyError) as ex:
+            logging.debug("Cannot share bandwidth allocation in %s: %s", self.state_file, ex)
+            self.allocated = now
+            return
+        shares = fair_shares(self.limit, dict(
+            (key, (WEIGHTS.get(entry['priority'], 1), entry['demand'])) for (key, entry) in processes.items()))
+        self.allocations = dict((key, dict(entry, rate=shares[key])) for (key, entry) in processes.items())
+        # A process that was idle starts again from a small share
+        self.rate = max(shares[self.key], self.limit * 0.01)
+        self.allocated = now
+        self.interval_bytes = 0
+        self.throttled = False
+
+    def consume(self, size):
+        """
+        Wait until size bytes can be transferred within the allocation of
+        the process. A large size is taken in slices of one allocation
+        interval, so that the entry of the process in the state file does
+        not become stale while it waits, and its rate follows the others.
+        """
+        while size > 0:
+            with self.lock:
+                now = time.time()
+                if now - self.allocated >= ALLOCATION_INTERVAL_SECONDS:
+                    self.allocate(now)
+                self.tokens = min(self.tokens + (now - self.last) * self.rate, self.rate * BURST_SECONDS)
+                self.last = now
+                part = min(size, max(int(self.rate * ALLOCATION_INTERVAL_SECONDS), 1))
+                self.tokens -= part
+                self.bytes += part
+                self.interval_bytes += part
+                wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+                if wait > 0:
+                    self.throttled = True
+            if wait > 0:
+                Instrumentation.add_time('bandwidth.wait', wait)
+                time.sleep(wait)
+            size -= part
+
+    def release(self):
+        """Remove this process from the state file, so that the others get its share at once."""
+        try:
+            with open(self.state_file, 'a+') as state:
+                fcntl.flock(state.fileno(), fcntl.LOCK_EX)
+                state.seek(0)
+                processes = json.loads(state.read() or '{}')
+                if processes.pop(self.key, None) is not None:
+                    state.truncate(0)
+                    state.seek(0)
+                    json.dump(processes, state)
+        except (IOError, OSError, ValueError) as ex:
+            logging.debug("Cannot release bandwidth allocation in %s: %s", self.state_file, ex)
+        self.allocated = 0.0
+
+    def reader(self, stream):
+        """A file-like object reading stream within the allocation."""
+        return ThrottledReader(stream, self)
+
+    def writer(self, output):
+        """A file-like object writing to output within the allocation."""
+        return ThrottledWriter(output, self)
+
+    def report(self):
+        """The limit and the allocations of the active processes, in MB/s, for the instrumentation output."""
+        return {
+            'limit_mb_per_second': round(self.limit / MB, 2),
+            'priority': self.priority,
+            'rate_mb_per_second': round(self.rate / MB, 2),
+            'bytes': self.bytes,
+            'allocations': dict((key, {
+                'priority': entry['priority'],
+                'rate_mb_per_second': round(entry['rate'] / MB, 2),
+                'throttled': entry['demand'] is None
+            }) for (key, entry) in self.allocations.items())
+        }
+
+class ThrottledReader(object):
+    """Read from a stream, waiting for the bandwidth governor."""
+
+    def __init__(self, stream, governor):
+        self.stream = stream
+        self.governor = governor
+
+    def read(self, size=-1):
+        """Read from the stream."""
+        data = self.stream.read(size)
+        if data:
+            self.governor.consume(len(data))
+        return data
+
+class ThrottledWriter(object):
+    """Write to a file-like object, waiting for the bandwidth governor."""
+
+    def __init__(self, output, governor):
+        self.output = output
+        self.governor = governor
+
+    def write(self, data):
+        """Write to the output."""
+        self.governor.consume(len(data))
+        self.output.write(data)
+
+    def flush(self):
+        """Flush the output."""
+        self.output.flush()
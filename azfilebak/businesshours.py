@@ -6,14 +6,22 @@
 # --------------------------------------------------------------------------
 
 import re
+import datetime
 
 from azfilebak.timing import Timing
 from azfilebak.backupexception import BackupException
 
+HOURS_PER_WEEK = 7 * 24
+WEEK_MASK = (1 << HOURS_PER_WEEK) - 1
+
 class BusinessHours(object):
     """
     Process business hour statements, such as determine wheter a certain
     point in time is within or outside business hours.
+
+    The schedule is compiled into a 168-bit week bitmap, where bit
+    (24 * weekday + hour) is set when backups are allowed in that hour
+    (weekday 0 is Monday).
     """
 
     default_schedule = "bkp_fs_schedule"
@@ -66,7 +74,11 @@ class BusinessHours(object):
             if not self.tags.has_key(weekdays[day]):
                 raise BackupException("Missing schedule for {}".format(weekdays[day]))
             self.hours[day+1] = BusinessHours.parse_day(self.tags[weekdays[day]])
-        
+            if len(self.hours[day+1]) != 24:
+                raise BackupException("Schedule for {} must have 24 hours".format(weekdays[day]))
+
+        self.week_bitmap = BusinessHours.compile_bitmap(self.hours)
+
         # Also retrieve min/max retention values from tag
         if not self.tags.has_key('min'):
             raise BackupException("Missing value for min")
@@ -101,6 +113,31 @@ class BusinessHours(object):
         except Exception as e:
             raise(BackupException("Error parsing business hours '{}': {}".format(day_values, e.message)))
 
+    @staticmethod
+    def compile_bitmap(hours):
+        """
+        Compile a dictionary of 7 lists of 24 booleans (days 1-7) into a week bitmap.
+
+        >>> mornings = [True] * 12 + [False] * 12
+        >>> BusinessHours.compile_bitmap(dict([(1, mornings)] + [(d, [False] * 24) for d in range(2, 8)])) == 0xfff
+        True
+        """
+        bitmap = 0
+        for day in range(1, 8):
+            for (hour, allowed) in enumerate(hours[day]):
+                if allowed:
+                    bitmap |= 1 << ((day - 1) * 24 + hour)
+        return bitmap
+
+    @staticmethod
+    def hour_of_week(time):
+        """Index of the hour of the week (0-167) for a datetime."""
+        return time.weekday() * 24 + time.hour
+
+    def rotated_bitmap(self, index):
+        """Return the week bitmap rotated so that bit 0 is the hour at index."""
+        return ((self.week_bitmap >> index) | (self.week_bitmap << (HOURS_PER_WEEK - index))) & WEEK_MASK
+
     def is_backup_allowed_dh(self, day, hour):
         """
         >>> sample_data = BusinessHours._BusinessHours__sample_data()
@@ -112,7 +149,7 @@ class BusinessHours(object):
         >>> sample_hours.is_backup_allowed_dh(day=7, hour=11)
         True
         """
-        return self.hours[day][hour]
+        return bool((self.week_bitmap >> ((day - 1) * 24 + hour)) & 1)
 
     def is_backup_allowed_time(self, time):
         """
@@ -128,9 +165,88 @@ class BusinessHours(object):
         >>> sample_hours.is_backup_allowed_time(some_sunday_noon)
         True
         """
-        # time.struct_time.tm_wday is range [0, 6], Monday is 0
-        t = Timing.parse(time)
-        return self.is_backup_allowed_dh(day=1 + t.tm_wday, hour=t.tm_hour)
+        # datetime.weekday() is range [0, 6], Monday is 0
+        t = Timing.to_datetime(time)
+        return bool((self.week_bitmap >> BusinessHours.hour_of_week(t)) & 1)
 
     def is_backup_allowed_now_localtime(self):
         return self.is_backup_allowed_time(time=Timing.now_localtime())
+
+    def next_allowed_time(self, time):
+        """
+        Return the first point in time, at or after the given time, when
+        backups are allowed. Returns None if the schedule allows no backups.
+
+        >>> sample_hours = BusinessHours.parse_tag_str(BusinessHours._BusinessHours__sample_data())
+        >>> sample_hours.next_allowed_time("20180605_115500")
+        datetime.datetime(2018, 6, 5, 19, 0)
+        >>> sample_hours.next_allowed_time("20180605_215959")
+        datetime.datetime(2018, 6, 5, 21, 59, 59)
+        """
+        t = Timing.to_datetime(time)
+        rotated = self.rotated_bitmap(BusinessHours.hour_of_week(t))
+        if rotated & 1:
+            return t
+        if not rotated:
+            return None
+        hours_ahead = (rotated & -rotated).bit_length() - 1
+        return t.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=hours_ahead)
+
+    def remaining_window(self, time):
+        """
+        Return how much longer backups are allowed, starting at the given time,
+        as a timedelta. Returns a zero timedelta outside of the allowed hours,
+        and None if backups are allowed at all times.
+
+        >>> sample_hours = BusinessHours.parse_tag_str(BusinessHours._BusinessHours__sample_data())
+        >>> sample_hours.remaining_window("20180605_213000")
+        datetime.timedelta(0, 41400)
+        >>> sample_hours.remaining_window("20180605_115500")
+        datetime.timedelta(0)
+        """
+        t = Timing.to_datetime(time)
+        rotated = self.rotated_bitmap(BusinessHours.hour_of_week(t))
+        if rotated == WEEK_MASK:
+            return None
+        allowed_hours = (~rotated & (rotated + 1)).bit_length() - 1
+        end = t.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=allowed_hours)
+        return max(end - t, datetime.timedelta(0))
+
+    def allowed_time_between(self, start, end):
+        """
+        Return the total time during which backups are allowed between
+        start and end, as a timedelta.
+
+        >>> sample_hours = BusinessHours.parse_tag_str(BusinessHours._BusinessHours__sample_data())
+        >>> sample_hours.allowed_time_between("20180604_000000", "20180611_000000")
+        datetime.timedelta(4, 79200)
+        >>> sample_hours.allowed_time_between("20180605_083000", "20180605_200000")
+        datetime.timedelta(0, 5400)
+        """
+        t1 = Timing.to_datetime(start)
+        t2 = Timing.to_datetime(end)
+        if t2 <= t1:
+            return datetime.timedelta(0)
+
+        def allowed_in_hour(t):
+            """1 if the hour containing t is allowed."""
+            return (self.week_bitmap >> BusinessHours.hour_of_week(t)) & 1
+
+        # Partial first hour
+        first_hour_end = t1.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+        if t2 <= first_hour_end:
+            return (t2 - t1) * allowed_in_hour(t1)
+        total = (first_hour_end - t1) * allowed_in_hour(t1)
+
+        # Whole hours: full weeks, then the remaining hours from the bitmap
+        whole_hours = int((t2 - first_hour_end).total_seconds() // 3600)
+        weeks, rest = divmod(whole_hours, HOURS_PER_WEEK)
+        allowed = weeks * bin(self.week_bitmap).count('1')
+        rotated = self.rotated_bitmap(BusinessHours.hour_of_week(first_hour_end))
+        allowed += bin(rotated & ((1 << rest) - 1)).count('1')
+        total += datetime.timedelta(hours=allowed)
+
+        # Partial last hour
+        last_hour_start = first_hour_end + datetime.timedelta(hours=whole_hours)
+        total += (t2 - last_hour_start) * allowed_in_hour(last_hour_start)
+        return total
@@ -0,0 +1,409 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Compression module."""
+
+import os
+import bz2
+import json
+import time
+import zlib
+import struct
+import logging
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.backupexception import BackupException
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # Not in the standard library of Python 2
+        lzma = None
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# Bytes of each block compressed to estimate its compressibility
+SAMPLE_SIZE = 64 * 1024
+# Blocks whose sample does not shrink below this ratio are stored
+INCOMPRESSIBLE_RATIO = 0.95
+# Backups kept in the statistics file of a fileset
+STATS_HISTORY = 100
+
+# For each policy, the codec and level of a block by the ratio of its sample:
+# the first entry whose threshold is above the ratio
+POLICIES = {
+    'fast': [(INCOMPRESSIBLE_RATIO, 'deflate', 1)],
+    'balanced': [(INCOMPRESSIBLE_RATIO, 'deflate', 6)],
+    'small': [(0.5, 'bz2', 9), (INCOMPRESSIBLE_RATIO, 'deflate', 6)],
+    'smallest': [(INCOMPRESSIBLE_RATIO, 'lzma', 6)]
+}
+DEFAULT_POLICY = 'balanced'
+
+CODECS = ['deflate', 'bz2', 'lzma']
+
+# Gzip member header with an extra field holding one 'AZ' subfield: the
+# codec and level of the member and the length of its compressed data
+HEADER_FORMAT = '<2sBBIBBH2sHBBHI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+TRAILER_FORMAT = '<II'
+TRAILER_SIZE = struct.calcsize(TRAILER_FORMAT)
+GZIP_MAGIC = '\x1f\x8b'
+SUBFIELD_ID = 'AZ'
+FEXTRA = 4
+
+def encode_member(data, codec, level):
+    """
+    One member of an adaptive archive. Members with the deflate codec
+    (level 0 stores the data) are standard gzip members.
+
+    >>> member = encode_member('hello', 'deflate', 0)
+    >>> import gzip, StringIO
+    >>> gzip.GzipFile(fileobj=StringIO.StringIO(member + member)).read()
+    'hellohello'
+    >>> parse_header(member), decode_member(member)
+    (('deflate', 0, 10), 'hello')
+    """
+    if codec == 'deflate':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        payload = compressor.compress(data) + compressor.flush()
+    elif codec == 'bz2':
+        payload = bz2.compress(data, level)
+    elif codec == 'lzma' and lzma is not None:
+        payload = lzma.compress(data, preset=level)
+    else:
+        raise BackupException("Unknown or unavailable codec {}".format(codec))
+    header = struct.pack(HEADER_FORMAT, GZIP_MAGIC, 8, FEXTRA, 0, 0, 255, 12, SUBFIELD_ID, 8,
+                         CODECS.index(codec), level, 0, len(payload))
+    trailer = struct.pack(TRAILER_FORMAT, zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + payload + trailer
+
+def parse_header(data):
+    """
+    (codec, level, compressed length) of the member at the start of data,
+    None if it is not the header of a member of an adaptive archive.
+
+    >>> parse_header('\\x1f\\x8b\\x08\\x00' + '\\x00' * 20) is None
+    True
+    """
+    if len(data) < HEADER_SIZE:
+        return None
+    (magic, method, flags, _mtime, _xfl, _os, xlen, subfield, length, codec, level, _reserved, size) = \
+        struct.unpack_from(HEADER_FORMAT, data)
+    if (magic != GZIP_MAGIC or method != 8 or flags != FEXTRA or xlen != 12 or subfield != SUBFIELD_ID
+            or length != 8 or codec >= len(CODECS)):
+        return None
+    return (CODECS[codec], level, size)
+
+def member_size(header):
+    """Total size of a member from its parsed header."""
+    return HEADER_SIZE + header[2] + TRAILER_SIZE
+
+def decode_member(member):
+    """Uncompressed data of a member; checks its CRC."""
+    (codec, _level, size) = parse_header(member)
+    payload = member[HEADER_SIZE:HEADER_SIZE + size]
+    if codec == 'deflate':
+        data = zlib.decompress(payload, -zlib.MAX_WBITS)
+    elif codec == 'bz2':
+        data = bz2.decompress(payload)
+    elif lzma is not None:
+        data = lzma.decompress(payload)
+    else:
+        raise BackupException("Archive has lzma members, install backports.lzma to restore it")
+    (crc, _isize) = struct.unpack_from(TRAILER_FORMAT, member, HEADER_SIZE + size)
+    if zlib.crc32(data) & 0xffffffff != crc:
+        raise BackupException("Corrupted archive member (CRC mismatch)")
+    return data
+
+def sample_ratio(data):
+    """
+    Compressed to uncompressed size of a sample of a block, from slices
+    spread over the block, with the fastest zlib level.
+
+    >>> sample_ratio('a' * 100000) < 0.1, sample_ratio(os.urandom(100000)) > 0.95
+    (True, True)
+    """
+    if len(data) <= SAMPLE_SIZE:
+        sample = data
+    else:
+        step = len(data) // 4
+        sample = ''.join(data[i * step:i * step + SAMPLE_SIZE // 4] for i in range(4))
+    if not sample:
+        return 1.0
+    return len(zlib.compress(sample, 1)) / float(len(sample))
+
+def compress_block(data, policy):
+    """Encode a block with the codec of the policy for its compressibility; returns (member, codec, level, seconds)."""
+    start = time.time()
+    ratio = sample_ratio(data)
+    (codec, level) = ('deflate', 0)
+    for (threshold, policy_codec, policy_level) in POLICIES[policy]:
+        if ratio < threshold:
+            (codec, level) = (policy_codec, policy_level)
+            break
+    member = encode_member(data, codec, level)
+    if level > 0 and len(member) > len(data) + HEADER_SIZE + TRAILER_SIZE + 16:
+        # The sample was not representative
+        (codec, level) = ('deflate', 0)
+        member = encode_member(data, codec, level)
+    return (member, codec, level, time.time() - start)
+
+class AdaptiveCompressor(object):
+    """
+    Compress a stream, such as the output of 'tar cf -', block by block in
+    a pool of threads. Each block is a gzip member: blocks whose sample
+    does not compress are stored, the others are compressed with the
+    codec and level the policy chooses for their compressibility. An
+    extra field of each member gives its codec and compressed length, so
+    the archive describes itself and can be decompressed in parallel.
+    Archives of deflate members only are standard .tar.gz files; restore
+    converts bz2 and lzma members (see GzipWriter).
+    """
+
+    def __init__(self, source, policy=DEFAULT_POLICY, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+        if policy not in POLICIES:
+            raise BackupException("Unknown compression policy {}, use one of {}".format(
+                policy, ", ".join(sorted(POLICIES))))
+        if lzma is None and any(codec == 'lzma' for (_t, codec, _l) in POLICIES[policy]):
+            raise BackupException("Compression policy {} needs lzma (backports.lzma)".format(policy))
+        self.source = source
+        self.policy = policy
+        self.block_size = block_size
+        self.threads = max(1, threads or multiprocessing.cpu_count())
+        self.pool = None
+        # Blocks being compressed, in order
+        self.pending = collections.deque()
+        self.buffer = ''
+        self.eof = False
+        self.stats = {'policy': policy, 'bytes_in': 0, 'bytes_out': 0, 'cpu_seconds': 0.0, 'blocks': {}}
+
+    def fill(self):
+        """Read blocks from the source until every thread has one."""
+        if self.pool is None:
+            self.pool = ThreadPool(processes=self.threads)
+        while not self.eof and len(self.pending) < self.threads * 2:
+            data = self.source.read(self.block_size)
+            if not data:
+                self.eof = True
+                break
+            self.stats['bytes_in'] += len(data)
+            self.pending.append(self.pool.apply_async(compress_block, (data, self.policy)))
+
+    def read(self, size=-1):
+        """Read compressed data, less than size bytes only at the end."""
+        chunks = [self.buffer]
+        available = len(self.buffer)
+        while size < 0 or available < size:
+            self.fill()
+            if not self.pending:
+                break
+            (member, codec, level, seconds) = self.pending.popleft().get()
+            key = "{}-{}".format(codec, level)
+            self.stats['blocks'][key] = self.stats['blocks'].get(key, 0) + 1
+            self.stats['bytes_out'] += len(member)
+            self.stats['cpu_seconds'] += seconds
+            chunks.append(member)
+            available += len(member)
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        if not self.pending and self.eof and not self.buffer:
+            self.close()
+        return data[:size]
+
+    def close(self):
+        """Stop the threads."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def ratio(self):
+        """Compressed to uncompressed size so far."""
+        return self.stats['bytes_out'] / float(self.stats['bytes_in']) if self.stats['bytes_in'] else 1.0
+
+    def save_stats(self, filename, blob_name):
+        """Log the statistics of the backup, and add them to the history of the fileset."""
+        stats = dict(self.stats, blob=blob_name, ratio=round(self.ratio(), 4),
+                     cpu_seconds=round(self.stats['cpu_seconds'], 3))
+        logging.info("Compressed %s with policy %s: %d to %d bytes (ratio %.3f) in %.1f CPU seconds, blocks %s",
+                     blob_name, self.policy, stats['bytes_in'], stats['bytes_out'], stats['ratio'],
+                     stats['cpu_seconds'], stats['blocks'])
+        Instrumentation.incr('compression.bytes_in', stats['bytes_in'])
+        Instrumentation.incr('compression.bytes_out', stats['bytes_out'])
+        Instrumentation.incr('compression.cpu_seconds', stats['cpu_seconds'])
+        Instrumentation.incr('compression.stored_blocks', stats['blocks'].get('deflate-0', 0))
+        try:
+            with open(filename, 'rt') as stats_file:
+                history = json.load(stats_file)
+        except (IOError, ValueError):
+            history = []
+        history = (history + [stats])[-STATS_HISTORY:]
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wt') as stats_file:
+                json.dump(history, stats_file, indent=2, sort_keys=True)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError) as ex:
+            logging.debug("Cannot write compression statistics %s: %s", filename, ex)
+
+def is_adaptive(data):
+    """Whether data starts with a member of an adaptive archive."""
+    return parse_header(data) is not None
+
+class GzipWriter(object):
+    """
+    File-like object that writes an adaptive archive as a standard gzip
+    stream: deflate members are written as they are, bz2 and lzma members
+    are decompressed and written as stored gzip members. Data that is not
+    an adaptive archive is written unchanged.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.buffer = ''
+        self.adaptive = None
+
+    def write(self, data):
+        """Write some data of the archive."""
+        if self.adaptive is False:
+            self.output.write(data)
+            return
+        self.buffer += data
+        if self.adaptive is None:
+            if len(self.buffer) < HEADER_SIZE:
+                return
+            self.adaptive = is_adaptive(self.buffer)
+            if not self.adaptive:
+                (data, self.buffer) = (self.buffer, '')
+                self.output.write(data)
+                return
+        offset = 0
+        while True:
+            header = parse_header(self.buffer[offset:offset + HEADER_SIZE])
+            if header is None:
+                if len(self.buffer) - offset >= HEADER_SIZE:
+                    raise BackupException("Corrupted archive: no member header at {}".format(offset))
+                break
+            size = member_size(header)
+            if len(self.buffer) - offset < size:
+                break
+            member = self.buffer[offset:offset + size]
+            if header[0] != 'deflate':
+                member = encode_member(decode_member(member), 'deflate', 0)
+            self.output.write(member)
+            offset += size
+        self.buffer = self.buffer[offset:]
+
+    def flush(self):
+        """Flush the output; the archive must be complete."""
+        if self.buffer:
+            if self.adaptive:
+                raise BackupException("Truncated archive: {} bytes left".format(len(self.buffer)))
+            self.output.write(self.buffer)
+            self.buffer = ''
+        self.output.flush()
+
+class ParallelDecompressor(object):
+    """
+    File-like object that writes the uncompressed content of an archive,
+    such as a tar stream, to output. The members of an adaptive archive
+    are independent and their headers give their sizes, so they are
+    decompressed in a pool of threads (zlib and bz2 release the GIL) and
+    written in order. Other gzip archives are decompressed on one thread.
+
+    >>> import StringIO
+    >>> output = StringIO.StringIO()
+    >>> writer = ParallelDecompressor(output, threads=2)
+    >>> writer.write(encode_member('hello ', 'bz2', 9) + encode_member('world', 'deflate', 6))
+    >>> writer.flush()
+    >>> writer.close()
+    >>> output.getvalue()
+    'hello world'
+    """
+
+    def __init__(self, output, threads=None):
+        self.output = output
+        self.threads = max(1, threads or multiprocessing.cpu_count())
+        self.pool = None
+        # Members being decompressed, in order
+        self.pending = collections.deque()
+        self.buffer = ''
+        self.adaptive = None
+        self.decompressor = None
+        self.members = 0
+
+    def write(self, data):
+        """Write some data of the archive."""
+        if self.adaptive is False:
+            self.write_gzip(data)
+            return
+        self.buffer += data
+        if self.adaptive is None:
+            if len(self.buffer) < HEADER_SIZE:
+                return
+            self.adaptive = is_adaptive(self.buffer)
+            if not self.adaptive:
+                (data, self.buffer) = (self.buffer, '')
+                self.write_gzip(data)
+                return
+        if self.pool is None:
+            self.pool = ThreadPool(processes=self.threads)
+        offset = 0
+        while True:
+            header = parse_header(self.buffer[offset:offset + HEADER_SIZE])
+            if header is None:
+                if len(self.buffer) - offset >= HEADER_SIZE:
+                    raise BackupException("Corrupted archive: no member header at {}".format(offset))
+                break
+            size = member_size(header)
+            if len(self.buffer) - offset < size:
+                break
+            if len(self.pending) >= self.threads * 2:
+                self.output.write(self.pending.popleft().get())
+            self.pending.append(self.pool.apply_async(decode_member, (self.buffer[offset:offset + size],)))
+            self.members += 1
+            offset += size
+        self.buffer = self.buffer[offset:]
+
+    def write_gzip(self, data):
+        """Decompress data of a gzip stream of one or more members."""
+        while data:
+            if self.decompressor is None:
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.members += 1
+            try:
+                self.output.write(self.decompressor.decompress(data))
+            except zlib.error as ex:
+                raise BackupException("Corrupted archive: {}".format(ex))
+            # Data after the end of a member starts the next one
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = None
+
+    def flush(self):
+        """Write the members still being decompressed; the archive must be complete."""
+        while self.pending:
+            self.output.write(self.pending.popleft().get())
+        if self.buffer:
+            raise BackupException("Truncated archive: {} bytes left".format(len(self.buffer)))
+        if self.decompressor is not None:
+            self.output.write(self.decompressor.flush())
+        self.output.flush()
+
+    def close(self):
+        """Stop the threads."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,324 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Daemon module."""
+
+import os
+import time
+import json
+import Queue
+import signal
+import logging
+import datetime
+import threading
+
+from azfilebak.timing import Timing
+from azfilebak.backupagent import BackupAgent
+from azfilebak.backupconfiguration import BackupConfiguration
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.backupexception import BackupException
+
+# The daemon wakes up at least this often, to pick up backups made by other
+# processes and schedule changes in the instance metadata tags.
+MAX_SLEEP_SECONDS = 3600
+# Delay before retrying a backup that failed or found the PID file locked
+RETRY_SECONDS = 300
+
+class BackupDaemon(object):
+    """
+    Long-running alternative to calling '--full-backup' from cron. The
+    configuration, storage client and access token stay in memory, and the
+    latest backup of each fileset is remembered between runs, so that the
+    daemon only has to list the container when it starts, on SIGHUP, and
+    every MAX_SLEEP_SECONDS. It sleeps until the next backup is due and
+    runs the due backups one at a time from a queue.
+
+    SIGHUP reloads the configuration file and the instance metadata.
+    SIGTERM and SIGINT let the running backup finish and exit.
+    """
+
+    def __init__(self, config_file, filesets=None, rate=None, status_file=None):
+        self.config_file = config_file
+        # The default fileset is stored under the name 'fs'
+        self.filesets = filesets or ['fs']
+        self.use_default_fileset = not filesets
+        self.rate = rate
+        self.backup_configuration = None
+        self.backup_agent = None
+        self.status_file_override = status_file
+
+        self.catalog = dict()
+        self.catalog_time = None
+        self.retry_after = dict()
+        self.last_results = dict()
+        self.next_wakeup = None
+
+        self.jobs = Queue.Queue()
+        self.queued = set()
+        self.running_job = None
+        self.state = 'starting'
+        self.started = Timing.now_localtime()
+        self.lock = threading.Lock()
+        self.worker = None
+
+        self.reload_requested = False
+        self.stop_requested = False
+        # Set when a job finishes, so that a failed one is rescheduled at once
+        self.job_finished = threading.Event()
+
+    @property
+    def status_file(self):
+        """The status file given on the command line, or one in the cache directory."""
+        if self.status_file_override:
+            return self.status_file_override
+        if self.backup_configuration is None:
+            return None
+        return os.path.join(self.backup_configuration.get_cache_directory(), 'daemon_status.json')
+
+    #
+    # Configuration and catalog.
+    #
+
+    def load_configuration(self):
+        """
+        Read the configuration file. When reloading, an invalid file is
+        logged and the previous configuration is kept.
+        """
+        backup_configuration = BackupConfiguration(self.config_file)
+        try:
+            backup_configuration.validate()
+        except BackupException as ex:
+            if self.backup_configuration is None:
+                raise
+            logging.error("Keeping previous configuration: %s", ex.message)
+            return
+
+        previous = self.backup_configuration
+        if previous is not None:
+            # Keep the storage client, its connection pool and its token
+            # as long as the storage account does not change.
+            if (previous.get_azure_storage_account_name() ==
+                    backup_configuration.get_azure_storage_account_name()):
+                backup_configuration._block_blob_service = previous._block_blob_service
+                backup_configuration.token_cache = previous.token_cache
+            elif previous.token_cache is not None:
+                previous.token_cache.stop_refresh_thread()
+            previous.notification_spool.stop_worker_thread()
+
+        # Notifications are delivered by a thread instead of a process per backup
+        backup_configuration.notification_spool.start_worker_thread()
+        with self.lock:
+            self.backup_configuration = backup_configuration
+            self.backup_agent = BackupAgent(backup_configuration)
+        logging.info("Loaded configuration %s", self.config_file)
+
+    def refresh_catalog(self):
+        """List the container to find the latest full backup of each fileset."""
+        for fileset in self.filesets:
+            self.catalog[fileset] = self.backup_agent.latest_checked_timestamp(fileset=fileset, is_full=True)
+        self.catalog_time = time.time()
+        Instrumentation.incr('daemon.catalog_refresh')
+        logging.info("Latest full backups: %s", ", ".join(
+            "{}={}".format(fileset, self.catalog[fileset]) for fileset in self.filesets))
+
+    def next_due(self, fileset):
+        """Time at which the next full backup of the fileset is due."""
+        backup_configuration = self.backup_configuration
+        due = BackupAgent.next_full_backup_time(
+            latest_full_backup_timestamp=self.catalog[fileset],
+            business_hours=backup_configuration.get_business_hours(),
+            db_backup_interval_min=backup_configuration.get_fs_backup_interval_min(),
+            db_backup_interval_max=backup_configuration.get_fs_backup_interval_max())
+        retry = self.retry_after.get(fileset)
+        if retry is not None and retry > due:
+            return retry
+        return due
+
+    #
+    # Scheduling.
+    #
+
+    def schedule(self, now):
+        """
+        Queue the filesets whose backup is due at 'now' (a datetime), and
+        return the number of seconds until the next one is due.
+        """
+        sleep = MAX_SLEEP_SECONDS
+        for fileset in self.filesets:
+            with self.lock:
+                if fileset in self.queued:
+                    continue
+            due = self.next_due(fileset)
+            if due <= now:
+                logging.info("Full backup of fileset %s is due since %s", fileset, due)
+                with self.lock:
+                    self.queued.add(fileset)
+                self.jobs.put(fileset)
+            else:
+                sleep = min(sleep, (due - now).total_seconds())
+        self.next_wakeup = now + datetime.timedelta(seconds=sleep)
+        return sleep
+
+    def run_job(self, fileset):
+        """Run the full backup of one fileset and update the catalog."""
+        import pid
+
+        with self.lock:
+            backup_agent = self.backup_agent
+            self.running_job = {'fileset': fileset, 'started': Timing.now_localtime()}
+        self.write_status()
+        blob_name = None
+        try:
+            # Same lock as '--full-backup', in case cron still runs it
+            with pid.PidFile(pidname='fileset-backup-full'):
+                # The schedule has already been checked, do not list the container again
+                with Instrumentation.timer('daemon.backup'):
+                    if self.use_default_fileset:
+                        blob_name = backup_agent.backup_default(is_full=True, force=True, rate=self.rate)
+                    else:
+                        blob_name = backup_agent.backup_single_fileset(
+                            fileset=fileset, is_full=True, force=True, rate=self.rate)
+            self.last_results[fileset] = {'result': 'success', 'blob': blob_name,
+                                          'finished': Timing.now_localtime()}
+            self.retry_after.pop(fileset, None)
+            if blob_name is not None:
+                # Later than the backup if the fileset was found unchanged
+                self.catalog[fileset] = backup_agent.checked_timestamp(fileset, blob_name)
+        except pid.PidFileAlreadyLockedError:
+            logging.warn("Skip full backup of fileset %s, already running", fileset)
+            self.retry_later(fileset, 'locked')
+        except Exception as ex:
+            logging.error("Full backup of fileset %s failed: %s", fileset, ex)
+            self.retry_later(fileset, 'failed: {}'.format(ex))
+        finally:
+            with self.lock:
+                self.running_job = None
+                self.queued.discard(fileset)
+            self.write_status()
+            self.job_finished.set()
+
+    def retry_later(self, fileset, result):
+        """Record a failed attempt and delay the next one."""
+        Instrumentation.incr('daemon.retries')
+        self.last_results[fileset] = {'result': result, 'finished': Timing.now_localtime()}
+        self.retry_after[fileset] = datetime.datetime.now() + datetime.timedelta(seconds=RETRY_SECONDS)
+
+    def work(self):
+        """Worker thread: run queued jobs until told to stop."""
+        while True:
+            fileset = self.jobs.get()
+            if fileset is None or self.stop_requested:
+                break
+            self.run_job(fileset)
+
+    #
+    # Status.
+    #
+
+    def status(self):
+        """Return the state of the daemon as a dictionary."""
+        with self.lock:
+            running_job = self.running_job
+            queued = sorted(self.queued - set([running_job['fileset']] if running_job else []))
+        return {
+            'pid': os.getpid(),
+            'state': self.state,
+            'started': self.started,
+            'config_file': self.config_file,
+            'running': running_job,
+            'queued': queued,
+            'next_wakeup': str(self.next_wakeup) if self.next_wakeup else None,
+            'latest_full_backups': dict(self.catalog),
+            'last_results': dict(self.last_results)
+        }
+
+    def write_status(self):
+        """Atomically replace the status file."""
+        if not self.status_file:
+            return
+        tmp_filename = "{}.{}.tmp".format(self.status_file, os.getpid())
+        try:
+            with open(tmp_filename, 'wt') as status_file:
+                json.dump(self.status(), status_file, indent=2, sort_keys=True)
+            os.rename(tmp_filename, self.status_file)
+        except (IOError, OSError) as ex:
+            logging.debug("Cannot write status file %s: %s", self.status_file, ex)
+
+    #
+    # Main loop.
+    #
+
+    def handle_signal(self, signum, _frame):
+        """Only set flags here, the main loop does the work."""
+        if signum == signal.SIGHUP:
+            self.reload_requested = True
+        else:
+            self.stop_requested = True
+
+    def sleep(self, seconds):
+        """
+        Sleep in short steps so that signals are handled promptly, and
+        until a job finishes: a queued fileset is not counted by schedule().
+        """
+        deadline = time.time() + seconds
+        while not (self.stop_requested or self.reload_requested or self.job_finished.is_set()):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.job_finished.wait(min(remaining, 1.0))
+
+    def run(self):
+        """Run until SIGTERM or SIGINT."""
+        signal.signal(signal.SIGHUP, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+
+        self.load_configuration()
+        self.refresh_catalog()
+        logging.info("Backup daemon started (pid %d), status in %s", os.getpid(), self.status_file)
+
+        self.worker = threading.Thread(target=self.work, name="backup-worker")
+        self.worker.daemon = True
+        self.worker.start()
+
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                logging.info("Reloading configuration")
+                try:
+                    self.load_configuration()
+                    self.refresh_catalog()
+                except Exception as ex:
+                    logging.error("Reload failed: %s", ex)
+            elif time.time() - self.catalog_time >= MAX_SLEEP_SECONDS:
+                try:
+                    self.refresh_catalog()
+                except Exception as ex:
+                    logging.error("Cannot list backups: %s", ex)
+
+            self.state = 'idle'
+            self.job_finished.clear()
+            sleep = self.schedule(datetime.datetime.now())
+            self.write_status()
+            Instrumentation.incr('daemon.wakeups')
+            self.sleep(sleep)
+
+        self.drain()
+
+    def drain(self):
+        """Let the running backup finish; queued ones are not started."""
+        self.state = 'draining'
+        self.write_status()
+        logging.info("Stopping, waiting for the running backup to finish")
+        self.jobs.put(None)
+        while self.worker.is_alive():
+            # join() with a timeout keeps the main thread responsive to signals
+            self.worker.join(1.0)
+        self.backup_configuration.notification_spool.stop_worker_thread(hand_over=True)
+        self.state = 'stopped'
+        self.write_status()
+        logging.info("Backup daemon stopped")
@@ -10,50 +10,87 @@ ExecutableConnector
 """
 
 import shlex
+import pipes
 import subprocess
 import logging
-import psutil
 import os
 
+from azfilebak.mounttable import MountTable
+from azfilebak.fileorder import FileOrder
+
 class ExecutableConnector(object):
     """Drive the command that executes the backup."""
 
     def __init__(self, backup_configuration):
         self.backup_configuration = backup_configuration
 
-    def assemble_backup_command(self, sources, exclude, rate = None):
-        """Assemble backup command line from configuration."""
+    def excluded_paths(self, sources, exclude):
+        """
+        Paths to exclude from a backup of the sources: the explicit
+        excludes, /dev, /run, /sys, /mnt/resource (a volatile file system
+        on Azure VMs), and pseudo and network file systems mounted inside
+        the sources. Empty entries (an empty exclude, a trailing comma)
+        are ignored.
+        """
+        excludes = [e for e in exclude.split(',') if e.strip()]
+        defaults = ['/dev', '/run', '/sys', '/mnt/resource']
+        cfg = self.backup_configuration
+        mounts = MountTable.exclusions(
+            sources, excluded=excludes + defaults,
+            allow=cfg.get_include_fstypes(), deny=cfg.get_exclude_fstypes())
+        return excludes + [d for d in defaults if d not in excludes] + mounts
+
+    def assemble_backup_command(self, sources, exclude, rate = None, directories=(), excluded=None,
+                                files_from=None, compress=True):
+        """
+        Assemble backup command line from configuration. The directories
+        are archived without their content, and 'excluded' replaces the
+        paths computed by excluded_paths (both for striped backups). With
+        files_from, tar archives the entries of that list (see
+        prepare_file_list) instead of the sources. Without compress, tar
+        does not gzip the archive (for adaptive compression).
+        """
 
         # Base command
-        cmd = 'tar cpzf - --hard-dereference --sparse'
-
-        # Add explicit excludes
-        excludes = exclude.split(',')
-        for i in excludes:
-            cmd += ' --exclude ' + i
-
-        # Exclude /dev, /run, /sys
-        # Also exclude /mnt/resource which is a volatile file system on Azure VMs
-        if '/dev' not in excludes:
-            cmd += ' --exclude /dev'
-        if '/run' not in excludes:
-            cmd += ' --exclude /run'
-        if '/sys' not in excludes:
-            cmd += ' --exclude /sys'
-        if '/mnt/resource' not in excludes:
-            cmd += ' --exclude /mnt/resource'
-
-        # Exclude any mount point of type 'proc'
-        mounts = psutil.disk_partitions(True)
-        procmounts = [m.mountpoint for m in mounts if m.fstype == 'proc']
-        for mnt in procmounts:
-            cmd += ' --exclude ' + mnt
+        cmd = 'tar cp{}f - --hard-dereference --sparse'.format('z' if compress else '')
+
+        if excluded is None:
+            excluded = self.excluded_paths(shlex.split(sources), exclude)
+        for path in excluded:
+            cmd += ' --exclude ' + pipes.quote(path)
+
+        # Optionally stay on the file systems of the sources
+        if self.backup_configuration.get_one_file_system():
+            cmd += ' --one-file-system'
+
+        if files_from:
+            # The list holds every directory and file, in reading order
+            cmd += ' --null --no-recursion --files-from ' + pipes.quote(files_from)
+            return cmd
+
+        if directories:
+            cmd += ' --no-recursion ' + ' '.join(pipes.quote(d) for d in directories) + ' --recursion'
 
         # Add the path to archive
         cmd += ' ' + sources
 
         return cmd
 
+    def prepare_file_list(self, name, paths, excluded, order, directories=()):
+        """
+        Write the list of files of a backup, sorted in the given order,
+        to the cache directory. Returns the list file name and the
+        (path, size) of the files, for readahead.
+        """
+        (dirs, files) = FileOrder.collect(paths, excluded, order, directories,
+                                          one_file_system=self.backup_configuration.get_one_file_system())
+        directory = self.backup_configuration.get_cache_directory()
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        filename = os.path.join(directory, "files_{}.lst".format(name))
+        FileOrder.write_list(dirs, files, filename)
+        return (filename, files)
+
     def check_pv_installed(self):
         for path in os.environ["PATH"].split(os.pathsep):
             pv = os.path.join(path, "pv")
@@ -75,6 +112,8 @@ class ExecutableConnector(object):
 
         if rate is not None and rate != "0" and self.check_pv_installed():
            proc2 = subprocess.Popen(['pv', '-L %sm' % rate], stdout=subprocess.PIPE, stdin=proc.stdout)
+           # The process that reads the files, for readahead
+           proc2.backup_command = proc
            return proc2
 
         return proc
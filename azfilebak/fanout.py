@@ -0,0 +1,226 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""FanOut module."""
+
+import os
+import time
+import Queue
+import logging
+import threading
+
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.backupexception import BackupException
+
+# What happens when a sink is slow or fails, see FanOut
+POLICIES = ('wait', 'drop', 'strict')
+DEFAULT_POLICY = 'wait'
+DEFAULT_QUEUE_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_WAIT_SECONDS = 60
+CHUNK_SIZE = 1024 * 1024
+# How often a blocked put checks whether its sink is still alive
+PUT_INTERVAL_SECONDS = 0.5
+
+# Queued for a sink that was dropped
+_ABORT = object()
+
+class SinkStream(object):
+    """
+    File-like object from which a sink reads the chunks queued for it. It
+    raises BackupException once the sink is dropped, so that a partial
+    upload is never committed.
+
+    >>> stream = SinkStream(4)
+    >>> for chunk in ['abc', 'de', None]:
+    ...     stream.queue.put(chunk)
+    >>> stream.read(4), stream.read(), stream.read(1)
+    ('abcd', 'e', '')
+    """
+
+    def __init__(self, max_chunks):
+        self.queue = Queue.Queue(max(1, max_chunks))
+        self.chunks = []
+        self.buffered = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        """Read size bytes, or less at the end of the stream; everything if size < 0."""
+        while not self.eof and (size < 0 or self.buffered < size):
+            chunk = self.queue.get()
+            if chunk is _ABORT:
+                raise BackupException("Sink dropped")
+            if chunk is None:
+                self.eof = True
+                break
+            self.chunks.append(chunk)
+            self.buffered += len(chunk)
+        data = ''.join(self.chunks)
+        if size < 0 or size >= len(data):
+            (self.chunks, self.buffered) = ([], 0)
+            return data
+        (self.chunks, self.buffered) = ([data[size:]], len(data) - size)
+        return data[:size]
+
+class Sink(object):
+    """A consumer of the stream, run in its own thread."""
+
+    def __init__(self, name, consume, required, max_chunks):
+        self.name = name
+        self.consume = consume
+        self.required = required
+        self.stream = SinkStream(max_chunks)
+        self.thread = threading.Thread(target=self.run, name="sink-{}".format(name))
+        self.thread.daemon = True
+        self.error = None
+        self.result = None
+        self.dropped = False
+        # Dropped because another sink failed
+        self.aborted = False
+        self.waited = 0.0
+
+    def run(self):
+        """Call consume(stream), and keep its result or error."""
+        try:
+            self.result = self.consume(self.stream)
+        except Exception as ex:
+            # A dropped sink keeps the reason it was dropped
+            if not self.dropped:
+                self.error = ex
+
+    def drop(self, reason):
+        """Stop feeding the sink, and make its next read fail."""
+        logging.warning("Dropping backup target %s: %s", self.name, reason)
+        self.dropped = True
+        if self.error is None:
+            self.error = BackupException(reason)
+        # Only the fan-out puts into the queue, so there is room once it is emptied
+        try:
+            while True:
+                self.stream.queue.get_nowait()
+        except Queue.Empty:
+            pass
+        self.stream.queue.put(_ABORT)
+
+class FanOut(object):
+    """
+    Read a stream once, such as the output of tar, and feed it to several
+    sinks: the backup blob, copies in other storage accounts, a local
+    directory. Each sink runs in its own thread and reads from its own
+    queue of at most queue_size bytes, so a sink that is slower than the
+    others holds the source back once its queue is full. The policy says
+    what happens with a slow or failed sink that is not required (the
+    backup blob always is):
+
+    - 'wait': the others wait for a slow sink; a failed sink is dropped
+      and the backup goes on.
+    - 'drop': as 'wait', but a sink whose queue stays full for max_wait
+      seconds is dropped too, so that it does not slow the backup.
+    - 'strict': every sink is required, any failure fails the backup.
+    """
+
+    def __init__(self, source, policy=DEFAULT_POLICY, queue_size=DEFAULT_QUEUE_SIZE,
+                 max_wait=DEFAULT_MAX_WAIT_SECONDS):
+        if policy not in POLICIES:
+            raise BackupException("Unknown fan-out policy {}, use one of {}".format(policy, ", ".join(POLICIES)))
+        self.source = source
+        self.policy = policy
+        self.max_chunks = max(1, queue_size // CHUNK_SIZE)
+        self.max_wait = max_wait
+        self.sinks = []
+
+    def add_sink(self, name, consume, required=False):
+        """Add a sink that reads the stream with consume(stream)."""
+        self.sinks.append(Sink(name, consume, required or self.policy == 'strict', self.max_chunks))
+
+    def put(self, sink, chunk):
+        """Queue a chunk for a sink; returns False if the sink was dropped."""
+        start = time.time()
+        while True:
+            try:
+                sink.stream.queue.put(chunk, timeout=PUT_INTERVAL_SECONDS)
+                break
+            except Queue.Full:
+                waited = time.time() - start
+                if not sink.thread.is_alive():
+                    sink.drop("stopped reading: {}".format(sink.error))
+                elif self.policy == 'drop' and not sink.required and waited > self.max_wait:
+                    sink.drop("too slow, its queue was full for {:.0f} s".format(waited))
+                else:
+                    continue
+                sink.waited += waited
+                return False
+        sink.waited += time.time() - start
+        return True
+
+    def failed(self):
+        """The required sinks that failed."""
+        return [s for s in self.sinks if s.required and s.error is not None]
+
+    def run(self):
+        """
+        Feed the stream to the sinks until its end, and wait for them.
+        Returns {name: result} of the sinks that succeeded. Raises the
+        error of a required sink that failed.
+        """
+        for sink in self.sinks:
+            sink.thread.start()
+        size = 0
+        complete = False
+        try:
+            while not self.failed():
+                chunk = self.source.read(CHUNK_SIZE)
+                for sink in self.sinks:
+                    if not sink.dropped:
+                        self.put(sink, chunk or None)
+                if not chunk:
+                    complete = True
+                    break
+                size += len(chunk)
+        finally:
+            for sink in self.sinks:
+                # Stop the sinks still waiting for data
+                if not complete and sink.thread.is_alive() and not sink.dropped:
+                    sink.aborted = True
+                    sink.drop("the backup failed")
+                sink.thread.join()
+
+        for sink in self.sinks:
+            Instrumentation.incr('fanout.wait_seconds', sink.waited)
+            if sink.error is None:
+                logging.info("Backup target %s: %d bytes, waited %.1f s", sink.name, size, sink.waited)
+            elif not sink.required:
+                logging.warning("Backup target %s failed: %s", sink.name, sink.error)
+        # The error of a sink that failed by itself, rather than of one stopped because of it
+        failed = sorted(self.failed(), key=lambda s: s.aborted)
+        if failed:
+            raise failed[0].error
+        return dict((s.name, s.result) for s in self.sinks if s.error is None)
+
+def write_file(path):
+    """
+    A sink that writes the stream to a file of an existing directory,
+    under a temporary name until it is complete.
+    """
+    def consume(stream):
+        """Copy the stream to the file."""
+        if not os.path.isdir(os.path.dirname(path)):
+            raise BackupException("Directory {} does not exist".format(os.path.dirname(path)))
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as out:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+    return consume
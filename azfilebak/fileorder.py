@@ -0,0 +1,242 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""FileOrder module."""
+
+import os
+import time
+import stat
+import fcntl
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+from azfilebak.striping import Striping
+from azfilebak.backupexception import BackupException
+
+# 'readdir' leaves the walk to tar
+ORDERS = ('readdir', 'inode', 'extent')
+
+# struct fiemap from linux/fiemap.h, with room for one extent
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = '=QQLLLL'
+FIEMAP_EXTENT_SIZE = 56
+
+POSIX_FADV_WILLNEED = 3
+DEFAULT_READAHEAD_WINDOW = 64 * 1024 * 1024
+# How often the readahead thread checks the progress of tar
+READAHEAD_INTERVAL_SECONDS = 0.05
+
+def open_noatime(path):
+    """Open a file for reading without updating its access time, None on error."""
+    try:
+        return os.open(path, os.O_RDONLY | getattr(os, 'O_NOATIME', 0))
+    except OSError:
+        try:
+            # O_NOATIME is only allowed to the owner of the file
+            return os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+
+class FileOrder(object):
+    """
+    Build the list of files of a backup in an order that reduces seeks:
+    by device and inode number, or by the physical offset of the first
+    extent of each file (FIEMAP). tar reads the list with --files-from
+    instead of walking the directories in readdir order, which on file
+    systems with hashed directories is close to random on disk.
+
+    Directories come first, in walk order, so that they are created before
+    their files on extraction.
+
+    >>> st = os.stat_result((0100644, 12, 2049, 1, 0, 0, 10, 0, 0, 0))
+    >>> FileOrder.sort_key(st, None), FileOrder.sort_key(st, 4096)
+    ((2049, -1, 12), (2049, 4096, 12))
+    """
+
+    @staticmethod
+    def physical_offset(path):
+        """
+        Physical offset of the first extent of a file, None if it has no
+        extent or cannot be opened. Raises IOError if the file system does
+        not support FIEMAP.
+        """
+        fd = open_noatime(path)
+        if fd is None:
+            return None
+        try:
+            request = struct.pack(FIEMAP_HEADER, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + '\0' * FIEMAP_EXTENT_SIZE
+            result = fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+        finally:
+            os.close(fd)
+        header_size = struct.calcsize(FIEMAP_HEADER)
+        if struct.unpack_from('=L', result, 20)[0] == 0:
+            # Empty, or data inline in the inode
+            return None
+        return struct.unpack_from('=Q', result, header_size + 8)[0]
+
+    @staticmethod
+    def sort_key(st, offset):
+        """Files without a known offset come first on their device, by inode."""
+        return (st.st_dev, -1 if offset is None else offset, st.st_ino)
+
+    @staticmethod
+    def collect(paths, excluded, order, directories=(), one_file_system=False):
+        """
+        Walk the paths and return (directories, files), where files is a
+        list of (path, size) in the given order. The 'directories' are
+        listed without their content. With one_file_system, mount points
+        on other file systems than their path are listed without their
+        content, as tar --one-file-system does (which has no effect on the
+        entries of a list).
+        """
+        if order not in ORDERS or order == 'readdir':
+            raise BackupException("Unknown file order {}, use one of {}".format(order, ", ".join(ORDERS[1:])))
+        start = time.time()
+        dirs = list(directories)
+        files = []
+        # Devices where FIEMAP is not supported, to stop trying
+        no_fiemap = set()
+
+        def add(path, st):
+            """Add a non-directory entry."""
+            offset = None
+            if order == 'extent' and stat.S_ISREG(st.st_mode) and st.st_size > 0 and st.st_dev not in no_fiemap:
+                try:
+                    offset = FileOrder.physical_offset(path)
+                except IOError as ex:
+                    logging.info("No FIEMAP on %s (%s), using inode order", path, ex.strerror)
+                    no_fiemap.add(st.st_dev)
+            files.append((FileOrder.sort_key(st, offset), path, st.st_size if stat.S_ISREG(st.st_mode) else 0))
+
+        for top in paths:
+            try:
+                st = os.lstat(top)
+            except OSError as ex:
+                logging.warning("Cannot read %s: %s", top, ex.strerror)
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                add(top, st)
+                continue
+            for (dirpath, dirnames, filenames) in os.walk(top):
+                dirnames[:] = [d for d in dirnames if not Striping.is_excluded(os.path.join(dirpath, d), excluded)]
+                dirs.append(dirpath)
+                if one_file_system:
+                    mount_points = [d for d in dirnames if FileOrder.device(os.path.join(dirpath, d)) != st.st_dev]
+                    dirs.extend(os.path.join(dirpath, d) for d in mount_points)
+                    dirnames[:] = [d for d in dirnames if d not in mount_points]
+                # os.walk does not follow symbolic links to directories: tar archives the links
+                for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+                    path = os.path.join(dirpath, name)
+                    if Striping.is_excluded(path, excluded):
+                        continue
+                    try:
+                        add(path, os.lstat(path))
+                    except OSError:
+                        continue
+        files.sort()
+        logging.info("Listed %d directories and %d files in %s order in %.1f s",
+                     len(dirs), len(files), order, time.time() - start)
+        return (dirs, [(path, size) for (_key, path, size) in files])
+
+    @staticmethod
+    def device(path):
+        """Device of a path, None if it cannot be read."""
+        try:
+            return os.lstat(path).st_dev
+        except OSError:
+            return None
+
+    @staticmethod
+    def write_list(dirs, files, filename):
+        """Write the names for tar --null --files-from."""
+        with open(filename, 'wb') as list_file:
+            for path in dirs:
+                list_file.write(path + '\0')
+            for (path, _size) in files:
+                list_file.write(path + '\0')
+
+class Readahead(threading.Thread):
+    """
+    Ask the kernel to read the next files of a backup ahead of tar, with
+    posix_fadvise(WILLNEED), so that they are read in the background in
+    list order. The progress of tar is the number of bytes it has read
+    (/proc/<pid>/io); files are advised up to 'window' bytes ahead of it.
+    """
+
+    _fadvise = None
+
+    def __init__(self, files, pid, window):
+        threading.Thread.__init__(self, name="readahead")
+        self.daemon = True
+        self.files = files
+        self.pid = pid
+        self.window = window
+        self.stopped = threading.Event()
+        self.advised = 0
+
+    @staticmethod
+    def fadvise():
+        """posix_fadvise from the C library, None if not available."""
+        if Readahead._fadvise is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                function = libc.posix_fadvise
+                function.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+                Readahead._fadvise = function
+            except (OSError, AttributeError):
+                Readahead._fadvise = False
+        return Readahead._fadvise
+
+    def progress(self):
+        """Bytes read by the process, None if unknown."""
+        try:
+            with open('/proc/{}/io'.format(self.pid), 'rt') as io_file:
+                for line in io_file:
+                    if line.startswith('rchar:'):
+                        return int(line.split()[1])
+        except (IOError, ValueError):
+            pass
+        return None
+
+    def advise(self, path):
+        """Start reading a file into the page cache."""
+        fd = open_noatime(path)
+        if fd is None:
+            return
+        try:
+            Readahead.fadvise()(fd, 0, 0, POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    def run(self):
+        if not Readahead.fadvise():
+            logging.debug("posix_fadvise is not available, no readahead")
+            return
+        index = 0
+        ahead = 0
+        while index < len(self.files) and not self.stopped.is_set():
+            done = self.progress()
+            if done is None:
+                # The process ended, or its progress cannot be read
+                break
+            while index < len(self.files) and ahead < done + self.window:
+                (path, size) = self.files[index]
+                if size > 0:
+                    self.advise(path)
+                ahead += size
+                index += 1
+            self.advised = index
+            self.stopped.wait(READAHEAD_INTERVAL_SECONDS)
+        logging.debug("Readahead of %d of %d files", self.advised, len(self.files))
+
+    def stop(self):
+        """Stop advising, and wait for the thread."""
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,95 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Fingerprint module."""
+
+import os
+import stat
+import time
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+
+from azfilebak.instrumentation import Instrumentation
+
+# Metadata key of the fingerprint on a backup blob
+METADATA_KEY = 'fingerprint'
+DEFAULT_THREADS = 8
+
+class Fingerprint(object):
+    """
+    Fingerprint of a set of files from their metadata only: the path,
+    size, modification time, inode and mode of every entry. No file data
+    is read, so a tree that did not change can be recognized without
+    archiving it. The subtrees below the sources are scanned in parallel.
+
+    >>> st = os.stat_result((0100644, 12, 2049, 1, 0, 0, 10, 0, 1530000000, 0))
+    >>> Fingerprint.entry('/a/b', st)
+    '/a/b\\x0010\\x001530000000.000000\\x0012\\x0033188\\n'
+    """
+
+    @staticmethod
+    def entry(path, st):
+        """What identifies the state of one entry."""
+        return "{}\0{}\0{:.6f}\0{}\0{}\n".format(path, st.st_size, st.st_mtime, st.st_ino, st.st_mode)
+
+    @staticmethod
+    def scan(top):
+        """SHA-256 and number of the entries below top (including top), in sorted order."""
+        digest = hashlib.sha256()
+        try:
+            digest.update(Fingerprint.entry(top, os.lstat(top)))
+        except OSError:
+            return (digest.hexdigest(), 0)
+        count = 1
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            dirnames.sort()
+            for name in sorted(dirnames + filenames):
+                path = os.path.join(dirpath, name)
+                try:
+                    digest.update(Fingerprint.entry(path, os.lstat(path)))
+                except OSError:
+                    # Deleted since the directory was read
+                    continue
+                count += 1
+        return (digest.hexdigest(), count)
+
+    @staticmethod
+    def compute(sources, salt='', threads=DEFAULT_THREADS):
+        """
+        Fingerprint of the sources. The salt, such as the backup command,
+        is part of it, so that a change of the command is a change.
+        """
+        start = time.time()
+        digest = hashlib.sha256(salt)
+        tops = []
+        for source in sources:
+            try:
+                st = os.lstat(source)
+            except OSError:
+                digest.update("{}\0missing\n".format(source))
+                continue
+            digest.update(Fingerprint.entry(source, st))
+            if stat.S_ISDIR(st.st_mode):
+                try:
+                    # The entries of each source are scanned in parallel
+                    tops.extend(os.path.join(source, n) for n in sorted(os.listdir(source)))
+                except OSError:
+                    pass
+
+        pool = ThreadPool(processes=max(1, min(threads, len(tops))))
+        try:
+            results = pool.map(Fingerprint.scan, tops)
+        finally:
+            pool.close()
+            pool.join()
+        for (top, (top_digest, _count)) in zip(tops, results):
+            digest.update("{}\0{}\n".format(top, top_digest))
+        entries = len(sources) + sum(count for (_digest, count) in results)
+        Instrumentation.incr('fingerprint.entries', entries)
+        logging.info("Fingerprint of %s: %d entries in %.1f s", " ".join(sources), entries, time.time() - start)
+        return digest.hexdigest()
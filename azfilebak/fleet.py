@@ -0,0 +1,145 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Fleet module."""
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+from azfilebak.naming import Naming
+from azfilebak.backupexception import BackupException
+
+DEFAULT_FLEET_WORKERS = 8
+
+class Fleet(object):
+    """
+    Run listing, summary and prune operations across many containers
+    (usually one container per VM) in a single process.
+    """
+
+    def __init__(self, backup_agent, containers=None, workers=DEFAULT_FLEET_WORKERS):
+        self.backup_agent = backup_agent
+        self.backup_configuration = backup_agent.backup_configuration
+        self.containers = containers
+        self.workers = max(1, int(workers))
+
+        self.backup_configuration.storage_backend.set_concurrency(self.workers)
+
+    def get_containers(self):
+        """Return the explicit list of containers, or enumerate all containers in the account."""
+        if self.containers:
+            return self.containers
+        return self.backup_configuration.storage_backend.list_containers()
+
+    def run(self, func):
+        """
+        Call func(container) for every container using the worker pool.
+        Returns a list of (container, result) tuples. Errors in one container
+        do not stop the others; they are reported once all containers are done.
+        """
+        def call(container):
+            """Run func for a single container and capture errors."""
+            try:
+                return (container, func(container), None)
+            except Exception as ex:
+                logging.error("Container %s: %s", container, ex)
+                return (container, None, ex)
+
+        containers = self.get_containers()
+        logging.info("Processing %d containers with %d workers", len(containers), self.workers)
+
+        pool = ThreadPool(processes=min(self.workers, max(1, len(containers))))
+        try:
+            results = pool.map(call, containers)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = [container for (container, _result, ex) in results if ex is not None]
+        if failed:
+            raise BackupException("Failed to process containers: {}".format(", ".join(failed)))
+
+        return [(container, result) for (container, result, _ex) in results]
+
+    #
+    # Listing methods.
+    #
+
+    def existing_backups(self, filesets=None):
+        """
+        Retrieve existing backups in all containers, aggregated per VM.
+        Returns a dictionary vmname -> list of tuples (container, name, datetime, length).
+        """
+        per_vm = dict()
+        results = self.run(
+            lambda container: self.backup_agent.existing_backups(
+                filesets=filesets or [], container=container))
+        for (container, backups) in results:
+            for (blob_name, date, length) in backups:
+                vmname = Naming.parse_blobname(blob_name)[3]
+                per_vm.setdefault(vmname, []).append((container, blob_name, date, length))
+        return per_vm
+
+    def list_backups(self, filesets=None):
+        """Print a list of existing backups, grouped by VM."""
+        per_vm = self.existing_backups(filesets=filesets)
+        for vmname in sorted(per_vm.keys()):
+            print '{0}:'.format(vmname)
+            for (container, blob_name, date, length) in per_vm[vmname]:
+                print '  {0} {1:12} {2}/{3}'.format(date, length, container, blob_name)
+
+    @staticmethod
+    def summarize(per_vm):
+        """
+        Compute per-VM statistics from the output of existing_backups.
+
+        >>> import datetime
+        >>> d = datetime.datetime(2018, 11, 21)
+        >>> s = Fleet.summarize({'vm1': [
+        ...     ('c1', 'fs_vm1_full_20181121_164327.tar.gz', d, 100),
+        ...     ('c1', 'fs_vm1_incr_20181122_164327.tar.gz', d, 10),
+        ...     ('c1', 'fs_vm1_full_20181120_164327.tar.gz', d, 90)]})
+        >>> (s['vm1']['full'], s['vm1']['incr'], s['vm1']['bytes'], s['vm1']['latest_full'])
+        (2, 1, 200, '20181121_164327')
+        """
+        summary = dict()
+        for (vmname, backups) in per_vm.items():
+            stats = {
+                'full': 0, 'incr': 0, 'bytes': 0,
+                'latest_full': None, 'latest_incr': None,
+                'containers': set()
+            }
+            for (container, blob_name, _date, length) in backups:
+                (_fileset, is_full, start_timestamp, _vmname) = Naming.parse_blobname(blob_name)
+                level = Naming.backup_type_str(is_full)
+                stats[level] += 1
+                stats['bytes'] += length or 0
+                stats['containers'].add(container)
+                latest = 'latest_' + level
+                if stats[latest] is None or start_timestamp > stats[latest]:
+                    stats[latest] = start_timestamp
+            summary[vmname] = stats
+        return summary
+
+    def show_summary(self, filesets=None):
+        """Print a summary of existing backups, one line per VM."""
+        summary = Fleet.summarize(self.existing_backups(filesets=filesets))
+        for vmname in sorted(summary.keys()):
+            stats = summary[vmname]
+            print '{0:20} full={1:<4} incr={2:<4} bytes={3:<14} latest_full={4} latest_incr={5}'.format(
+                vmname, stats['full'], stats['incr'], stats['bytes'],
+                stats['latest_full'] or '-', stats['latest_incr'] or '-')
+
+    #
+    # Prune methods.
+    #
+
+    def prune_old_backups(self, older_than, filesets):
+        """Delete old backups in all containers."""
+        self.run(
+            lambda container: self.backup_agent.prune_old_backups(
+                older_than=older_than, filesets=filesets, container=container))
@@ -0,0 +1,164 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""HttpSession module."""
+
+import socket
+import weakref
+import threading
+
+from azfilebak.instrumentation import Instrumentation
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = "20s"
+DEFAULT_READ_TIMEOUT = "2m"
+# Idle pooled connections are probed well before the load balancers in
+# front of the storage service drop them (after 4 minutes).
+KEEPALIVE_IDLE_SECONDS = 60
+KEEPALIVE_INTERVAL_SECONDS = 15
+KEEPALIVE_COUNT = 4
+
+class HttpSession(object):
+    """
+    The requests session shared by all storage calls of the process, so
+    that connections (and their TLS sessions) are kept alive and reused
+    across listing, uploads, downloads and deletes, and across storage
+    clients. The connection pool grows to the concurrency of the callers.
+    Each storage client gets its own session (see client_session) that
+    shares the connection pool but not the headers, such as the bearer
+    token of its storage account.
+
+    New and reused connections are counted in the instrumentation as
+    'http.connections.new' and 'http.connections.reused'.
+
+    >>> from socket import SOL_SOCKET, SO_RCVBUF
+    >>> (SOL_SOCKET, SO_RCVBUF, 1048576) in HttpSession.socket_options(socket_buffer_size=1048576)
+    True
+    """
+
+    _lock = threading.Lock()
+    _session = None
+    _pool_size = 0
+    _socket_options = None
+    # Sessions of the storage clients, which mount the adapters of the shared session
+    _client_sessions = weakref.WeakSet()
+
+    @staticmethod
+    def socket_options(socket_buffer_size=None):
+        """
+        Options of new sockets: no Nagle delay, TCP keep-alive, and fixed
+        buffer sizes if given (by default the kernel sizes them).
+        """
+        options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                   (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        for (name, value) in [('TCP_KEEPIDLE', KEEPALIVE_IDLE_SECONDS),
+                              ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL_SECONDS),
+                              ('TCP_KEEPCNT', KEEPALIVE_COUNT)]:
+            if hasattr(socket, name):
+                options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+        if socket_buffer_size:
+            options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, socket_buffer_size))
+            options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, socket_buffer_size))
+        return options
+
+    @staticmethod
+    def get(pool_size=DEFAULT_POOL_SIZE, socket_buffer_size=None):
+        """Create or return the shared session, with at least pool_size connections."""
+        with HttpSession._lock:
+            if HttpSession._session is None:
+                import requests
+                HttpSession._session = requests.Session()
+                HttpSession._socket_options = HttpSession.socket_options(socket_buffer_size)
+            if pool_size > HttpSession._pool_size:
+                HttpSession._mount(pool_size)
+            return HttpSession._session
+
+    @staticmethod
+    def client_session(pool_size=DEFAULT_POOL_SIZE, socket_buffer_size=None):
+        """
+        A session for one storage client, using the connection pool of the
+        shared session. Credentials set the Authorization header on the
+        session of their client, so sessions with headers are not shared.
+        """
+        import requests
+        shared = HttpSession.get(pool_size=pool_size, socket_buffer_size=socket_buffer_size)
+        with HttpSession._lock:
+            session = requests.Session()
+            for (prefix, adapter) in shared.adapters.items():
+                session.mount(prefix, adapter)
+            HttpSession._client_sessions.add(session)
+            return session
+
+    @staticmethod
+    def resize(pool_size):
+        """Grow the connection pool for pool_size concurrent callers."""
+        HttpSession.get(pool_size=pool_size)
+
+    @staticmethod
+    def _mount(pool_size):
+        """
+        Replace the adapters with ones for pool_size connections per host,
+        and close the previous ones: their idle connections are closed at
+        once, and the connections in use when they are returned.
+        """
+        adapter = create_adapter(pool_size, HttpSession._socket_options)
+        sessions = [HttpSession._session] + list(HttpSession._client_sessions)
+        previous = set(session.adapters[prefix] for session in sessions for prefix in ['http://', 'https://'])
+        for session in sessions:
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        for old_adapter in previous:
+            old_adapter.close()
+        HttpSession._pool_size = pool_size
+        Instrumentation.gauge('http.pool_size', pool_size)
+
+    @staticmethod
+    def reset():
+        """Forget the shared session (for tests)."""
+        with HttpSession._lock:
+            if HttpSession._session is not None:
+                HttpSession._session.close()
+            HttpSession._session = None
+            HttpSession._pool_size = 0
+            HttpSession._client_sessions = weakref.WeakSet()
+
+def create_adapter(pool_size, socket_options):
+    """
+    A requests adapter whose connection pools apply the socket options
+    and count new and reused connections. The classes are defined here
+    so that requests is only imported when storage is used.
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def make_request(pool_class):
+        """_make_request of pool_class, counting connections."""
+        def _make_request(self, conn, *args, **kwargs):
+            # Pooled connections that were dropped are reconnected as well
+            if conn.sock is None:
+                Instrumentation.incr('http.connections.new')
+            else:
+                Instrumentation.incr('http.connections.reused')
+            return pool_class._make_request(self, conn, *args, **kwargs)
+        return _make_request
+
+    pool_classes = {
+        'http': type('CountingHTTPConnectionPool', (HTTPConnectionPool,),
+                     {'_make_request': make_request(HTTPConnectionPool)}),
+        'https': type('CountingHTTPSConnectionPool', (HTTPSConnectionPool,),
+                      {'_make_request': make_request(HTTPSConnectionPool)}),
+    }
+
+    class StorageHTTPAdapter(HTTPAdapter):
+        """HTTPAdapter with socket options and counting connection pools."""
+
+        def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+            pool_kwargs['socket_options'] = socket_options
+            HTTPAdapter.init_poolmanager(self, connections, maxsize, block, **pool_kwargs)
+            self.poolmanager.pool_classes_by_scheme = pool_classes
+
+    return StorageHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
@@ -0,0 +1,93 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Instrumentation module."""
+
+import time
+import threading
+from contextlib import contextmanager
+
+class Instrumentation(object):
+    """
+    Process-wide counters, gauges and timers. They are reported at the
+    end of a run when the '--instrumentation' option is used.
+
+    >>> Instrumentation.reset()
+    >>> Instrumentation.incr('requests')
+    >>> Instrumentation.incr('requests', 2)
+    >>> Instrumentation.gauge('workers', 4)
+    >>> with Instrumentation.timer('startup'):
+    ...     pass
+    >>> report = Instrumentation.report()
+    >>> (report['counters']['requests'], report['gauges']['workers'], report['timers']['startup']['count'])
+    (3, 4, 1)
+    """
+
+    _lock = threading.Lock()
+    _counters = dict()
+    _gauges = dict()
+    _timers = dict()
+    _providers = dict()
+
+    @classmethod
+    def reset(cls):
+        """Clear all values."""
+        with cls._lock:
+            cls._counters.clear()
+            cls._gauges.clear()
+            cls._timers.clear()
+            cls._providers.clear()
+
+    @classmethod
+    def incr(cls, name, value=1):
+        """Increment a counter."""
+        with cls._lock:
+            cls._counters[name] = cls._counters.get(name, 0) + value
+
+    @classmethod
+    def gauge(cls, name, value):
+        """Set a gauge to its current value."""
+        with cls._lock:
+            cls._gauges[name] = value
+
+    @classmethod
+    def add_time(cls, name, seconds):
+        """Record a duration."""
+        with cls._lock:
+            timer = cls._timers.setdefault(name, {'count': 0, 'seconds': 0.0})
+            timer['count'] += 1
+            timer['seconds'] += seconds
+
+    @classmethod
+    @contextmanager
+    def timer(cls, name):
+        """Context manager recording the time spent in the block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            cls.add_time(name, time.time() - start)
+
+    @classmethod
+    def register(cls, name, provider):
+        """Register a function returning a dictionary of values, evaluated at report time."""
+        with cls._lock:
+            cls._providers[name] = provider
+
+    @classmethod
+    def report(cls):
+        """Return all values as a dictionary."""
+        with cls._lock:
+            report = {
+                'counters': dict(cls._counters),
+                'gauges': dict(cls._gauges),
+                'timers': dict((k, dict(v)) for (k, v) in cls._timers.items())
+            }
+            providers = dict(cls._providers)
+        for (name, provider) in providers.items():
+            report[name] = provider()
+        return report
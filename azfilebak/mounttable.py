@@ -0,0 +1,150 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""MountTable module."""
+
+import os
+import logging
+import threading
+from collections import namedtuple
+
+Mount = namedtuple('Mount', ['device', 'mountpoint', 'fstype'])
+
+# Kernel and memory file systems: their content is not worth a backup
+PSEUDO_FSTYPES = frozenset([
+    'autofs', 'binfmt_misc', 'bpf', 'cgroup', 'cgroup2', 'configfs', 'debugfs', 'devfs', 'devpts',
+    'devtmpfs', 'efivarfs', 'fusectl', 'hugetlbfs', 'mqueue', 'nsfs', 'overlay', 'proc', 'pstore',
+    'ramfs', 'rpc_pipefs', 'securityfs', 'selinuxfs', 'squashfs', 'sysfs', 'tmpfs', 'tracefs',
+    'fuse.lxcfs', 'fuse.gvfsd-fuse', 'fuse.portal'
+])
+# Remote file systems: they are backed up (if at all) where they are served
+NETWORK_FSTYPES = frozenset([
+    '9p', 'afs', 'ceph', 'cifs', 'davfs', 'glusterfs', 'lustre', 'ncpfs', 'nfs', 'nfs4', 'smb3', 'smbfs',
+    'fuse.blobfuse', 'fuse.blobfuse2', 'fuse.ceph', 'fuse.glusterfs', 'fuse.s3fs', 'fuse.sshfs'
+])
+# A hung network mount must not block the backup
+STATVFS_TIMEOUT_SECONDS = 2
+
+class MountTable(object):
+    """
+    Classify the mounts below the directories of a backup, to keep pseudo
+    and network file systems out of the archive. The mount table is read
+    once per process.
+
+    >>> MountTable.classify(Mount('server:/export', '/mnt/nfs', 'nfs4'))
+    'network'
+    >>> MountTable.classify(Mount('tmpfs', '/tmp', 'tmpfs'), allow=['tmpfs'])
+    'local'
+    >>> MountTable.classify(Mount('/dev/sdc1', '/scratch', 'xfs'), deny=['xfs'])
+    'denied'
+    >>> MountTable.below(Mount('proc', '/proc', 'proc'), ['/']), MountTable.below(Mount('proc', '/proc', 'proc'), ['/proc'])
+    (True, False)
+    """
+
+    _mounts = None
+
+    @staticmethod
+    def parse(lines):
+        """
+        Parse lines in the format of /proc/self/mounts.
+
+        >>> MountTable.parse(['/dev/sda1 / ext4 rw 0 0', 'srv:/a\\\\040b /mnt/a\\\\040b nfs rw 0 0'])
+        [Mount(device='/dev/sda1', mountpoint='/', fstype='ext4'), Mount(device='srv:/a b', mountpoint='/mnt/a b', fstype='nfs')]
+        """
+        mounts = []
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            # Spaces and tabs in paths are escaped as octal sequences
+            (device, mountpoint) = [f.decode('string_escape') for f in fields[:2]]
+            mounts.append(Mount(device, mountpoint, fields[2]))
+        return mounts
+
+    @staticmethod
+    def mounts():
+        """The mounts of the system, read once."""
+        if MountTable._mounts is None:
+            try:
+                with open('/proc/self/mounts', 'rt') as mounts_file:
+                    MountTable._mounts = MountTable.parse(mounts_file)
+            except IOError:
+                # Not Linux
+                import psutil
+                MountTable._mounts = [Mount(p.device, p.mountpoint, p.fstype)
+                                      for p in psutil.disk_partitions(True)]
+        return MountTable._mounts
+
+    @staticmethod
+    def classify(mount, allow=(), deny=()):
+        """
+        Return 'pseudo', 'network' or 'denied' for mounts to exclude, or
+        'local'. The allow and deny lists of file system types override
+        the default classification.
+        """
+        if mount.fstype in deny:
+            return 'denied'
+        if mount.fstype in allow:
+            return 'local'
+        if mount.fstype in PSEUDO_FSTYPES:
+            return 'pseudo'
+        if mount.fstype in NETWORK_FSTYPES:
+            return 'network'
+        return 'local'
+
+    @staticmethod
+    def below(mount, sources):
+        """True if the mount point is inside one of the sources (but is not a source itself)."""
+        for source in sources:
+            prefix = source.rstrip('/') + '/'
+            if mount.mountpoint != source and mount.mountpoint.startswith(prefix):
+                return True
+        return False
+
+    @staticmethod
+    def used_bytes(mountpoint):
+        """Bytes used on the file system, or None if it does not answer in time."""
+        result = []
+
+        def statvfs():
+            """Thread body."""
+            try:
+                stat = os.statvfs(mountpoint)
+                result.append((stat.f_blocks - stat.f_bfree) * stat.f_frsize)
+            except OSError:
+                pass
+
+        thread = threading.Thread(target=statvfs, name="statvfs")
+        thread.daemon = True
+        thread.start()
+        thread.join(STATVFS_TIMEOUT_SECONDS)
+        return result[0] if result else None
+
+    @staticmethod
+    def exclusions(sources, excluded=(), allow=(), deny=()):
+        """
+        Mount points inside the sources to exclude from the backup, in the
+        order of the mount table. Mounts inside an already excluded
+        directory are skipped. Logs the data each exclusion avoids reading.
+        """
+        excluded = [e.rstrip('/') or '/' for e in excluded if e]
+        result = []
+        for mount in MountTable.mounts():
+            if not MountTable.below(mount, sources):
+                continue
+            kind = MountTable.classify(mount, allow, deny)
+            if kind == 'local':
+                continue
+            if any(mount.mountpoint == e or mount.mountpoint.startswith(e.rstrip('/') + '/') for e in excluded):
+                continue
+            used = MountTable.used_bytes(mount.mountpoint)
+            logging.info("Excluding %s mount %s (%s), avoids reading %s",
+                         kind, mount.mountpoint, mount.fstype,
+                         "unknown size" if used is None else "{:.1f} MB".format(used / 1024.0 / 1024.0))
+            excluded.append(mount.mountpoint)
+            result.append(mount.mountpoint)
+        return result
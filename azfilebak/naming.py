@@ -13,6 +13,9 @@ import re
 class Naming(object):
     """Utility functions to generate file and blob names."""
 
+    BLOBNAME_PATTERN = (r'(?P<fileset>\S+?)_(?P<vmname>\S+?)_(?P<type>full|incr)_(?P<start>\d{8}_\d{6})'
+                        r'(?:\.(?P<stripe>\d+)of(?P<stripes>\d+))?(?:\.tar\.gz|\.manifest\.json)')
+
     @staticmethod
     def backup_type_str(is_full):
         """
@@ -104,14 +107,21 @@ class Naming(object):
     @staticmethod
     def parse_blobname(filename):
         """
+        Parse the name of a backup blob, a stripe of a backup, or the
+        manifest of a striped backup.
+
         >>> Naming.parse_blobname('test1fs_vm1_full_20180601_112429.tar.gz')
         ('test1fs', True, '20180601_112429', 'vm1')
         >>> Naming.parse_blobname('test1fs_vm1_incr_20180601_112429.tar.gz')
         ('test1fs', False, '20180601_112429', 'vm1')
+        >>> Naming.parse_blobname('test1fs_vm1_full_20180601_112429.2of4.tar.gz')
+        ('test1fs', True, '20180601_112429', 'vm1')
+        >>> Naming.parse_blobname('test1fs_vm1_full_20180601_112429.manifest.json')
+        ('test1fs', True, '20180601_112429', 'vm1')
         >>> Naming.parse_filename('bad_input') == None
         True
         """
-        match = re.search(r'(?P<fileset>\S+?)_(?P<vmname>\S+?)_(?P<type>full|incr)_(?P<start>\d{8}_\d{6})\.tar.gz', filename)
+        match = re.search(Naming.BLOBNAME_PATTERN, filename)
         if match is None:
             return None
 
@@ -123,6 +133,68 @@ class Naming(object):
 
         return fileset, is_full, start_timestamp, vmname
 
+    @staticmethod
+    def construct_stripe_blobname(fileset, is_full, start_timestamp, vmname, stripe_index, stripe_count):
+        """
+        Name of one stripe (counted from 1) of a striped backup.
+
+        >>> Naming.construct_stripe_blobname("test1fs", True, "20180601_112429", "vm1", 2, 4)
+        'test1fs_vm1_full_20180601_112429.2of4.tar.gz'
+        """
+        return "{fileset}_{vmname}_{type}_{start}.{index}of{count}.tar.gz".format(
+            fileset=fileset,
+            vmname=vmname,
+            type=Naming.backup_type_str(is_full),
+            start=start_timestamp,
+            index=stripe_index,
+            count=stripe_count)
+
+    @staticmethod
+    def construct_manifest_name(blobname):
+        """
+        Name of the manifest of a striped backup, from its logical blob name.
+
+        >>> Naming.construct_manifest_name('test1fs_vm1_full_20180601_112429.tar.gz')
+        'test1fs_vm1_full_20180601_112429.manifest.json'
+        """
+        return blobname[:-len('.tar.gz')] + '.manifest.json'
+
+    @staticmethod
+    def parse_stripe(blobname):
+        """
+        Return (stripe_index, stripe_count) of a stripe, or None.
+
+        >>> Naming.parse_stripe('test1fs_vm1_full_20180601_112429.2of4.tar.gz')
+        (2, 4)
+        >>> Naming.parse_stripe('test1fs_vm1_full_20180601_112429.tar.gz') is None
+        True
+        """
+        match = re.search(Naming.BLOBNAME_PATTERN, blobname)
+        if match is None or match.group('stripe') is None:
+            return None
+        return int(match.group('stripe')), int(match.group('stripes'))
+
+    @staticmethod
+    def is_manifest(blobname):
+        """
+        >>> Naming.is_manifest('test1fs_vm1_full_20180601_112429.manifest.json')
+        True
+        """
+        return blobname.endswith('.manifest.json')
+
+    @staticmethod
+    def logical_blobname(blobname):
+        """
+        The name a striped backup is listed and restored as.
+
+        >>> Naming.logical_blobname('test1fs_vm1_full_20180601_112429.2of4.tar.gz')
+        'test1fs_vm1_full_20180601_112429.tar.gz'
+        >>> Naming.logical_blobname('test1fs_vm1_full_20180601_112429.manifest.json')
+        'test1fs_vm1_full_20180601_112429.tar.gz'
+        """
+        (fileset, is_full, start_timestamp, vmname) = Naming.parse_blobname(blobname)
+        return Naming.construct_blobname(fileset, is_full, start_timestamp, vmname)
+
     @staticmethod
     def blobname_to_filename(blobname):
         """Convert blob name to file name."""
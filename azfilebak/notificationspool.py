@@ -0,0 +1,324 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""NotificationSpool module."""
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import shlex
+import logging
+import argparse
+import itertools
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.backupexception import BackupException
+
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_TIMEOUT_SECONDS = 60
+# Retries wait 10s, 20s, 40s, ... up to an hour; after the last attempt
+# the notification is moved to the 'failed' subdirectory.
+BACKOFF_BASE_SECONDS = 10
+BACKOFF_MAX_SECONDS = 3600
+MAX_ATTEMPTS = 12
+
+class NotificationSpool(object):
+    """
+    Deliver notifications asynchronously. Each notification is written to
+    its own file (an 'envelope') in the spool directory; a single drainer per
+    host then runs the notification command for the spooled messages, with
+    a bounded number of commands in flight, and retries failed deliveries
+    with exponential backoff. The drainer is a detached process when the
+    tool runs from cron, or a thread of the daemon.
+
+    >>> NotificationSpool.backoff(1), NotificationSpool.backoff(3), NotificationSpool.backoff(20)
+    (10, 40, 3600)
+    """
+
+    _sequence = itertools.count()
+
+    def __init__(self, directory, command, batch_size=DEFAULT_BATCH_SIZE,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+                 background='process'):
+        self.directory = directory
+        self.command = command
+        self.batch_size = max(1, int(batch_size))
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.timeout_seconds = timeout_seconds
+        self.background = background
+        self.worker = None
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+
+    @staticmethod
+    def backoff(attempts):
+        """Seconds to wait before the next attempt."""
+        return min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS)
+
+    def makedirs(self):
+        """Create the spool directories."""
+        for directory in [self.directory, os.path.join(self.directory, 'tmp'),
+                          os.path.join(self.directory, 'failed')]:
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+
+    #
+    # Producer side.
+    #
+
+    def write_envelope(self, filename, envelope):
+        """Atomically write an envelope: write in 'tmp', then rename into the spool."""
+        tmp_filename = os.path.join(self.directory, 'tmp', os.path.basename(filename))
+        with open(tmp_filename, 'wt') as envelope_file:
+            json.dump(envelope, envelope_file)
+        os.rename(tmp_filename, filename)
+
+    def enqueue(self, message):
+        """Spool a message and make sure a drainer is running."""
+        with Instrumentation.timer('notification.enqueue'):
+            self.makedirs()
+            now = time.time()
+            filename = os.path.join(self.directory, "{:.6f}-{}-{}.json".format(
+                now, os.getpid(), next(NotificationSpool._sequence)))
+            self.write_envelope(filename, {
+                'message': message,
+                'created': now,
+                'attempts': 0,
+                'next_attempt': now
+            })
+            self.kick()
+        return filename
+
+    def kick(self):
+        """
+        Wake up the drainer thread, or start a drainer process unless one
+        holds the spool lock: it checks the spool again after releasing
+        the lock, so that it delivers the message without a new process.
+        """
+        if self.worker is not None:
+            self._wakeup.set()
+        elif self.background == 'process':
+            lock_file = self.lock()
+            if lock_file is None:
+                return
+            lock_file.close()
+            self.spawn_drainer()
+
+    def spawn_drainer(self):
+        """
+        Start a detached drainer process. If another drainer already holds
+        the spool lock, the new one exits immediately.
+        """
+        self.makedirs()
+        log_filename = os.path.join(self.directory, 'drainer.log')
+        with open(os.devnull, 'r+') as devnull, open(log_filename, 'a') as log_file:
+            subprocess.Popen(
+                [sys.executable, '-m', 'azfilebak.notificationspool',
+                 '--command', self.command,
+                 '--batch-size', str(self.batch_size),
+                 '--max-in-flight', str(self.max_in_flight),
+                 '--timeout', str(self.timeout_seconds),
+                 self.directory],
+                stdin=devnull, stdout=log_file, stderr=log_file,
+                close_fds=True, preexec_fn=os.setsid)
+
+    #
+    # Consumer side.
+    #
+
+    def envelopes(self):
+        """Return (filename, envelope) for all spooled messages, oldest first."""
+        result = []
+        try:
+            names = sorted(n for n in os.listdir(self.directory) if n.endswith('.json'))
+        except OSError:
+            return result
+        for name in names:
+            filename = os.path.join(self.directory, name)
+            try:
+                with open(filename, 'rt') as envelope_file:
+                    result.append((filename, json.load(envelope_file)))
+            except (IOError, OSError, ValueError):
+                # Delivered and removed by another drainer in the meantime
+                continue
+        return result
+
+    def seconds_until_next_attempt(self):
+        """Seconds until a spooled message is due, or None if the spool is empty."""
+        envelopes = self.envelopes()
+        if not envelopes:
+            return None
+        return max(0, min(e['next_attempt'] for (_f, e) in envelopes) - time.time())
+
+    def send(self, messages):
+        """
+        Run the notification command once for a list of messages, separated
+        by newlines on its standard input. Returns True on success.
+        """
+        cmd = shlex.split(self.command)
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, close_fds=True)
+        except OSError as ex:
+            # Silently ignore error if notification command does not exist
+            if ex.errno == errno.ENOENT:
+                logging.debug("Notification command %s not found", cmd[0])
+                return True
+            logging.warning("Cannot run notification command %s: %s", cmd[0], ex)
+            return False
+
+        def kill():
+            """Do not let a hung notifier block the spool forever."""
+            try:
+                logging.warning("Notification command %s timed out", cmd[0])
+                proc.kill()
+            except OSError:
+                pass
+
+        timer = threading.Timer(self.timeout_seconds, kill)
+        timer.start()
+        try:
+            proc.communicate("\n".join(messages))
+        finally:
+            timer.cancel()
+        if proc.returncode != 0:
+            logging.warning("Notification command %s failed with return code %d", cmd[0], proc.returncode)
+            return False
+        return True
+
+    def deliver(self, batch):
+        """Deliver a batch of (filename, envelope) and update the spool."""
+        with Instrumentation.timer('notification.deliver'):
+            success = self.send([envelope['message'] for (_filename, envelope) in batch])
+        for (filename, envelope) in batch:
+            if success:
+                Instrumentation.incr('notification.delivered')
+                os.remove(filename)
+                continue
+            envelope['attempts'] += 1
+            if envelope['attempts'] >= MAX_ATTEMPTS:
+                Instrumentation.incr('notification.failed')
+                logging.error("Giving up notification %s after %d attempts", filename, envelope['attempts'])
+                os.rename(filename, os.path.join(self.directory, 'failed', os.path.basename(filename)))
+            else:
+                Instrumentation.incr('notification.retried')
+                envelope['next_attempt'] = time.time() + NotificationSpool.backoff(envelope['attempts'])
+                self.write_envelope(filename, envelope)
+        return success
+
+    def lock(self):
+        """Take the spool lock without waiting; returns the lock file, or None."""
+        self.makedirs()
+        lock_file = open(os.path.join(self.directory, '.lock'), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except IOError as ex:
+            lock_file.close()
+            if ex.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+
+    def drain(self):
+        """
+        Deliver all the messages that are due. Returns False if another
+        drainer holds the spool lock.
+        """
+        lock_file = self.lock()
+        if lock_file is None:
+            return False
+        pool = ThreadPool(processes=self.max_in_flight)
+        try:
+            while True:
+                now = time.time()
+                due = [(f, e) for (f, e) in self.envelopes() if e['next_attempt'] <= now]
+                if not due:
+                    break
+                batches = [due[i:i + self.batch_size] for i in range(0, len(due), self.batch_size)]
+                # Failed batches are rescheduled in the future, so this terminates
+                pool.map(self.deliver, batches)
+        finally:
+            pool.close()
+            pool.join()
+            lock_file.close()
+        return True
+
+    def run(self):
+        """Drain until the spool is empty (drainer process)."""
+        while True:
+            if not self.drain():
+                return
+            # Checked after the lock is released, so that a message spooled
+            # while its drainer could not get the lock is not left behind.
+            wait = self.seconds_until_next_attempt()
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    #
+    # Drainer thread, used by the daemon.
+    #
+
+    def start_worker_thread(self):
+        """Deliver notifications from a background thread instead of a process."""
+        def run():
+            """Thread body."""
+            while not self._stop.is_set():
+                try:
+                    self.drain()
+                except Exception as ex:
+                    logging.error("Notification spool: %s", ex)
+                wait = self.seconds_until_next_attempt()
+                self._wakeup.wait(BACKOFF_MAX_SECONDS if wait is None else max(wait, 0.1))
+                self._wakeup.clear()
+
+        self.worker = threading.Thread(target=run, name="notification-spool")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop_worker_thread(self, hand_over=False):
+        """
+        Stop the drainer thread. With hand_over, messages still in the
+        spool are left to a drainer process.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        self.worker = None
+        if hand_over and self.seconds_until_next_attempt() is not None:
+            self.spawn_drainer()
+
+def main(argv=None):
+    """Drainer process entry point."""
+    parser = argparse.ArgumentParser(description="Deliver spooled notifications")
+    parser.add_argument("--command", required=True)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT_SECONDS)
+    parser.add_argument("directory")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)-15s pid-%(process)d %(levelname)s: \"%(message)s\"")
+    NotificationSpool(args.directory, args.command, batch_size=args.batch_size,
+                      max_in_flight=args.max_in_flight, timeout_seconds=args.timeout,
+                      background=None).run()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except BackupException as be:
+        sys.stderr.write("{}\n".format(be.message))
+        sys.exit(-1)
@@ -0,0 +1,154 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Replication module."""
+
+import time
+import logging
+import datetime
+from multiprocessing.pool import ThreadPool
+
+from azfilebak.naming import Naming
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.backupexception import BackupException
+
+DEFAULT_REPLICATION_WORKERS = 8
+
+def utc(created):
+    """
+    Naive UTC time of a BlobInfo creation time, which the blob service
+    returns with a time zone.
+
+    >>> import dateutil.tz
+    >>> utc(datetime.datetime(2018, 7, 1, 14, 0, tzinfo=dateutil.tz.tzoffset(None, 7200)))
+    datetime.datetime(2018, 7, 1, 12, 0)
+    """
+    if created is not None and created.tzinfo is not None:
+        return (created - created.utcoffset()).replace(tzinfo=None)
+    return created
+
+class Replicator(object):
+    """
+    Mirror the backups of a container to other storage accounts (or
+    regions) with server-side copies: the target service reads each blob
+    from a read-only URL of the source, so no data goes through the VM.
+
+    A blob is replicated when a blob of the same name and size exists in
+    the target container; each run copies the others. Every worker has
+    one copy in flight and polls its status until it is done. Stripe
+    manifests are copied after all the data, so that a target never has
+    a manifest of stripes it does not have yet.
+    """
+
+    def __init__(self, backup_configuration, targets=None, workers=None):
+        self.backup_configuration = backup_configuration
+        self.source = backup_configuration.storage_backend
+        self.container_name = backup_configuration.azure_storage_container_name
+        # List of (name, StorageBackend, container name)
+        self.targets = targets if targets is not None else backup_configuration.get_replication_backends()
+        self.workers = max(1, int(workers or backup_configuration.get_replication_workers()))
+
+    def pending(self, target, filesets=None):
+        """
+        Blobs of the source container (BlobInfo) not yet replicated to a
+        target, the data before the manifests, oldest first.
+        """
+        (_name, backend, container_name) = target
+        replicated = dict((b.name, b.size) for b in backend.iter_blobs(container_name))
+        blobs = []
+        for blob in self.source.iter_blobs(self.container_name):
+            if replicated.get(blob.name) == blob.size:
+                continue
+            if filesets:
+                parsed = Naming.parse_blobname(blob.name)
+                if parsed is None or parsed[0] not in filesets:
+                    continue
+            blobs.append(blob)
+        blobs.sort(key=lambda b: (Naming.is_manifest(b.name), utc(b.created), b.name))
+        return blobs
+
+    def copy(self, target, blob):
+        """Copy a blob to a target and wait for the copy; returns the error, or None."""
+        (name, backend, container_name) = target
+        try:
+            with Instrumentation.timer('replication.copy'):
+                status = backend.start_copy(container_name, blob.name,
+                                            self.source.source_url(self.container_name, blob.name))
+                backend.wait_for_copy(container_name, blob.name, status)
+            logging.debug("Replicated %s to %s", blob.name, name)
+            return None
+        except Exception as ex:
+            logging.error("Cannot replicate %s to %s: %s", blob.name, name, ex)
+            return ex
+
+    def replicate(self, filesets=None):
+        """
+        Copy the blobs missing in each target. Returns a report per target
+        with the number and bytes of blobs copied, the time and throughput,
+        the failures, and the lag: the age of the oldest blob that was not
+        replicated when the run started.
+        """
+        start = time.time()
+        now = datetime.datetime.utcnow()
+        jobs = []
+        reports = []
+        for target in self.targets:
+            blobs = self.pending(target, filesets)
+            created = [utc(b.created) for b in blobs if b.created is not None]
+            reports.append({
+                'target': target[0],
+                'blobs': len(blobs),
+                'bytes': sum(b.size for b in blobs),
+                'lag_seconds': (now - min(created)).total_seconds() if created else 0,
+                'failed': []
+            })
+            jobs.extend((len(reports) - 1, target, blob) for blob in blobs)
+        logging.info("Replicating %d blobs of %s to %d targets with %d workers",
+                     len(jobs), self.container_name, len(self.targets), self.workers)
+
+        def run(job):
+            """Copy one blob, for the pool."""
+            (index, target, blob) = job
+            return (index, blob, self.copy(target, blob))
+
+        for target in self.targets:
+            target[1].set_concurrency(self.workers)
+        pool = ThreadPool(processes=self.workers)
+        try:
+            # The manifests only once all the data is copied
+            results = pool.map(run, [j for j in jobs if not Naming.is_manifest(j[2].name)])
+            results += pool.map(run, [j for j in jobs if Naming.is_manifest(j[2].name)])
+        finally:
+            pool.close()
+            pool.join()
+
+        seconds = time.time() - start
+        for (index, blob, ex) in results:
+            if ex is not None:
+                reports[index]['failed'].append(blob.name)
+                reports[index]['blobs'] -= 1
+                reports[index]['bytes'] -= blob.size
+        for report in reports:
+            copied = report['bytes']
+            report['seconds'] = round(seconds, 3)
+            report['mb_per_second'] = round(copied / 1024.0 / 1024.0 / seconds, 1) if seconds > 0 else 0
+            logging.info("Replicated %d blobs (%d bytes) to %s in %.1f s (%.1f MB/s), lag was %d s, %d failed",
+                         report['blobs'], copied, report['target'], seconds, report['mb_per_second'],
+                         report['lag_seconds'], len(report['failed']))
+            Instrumentation.incr('replication.bytes', copied)
+        return reports
+
+    def show_report(self, filesets=None):
+        """Replicate and print the report of each target; raises BackupException if copies failed."""
+        reports = self.replicate(filesets=filesets)
+        for report in reports:
+            print '{0:30} blobs={1:<6} bytes={2:<14} seconds={3:<8} MB/s={4:<8} lag={5}s failed={6}'.format(
+                report['target'], report['blobs'], report['bytes'], report['seconds'],
+                report['mb_per_second'], int(report['lag_seconds']), len(report['failed']))
+        failed = ["{} ({})".format(r['target'], len(r['failed'])) for r in reports if r['failed']]
+        if failed:
+            raise BackupException("Failed to replicate blobs to: {}".format(", ".join(failed)))
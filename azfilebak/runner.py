@@ -9,18 +9,22 @@
 
 import sys
 import os
+import json
 import os.path
 import getpass
 import socket
 import logging
 import argparse
-import pid
 
 from .backupagent import BackupAgent
+from .fleet import Fleet, DEFAULT_FLEET_WORKERS
+from .replication import Replicator
 from .backupconfiguration import BackupConfiguration
 from .scheduleparser import ScheduleParser
 from .timing import Timing
 from .backupexception import BackupException
+from .instrumentation import Instrumentation
+from .funcmodule import printe
 from .__init__ import version
 
 class Runner(object):
@@ -49,11 +53,22 @@ class Runner(object):
         commands = parser.add_argument_group("commands")
 
         commands.add_argument("-f", "--full-backup", help="Perform backup for configuration", action="store_true")
+        commands.add_argument("-D", "--daemon",
+                              help="Keep running and perform full backups when they are due",
+                              action="store_true")
         commands.add_argument("-r", "--restore", help="Perform restore for date")
         commands.add_argument("-l", "--list-backups", help="Lists all backups in Azure storage",
                               action="store_true")
+        commands.add_argument("-S", "--summary", help="Shows a summary of existing backups per VM",
+                              action="store_true")
         commands.add_argument("-p", "--prune-old-backups",
                               help="Removes old backups from Azure storage ('--prune-old-backups 30d' removes files older 30 days)")
+        commands.add_argument("-T", "--synthetic-full",
+                              help="Builds a full backup in storage from the latest full and later incremental backups",
+                              action="store_true")
+        commands.add_argument("-P", "--replicate",
+                              help="Copies new backups to the replication targets with server-side copies",
+                              action="store_true")
         commands.add_argument("-x", "--show-configuration",
                               help="Shows the VM's configuration values",
                               action="store_true")
@@ -69,10 +84,22 @@ class Runner(object):
 
         options.add_argument("-C", "--container", help="Override container name to use (for list and restore)")
 
+        options.add_argument("-M", "--fleet",
+                             help="Run list, summary or prune on all containers in the storage account, "
+                                  "or on the containers given with '--container A,B,C'",
+                             action="store_true")
+
+        options.add_argument("-W", "--workers", type=int, default=DEFAULT_FLEET_WORKERS,
+                             help="Number of containers processed in parallel in fleet mode")
+
         options.add_argument("-s", "--stream",
                              help="Stream restore data to stdout",
                              action="store_true")
 
+        options.add_argument("-e", "--extract",
+                             help="Extract the restored backup into the output directory (or stream it uncompressed)",
+                             action="store_true")
+
         options.add_argument("-o",  "--output-dir", help="Specify target folder for backup files")
 
         options.add_argument("-c", "--config", help="the path to the config file")
@@ -81,6 +108,10 @@ class Runner(object):
                              help="display debug messages",
                              action="store_true")
 
+        options.add_argument("-I", "--instrumentation",
+                             help="Print timings and counters to stderr at the end of the run",
+                             action="store_true")
+
         options.add_argument("-R", "--rate-limit",
                              help="Limits the rate the backup is written/read [value in MB/s]")
 
@@ -152,6 +183,13 @@ class Runner(object):
         logging.debug("User did not select filesets, will use default fileset")
         return []
 
+    @staticmethod
+    def get_containers(args):
+        """Determine containers to process in fleet mode."""
+        if args.container:
+            return args.container.split(",")
+        return None
+
     @staticmethod
     def main():
         """Main method."""
@@ -165,19 +203,50 @@ class Runner(object):
 
         logging.debug(Runner.log_script_invocation())
 
+        try:
+            with Instrumentation.timer('run'):
+                Runner.run_command(parser, args)
+        finally:
+            if args.instrumentation:
+                printe(json.dumps(Instrumentation.report(), indent=2, sort_keys=True))
+
+    @staticmethod
+    def run_command(parser, args):
+        """Execute the command requested on the command line."""
+
+        # Only the commands that need them pay for the output directory check,
+        # the instance metadata and the storage client; heavy modules are
+        # imported on first use.
+        if not (args.full_backup or args.daemon or args.restore or args.list_backups or args.summary
+                or args.prune_old_backups or args.synthetic_full or args.replicate
+                or args.show_configuration):
+            parser.print_help()
+            return
+
         config_file = Runner.get_config_file(args=args)
+
+        if args.daemon:
+            # The daemon loads (and reloads) the configuration itself
+            from .daemon import BackupDaemon
+            BackupDaemon(config_file, filesets=Runner.get_filesets(args), rate=args.rate_limit).run()
+            return
+
         backup_configuration = BackupConfiguration(config_file)
+        backup_configuration.validate()
         backup_agent = BackupAgent(backup_configuration)
-        output_dir = Runner.get_output_dir(args, backup_configuration)
         filesets = Runner.get_filesets(args)
 
         force = args.force
         rate = args.rate_limit
 
-        for line in backup_agent.get_configuration_printable(output_dir=output_dir):
-            logging.debug(line)
+        if args.restore or args.show_configuration:
+            output_dir = Runner.get_output_dir(args, backup_configuration)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                for line in backup_agent.get_configuration_printable(output_dir=output_dir):
+                    logging.debug(line)
 
         if args.full_backup:
+            import pid
             try:
                 with pid.PidFile(pidname='fileset-backup-full') as _p:
                     backup_agent.backup(filesets=filesets, is_full=args.full_backup, force=force, rate=rate)
@@ -192,7 +261,8 @@ class Runner(object):
                     blobname=args.restore,
                     output_dir=output_dir,
                     stream=args.stream,
-                    container=args.container)
+                    container=args.container,
+                    extract=args.extract)
             else:
                 # Restore using fileset + timestamp
                 try:
@@ -206,13 +276,28 @@ class Runner(object):
                     output_dir=output_dir,
                     filesets=filesets,
                     stream=args.stream,
-                    container=args.container)
+                    container=args.container,
+                    extract=args.extract)
+        elif args.fleet and (args.list_backups or args.summary or args.prune_old_backups):
+            fleet = Fleet(backup_agent, containers=Runner.get_containers(args), workers=args.workers)
+            if args.list_backups:
+                fleet.list_backups(filesets=filesets)
+            elif args.summary:
+                fleet.show_summary(filesets=filesets)
+            else:
+                age = ScheduleParser.parse_timedelta(args.prune_old_backups)
+                fleet.prune_old_backups(older_than=age, filesets=filesets)
         elif args.list_backups:
             backup_agent.list_backups(filesets=filesets, container=args.container)
+        elif args.summary:
+            fleet = Fleet(backup_agent, containers=[args.container or backup_configuration.azure_storage_container_name])
+            fleet.show_summary(filesets=filesets)
         elif args.prune_old_backups:
             age = ScheduleParser.parse_timedelta(args.prune_old_backups)
             backup_agent.prune_old_backups(older_than=age, filesets=filesets)
+        elif args.synthetic_full:
+            backup_agent.synthesize_fulls(filesets=filesets)
+        elif args.replicate:
+            Replicator(backup_configuration).show_report(filesets=filesets)
         elif args.show_configuration:
             print(backup_agent.show_configuration(output_dir=output_dir))
-        else:
-            parser.print_help()
@@ -0,0 +1,246 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""
+Offline schedule simulator.
+
+Replays virtual time through the scheduling rules of BackupAgent against an
+in-memory container, to tune 'bkp_fs_schedule' and the min/max intervals
+without waiting for real backups. Example:
+
+    python -m azfilebak.simulator --days 365 --full-size 500G --throughput 100 \\
+        --schedule "bkp_fs_schedule:mo:111111111000000000011111, ..., min:1d, max:3d"
+"""
+
+import re
+import sys
+import json
+import random
+import datetime
+import argparse
+
+from azfilebak.backupagent import BackupAgent
+from azfilebak.businesshours import BusinessHours
+from azfilebak.scheduleparser import ScheduleParser
+from azfilebak.backupexception import BackupException
+
+NO_BACKUP = datetime.datetime(1900, 1, 1)
+
+def parse_size(size_str):
+    """
+    Parse a size such as '500G' into bytes.
+
+    >>> parse_size('500G')
+    536870912000
+    >>> parse_size('42')
+    42
+    """
+    match = re.match(r"^\s*(\d+)\s*([KMGT]?)B?\s*$", size_str.upper())
+    if match is None:
+        raise BackupException("Cannot parse size '{}'".format(size_str))
+    return int(match.group(1)) * 1024 ** " KMGT".index(match.group(2) or " ")
+
+class BackupModel(object):
+    """
+    Model of backup sizes and durations. Sizes grow linearly over time,
+    durations are a fixed overhead plus the size divided by the throughput,
+    with an optional random jitter.
+    """
+
+    def __init__(self, full_size, incr_size=0, daily_growth=0, throughput=100 * 1024 ** 2,
+                 overhead=datetime.timedelta(minutes=1), jitter=0.0, seed=0):
+        self.full_size = full_size
+        self.incr_size = incr_size
+        self.daily_growth = daily_growth
+        self.throughput = throughput
+        self.overhead = overhead
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def size(self, is_full, elapsed_days):
+        """Size of a backup taken elapsed_days after the simulation start."""
+        base = self.full_size if is_full else self.incr_size
+        return int(base + self.daily_growth * elapsed_days)
+
+    def duration(self, size):
+        """Duration of a backup of the given size."""
+        seconds = float(size) / self.throughput
+        if self.jitter:
+            seconds *= 1 + self.random.uniform(-self.jitter, self.jitter)
+        return self.overhead + datetime.timedelta(seconds=seconds)
+
+class FakeContainer(object):
+    """
+    In-memory stand-in for a blob container. Like a block blob uploaded from
+    a stream, a backup only becomes visible in listings once it is complete,
+    under the name of its start time.
+    """
+
+    def __init__(self):
+        self.backups = []
+        self.pending = []
+        self.latest = {True: NO_BACKUP, False: NO_BACKUP}
+
+    def start_backup(self, is_full, start, end, size):
+        """Record a backup that will be visible at its end time."""
+        self.pending.append((end, is_full, start, size))
+        self.pending.sort()
+
+    def advance(self, now):
+        """Make backups completed by 'now' visible."""
+        while self.pending and self.pending[0][0] <= now:
+            (end, is_full, start, size) = self.pending.pop(0)
+            self.backups.append((is_full, start, end, size))
+            if start > self.latest[is_full]:
+                self.latest[is_full] = start
+
+    def running(self, is_full=None):
+        """Number of backups in progress."""
+        return len([b for b in self.pending if is_full is None or b[1] == is_full])
+
+    def latest_backup_timestamp(self, is_full):
+        """Start time of the latest visible backup."""
+        return self.latest[is_full]
+
+class ScheduleSimulator(object):
+    """
+    Call BackupAgent.should_run_full_backup (and should_run_tran_backup when
+    a log interval is given) on every tick, like cron would, and record the
+    backups that would have been taken. As with the PID file used by the
+    command line, only one full backup runs at a time.
+    """
+
+    def __init__(self, business_hours, interval_min, interval_max, model,
+                 tran_interval_min=None):
+        self.business_hours = business_hours
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.tran_interval_min = tran_interval_min
+        self.model = model
+
+    def run(self, start, end, tick=datetime.timedelta(minutes=1)):
+        """Simulate from start to end and return a report dictionary."""
+        container = FakeContainer()
+        peak_concurrent = 0
+        ticks = 0
+        now = start
+        while now < end:
+            ticks += 1
+            container.advance(now)
+
+            if not container.running(is_full=True) and BackupAgent.should_run_full_backup(
+                    now_time=now, force=False,
+                    latest_full_backup_timestamp=container.latest_backup_timestamp(True),
+                    business_hours=self.business_hours,
+                    db_backup_interval_min=self.interval_min,
+                    db_backup_interval_max=self.interval_max):
+                self.start_backup(container, True, start, now)
+
+            if self.tran_interval_min is not None and BackupAgent.should_run_tran_backup(
+                    now_time=now, force=False,
+                    latest_tran_backup_timestamp=max(container.latest_backup_timestamp(False),
+                                                     self.pending_start(container, False)),
+                    log_backup_interval_min=self.tran_interval_min):
+                self.start_backup(container, False, start, now)
+
+            peak_concurrent = max(peak_concurrent, len(container.pending))
+            now += tick
+
+        container.advance(end)
+        return self.report(container, start, end, tick, ticks, peak_concurrent)
+
+    @staticmethod
+    def pending_start(container, is_full):
+        """Start of the latest backup still in progress (cron would not see it, but tran
+        backups are only skipped by the min interval, so count it to avoid piling up)."""
+        starts = [b[2] for b in container.pending if b[1] == is_full]
+        return max(starts) if starts else NO_BACKUP
+
+    def start_backup(self, container, is_full, start, now):
+        """Start a backup at 'now' using the size and duration models."""
+        elapsed_days = (now - start).total_seconds() / 86400
+        size = self.model.size(is_full, elapsed_days)
+        container.start_backup(is_full, now, now + self.model.duration(size), size)
+
+    def report(self, container, start, end, tick, ticks, peak_concurrent):
+        """Summarize the simulated backups."""
+        days = (end - start).total_seconds() / 86400
+        fulls = sorted(b for b in container.backups if b[0])
+        incrs = [b for b in container.backups if not b[0]]
+
+        # Gaps between consecutive full backups that exceed the maximum interval;
+        # backups forced by the maximum interval start up to one tick after it.
+        gaps = []
+        for (previous, current) in zip(fulls, fulls[1:]):
+            gap = current[1] - previous[1]
+            if gap > self.interval_max + tick:
+                gaps.append({'from': str(previous[1]), 'to': str(current[1]), 'gap': str(gap)})
+
+        durations = [b[2] - b[1] for b in fulls]
+        outside = [b for b in fulls if not self.business_hours.is_backup_allowed_time(b[1])]
+        return {
+            'days': days,
+            'ticks': ticks,
+            'full_backups': len(fulls),
+            'incr_backups': len(incrs),
+            'full_backups_per_day': len(fulls) / days if days else 0,
+            'incr_backups_per_day': len(incrs) / days if days else 0,
+            'full_bytes': sum(b[3] for b in fulls),
+            'incr_bytes': sum(b[3] for b in incrs),
+            'max_full_duration': str(max(durations)) if durations else None,
+            'full_backups_outside_allowed_hours': len(outside),
+            'gaps_over_max': gaps,
+            'peak_concurrent_jobs': peak_concurrent
+        }
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="Simulate the backup schedule over virtual time")
+    parser.add_argument("--schedule", required=True,
+                        help="The bkp_fs_schedule tag value, or all the VM tags ('a:b;bkp_fs_schedule:...')")
+    parser.add_argument("--days", type=int, default=365, help="Simulated days")
+    parser.add_argument("--start", default="20180101_000000", help="Simulation start time")
+    parser.add_argument("--tick", default="1m", help="Interval between cron invocations")
+    parser.add_argument("--log-interval-min", help="Also simulate 'incr' backups with this minimum interval")
+    parser.add_argument("--full-size", default="100G", help="Size of a full backup")
+    parser.add_argument("--incr-size", default="1G", help="Size of an incremental backup")
+    parser.add_argument("--daily-growth", default="0", help="Growth of full backups per day")
+    parser.add_argument("--throughput", type=float, default=100, help="Backup throughput in MB/s")
+    parser.add_argument("--overhead", default="1m", help="Fixed duration added to every backup")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random duration variation (0.1 = 10%%)")
+    args = parser.parse_args(argv)
+
+    tags = args.schedule
+    if BusinessHours.default_schedule + ":" not in tags:
+        tags = BusinessHours.default_schedule + ":" + tags
+    business_hours = BusinessHours.parse_tag_str(tags)
+
+    model = BackupModel(
+        full_size=parse_size(args.full_size),
+        incr_size=parse_size(args.incr_size),
+        daily_growth=parse_size(args.daily_growth),
+        throughput=args.throughput * 1024 ** 2,
+        overhead=ScheduleParser.parse_timedelta(args.overhead),
+        jitter=args.jitter)
+    simulator = ScheduleSimulator(
+        business_hours=business_hours,
+        interval_min=ScheduleParser.parse_timedelta(business_hours.min),
+        interval_max=ScheduleParser.parse_timedelta(business_hours.max),
+        model=model,
+        tran_interval_min=ScheduleParser.parse_timedelta(args.log_interval_min) if args.log_interval_min else None)
+
+    start = datetime.datetime.strptime(args.start, "%Y%m%d_%H%M%S")
+    report = simulator.run(start=start, end=start + datetime.timedelta(days=args.days),
+                           tick=ScheduleParser.parse_timedelta(args.tick))
+    print json.dumps(report, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except BackupException as be:
+        sys.stderr.write("{}\n".format(be.message))
+        sys.exit(-1)
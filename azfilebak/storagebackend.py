@@ -0,0 +1,595 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""StorageBackend module."""
+
+import os
+import json
+import errno
+import shutil
+import logging
+import binascii
+import datetime
+import tempfile
+import time
+import ctypes
+import ctypes.util
+
+from azfilebak.httpsession import HttpSession
+from azfilebak.backupexception import BackupException
+
+# Same page size as the blob service
+DEFAULT_PAGE_SIZE = 5000
+# Buffer size when data cannot be copied inside the kernel
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+# How often the state of a server-side copy is checked
+COPY_POLL_SECONDS = 1
+# Validity of the shared access signatures that let the service read a blob
+SAS_VALIDITY = datetime.timedelta(hours=4)
+
+class BlobInfo(object):
+    """Name, size, creation time and (optionally) metadata of a stored backup."""
+
+    def __init__(self, name, size, created=None, metadata=None):
+        self.name = name
+        self.size = size
+        self.created = created
+        self.metadata = metadata
+
+    def __repr__(self):
+        return "BlobInfo({!r}, {!r})".format(self.name, self.size)
+
+class BlobList(list):
+    """One page of a listing; next_marker is None on the last page."""
+
+    def __init__(self, blobs, next_marker=None):
+        super(BlobList, self).__init__(blobs)
+        self.next_marker = next_marker
+
+class StorageBackend(object):
+    """
+    Operations the backup agent needs from a storage service. Parameter
+    names follow the blob service SDK. Block ids are strings, and blocks
+    only become visible once committed with put_block_list.
+
+    max_blocks is the number of blocks a blob can have, or None if streams
+    are best uploaded with create_blob_from_stream (see StreamUploader).
+    """
+
+    max_blocks = None
+
+    def list_containers(self):
+        """Return the names of all containers."""
+        raise NotImplementedError()
+
+    def list_blobs(self, container_name, prefix=None, marker=None,
+                   include_metadata=False, page_size=DEFAULT_PAGE_SIZE):
+        """Return one page (a BlobList of BlobInfo) of the blobs, sorted by name."""
+        raise NotImplementedError()
+
+    def get_blob_properties(self, container_name, blob_name):
+        """Return the BlobInfo of a blob, including its metadata."""
+        raise NotImplementedError()
+
+    def create_blob_from_stream(self, container_name, blob_name, stream, metadata=None):
+        """Upload a stream of unknown length."""
+        raise NotImplementedError()
+
+    def create_blob_from_bytes(self, container_name, blob_name, data, metadata=None):
+        """Upload a blob with a single request."""
+        raise NotImplementedError()
+
+    def put_block(self, container_name, blob_name, block_id, data):
+        """Stage a block."""
+        raise NotImplementedError()
+
+    def put_block_list(self, container_name, blob_name, block_ids, metadata=None):
+        """Commit staged blocks, in the given order, as the content of the blob."""
+        raise NotImplementedError()
+
+    def get_block_list(self, container_name, blob_name):
+        """Return the committed blocks of a blob, as (block_id, size) in order."""
+        raise NotImplementedError()
+
+    def put_block_from_blob(self, container_name, blob_name, block_id, source_blob_name, start_range, end_range):
+        """Stage a block with bytes start_range to end_range (inclusive) of another blob of the container."""
+        raise NotImplementedError()
+
+    def get_blob_range(self, container_name, blob_name, start_range, end_range):
+        """Return bytes start_range to end_range (inclusive) of a blob."""
+        raise NotImplementedError()
+
+    def get_blob_to_stream(self, container_name, blob_name, stream):
+        """Download a blob into a file-like object."""
+        raise NotImplementedError()
+
+    def get_blob_to_path(self, container_name, blob_name, file_path):
+        """Download a blob into a local file."""
+        raise NotImplementedError()
+
+    def set_blob_metadata(self, container_name, blob_name, metadata):
+        """Replace the metadata of a blob."""
+        raise NotImplementedError()
+
+    def source_url(self, container_name, blob_name):
+        """URL from which a storage service can copy a blob."""
+        raise NotImplementedError()
+
+    def start_copy(self, container_name, blob_name, source_url, metadata=None):
+        """
+        Start copying a blob from a URL inside the storage service. Returns
+        the state of the copy ('pending', 'success', 'aborted' or 'failed')
+        and its description. Without metadata, that of the source is kept.
+        """
+        raise NotImplementedError()
+
+    def get_copy_status(self, container_name, blob_name):
+        """Return the state and description of the last copy into a blob."""
+        raise NotImplementedError()
+
+    def wait_for_copy(self, container_name, blob_name, status):
+        """Poll the status of a copy until it is done; raises BackupException if it failed."""
+        (state, description) = status
+        while state == 'pending':
+            time.sleep(COPY_POLL_SECONDS)
+            (state, description) = self.get_copy_status(container_name, blob_name)
+        if state != 'success':
+            raise BackupException("Copy to {}/{} failed: {} {}".format(container_name, blob_name, state, description))
+
+    def copy_blob(self, container_name, blob_name, source_blob_name, metadata=None):
+        """Copy a blob of the container inside the storage service, and wait for the copy."""
+        self.wait_for_copy(container_name, blob_name, self.start_copy(
+            container_name, blob_name, self.source_url(container_name, source_blob_name), metadata))
+
+    def delete_blob(self, container_name, blob_name):
+        """Delete a blob."""
+        raise NotImplementedError()
+
+    def set_concurrency(self, connections):
+        """Prepare for this many concurrent requests."""
+        pass
+
+    def iter_blobs(self, container_name, prefix=None, include_metadata=False):
+        """Iterate over all the pages of a listing."""
+        marker = None
+        while True:
+            results = self.list_blobs(container_name=container_name, prefix=prefix,
+                                      marker=marker, include_metadata=include_metadata)
+            for blob in results:
+                yield blob
+            if results.next_marker:
+                marker = results.next_marker
+            else:
+                break
+
+class AzureStorageBackend(StorageBackend):
+    """Azure blob storage, through the storage client of the configuration."""
+
+    max_blocks = 50000
+
+    def __init__(self, backup_configuration, client=None):
+        self.backup_configuration = backup_configuration
+        self._client = client
+        # Read-only URLs of source blobs of Put Block From URL, and their expiry
+        self.source_urls = {}
+        # The user delegation key that signs them, and its expiry
+        self.user_delegation_key = (None, None)
+
+    @property
+    def client(self):
+        """The BlockBlobService of the configuration, or of another storage account."""
+        return self._client or self.backup_configuration.storage_client
+
+    @staticmethod
+    def blob_info(blob):
+        """Convert a Blob of the SDK."""
+        return BlobInfo(name=blob.name,
+                        size=blob.properties.content_length,
+                        created=blob.properties.creation_time,
+                        metadata=blob.metadata)
+
+    def list_containers(self):
+        return [c.name for c in self.client.list_containers()]
+
+    def list_blobs(self, container_name, prefix=None, marker=None,
+                   include_metadata=False, page_size=DEFAULT_PAGE_SIZE):
+        include = None
+        if include_metadata:
+            from azure.storage.blob.models import Include
+            include = Include(metadata=True)
+        results = self.client.list_blobs(container_name=container_name, prefix=prefix,
+                                         marker=marker, include=include, num_results=page_size)
+        return BlobList([AzureStorageBackend.blob_info(b) for b in results], results.next_marker)
+
+    def get_blob_properties(self, container_name, blob_name):
+        return AzureStorageBackend.blob_info(self.client.get_blob_properties(container_name, blob_name))
+
+    def create_blob_from_stream(self, container_name, blob_name, stream, metadata=None):
+        self.client.create_blob_from_stream(
+            container_name=container_name, blob_name=blob_name, stream=stream,
+            metadata=metadata, use_byte_buffer=True, max_connections=1)
+
+    def create_blob_from_bytes(self, container_name, blob_name, data, metadata=None):
+        self.client.create_blob_from_bytes(container_name, blob_name, data, metadata=metadata)
+
+    def put_block(self, container_name, blob_name, block_id, data):
+        self.client.put_block(container_name, blob_name, data, block_id)
+
+    def put_block_list(self, container_name, blob_name, block_ids, metadata=None):
+        from azure.storage.blob.models import BlobBlock
+        self.client.put_block_list(container_name, blob_name,
+                                   [BlobBlock(id=block_id) for block_id in block_ids],
+                                   metadata=metadata)
+
+    def get_block_list(self, container_name, blob_name):
+        blocks = self.client.get_block_list(container_name, blob_name, block_list_type='committed')
+        return [(block.id, block.size) for block in blocks.committed_blocks]
+
+    def source_url(self, container_name, blob_name):
+        """
+        URL of a blob with a read-only shared access signature, for the
+        service to read it. It is signed with the account key if there is
+        one, otherwise with a user delegation key of the managed identity.
+        """
+        now = datetime.datetime.utcnow()
+        (url, expiry) = self.source_urls.get((container_name, blob_name), (None, now))
+        if expiry - now > SAS_VALIDITY / 2:
+            return url
+        from azure.storage.blob.models import BlobPermissions
+        client = self.client
+        expiry = now + SAS_VALIDITY
+        key = None
+        if not client.account_key:
+            (key, key_expiry) = self.user_delegation_key
+            if key is None or key_expiry < expiry:
+                key_expiry = expiry + SAS_VALIDITY
+                key = client.get_user_delegation_key(now - datetime.timedelta(minutes=5), key_expiry)
+                self.user_delegation_key = (key, key_expiry)
+        sas = client.generate_blob_shared_access_signature(
+            container_name, blob_name, permission=BlobPermissions.READ,
+            start=now - datetime.timedelta(minutes=5), expiry=expiry, user_delegation_key=key)
+        url = client.make_blob_url(container_name, blob_name, sas_token=sas)
+        self.source_urls[(container_name, blob_name)] = (url, expiry)
+        return url
+
+    def put_block_from_blob(self, container_name, blob_name, block_id, source_blob_name, start_range, end_range):
+        self.client.put_block_from_url(container_name, blob_name, self.source_url(container_name, source_blob_name),
+                                       block_id, source_range_start=start_range, source_range_end=end_range)
+
+    def get_blob_range(self, container_name, blob_name, start_range, end_range):
+        return self.client.get_blob_to_bytes(container_name, blob_name, start_range=start_range,
+                                             end_range=end_range).content
+
+    def get_blob_to_stream(self, container_name, blob_name, stream):
+        self.client.get_blob_to_stream(container_name=container_name, blob_name=blob_name,
+                                       stream=stream, max_connections=1)
+
+    def get_blob_to_path(self, container_name, blob_name, file_path):
+        self.client.get_blob_to_path(container_name=container_name, blob_name=blob_name,
+                                     file_path=file_path, max_connections=1)
+
+    def set_blob_metadata(self, container_name, blob_name, metadata):
+        self.client.set_blob_metadata(container_name, blob_name, metadata)
+
+    def start_copy(self, container_name, blob_name, source_url, metadata=None):
+        # Copies inside a storage account usually complete at once
+        copy = self.client.copy_blob(container_name, blob_name, source_url, metadata=metadata)
+        return (copy.status, copy.status_description)
+
+    def get_copy_status(self, container_name, blob_name):
+        copy = self.client.get_blob_properties(container_name, blob_name).properties.copy
+        return (copy.status, copy.status_description)
+
+    def delete_blob(self, container_name, blob_name):
+        self.client.delete_blob(container_name=container_name, blob_name=blob_name)
+
+    def set_concurrency(self, connections):
+        # All the threads share the connection pool of the process,
+        # make sure it is large enough for all of them.
+        HttpSession.resize(connections)
+
+_kernel_copy = {}
+
+def kernel_copy(name):
+    """
+    copy_file_range or sendfile from the C library, as a function
+    (src_fd, dst_fd, length) copying from the current offsets and
+    returning the bytes copied; None if not available. Python 2 has
+    neither in the os module.
+    """
+    if name not in _kernel_copy:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            function = getattr(libc, name)
+        except (OSError, AttributeError):
+            _kernel_copy[name] = None
+            return None
+        function.restype = ctypes.c_ssize_t
+        if name == 'copy_file_range':
+            function.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_uint]
+            call = lambda src_fd, dst_fd, length: function(src_fd, None, dst_fd, None, length, 0)
+        else:
+            function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+            call = lambda src_fd, dst_fd, length: function(dst_fd, src_fd, None, length)
+
+        def copy(src_fd, dst_fd, length):
+            """Raise OSError when the system call fails."""
+            done = call(src_fd, dst_fd, length)
+            if done < 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+            return done
+        _kernel_copy[name] = copy
+    return _kernel_copy[name]
+
+def copy_fd(src_fd, dst_fd, count=None):
+    """
+    Copy count bytes (or until end of file) between file descriptors,
+    inside the kernel with copy_file_range or sendfile where the files
+    allow it, otherwise (e.g. from a pipe) through a large buffer.
+    """
+    copied = 0
+    for name in ['copy_file_range', 'sendfile']:
+        copy = kernel_copy(name)
+        if copy is None:
+            continue
+        try:
+            while count is None or copied < count:
+                length = COPY_BUFFER_SIZE * 16 if count is None else min(COPY_BUFFER_SIZE * 16, count - copied)
+                done = copy(src_fd, dst_fd, length)
+                if done == 0:
+                    break
+                copied += done
+            return copied
+        except OSError as ex:
+            # Not supported between these files, try the next method
+            if ex.errno not in (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF, errno.ENOTSUP,
+                                errno.EPERM, errno.ESPIPE):
+                raise
+    while count is None or copied < count:
+        length = COPY_BUFFER_SIZE if count is None else min(COPY_BUFFER_SIZE, count - copied)
+        data = os.read(src_fd, length)
+        if not data:
+            break
+        os.write(dst_fd, data)
+        copied += len(data)
+    return copied
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Store backups in a local directory, such as an NFS mount, or a scratch
+    directory for tests and benchmarks. Containers are directories and
+    blobs are files; metadata and staged blocks are kept in a hidden
+    '.azfilebak' directory of each container. Blobs are written to a
+    temporary file and renamed, so readers never see partial content.
+    """
+
+    STATE_DIR = '.azfilebak'
+
+    def __init__(self, root):
+        self.root = root
+
+    def container_path(self, container_name):
+        """Directory of a container."""
+        if not container_name or container_name.startswith('.') or os.sep in container_name:
+            raise BackupException("Invalid container name '{}'".format(container_name))
+        return os.path.join(self.root, container_name)
+
+    def blob_path(self, container_name, blob_name):
+        """File of a blob."""
+        if not blob_name or blob_name.startswith('.') or os.sep in blob_name:
+            raise BackupException("Invalid blob name '{}'".format(blob_name))
+        return os.path.join(self.container_path(container_name), blob_name)
+
+    def state_path(self, container_name, *parts):
+        """Path in the hidden state directory of a container; creates the parent directory."""
+        path = os.path.join(self.container_path(container_name), LocalStorageBackend.STATE_DIR, *parts)
+        LocalStorageBackend.makedirs(os.path.dirname(path))
+        return path
+
+    @staticmethod
+    def makedirs(path):
+        """Create a directory and its parents if needed."""
+        try:
+            os.makedirs(path)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+    def open_blob(self, container_name, blob_name):
+        """Open a blob for reading."""
+        try:
+            return open(self.blob_path(container_name, blob_name), 'rb')
+        except IOError as ex:
+            if ex.errno == errno.ENOENT:
+                raise BackupException("Blob {}/{} does not exist".format(container_name, blob_name))
+            raise
+
+    def commit(self, container_name, blob_name, write, metadata=None):
+        """Call write(file) on a temporary file, then move it into place."""
+        tmp_dir = os.path.dirname(self.state_path(container_name, 'tmp', blob_name))
+        (fd, tmp_path) = tempfile.mkstemp(dir=tmp_dir, prefix=blob_name + '.')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                write(tmp_file)
+            if metadata is not None:
+                self.set_blob_metadata(container_name, blob_name, metadata)
+            os.rename(tmp_path, self.blob_path(container_name, blob_name))
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def read_metadata(self, container_name, blob_name):
+        """Metadata of a blob, {} if none was set."""
+        try:
+            with open(self.state_path(container_name, 'metadata', blob_name + '.json'), 'rt') as meta_file:
+                return json.load(meta_file)
+        except IOError:
+            return {}
+
+    def blob_info(self, container_name, blob_name, include_metadata=True):
+        """BlobInfo from the file of a blob."""
+        try:
+            stat = os.stat(self.blob_path(container_name, blob_name))
+        except OSError as ex:
+            if ex.errno == errno.ENOENT:
+                raise BackupException("Blob {}/{} does not exist".format(container_name, blob_name))
+            raise
+        return BlobInfo(name=blob_name, size=stat.st_size,
+                        created=datetime.datetime.utcfromtimestamp(stat.st_mtime),
+                        metadata=self.read_metadata(container_name, blob_name) if include_metadata else None)
+
+    def list_containers(self):
+        return sorted(n for n in os.listdir(self.root)
+                      if not n.startswith('.') and os.path.isdir(os.path.join(self.root, n)))
+
+    def list_blobs(self, container_name, prefix=None, marker=None,
+                   include_metadata=False, page_size=DEFAULT_PAGE_SIZE):
+        try:
+            names = os.listdir(self.container_path(container_name))
+        except OSError as ex:
+            # Containers are created by the first backup
+            if ex.errno == errno.ENOENT:
+                return BlobList([])
+            raise
+        # The marker is the last name of the previous page
+        names = sorted(n for n in names if not n.startswith('.')
+                       and (prefix is None or n.startswith(prefix))
+                       and (marker is None or n > marker))
+        page = names[:page_size]
+        next_marker = page[-1] if len(names) > page_size else None
+        return BlobList([self.blob_info(container_name, n, include_metadata) for n in page], next_marker)
+
+    def get_blob_properties(self, container_name, blob_name):
+        return self.blob_info(container_name, blob_name)
+
+    def create_blob_from_stream(self, container_name, blob_name, stream, metadata=None):
+        def write(tmp_file):
+            """Copy the stream, usually a pipe from the backup command."""
+            if hasattr(stream, 'fileno'):
+                copy_fd(stream.fileno(), tmp_file.fileno())
+            else:
+                shutil.copyfileobj(stream, tmp_file, COPY_BUFFER_SIZE)
+        self.commit(container_name, blob_name, write, metadata)
+
+    def create_blob_from_bytes(self, container_name, blob_name, data, metadata=None):
+        self.commit(container_name, blob_name, lambda tmp_file: tmp_file.write(data), metadata)
+
+    def block_path(self, container_name, blob_name, block_id):
+        """File of a staged block."""
+        return self.state_path(container_name, 'blocks', blob_name, binascii.hexlify(block_id))
+
+    def put_block(self, container_name, blob_name, block_id, data):
+        with open(self.block_path(container_name, blob_name, block_id), 'wb') as block_file:
+            block_file.write(data)
+
+    def put_block_from_blob(self, container_name, blob_name, block_id, source_blob_name, start_range, end_range):
+        with self.open_blob(container_name, source_blob_name) as blob_file:
+            blob_file.seek(start_range)
+            with open(self.block_path(container_name, blob_name, block_id), 'wb') as block_file:
+                copy_fd(blob_file.fileno(), block_file.fileno(), end_range - start_range + 1)
+
+    def put_block_list(self, container_name, blob_name, block_ids, metadata=None):
+        committed = []
+
+        def write(tmp_file):
+            """Concatenate the blocks."""
+            for block_id in block_ids:
+                path = self.block_path(container_name, blob_name, block_id)
+                if not os.path.exists(path):
+                    raise BackupException("Block {} of {}/{} was not staged".format(
+                        block_id, container_name, blob_name))
+                with open(path, 'rb') as block_file:
+                    committed.append((block_id, copy_fd(block_file.fileno(), tmp_file.fileno())))
+        self.commit(container_name, blob_name, write, metadata)
+        self.write_block_list(container_name, blob_name, committed)
+        # Like the blob service, discard the blocks that were not committed
+        shutil.rmtree(self.state_path(container_name, 'blocks', blob_name), ignore_errors=True)
+
+    def write_block_list(self, container_name, blob_name, blocks):
+        """Remember the committed blocks of a blob."""
+        path = self.state_path(container_name, 'blocklists', blob_name + '.json')
+        with open(path + '.tmp', 'wt') as list_file:
+            json.dump(blocks, list_file)
+        os.rename(path + '.tmp', path)
+
+    def get_block_list(self, container_name, blob_name):
+        # Blobs that were not uploaded in blocks have none
+        self.blob_info(container_name, blob_name, include_metadata=False)
+        try:
+            with open(self.state_path(container_name, 'blocklists', blob_name + '.json'), 'rt') as list_file:
+                return [(str(block_id), size) for (block_id, size) in json.load(list_file)]
+        except IOError:
+            return []
+
+    def get_blob_range(self, container_name, blob_name, start_range, end_range):
+        with self.open_blob(container_name, blob_name) as blob_file:
+            blob_file.seek(start_range)
+            return blob_file.read(end_range - start_range + 1)
+
+    def get_blob_to_stream(self, container_name, blob_name, stream):
+        with self.open_blob(container_name, blob_name) as blob_file:
+            try:
+                fileno = stream.fileno()
+            except (AttributeError, IOError, ValueError):
+                fileno = None
+            if fileno is None:
+                shutil.copyfileobj(blob_file, stream, COPY_BUFFER_SIZE)
+            else:
+                stream.flush()
+                copy_fd(blob_file.fileno(), fileno)
+
+    def get_blob_to_path(self, container_name, blob_name, file_path):
+        with open(file_path, 'wb') as out:
+            self.get_blob_to_stream(container_name, blob_name, out)
+
+    def set_blob_metadata(self, container_name, blob_name, metadata):
+        path = self.state_path(container_name, 'metadata', blob_name + '.json')
+        with open(path + '.tmp', 'wt') as meta_file:
+            json.dump(metadata, meta_file)
+        os.rename(path + '.tmp', path)
+
+    def source_url(self, container_name, blob_name):
+        return 'file://' + os.path.abspath(self.blob_path(container_name, blob_name))
+
+    def start_copy(self, container_name, blob_name, source_url, metadata=None):
+        if not source_url.startswith('file://'):
+            raise BackupException("Cannot copy {} into local storage".format(source_url))
+        # The source is a blob of this or another local storage directory
+        path = source_url[len('file://'):]
+        source_container_path = os.path.dirname(path)
+        source = LocalStorageBackend(os.path.dirname(source_container_path))
+        source_container_name = os.path.basename(source_container_path)
+        source_blob_name = os.path.basename(path)
+        if metadata is None:
+            metadata = source.read_metadata(source_container_name, source_blob_name)
+        with source.open_blob(source_container_name, source_blob_name) as blob_file:
+            self.commit(container_name, blob_name,
+                        lambda tmp_file: copy_fd(blob_file.fileno(), tmp_file.fileno()), metadata)
+        # Like the blob service, keep the blocks of the source
+        self.write_block_list(container_name, blob_name, source.get_block_list(source_container_name, source_blob_name))
+        return ('success', None)
+
+    def get_copy_status(self, container_name, blob_name):
+        # Copies are done by start_copy
+        self.blob_info(container_name, blob_name, include_metadata=False)
+        return ('success', None)
+
+    def delete_blob(self, container_name, blob_name):
+        try:
+            os.remove(self.blob_path(container_name, blob_name))
+        except OSError as ex:
+            if ex.errno == errno.ENOENT:
+                raise BackupException("Blob {}/{} does not exist".format(container_name, blob_name))
+            raise
+        for state in ['metadata', 'blocklists']:
+            try:
+                os.remove(self.state_path(container_name, state, blob_name + '.json'))
+            except OSError:
+                pass
+        logging.debug("Deleted %s/%s", container_name, blob_name)
@@ -0,0 +1,129 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Striping module."""
+
+import os
+import logging
+
+# Directories are split at most this many levels below a source
+MAX_SPLIT_DEPTH = 3
+
+class Shard(object):
+    """The paths one stripe of a backup archives, and their size on disk."""
+
+    def __init__(self):
+        self.paths = []
+        self.size = 0
+        # Directories that were split between stripes: archived without their content
+        self.directories = []
+
+    def __repr__(self):
+        return "Shard({!r}, {!r})".format(self.paths, self.size)
+
+class Striping(object):
+    """
+    Partition the sources of a fileset into shards of similar size, so
+    that each one can be archived by its own tar process. Directories
+    that are larger than a fair share are split into their entries, down
+    to MAX_SPLIT_DEPTH levels below the sources; the shards are then
+    filled largest entry first.
+
+    >>> Striping.is_excluded('/usr/lib', ['/usr']), Striping.is_excluded('/usrx', ['/usr', ''])
+    (True, False)
+    """
+
+    @staticmethod
+    def is_excluded(path, excluded):
+        """True if path is, or is inside, one of the excluded paths."""
+        for exclude in excluded:
+            if not exclude:
+                continue
+            exclude = exclude.rstrip('/') or '/'
+            if path == exclude or path.startswith(exclude.rstrip('/') + '/'):
+                return True
+        return False
+
+    @staticmethod
+    def scan(source, excluded):
+        """
+        Walk a source once. Returns the size on disk of every path up to
+        MAX_SPLIT_DEPTH levels below it (deeper content is counted in its
+        ancestor at that depth), and the entries of these directories.
+        """
+        sizes = {source: 0}
+        children = dict()
+        base_depth = source.rstrip('/').count('/')
+        for (dirpath, dirnames, filenames) in os.walk(source):
+            depth = dirpath.rstrip('/').count('/') - base_depth
+            # Do not descend into excluded directories (or mounts)
+            dirnames[:] = [d for d in dirnames if not Striping.is_excluded(os.path.join(dirpath, d), excluded)]
+            filenames = [f for f in filenames if not Striping.is_excluded(os.path.join(dirpath, f), excluded)]
+            if depth < MAX_SPLIT_DEPTH:
+                children[dirpath] = [os.path.join(dirpath, n) for n in dirnames + filenames]
+                for path in children[dirpath]:
+                    sizes[path] = 0
+            # Deep content is accounted to its ancestor at MAX_SPLIT_DEPTH
+            owner = dirpath if depth <= MAX_SPLIT_DEPTH else '/'.join(
+                dirpath.split('/')[:base_depth + 1 + MAX_SPLIT_DEPTH])
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    size = os.lstat(path).st_blocks * 512
+                except OSError:
+                    continue
+                sizes[path if depth < MAX_SPLIT_DEPTH else owner] += size
+        # Add the size of every directory to its parents
+        for path in sorted(sizes, key=lambda p: -p.count('/')):
+            parent = os.path.dirname(path)
+            if path != source and parent in sizes:
+                sizes[parent] += sizes[path]
+        return (sizes, children)
+
+    @staticmethod
+    def partition(sources, excluded, stripes):
+        """Return up to 'stripes' non-empty shards of the sources."""
+        sizes = dict()
+        children = dict()
+        items = []
+        for source in [os.path.normpath(s) for s in sources]:
+            if not os.path.exists(source):
+                logging.warning("Source %s does not exist", source)
+                continue
+            (source_sizes, source_children) = Striping.scan(source, excluded)
+            sizes.update(source_sizes)
+            children.update(source_children)
+            items.append(source)
+
+        total = sum(sizes[i] for i in items)
+        fair_share = total / max(1, stripes)
+        split = []
+        while True:
+            # Split the largest directory that is too large for a stripe,
+            # unless it holds a single entry
+            candidates = [i for i in items if len(children.get(i, [])) > 1 and sizes[i] > fair_share]
+            if not candidates:
+                break
+            largest = max(candidates, key=lambda i: sizes[i])
+            items.remove(largest)
+            items.extend(children[largest])
+            split.append(largest)
+
+        shards = [Shard() for _ in range(stripes)]
+        for item in sorted(items, key=lambda i: -sizes[i]):
+            shard = min(shards, key=lambda s: s.size)
+            shard.paths.append(item)
+            shard.size += sizes[item]
+        shards = [s for s in shards if s.paths]
+        if shards:
+            # Keep the owner and permissions of split directories
+            shards[0].directories = sorted(split)
+        for shard in shards:
+            shard.paths.sort()
+        logging.info("Partitioned %s (%d bytes) into %d stripes: %s", " ".join(sources), total,
+                     len(shards), ", ".join(str(s.size) for s in shards))
+        return shards
@@ -8,9 +8,10 @@
 """ Timing module."""
 
 import time
+# time.strptime imports _strptime lazily, which is not thread safe on first
+# use (https://bugs.python.org/issue7980); import it before any worker thread.
+import _strptime # pylint: disable=unused-import
 import datetime
-import pytz
-import tzlocal
 
 class Timing(object):
     """Timing class."""
@@ -26,21 +27,39 @@ class Timing(object):
         """Parse time string."""
         return time.strptime(time_str, Timing.time_format)
 
+    @staticmethod
+    def to_datetime(time_value):
+        """
+        Convert a time string to a datetime; datetime values are returned as is.
+        Strings in the standard format are converted by slicing, which is much
+        faster than strptime; anything else goes through strptime.
+
+        >>> Timing.to_datetime("20180605_215959")
+        datetime.datetime(2018, 6, 5, 21, 59, 59)
+        """
+        if isinstance(time_value, datetime.datetime):
+            return time_value
+        if (len(time_value) == 15 and time_value[8] == '_'
+                and time_value[0:8].isdigit() and time_value[9:15].isdigit()):
+            return datetime.datetime(
+                int(time_value[0:4]), int(time_value[4:6]), int(time_value[6:8]),
+                int(time_value[9:11]), int(time_value[11:13]), int(time_value[13:15]))
+        t = Timing.parse(time_value)
+        return datetime.datetime(year=t.tm_year, month=t.tm_mon, day=t.tm_mday,
+                                 hour=t.tm_hour, minute=t.tm_min, second=t.tm_sec)
+
     @staticmethod
     def time_diff(str1, str2):
-        """Calculate time difference."""
-        t1 = Timing.parse(str1)
-        dt1 = datetime.datetime(year=t1.tm_year, month=t1.tm_mon, day=t1.tm_mday, hour=t1.tm_hour, minute=t1.tm_min, second=t1.tm_sec)
-        t2 = Timing.parse(str2)
-        dt2 = datetime.datetime(year=t2.tm_year, month=t2.tm_mon, day=t2.tm_mday, hour=t2.tm_hour, minute=t2.tm_min, second=t2.tm_sec)
-        return dt2 - dt1
+        """Calculate time difference (accepts time strings or datetimes)."""
+        return Timing.to_datetime(str2) - Timing.to_datetime(str1)
 
     @staticmethod
     def local_string_to_utc_epoch(time_str):
         """Converts a local time string to UTC epoch"""
-        t = Timing.parse(time_str)
-        dt = datetime.datetime(year=t.tm_year, month=t.tm_mon, day=t.tm_mday,
-                               hour=t.tm_hour, minute=t.tm_min, second=t.tm_sec)
+        import pytz
+        import tzlocal
+
+        dt = Timing.to_datetime(time_str)
 
         timezone_loc = tzlocal.get_localzone()
         timezone_utc = pytz.timezone("UTC")
@@ -0,0 +1,159 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""TokenCache module."""
+
+import os
+import time
+import json
+import errno
+import fcntl
+import logging
+import threading
+
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.backupexception import BackupException
+
+# Tokens are renewed when they expire in less than this
+DEFAULT_REFRESH_MARGIN_SECONDS = 600
+
+def request_msi_token(resource):
+    """Request a token for the resource from the managed identity endpoint."""
+    from msrestazure.azure_active_directory import MSIAuthentication
+    token = MSIAuthentication(resource=resource).token
+    return {
+        'access_token': token['access_token'],
+        'expires_on': int(token['expires_on'])
+    }
+
+class TokenCache(object):
+    """
+    Share managed identity access tokens between azfilebak processes on
+    the same host. Tokens are kept in a cache file, protected by a lock
+    file, and reused until shortly before they expire.
+    """
+
+    def __init__(self, filename, resource, fetch=request_msi_token,
+                 refresh_margin_seconds=DEFAULT_REFRESH_MARGIN_SECONDS):
+        self.filename = filename
+        self.resource = resource
+        self.fetch = fetch
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.refresh_thread = None
+        self._token = None
+        self._stop = threading.Event()
+
+    def is_valid(self, token):
+        """Return True if the token is not about to expire."""
+        return token is not None and token['expires_on'] - time.time() > self.refresh_margin_seconds
+
+    def read(self):
+        """Read the cached token, if any."""
+        try:
+            with open(self.filename, 'rt') as cache_file:
+                token = json.load(cache_file)
+            if token.get('resource') != self.resource:
+                return None
+            return token
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write(self, token):
+        """Atomically replace the cache file."""
+        tmp_filename = "{}.{}.tmp".format(self.filename, os.getpid())
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wt') as cache_file:
+            json.dump(token, cache_file)
+        os.rename(tmp_filename, self.filename)
+
+    def lock(self, operation):
+        """Open and lock the lock file; returns the file, or None if it cannot be created."""
+        try:
+            try:
+                os.makedirs(os.path.dirname(self.filename), 0o700)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+            lock_file = open(self.filename + '.lock', 'a')
+            fcntl.flock(lock_file.fileno(), operation)
+            return lock_file
+        except (IOError, OSError) as ex:
+            logging.debug("Cannot use token cache %s: %s", self.filename, ex)
+            return None
+
+    def get_token(self):
+        """Return a valid access token, from the cache file if possible."""
+        start = time.time()
+
+        # Warm path: a valid token is already cached
+        lock_file = self.lock(fcntl.LOCK_SH)
+        try:
+            token = self.read() if lock_file else None
+        finally:
+            if lock_file:
+                lock_file.close()
+        if self.is_valid(token):
+            self._token = token
+            elapsed = time.time() - start
+            Instrumentation.add_time('token.warm', elapsed)
+            logging.debug("Using cached storage token (%.1f ms)", elapsed * 1000)
+            return token['access_token']
+
+        # Cold path: only one process on the host requests a new token,
+        # the others wait for the lock and then find it in the cache.
+        lock_file = self.lock(fcntl.LOCK_EX)
+        try:
+            token = self.read() if lock_file else None
+            if not self.is_valid(token):
+                try:
+                    token = self.fetch(self.resource)
+                except Exception as ex:
+                    raise BackupException("Cannot get access token for {}: {}".format(self.resource, ex))
+                token['resource'] = self.resource
+                if lock_file:
+                    try:
+                        self.write(token)
+                    except (IOError, OSError) as ex:
+                        logging.debug("Cannot write token cache %s: %s", self.filename, ex)
+                Instrumentation.incr('token.requests')
+        finally:
+            if lock_file:
+                lock_file.close()
+
+        elapsed = time.time() - start
+        Instrumentation.add_time('token.cold', elapsed)
+        logging.debug("Obtained storage token (%.1f ms)", elapsed * 1000)
+        self._token = token
+        return token['access_token']
+
+    def seconds_until_refresh(self):
+        """Seconds to wait before the current token needs to be renewed."""
+        if self._token is None:
+            return 0
+        return max(0, self._token['expires_on'] - time.time() - self.refresh_margin_seconds)
+
+    def start_refresh_thread(self, credential):
+        """
+        Keep the token of a TokenCredential fresh from a background thread,
+        for runs that last longer than the token lifetime.
+        """
+        def run():
+            """Thread body."""
+            while not self._stop.wait(max(1, self.seconds_until_refresh())):
+                try:
+                    credential.token = self.get_token()
+                except BackupException as ex:
+                    logging.warning("Failed to refresh storage token: %s", ex)
+                    self._stop.wait(30)
+
+        self.refresh_thread = threading.Thread(target=run, name="token-refresh")
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+
+    def stop_refresh_thread(self):
+        """Stop the background refresh."""
+        self._stop.set()
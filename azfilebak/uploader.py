@@ -0,0 +1,289 @@
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Uploader module."""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.backupexception import BackupException
+
+MB = 1024 * 1024
+MIN_BLOCK_SIZE = 4 * MB
+# Largest block and largest single Put Blob of the storage service version used by the SDK
+MAX_BLOCK_SIZE = 100 * MB
+MAX_SINGLE_PUT_SIZE = 64 * MB
+# Fixed block size of delta uploads: 50,000 blocks hold about 390 GB
+DEFAULT_DELTA_BLOCK_SIZE = 8 * MB
+# Each block is at least this fraction of the data uploaded before it
+GROWTH_DIVISOR = 1000
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_MAX_MEMORY = 512 * MB
+
+def read_block(stream, size):
+    """Read size bytes, or less at the end of the stream."""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return ''.join(chunks)
+
+class StreamUploader(object):
+    """
+    Upload a stream of unknown length, such as the output of tar, as a block
+    blob. A blob has at most 50,000 blocks, so the block size grows with the
+    amount of data uploaded: each block is at least 1/1000 of the data before
+    it. Starting with 4 MB blocks, a stream reaches 100 MB blocks after about
+    100 GB and 4,100 blocks, and streams of up to about 4.4 TiB fit. Blocks
+    are uploaded in parallel while the next one is read, within a memory
+    budget. A stream that fits in the first block is uploaded with a
+    single Put Blob.
+
+    The size of the last upload of a fileset is kept in a state file, so
+    that the next upload starts with the block size it ended with.
+
+    >>> StreamUploader.next_block_size(MIN_BLOCK_SIZE, 0) // MB
+    4
+    >>> StreamUploader.next_block_size(MIN_BLOCK_SIZE, 10 * 1024 * MB) // MB
+    11
+    >>> StreamUploader.next_block_size(MIN_BLOCK_SIZE, 1024 * 1024 * MB) // MB
+    100
+    """
+
+    def __init__(self, storage_backend, state_file=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, max_memory=DEFAULT_MAX_MEMORY):
+        self.storage_backend = storage_backend
+        self.state_file = state_file
+        self.max_connections = max(1, int(max_connections))
+        self.max_memory = max(MIN_BLOCK_SIZE, int(max_memory))
+
+    @staticmethod
+    def next_block_size(block_size, uploaded):
+        """Block size after 'uploaded' bytes, in whole MB; it never shrinks."""
+        size = max(block_size, uploaded // GROWTH_DIVISOR)
+        size = (size + MB - 1) // MB * MB
+        return min(max(size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+    #
+    # State of the previous upload.
+    #
+
+    def load_state(self):
+        """Parameters of the previous upload of the fileset, {} if unknown."""
+        if not self.state_file:
+            return {}
+        try:
+            with open(self.state_file, 'rt') as state_file:
+                return json.load(state_file)
+        except (IOError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        """Atomically replace the state file."""
+        if not self.state_file:
+            return
+        tmp_filename = "{}.{}.tmp".format(self.state_file, os.getpid())
+        try:
+            with open(tmp_filename, 'wt') as state_file:
+                json.dump(state, state_file, indent=2, sort_keys=True)
+            os.rename(tmp_filename, self.state_file)
+        except (IOError, OSError) as ex:
+            logging.debug("Cannot write upload state %s: %s", self.state_file, ex)
+
+    #
+    # Upload.
+    #
+
+    def upload(self, container_name, blob_name, stream, metadata=None):
+        """Upload the stream; returns the parameters that were used."""
+        start = time.time()
+        if self.storage_backend.max_blocks is None:
+            self.storage_backend.create_blob_from_stream(container_name, blob_name, stream, metadata=metadata)
+            return None
+
+        previous = self.load_state()
+        block_size = StreamUploader.next_block_size(MIN_BLOCK_SIZE, previous.get('size', 0))
+        logging.info("Uploading %s with %d MB blocks (previous upload: %s)",
+                     blob_name, block_size // MB, previous.get('size', 'none'))
+
+        data = read_block(stream, block_size)
+        if len(data) < block_size and len(data) <= MAX_SINGLE_PUT_SIZE:
+            with Instrumentation.timer('upload.put_blob'):
+                self.storage_backend.create_blob_from_bytes(container_name, blob_name, data, metadata=metadata)
+            result = {'size': len(data), 'blocks': 0, 'block_size': block_size, 'connections': 1}
+        else:
+            result = self.upload_blocks(container_name, blob_name, stream, data, block_size, metadata)
+        return self.report(result, start)
+
+    def report(self, result, start):
+        """Log and remember the parameters of an upload."""
+        seconds = time.time() - start
+        result['seconds'] = round(seconds, 3)
+        result['mb_per_second'] = round(result['size'] / float(MB) / max(seconds, 0.001), 2)
+        logging.info("Uploaded %d bytes in %d blocks of up to %d MB with %d connections (%.1f MB/s)",
+                     result['size'], result['blocks'], result['block_size'] // MB,
+                     result['connections'], result['mb_per_second'])
+        Instrumentation.incr('upload.bytes', result['size'])
+        self.save_state(result)
+        return result
+
+    def block_id(self, index, data):
+        """Id of the block at index."""
+        return '{:05d}'.format(index)
+
+    def stage_block(self, container_name, blob_name, block_id, data):
+        """Upload one block."""
+        with Instrumentation.timer('upload.put_block'):
+            self.storage_backend.put_block(container_name, blob_name, block_id, data)
+
+    def upload_blocks(self, container_name, blob_name, stream, data, block_size, metadata):
+        """Upload blocks in parallel while reading the stream, then commit them."""
+        backend = self.storage_backend
+        backend.set_concurrency(self.max_connections)
+        pool = ThreadPool(processes=self.max_connections)
+        condition = threading.Condition()
+        in_flight = {'count': 0, 'bytes': 0}
+        errors = []
+
+        def put_block(block_id, block):
+            """Upload one block and release its share of the budget."""
+            try:
+                self.stage_block(container_name, blob_name, block_id, block)
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                with condition:
+                    in_flight['count'] -= 1
+                    in_flight['bytes'] -= len(block)
+                    condition.notify_all()
+
+        block_ids = []
+        uploaded = 0
+        peak_connections = 0
+        try:
+            while data and not errors:
+                if backend.max_blocks is not None and len(block_ids) >= backend.max_blocks:
+                    raise BackupException("Cannot upload {}: more than {} blocks of {} MB".format(
+                        blob_name, backend.max_blocks, block_size // MB))
+                with condition:
+                    # Larger blocks leave room for fewer uploads in flight
+                    while in_flight['count'] > 0 and (
+                            in_flight['count'] >= self.max_connections or
+                            in_flight['bytes'] + len(data) > self.max_memory):
+                        condition.wait()
+                    in_flight['count'] += 1
+                    in_flight['bytes'] += len(data)
+                    peak_connections = max(peak_connections, in_flight['count'])
+                block_id = self.block_id(len(block_ids), data)
+                pool.apply_async(put_block, (block_id, data))
+                block_ids.append(block_id)
+                uploaded += len(data)
+                Instrumentation.incr('upload.blocks')
+
+                new_block_size = self.next_block_size(block_size, uploaded)
+                if new_block_size != block_size:
+                    logging.debug("Block size %d MB after %d bytes", new_block_size // MB, uploaded)
+                    block_size = new_block_size
+                data = read_block(stream, block_size)
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise errors[0]
+
+        with Instrumentation.timer('upload.put_block_list'):
+            backend.put_block_list(container_name, blob_name, block_ids, metadata=metadata)
+        return {'size': uploaded, 'blocks': len(block_ids), 'block_size': block_size,
+                'connections': peak_connections}
+
+class DeltaUploader(StreamUploader):
+    """
+    Upload a stream in fixed-size blocks whose ids are the SHA-256 of their
+    content, reusing the blocks of a previous backup. A block whose content
+    is in the previous blob is copied inside the storage service (Put Block
+    From URL) instead of being sent; a block that appears several times is
+    staged once. Only blocks that changed are uploaded, and the result is
+    an ordinary blob.
+
+    The stream must keep unchanged data at the same offsets for blocks to
+    match: uncompressed output, such as a database dump or a tar archive
+    of a disk image, not gzip output.
+
+    >>> DeltaUploader.block_hash('')[:16]
+    'e3b0c44298fc1c14'
+    """
+
+    def __init__(self, storage_backend, previous_blob=None, block_size=DEFAULT_DELTA_BLOCK_SIZE,
+                 state_file=None, max_connections=DEFAULT_MAX_CONNECTIONS, max_memory=DEFAULT_MAX_MEMORY):
+        StreamUploader.__init__(self, storage_backend, state_file, max_connections, max_memory)
+        self.previous_blob = previous_blob
+        self.block_size = min(max(int(block_size), MB), MAX_BLOCK_SIZE)
+        self.previous_blocks = {}
+        self.staged = set()
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def block_hash(data):
+        """Block id of some content."""
+        return hashlib.sha256(data).hexdigest()
+
+    def block_id(self, index, data):
+        return DeltaUploader.block_hash(data)
+
+    def next_block_size(self, block_size, uploaded):
+        # Blocks stay aligned with those of the previous backup
+        return block_size
+
+    def load_previous_blocks(self, container_name):
+        """Map the blocks of the previous blob to their byte range in it."""
+        blocks = {}
+        offset = 0
+        for (block_id, size) in self.storage_backend.get_block_list(container_name, self.previous_blob):
+            if block_id not in blocks:
+                blocks[block_id] = (offset, offset + size - 1)
+            offset += size
+        return blocks
+
+    def stage_block(self, container_name, blob_name, block_id, data):
+        with self.lock:
+            if block_id in self.staged:
+                return
+            self.staged.add(block_id)
+        source = self.previous_blocks.get(block_id)
+        if source is not None and source[1] - source[0] + 1 == len(data):
+            with Instrumentation.timer('upload.put_block_from_url'):
+                self.storage_backend.put_block_from_blob(container_name, blob_name, block_id,
+                                                         self.previous_blob, source[0], source[1])
+            with self.lock:
+                self.reused += len(data)
+        else:
+            StreamUploader.stage_block(self, container_name, blob_name, block_id, data)
+
+    def upload(self, container_name, blob_name, stream, metadata=None):
+        """Upload the stream; returns the parameters that were used."""
+        start = time.time()
+        if self.previous_blob:
+            self.previous_blocks = self.load_previous_blocks(container_name)
+        logging.info("Uploading %s with %d MB blocks, reusing %d blocks of %s",
+                     blob_name, self.block_size // MB, len(self.previous_blocks), self.previous_blob or 'none')
+        data = read_block(stream, self.block_size)
+        result = self.upload_blocks(container_name, blob_name, stream, data, self.block_size, metadata)
+        result['reused'] = self.reused
+        logging.info("Reused %d of %d bytes from %s", self.reused, result['size'], self.previous_blob)
+        Instrumentation.incr('upload.reused_bytes', self.reused)
+        return self.report(result, start)
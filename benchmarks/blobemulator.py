@@ -0,0 +1,344 @@
+#!/usr/bin/env python2.7
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""
+Blob service emulator for benchmarks.
+
+Serves the subset of the blob REST API used by azfilebak (block uploads,
+ranged downloads, properties, metadata, listings and deletes) over plain
+HTTP, storing the data with the local storage backend. Authentication is
+not checked. A fixed latency can be added to every request, and a
+bandwidth cap is shared by all connections. Request counts and bytes
+transferred are served as JSON on /__stats.
+
+    python benchmarks/blobemulator.py --port 10000 --latency-ms 20 --bandwidth-mbps 100
+
+Point azfilebak at it with azure.blob.endpoint="http://127.0.0.1:10000"
+and any base64 STORAGE_KEY in the environment.
+"""
+
+import os
+import sys
+import json
+import time
+import email.utils
+import argparse
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+from xml.sax.saxutils import escape
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.getcwd())
+
+from azfilebak.storagebackend import LocalStorageBackend
+from azfilebak.backupexception import BackupException
+
+CHUNK_SIZE = 64 * 1024
+API_VERSION = '2018-11-09'
+
+class Throttle(object):
+    """Token bucket shared by all connections; rate in bytes per second, None for no limit."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_free = time.time()
+
+    def consume(self, count):
+        """Wait until count bytes may be transferred."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_free)
+            self.next_free = start + float(count) / self.rate
+            wait = self.next_free - now
+        if wait > 0:
+            time.sleep(wait)
+
+class Stats(object):
+    """Request counters."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear the counters."""
+        self.requests = dict()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, operation, bytes_in, bytes_out):
+        """Count a request."""
+        with self.lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def report(self):
+        """Counters as a dictionary."""
+        with self.lock:
+            return {
+                'requests': dict(self.requests),
+                'total_requests': sum(self.requests.values()),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out
+            }
+
+def http_date(value):
+    """Format a datetime for HTTP headers and listings."""
+    return email.utils.formatdate(time.mktime(value.timetuple()) - time.timezone, usegmt=True)
+
+class BlobRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle one blob service request."""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    #
+    # Request and response helpers.
+    #
+
+    def parse(self):
+        """Split the request into container, blob and query parameters."""
+        url = urlparse.urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        self.container = urlparse.unquote(parts[0]) if parts[0] else None
+        self.blob = urlparse.unquote(parts[1]) if len(parts) > 1 and parts[1] else None
+        self.query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        self.bytes_in = 0
+        time.sleep(self.server.latency)
+
+    def read_body(self):
+        """Read the request body, subject to the bandwidth cap."""
+        remaining = int(self.headers.getheader('content-length') or 0)
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            self.server.throttle.consume(len(chunk))
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        body = ''.join(chunks)
+        self.bytes_in = len(body)
+        return body
+
+    def respond(self, operation, status, body='', headers=None):
+        """Send a response, subject to the bandwidth cap."""
+        self.send_response(status)
+        self.send_header('x-ms-request-id', '{}-{}'.format(os.getpid(), id(self)))
+        self.send_header('x-ms-version', API_VERSION)
+        self.send_header('Date', email.utils.formatdate(usegmt=True))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        if not (headers and 'Content-Length' in headers):
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            for start in range(0, len(body), CHUNK_SIZE):
+                chunk = body[start:start + CHUNK_SIZE]
+                self.server.throttle.consume(len(chunk))
+                self.wfile.write(chunk)
+        if operation != 'Stats':
+            self.server.stats.add(operation, self.bytes_in, 0 if self.command == 'HEAD' else len(body))
+
+    def error(self, operation, status, code):
+        """Send an error in the format of the blob service."""
+        body = '<?xml version="1.0" encoding="utf-8"?><Error><Code>{}</Code><Message>{}</Message></Error>'.format(
+            code, code)
+        self.respond(operation, status, body, {'x-ms-error-code': code, 'Content-Type': 'application/xml'})
+
+    def blob_headers(self, info):
+        """Property and metadata headers of a blob."""
+        headers = {
+            'Last-Modified': http_date(info.created),
+            'x-ms-creation-time': http_date(info.created),
+            'ETag': '"0x{:X}"'.format(hash((info.name, info.size, info.created)) & 0xffffffffffff),
+            'x-ms-blob-type': 'BlockBlob',
+            'Accept-Ranges': 'bytes',
+            'Content-Type': 'application/octet-stream'
+        }
+        for (name, value) in (info.metadata or {}).items():
+            headers['x-ms-meta-' + name] = value
+        return headers
+
+    def request_metadata(self):
+        """x-ms-meta-* headers of the request."""
+        return dict((name[len('x-ms-meta-'):], value) for (name, value) in self.headers.items()
+                    if name.lower().startswith('x-ms-meta-'))
+
+    #
+    # Operations.
+    #
+
+    def do_PUT(self):
+        self.parse()
+        backend = self.server.backend
+        comp = self.query.get('comp')
+        body = self.read_body()
+        try:
+            if self.blob is None:
+                # Create container
+                LocalStorageBackend.makedirs(backend.container_path(self.container))
+                self.respond('CreateContainer', 201)
+            elif comp == 'block':
+                backend.put_block(self.container, self.blob, self.query['blockid'], body)
+                self.respond('PutBlock', 201)
+            elif comp == 'blocklist':
+                block_ids = [e.text for e in ElementTree.fromstring(body)]
+                backend.put_block_list(self.container, self.blob, block_ids, self.request_metadata())
+                self.respond('PutBlockList', 201, headers={'ETag': '"0x1"', 'Last-Modified': http_date_now()})
+            elif comp == 'metadata':
+                backend.get_blob_properties(self.container, self.blob)
+                backend.set_blob_metadata(self.container, self.blob, self.request_metadata())
+                self.respond('SetBlobMetadata', 200)
+            elif comp is None:
+                backend.put_block(self.container, self.blob, 'single', body)
+                backend.put_block_list(self.container, self.blob, ['single'], self.request_metadata())
+                self.respond('PutBlob', 201, headers={'ETag': '"0x1"', 'Last-Modified': http_date_now()})
+            else:
+                self.error('Unsupported', 400, 'UnsupportedQueryParameter')
+        except BackupException:
+            self.error('PutBlockList', 400, 'InvalidBlockList')
+
+    def do_HEAD(self):
+        self.parse()
+        try:
+            info = self.server.backend.get_blob_properties(self.container, self.blob)
+        except BackupException:
+            self.error('GetBlobProperties', 404, 'BlobNotFound')
+            return
+        headers = self.blob_headers(info)
+        headers['Content-Length'] = str(info.size)
+        self.respond('GetBlobProperties', 200, headers=headers)
+
+    def do_GET(self):
+        self.parse()
+        if self.container == '__stats':
+            body = json.dumps(self.server.stats.report())
+            if 'reset' in self.query:
+                self.server.stats.reset()
+            self.respond('Stats', 200, body, {'Content-Type': 'application/json'})
+        elif self.query.get('comp') == 'list':
+            if self.container is None:
+                self.list_containers()
+            else:
+                self.list_blobs()
+        else:
+            self.get_blob()
+
+    def get_blob(self):
+        """Get Blob, with an optional range."""
+        backend = self.server.backend
+        try:
+            info = backend.get_blob_properties(self.container, self.blob)
+        except BackupException:
+            self.error('GetBlob', 404, 'BlobNotFound')
+            return
+        headers = self.blob_headers(info)
+        range_header = self.headers.getheader('x-ms-range') or self.headers.getheader('range')
+        if range_header is None:
+            body = backend.get_blob_range(self.container, self.blob, 0, info.size - 1) if info.size else ''
+            self.respond('GetBlob', 200, body, headers)
+            return
+        (start, end) = range_header.split('=')[1].split('-')
+        start = int(start)
+        end = min(int(end) if end else info.size - 1, info.size - 1)
+        if start >= info.size:
+            self.error('GetBlob', 416, 'InvalidRange')
+            return
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, info.size)
+        self.respond('GetBlob', 206, backend.get_blob_range(self.container, self.blob, start, end), headers)
+
+    def list_containers(self):
+        """List Containers."""
+        items = ''.join(
+            '<Container><Name>{}</Name><Properties><Last-Modified>{}</Last-Modified>'
+            '<Etag>"0x1"</Etag></Properties></Container>'.format(escape(name), http_date_now())
+            for name in self.server.backend.list_containers())
+        body = ('<?xml version="1.0" encoding="utf-8"?><EnumerationResults ServiceEndpoint="{}">'
+                '<Containers>{}</Containers><NextMarker /></EnumerationResults>').format(
+                    escape(self.server.endpoint), items)
+        self.respond('ListContainers', 200, body, {'Content-Type': 'application/xml'})
+
+    def list_blobs(self):
+        """List Blobs, paginated with markers."""
+        page = self.server.backend.list_blobs(
+            self.container, prefix=self.query.get('prefix') or None, marker=self.query.get('marker') or None,
+            include_metadata='metadata' in self.query.get('include', ''),
+            page_size=int(self.query.get('maxresults') or 5000))
+        items = []
+        for info in page:
+            metadata = ''.join('<{0}>{1}</{0}>'.format(k, escape(v)) for (k, v) in (info.metadata or {}).items())
+            items.append(
+                '<Blob><Name>{}</Name><Properties><Creation-Time>{}</Creation-Time>'
+                '<Last-Modified>{}</Last-Modified><Etag>"0x1"</Etag><Content-Length>{}</Content-Length>'
+                '<BlobType>BlockBlob</BlobType></Properties><Metadata>{}</Metadata></Blob>'.format(
+                    escape(info.name), http_date(info.created), http_date(info.created), info.size, metadata))
+        body = ('<?xml version="1.0" encoding="utf-8"?><EnumerationResults ContainerName="{}">'
+                '<Blobs>{}</Blobs><NextMarker>{}</NextMarker></EnumerationResults>').format(
+                    escape(self.container), ''.join(items), escape(page.next_marker or ''))
+        self.respond('ListBlobs', 200, body, {'Content-Type': 'application/xml'})
+
+    def do_DELETE(self):
+        self.parse()
+        try:
+            self.server.backend.delete_blob(self.container, self.blob)
+            self.respond('DeleteBlob', 202)
+        except BackupException:
+            self.error('DeleteBlob', 404, 'BlobNotFound')
+
+def http_date_now():
+    """Current time for HTTP headers."""
+    return email.utils.formatdate(usegmt=True)
+
+class BlobEmulator(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server with the emulator state."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+    def __init__(self, address, root, latency_ms=0, bandwidth_mbps=None, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, BlobRequestHandler)
+        self.backend = LocalStorageBackend(root)
+        self.latency = latency_ms / 1000.0
+        self.throttle = Throttle(bandwidth_mbps * 1024 * 1024 / 8 if bandwidth_mbps else None)
+        self.stats = Stats()
+        self.verbose = verbose
+        self.endpoint = 'http://{}:{}/'.format(*self.server_address)
+
+def main():
+    """Run the emulator until interrupted."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=10000)
+    parser.add_argument("--root", required=True, help="Directory where blobs are stored")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every request")
+    parser.add_argument("--bandwidth-mbps", type=float, default=None, help="Shared bandwidth cap in Mbit/s")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = BlobEmulator(('127.0.0.1', args.port), args.root, args.latency_ms, args.bandwidth_mbps, args.verbose)
+    print "Blob emulator listening on {}".format(server.endpoint)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
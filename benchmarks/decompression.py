@@ -0,0 +1,146 @@
+#!/usr/bin/env python2.7
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""
+Decompression benchmark.
+
+Compresses generated data, a mix of text and incompressible blocks, into
+an adaptive archive and into a standard single-member .tar.gz, then
+measures the MB/s (of uncompressed data) at which restore decompresses
+them: 'gzip -dc' and the single thread fallback for the standard archive
+(what 'tar xzf' does), and the members of the adaptive archive with 1, 2,
+4... threads up to the number of CPUs. Run from the repository root:
+
+    python benchmarks/decompression.py --size 512M --policy balanced
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.getcwd())
+
+from azfilebak.compression import AdaptiveCompressor, ParallelDecompressor, POLICIES, DEFAULT_POLICY
+from azfilebak.simulator import parse_size
+
+BLOCK_SIZE = 1024 * 1024
+
+class NullOutput(object):
+    """Count and discard what is written."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        """Discard data."""
+        self.size += len(data)
+
+    def flush(self):
+        """Nothing to flush."""
+        pass
+
+class StringReader(object):
+    """Read a string in pieces without copying the rest of it."""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size=-1):
+        """Read size bytes."""
+        end = len(self.data) if size < 0 else self.offset + size
+        chunk = self.data[self.offset:end]
+        self.offset += len(chunk)
+        return chunk
+
+def generate(size, random_share, seed):
+    """Blocks of text, and a share of incompressible blocks."""
+    rand = random.Random(seed)
+    words = ['backup', 'restore', 'azure', 'blob', 'tar', 'gzip', 'fileset', 'stripe', 'member', 'thread']
+    text = ' '.join(rand.choice(words) + str(rand.randint(0, 999)) for _ in range(BLOCK_SIZE))
+    noise = os.urandom(BLOCK_SIZE * 2)
+    blocks = []
+    for _ in range(size // BLOCK_SIZE):
+        source = noise if rand.random() < random_share else text
+        offset = rand.randint(0, len(source) - BLOCK_SIZE)
+        blocks.append(source[offset:offset + BLOCK_SIZE])
+    return ''.join(blocks)
+
+def thread_counts():
+    """1, 2, 4... up to the number of CPUs."""
+    counts = []
+    threads = 1
+    while threads < multiprocessing.cpu_count():
+        counts.append(threads)
+        threads *= 2
+    return counts + [multiprocessing.cpu_count()]
+
+def run_decompressor(archive, threads):
+    """Decompress the archive as restore downloads it, in chunks; returns seconds."""
+    output = NullOutput()
+    start = time.time()
+    decompressor = ParallelDecompressor(output, threads=threads)
+    for offset in range(0, len(archive), 4 * 1024 * 1024):
+        decompressor.write(archive[offset:offset + 4 * 1024 * 1024])
+    decompressor.flush()
+    decompressor.close()
+    return time.time() - start
+
+def run_gzip(archive):
+    """Decompress the archive with 'gzip -dc'; returns seconds."""
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(['gzip', '-dc'], stdin=subprocess.PIPE, stdout=devnull)
+        proc.communicate(archive)
+    return time.time() - start
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="256M", help="Size of the uncompressed data")
+    parser.add_argument("--random-share", type=float, default=0.2, help="Share of incompressible blocks")
+    parser.add_argument("--policy", default=DEFAULT_POLICY, choices=sorted(POLICIES), help="Compression policy")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per mode (the best is kept)")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    data = generate(parse_size(args.size), args.random_share, seed=1)
+    print "Compressing {} MB".format(len(data) // BLOCK_SIZE)
+    adaptive = AdaptiveCompressor(StringReader(data), policy=args.policy).read()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    standard = compressor.compress(data) + compressor.flush()
+
+    modes = [('gzip -dc', lambda: run_gzip(standard)),
+             ('single member', lambda: run_decompressor(standard, 1))]
+    modes += [('adaptive, {} threads'.format(threads), lambda threads=threads: run_decompressor(adaptive, threads))
+              for threads in thread_counts()]
+    results = {'size': len(data), 'policy': args.policy, 'cpus': multiprocessing.cpu_count(),
+               'adaptive_size': len(adaptive), 'standard_size': len(standard), 'modes': {}}
+    for (name, run) in modes:
+        seconds = min(run() for _ in range(args.runs))
+        results['modes'][name] = {'seconds': round(seconds, 3), 'mb_per_second': round(len(data) / 1e6 / seconds, 1)}
+
+    baseline = results['modes']['single member']['mb_per_second']
+    print "{:24} {:>10} {:>10} {:>8}".format("mode", "seconds", "MB/s", "gain")
+    for (name, _run) in modes:
+        mode = results['modes'][name]
+        print "{:24} {:10.2f} {:10.1f} {:7.2f}x".format(
+            name, mode['seconds'], mode['mb_per_second'], mode['mb_per_second'] / baseline)
+
+    if args.json:
+        with open(args.json, 'wt') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
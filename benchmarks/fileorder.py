@@ -0,0 +1,151 @@
+#!/usr/bin/env python2.7
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""
+File order benchmark.
+
+Creates a tree of small files in random order, so that the order of the
+directory entries, of the inodes and of the data on disk differ, and
+measures how many files per second tar archives them in each file order
+(fs.<fileset>.order): readdir (tar walks the tree), inode and extent (tar
+reads a sorted --files-from list, with and without readahead). The time
+to build the sorted list is included.
+
+The page cache is dropped before each run, which needs root; without it
+the files are read from memory and the orders cannot differ much. Run on
+the disk to measure, from the repository root:
+
+    sudo python benchmarks/fileorder.py --workdir /data/bench --files 200000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.getcwd())
+
+from azfilebak.fileorder import FileOrder, Readahead, DEFAULT_READAHEAD_WINDOW
+from azfilebak.simulator import parse_size
+
+MODES = [
+    ('readdir', None, False),
+    ('inode', 'inode', False),
+    ('inode+readahead', 'inode', True),
+    ('extent', 'extent', False),
+    ('extent+readahead', 'extent', True),
+]
+
+def generate_tree(path, files, dirs, size, seed):
+    """Files of random content spread over dirs directories, created in random order."""
+    rand = random.Random(seed)
+    names = [os.path.join('d{:04d}'.format(i % dirs), 'f{:07d}'.format(i)) for i in range(files)]
+    rand.shuffle(names)
+    for i in range(dirs):
+        os.makedirs(os.path.join(path, 'd{:04d}'.format(i)))
+    data = os.urandom(size * 2)
+    for name in names:
+        offset = rand.randint(0, size)
+        with open(os.path.join(path, name), 'wb') as out:
+            out.write(data[offset:offset + size])
+    subprocess.check_call(['sync'])
+
+def drop_caches():
+    """Drop the page, dentry and inode caches; False if not allowed."""
+    subprocess.check_call(['sync'])
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as drop:
+            drop.write('3\n')
+        return True
+    except IOError:
+        return False
+
+def run_tar(tree, order, readahead, window):
+    """Archive the tree to a pipe that is read and discarded; returns (seconds, list seconds)."""
+    start = time.time()
+    files = []
+    if order is None:
+        args = ['tar', 'cf', '-', tree]
+    else:
+        (dirs, files) = FileOrder.collect([tree], [], order)
+        list_file = tempfile.NamedTemporaryFile(suffix='.lst')
+        FileOrder.write_list(dirs, files, list_file.name)
+        args = ['tar', 'cf', '-', '--null', '--no-recursion', '--files-from', list_file.name]
+    list_seconds = time.time() - start
+    with open(os.devnull, 'w') as devnull:
+        # Not tar cf /dev/null: GNU tar does not read the files then
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=devnull)
+        reader = None
+        if readahead:
+            reader = Readahead(files, proc.pid, window)
+            reader.start()
+        while proc.stdout.read(1024 * 1024):
+            pass
+        proc.wait()
+        if reader:
+            reader.stop()
+    return (time.time() - start, list_seconds)
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", help="Directory for the tree, kept between runs (default: temporary)")
+    parser.add_argument("--files", type=int, default=100000, help="Number of files")
+    parser.add_argument("--dirs", type=int, default=100, help="Number of directories")
+    parser.add_argument("--file-size", default="4K", help="Size of each file")
+    parser.add_argument("--window", default=str(DEFAULT_READAHEAD_WINDOW), help="Readahead window")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per mode (the best is kept)")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    tree = os.path.join(workdir, 'tree-{}-{}-{}'.format(args.files, args.dirs, args.file_size))
+    try:
+        if not os.path.isdir(tree):
+            print "Creating {} files in {}".format(args.files, tree)
+            generate_tree(tree, args.files, args.dirs, parse_size(args.file_size), seed=1)
+
+        cold = drop_caches()
+        if not cold:
+            print "Cannot drop the page cache (not root): files are read from memory"
+        results = {'files': args.files, 'file_size': args.file_size, 'cold_cache': cold, 'modes': {}}
+        for (name, order, readahead) in MODES:
+            best = None
+            for _ in range(args.runs):
+                drop_caches()
+                (seconds, list_seconds) = run_tar(tree, order, readahead, parse_size(args.window))
+                if best is None or seconds < best[0]:
+                    best = (seconds, list_seconds)
+            results['modes'][name] = {
+                'seconds': round(best[0], 3),
+                'list_seconds': round(best[1], 3),
+                'files_per_second': round(args.files / best[0], 1)
+            }
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    baseline = results['modes']['readdir']['files_per_second']
+    print "{:20} {:>10} {:>10} {:>10} {:>8}".format("order", "seconds", "list s", "files/s", "gain")
+    for (name, _order, _readahead) in MODES:
+        mode = results['modes'][name]
+        print "{:20} {:10.2f} {:10.2f} {:10.0f} {:7.2f}x".format(
+            name, mode['seconds'], mode['list_seconds'], mode['files_per_second'],
+            mode['files_per_second'] / baseline)
+
+    if args.json:
+        with open(args.json, 'wt') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python2.7
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""
+Notification latency benchmark.
+
+Compares the time a backup waits for its notification when the notification
+command is run synchronously, and when the notification is spooled and
+delivered by a background drainer process, using a deliberately slow
+notification command. Also reports how long the drainer takes to deliver
+everything.
+
+Run from the repository root:
+
+    python benchmarks/notification_latency.py --count 5 --delay 2
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.getcwd())
+
+from azfilebak.notificationspool import NotificationSpool
+
+MESSAGE = json.dumps({"cloud": "azure", "state": "success", "type": "fs", "level": "full"})
+
+def summarize(samples):
+    """Median and maximum of latencies in ms."""
+    samples = sorted(samples)
+    return {'median_ms': samples[len(samples) // 2] * 1000, 'max_ms': samples[-1] * 1000}
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=5, help="Notifications per mode")
+    parser.add_argument("--delay", type=float, default=2.0, help="Seconds the notifier takes")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        # Concurrent deliveries each write their own file
+        received = os.path.join(workdir, 'received')
+        os.mkdir(received)
+        command = "sh -c 'sleep {}; cat > $(mktemp {}/msg.XXXXXX)'".format(args.delay, received)
+        spool = NotificationSpool(os.path.join(workdir, 'spool'), command)
+
+        # Synchronous delivery, as before the spool
+        synchronous = []
+        for _ in range(args.count):
+            start = time.time()
+            spool.send([MESSAGE])
+            synchronous.append(time.time() - start)
+
+        # Spooled delivery with a drainer process
+        spooled = []
+        first_enqueue = time.time()
+        for _ in range(args.count):
+            start = time.time()
+            spool.enqueue(MESSAGE)
+            spooled.append(time.time() - start)
+        while spool.seconds_until_next_attempt() is not None:
+            time.sleep(0.05)
+        delivered = time.time() - first_enqueue
+
+        lines = len(os.listdir(received))
+        results = {
+            'notifier_delay_s': args.delay,
+            'count': args.count,
+            'synchronous': summarize(synchronous),
+            'spooled': summarize(spooled),
+            'spooled_all_delivered_s': delivered,
+            'received': lines
+        }
+    finally:
+        shutil.rmtree(workdir)
+
+    print "{:30} {:>12} {:>12}".format("end-of-backup latency", "median ms", "max ms")
+    for mode in ['synchronous', 'spooled']:
+        print "{:30} {:12.1f} {:12.1f}".format(mode, results[mode]['median_ms'], results[mode]['max_ms'])
+    print
+    print "Spooled notifications delivered after {:.1f} s ({} of {} received)".format(
+        results['spooled_all_delivered_s'], results['received'], 2 * args.count)
+
+    if args.json:
+        with open(args.json, 'wt') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python2.7
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""
+Startup benchmark.
+
+Measures the import time of the azfilebak modules and of the third-party
+modules they use, each in a fresh interpreter, and the wall time of CLI
+invocations that can run without Azure storage. The instance metadata is
+served from a prepared cache so that no network access is needed.
+
+Run from the repository root:
+
+    python benchmarks/startup.py --runs 10 --budget-ms 100
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+MODULES = [
+    'azfilebak.runner',
+    'azfilebak.backupagent',
+    'azfilebak.backupconfiguration',
+    'azfilebak.executableconnector',
+    'azfilebak.timing',
+    'azure.storage.blob',
+    'msrestazure.azure_active_directory',
+    'psutil',
+    'pytz',
+    'tzlocal',
+    'pid',
+    'urllib2',
+]
+
+IMPORT_SNIPPET = "import time; t = time.time(); import {module}; print(time.time() - t)"
+
+def median(values):
+    """Median of a list of numbers."""
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def time_import(module, runs):
+    """Median import time of a module in a fresh interpreter, in ms."""
+    samples = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_SNIPPET.format(module=module)])
+        samples.append(float(out.strip()) * 1000)
+    return median(samples)
+
+def time_command(args, runs):
+    """Median wall time of an azfilebak invocation, in ms."""
+    samples = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-m', 'azfilebak'] + args,
+                                  stdout=devnull, stderr=devnull)
+            samples.append((time.time() - start) * 1000)
+    return median(samples)
+
+def prepare_config(workdir):
+    """Create a configuration file whose instance metadata is already cached."""
+    cache_dir = os.path.join(workdir, 'cache')
+    os.makedirs(cache_dir)
+    shutil.copy('sample_instance_metadata.json', os.path.join(cache_dir, 'instance_metadata.json'))
+    config_file = os.path.join(workdir, 'backup.conf')
+    shutil.copy('sample_backup.conf', config_file)
+    with open(config_file, 'at') as config:
+        config.write('\ncache_directory="{}"\ninstance_metadata_cache_ttl="1h"\n'.format(cache_dir))
+    return config_file
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="Runs per measurement")
+    parser.add_argument("--budget-ms", type=float, default=None,
+                        help="Fail if a command takes longer than this")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        config_file = prepare_config(workdir)
+        # Time the interpreter itself, to subtract from the command timings
+        baseline = []
+        for _ in range(args.runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', 'pass'])
+            baseline.append((time.time() - start) * 1000)
+
+        results = {
+            'python': sys.version.split()[0],
+            'interpreter_ms': median(baseline),
+            'imports_ms': dict((m, time_import(m, args.runs)) for m in MODULES),
+            'commands_ms': {
+                '--help': time_command(['--help'], args.runs),
+                '--show-configuration': time_command(['-c', config_file, '-x', '-o', workdir], args.runs),
+            }
+        }
+    finally:
+        shutil.rmtree(workdir)
+
+    print "{:45} {:>10}".format("import", "ms")
+    for (module, elapsed) in sorted(results['imports_ms'].items(), key=lambda x: -x[1]):
+        print "{:45} {:10.1f}".format(module, elapsed)
+    print
+    print "{:45} {:>10}".format("command (interpreter: {:.1f} ms)".format(results['interpreter_ms']), "ms")
+    for (command, elapsed) in sorted(results['commands_ms'].items()):
+        print "{:45} {:10.1f}".format(command, elapsed)
+
+    if args.json:
+        with open(args.json, 'wt') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.budget_ms is not None:
+        over = [c for (c, elapsed) in results['commands_ms'].items() if elapsed > args.budget_ms]
+        if over:
+            print "Over budget of {} ms: {}".format(args.budget_ms, ", ".join(over))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python2.7
+# coding=utf-8
+
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""
+End-to-end throughput benchmark.
+
+Generates synthetic filesets (a large sparse file, many small files and
+incompressible data), starts the blob emulator, and runs backup, list,
+prune and restore with the azfilebak command line against it. Each phase
+reports wall time, MB/s, CPU seconds and peak RSS of the azfilebak process
+(including the backup command it runs), and the requests the emulator
+received. The results are written as JSON, so that runs on different
+commits can be compared:
+
+    python benchmarks/throughput.py --json before.json
+    git checkout my-branch
+    python benchmarks/throughput.py --json after.json --compare before.json
+
+Generating a million small files takes a while; use --workdir to keep the
+datasets between runs, and smaller sizes for a quick check:
+
+    python benchmarks/throughput.py --sparse-size 100M --small-files 1000 --random-size 10M
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import socket
+import urllib2
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.getcwd())
+
+from azfilebak.naming import Naming
+from azfilebak.simulator import parse_size
+from azfilebak.storagebackend import LocalStorageBackend
+
+CONTAINER = 'benchmark'
+PHASES = ['backup', 'list', 'restore', 'prune']
+MB = 1024.0 * 1024.0
+
+#
+# Datasets.
+#
+
+def generate_sparse(path, size):
+    """A sparse file with 64 KB of data every 256 MB."""
+    with open(os.path.join(path, 'sparse.img'), 'wb') as out:
+        out.truncate(size)
+        for offset in range(0, size, 256 * 1024 * 1024):
+            out.seek(offset)
+            out.write(os.urandom(min(64 * 1024, size - offset)))
+
+def generate_small(path, count, file_size):
+    """Many small files, a thousand per directory."""
+    filler = 'x' * file_size
+    for i in range(count):
+        directory = os.path.join(path, '{:06d}'.format(i // 1000))
+        if i % 1000 == 0:
+            os.mkdir(directory)
+        with open(os.path.join(directory, '{:06d}'.format(i)), 'wb') as out:
+            out.write(('{}\n'.format(i) + filler)[:file_size])
+
+def generate_random(path, size):
+    """Incompressible data."""
+    with open(os.path.join(path, 'random.bin'), 'wb') as out:
+        for offset in range(0, size, 1024 * 1024):
+            out.write(os.urandom(min(1024 * 1024, size - offset)))
+
+def prepare_datasets(data_dir, args):
+    """
+    Create the datasets that do not exist yet with the same parameters.
+    Returns a dictionary of dataset name to logical size in bytes.
+    """
+    datasets = {
+        'sparse': ((args.sparse_size,), lambda p: generate_sparse(p, args.sparse_size)),
+        'small': ((args.small_files, args.small_file_size),
+                  lambda p: generate_small(p, args.small_files, args.small_file_size)),
+        'random': ((args.random_size,), lambda p: generate_random(p, args.random_size)),
+    }
+    sizes = dict()
+    for name in args.datasets.split(','):
+        (parameters, generate) = datasets[name]
+        path = os.path.join(data_dir, name)
+        marker = os.path.join(data_dir, name + '.json')
+        if not (os.path.exists(marker) and json.load(open(marker)) == list(parameters)):
+            print "Generating dataset {}".format(name)
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+            generate(path)
+            with open(marker, 'wt') as out:
+                json.dump(list(parameters), out)
+        sizes[name] = sum(os.path.getsize(os.path.join(d, f)) for (d, _, files) in os.walk(path) for f in files)
+    return sizes
+
+#
+# Emulator and configuration.
+#
+
+def free_port():
+    """A TCP port that is currently unused."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def start_emulator(root, args):
+    """Start the blob emulator and wait until it accepts requests."""
+    port = free_port()
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blobemulator.py'),
+           '--port', str(port), '--root', root, '--latency-ms', str(args.latency_ms)]
+    if args.bandwidth_mbps:
+        cmd += ['--bandwidth-mbps', str(args.bandwidth_mbps)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    proc.stdout.readline()
+    return (proc, 'http://127.0.0.1:{}'.format(port))
+
+def emulator_stats(endpoint):
+    """Return and reset the request counters of the emulator."""
+    return json.load(urllib2.urlopen(endpoint + '/__stats?reset=1'))
+
+def prepare_config(workdir, data_dir, endpoint, datasets):
+    """Create a configuration file for the emulator, with cached instance metadata."""
+    cache_dir = os.path.join(workdir, 'cache')
+    os.makedirs(cache_dir)
+    shutil.copy('sample_instance_metadata.json', os.path.join(cache_dir, 'instance_metadata.json'))
+    config_file = os.path.join(workdir, 'backup.conf')
+    with open('sample_backup.conf', 'rt') as sample, open(config_file, 'wt') as config:
+        # The sample commands are not used, and its test commands do not parse
+        for line in sample:
+            if not line.startswith(('command.', 'notification_command')):
+                config.write(line)
+        config.write('\ncache_directory="{}"\ninstance_metadata_cache_ttl="1h"\n'.format(cache_dir))
+        config.write('azure.blob.endpoint="{}"\nazure.blob.container_name="{}"\n'.format(endpoint, CONTAINER))
+        config.write('notification_command="true"\n')
+        for name in datasets:
+            config.write('command.backup.{0}="tar cpzf - --sparse -C {1} {0}"\n'.format(name, data_dir))
+    return config_file
+
+#
+# Phases.
+#
+
+def run_phase(name, cmd, endpoint, payload_bytes=None):
+    """Run one azfilebak command and measure it."""
+    env = dict(os.environ)
+    # Any key is accepted by the emulator
+    env['STORAGE_KEY'] = base64.b64encode('azfilebak-benchmark')
+    emulator_stats(endpoint)
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        proc = subprocess.Popen([sys.executable, '-m', 'azfilebak'] + cmd, stdout=devnull, stderr=devnull, env=env)
+        # wait4 also accounts for the backup command run by azfilebak
+        (_pid, status, rusage) = os.wait4(proc.pid, 0)
+        wall = time.time() - start
+    if status != 0:
+        raise Exception("Phase {} failed: azfilebak {}".format(name, " ".join(cmd)))
+    stats = emulator_stats(endpoint)
+    if payload_bytes is None:
+        payload_bytes = stats['bytes_in'] + stats['bytes_out']
+    return {
+        'wall_seconds': round(wall, 3),
+        'mb_per_second': round(payload_bytes / MB / wall, 2),
+        'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 3),
+        'peak_rss_mb': round(rusage.ru_maxrss / 1024.0, 1),
+        'requests': stats['requests'],
+        'total_requests': stats['total_requests'],
+        'bytes_uploaded': stats['bytes_in'],
+        'bytes_downloaded': stats['bytes_out'],
+    }
+
+def seed_old_backups(root, blob_name, count):
+    """Add backups older than the retention, for prune to delete."""
+    (fileset, is_full, _timestamp, vmname) = Naming.parse_blobname(blob_name)
+    backend = LocalStorageBackend(root)
+    start = datetime.datetime.now() - datetime.timedelta(days=30)
+    for i in range(count):
+        timestamp = (start - datetime.timedelta(minutes=i)).strftime('%Y%m%d_%H%M%S')
+        name = Naming.construct_blobname(fileset, is_full, timestamp, vmname)
+        backend.put_block(CONTAINER, name, 'seed', '')
+        backend.put_block_list(CONTAINER, name, ['seed'])
+
+def run_dataset(name, size, config_file, workdir, root, endpoint, args):
+    """Run all phases for one dataset."""
+    results = dict()
+    results['backup'] = run_phase('backup', ['-c', config_file, '-f', '-y', '-F', name], endpoint, size)
+    blob_name = [n for n in LocalStorageBackend(root).list_blobs(CONTAINER) if n.name.startswith(name + '_')]
+    blob_name = max(b.name for b in blob_name)
+    results['backup']['compressed_mb'] = round(LocalStorageBackend(root).get_blob_properties(
+        CONTAINER, blob_name).size / MB, 2)
+
+    seed_old_backups(root, blob_name, args.prune_blobs)
+    results['list'] = run_phase('list', ['-c', config_file, '-l', '-F', name], endpoint)
+
+    restore_dir = os.path.join(workdir, 'restore')
+    os.makedirs(restore_dir)
+    results['restore'] = run_phase('restore', ['-c', config_file, '-r', blob_name, '-o', restore_dir], endpoint)
+    shutil.rmtree(restore_dir)
+
+    results['prune'] = run_phase('prune', ['-c', config_file, '-p', '7d', '-F', name], endpoint)
+    return results
+
+#
+# Report.
+#
+
+def git_commit():
+    """Commit of the working tree, or None."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, previous=None):
+    """Print a table, with the change from a previous run if given."""
+    columns = ['wall_seconds', 'mb_per_second', 'cpu_seconds', 'peak_rss_mb', 'total_requests']
+    print "{:8} {:8} {:>14} {:>14} {:>14} {:>14} {:>14}".format(
+        "dataset", "phase", "wall s", "MB/s", "CPU s", "RSS MB", "requests")
+    for (dataset, phases) in sorted(results['datasets'].items()):
+        for phase in PHASES:
+            cells = []
+            for column in columns:
+                value = phases[phase][column]
+                try:
+                    old = previous['datasets'][dataset][phase][column]
+                    change = "{:+.0f}%".format((value - old) * 100.0 / old) if old else "-"
+                    cells.append("{:>8} {:>5}".format(value, change))
+                except (KeyError, TypeError):
+                    cells.append("{:>14}".format(value))
+            print "{:8} {:8} {}".format(dataset, phase, " ".join(cells))
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datasets", default="sparse,small,random", help="Datasets to use")
+    parser.add_argument("--sparse-size", type=parse_size, default="10G", help="Size of the sparse file")
+    parser.add_argument("--small-files", type=int, default=1000000, help="Number of small files")
+    parser.add_argument("--small-file-size", type=parse_size, default="1K", help="Size of each small file")
+    parser.add_argument("--random-size", type=parse_size, default="1G", help="Size of the incompressible file")
+    parser.add_argument("--prune-blobs", type=int, default=1000, help="Expired backups deleted by prune")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Latency added to each request")
+    parser.add_argument("--bandwidth-mbps", type=float, default=None, help="Emulator bandwidth in Mbit/s")
+    parser.add_argument("--workdir", help="Keep datasets in this directory between runs")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--compare", help="Show the change from the results in this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    data_dir = os.path.abspath(os.path.join(args.workdir, 'data') if args.workdir else os.path.join(workdir, 'data'))
+    root = os.path.join(workdir, 'blobs')
+    os.makedirs(root)
+    emulator = None
+    try:
+        sizes = prepare_datasets(data_dir, args)
+        (emulator, endpoint) = start_emulator(root, args)
+        config_file = prepare_config(workdir, data_dir, endpoint, sizes.keys())
+        results = {
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'emulator': {'latency_ms': args.latency_ms, 'bandwidth_mbps': args.bandwidth_mbps},
+            'dataset_mb': dict((n, round(s / MB, 2)) for (n, s) in sizes.items()),
+            'datasets': dict()
+        }
+        for (name, size) in sorted(sizes.items()):
+            print "Running dataset {} ({:.0f} MB)".format(name, size / MB)
+            results['datasets'][name] = run_dataset(name, size, config_file, workdir, root, endpoint, args)
+    finally:
+        if emulator is not None:
+            emulator.terminate()
+            emulator.wait()
+        shutil.rmtree(workdir)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, 'rt') as old:
+            previous = json.load(old)
+        print "Compared to {}".format(previous.get('commit'))
+    print_results(results, previous)
+
+    if args.json:
+        with open(args.json, 'wt') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
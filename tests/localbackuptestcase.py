@@ -0,0 +1,62 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Base class of the tests that back up with the local storage backend."""
+
+import os
+import json
+import shutil
+import tempfile
+from mock import patch, PropertyMock
+from azfilebak.backupconfiguration import BackupConfiguration
+from azfilebak.backupagent import BackupAgent
+from azfilebak.azurevminstancemetadata import AzureVMInstanceMetadata
+from tests.loggedtestcase import LoggedTestCase
+
+class LocalBackupTestCase(LoggedTestCase):
+    """
+    Backups without Azure: the sample configuration with the storage and
+    the caches in a temporary directory, and the instance metadata, the
+    storage client and the notifications patched. Subclasses add their
+    files and configuration with config_lines, and patchers with patchers.
+    """
+
+    def config_lines(self):
+        """
+        Lines appended to the configuration file. Called once self.tmpdir
+        exists, so that the files of the test can be created there.
+        """
+        return []
+
+    def patchers(self):
+        """Patchers started for each test."""
+        meta = AzureVMInstanceMetadata(lambda: json.load(open('sample_instance_metadata.json')))
+        return [
+            patch('azfilebak.azurevminstancemetadata.AzureVMInstanceMetadata.create_instance', return_value=meta),
+            patch.object(BackupAgent, 'send_notification'),
+            patch('azfilebak.backupconfiguration.BackupConfiguration.storage_client', new_callable=PropertyMock)
+        ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmpdir, 'backup.conf')
+        shutil.copy('sample_backup.conf', self.config_file)
+        lines = ['storage_backend="local"',
+                 'local_storage_directory="{}"'.format(os.path.join(self.tmpdir, 'storage')),
+                 'cache_directory="{}"'.format(self.tmpdir)]
+        with open(self.config_file, 'at') as config:
+            config.write('\n' + ''.join(line + '\n' for line in lines + self.config_lines()))
+
+        self.started = self.patchers()
+        for patcher in self.started:
+            patcher.start()
+        self.cfg = BackupConfiguration(self.config_file)
+        self.agent = BackupAgent(self.cfg)
+        self.container = self.cfg.azure_storage_container_name
+
+    def tearDown(self):
+        for patcher in self.started:
+            patcher.stop()
+        shutil.rmtree(self.tmpdir)
@@ -11,31 +11,38 @@ import logging
 
 class LogThisTestCase(type):
     def __new__(cls, name, bases, dct):
+        # A subclass of a logged test case inherits its wrapped setUp and tearDown
+        inherited = any(isinstance(base, LogThisTestCase) for base in bases)
+
         # if the TestCase already provides setUp, wrap it
-        if 'setUp' in dct:
-            setUp = dct['setUp']
-        else:
-            setUp = lambda self: None
-            print "creating setUp..."
-
-        def wrappedSetUp(self):
-            # for hdlr in self.logger.handlers:
-            #    self.logger.removeHandler(hdlr)
-            self.hdlr = logging.StreamHandler(sys.stdout)
-            self.logger.addHandler(self.hdlr)
-            setUp(self)
-        dct['setUp'] = wrappedSetUp
+        if 'setUp' in dct or not inherited:
+            if 'setUp' in dct:
+                setUp = dct['setUp']
+            else:
+                setUp = lambda self: None
+                print "creating setUp..."
+
+            def wrappedSetUp(self):
+                # for hdlr in self.logger.handlers:
+                #    self.logger.removeHandler(hdlr)
+                # once, when a setUp calls the one of its base class
+                if getattr(self, 'hdlr', None) is None:
+                    self.hdlr = logging.StreamHandler(sys.stdout)
+                    self.logger.addHandler(self.hdlr)
+                setUp(self)
+            dct['setUp'] = wrappedSetUp
 
         # same for tearDown
-        if 'tearDown' in dct:
-            tearDown = dct['tearDown']
-        else:
-            tearDown = lambda self: None
-
-        def wrappedTearDown(self):
-            tearDown(self)
-            self.logger.removeHandler(self.hdlr)
-        dct['tearDown'] = wrappedTearDown
+        if 'tearDown' in dct or not inherited:
+            if 'tearDown' in dct:
+                tearDown = dct['tearDown']
+            else:
+                tearDown = lambda self: None
+
+            def wrappedTearDown(self):
+                tearDown(self)
+                self.logger.removeHandler(self.hdlr)
+            dct['tearDown'] = wrappedTearDown
 
         # return the class instance with the replaced setUp/tearDown
         return type.__new__(cls, name, bases, dct)
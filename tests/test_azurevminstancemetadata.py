@@ -5,10 +5,15 @@
 
 """Unit tests for azurevminstancemetadata."""
 
+import os
 import json
+import time
+import shutil
+import tempfile
 import unittest
-from mock import patch
-from azfilebak.azurevminstancemetadata import AzureVMInstanceMetadata
+from mock import patch, MagicMock
+from azfilebak.azurevminstancemetadata import AzureVMInstanceMetadata, MetadataCache
+from azfilebak.backupexception import BackupException
 from tests.loggedtestcase import LoggedTestCase
 
 class TestAzureVMInstanceMetadata(LoggedTestCase):
@@ -45,8 +50,63 @@ class TestAzureVMInstanceMetadata(LoggedTestCase):
         """test location"""
         self.assertEqual(self.meta.location, 'westeurope')
 
+    def test_tags_parsed_once(self):
+        """test get_tags returns the same parsed dictionary"""
+        self.assertIs(self.meta.get_tags(), self.meta.get_tags())
+
     def tearDown(self):
         self.patcher1.stop()
 
+class TestMetadataCache(LoggedTestCase):
+    """Unit tests for class MetadataCache."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'cache', 'instance_metadata.json')
+        self.data = json.loads(open('sample_instance_metadata.json').read())
+        self.request = MagicMock(return_value=self.data)
+
+    def set_age(self, seconds):
+        """Make the cache file look older."""
+        mtime = time.time() - seconds
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_cache_miss_and_hit(self):
+        """test the endpoint is only called when there is no cached copy"""
+        cache = MetadataCache(self.filename, 300, self.request)
+        self.assertEqual(cache.get()['compute']['name'], 'hec99v106014')
+        self.assertEqual(cache.get()['compute']['name'], 'hec99v106014')
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_background_refresh(self):
+        """test an ageing copy is returned and refreshed in the background"""
+        cache = MetadataCache(self.filename, 300, self.request)
+        cache.get()
+        self.set_age(200)
+        self.assertEqual(cache.get()['compute']['name'], 'hec99v106014')
+        cache.refresh_thread.join()
+        self.assertEqual(self.request.call_count, 2)
+
+    def test_stale_copy_on_outage(self):
+        """test an expired copy is used when the endpoint is down"""
+        cache = MetadataCache(self.filename, 300, self.request)
+        cache.get()
+        self.set_age(600)
+        self.request.side_effect = BackupException("endpoint down")
+        self.assertEqual(cache.get()['compute']['name'], 'hec99v106014')
+        self.set_age(2 * 24 * 3600)
+        self.assertRaises(BackupException, cache.get)
+
+    def test_create_instance_with_cache(self):
+        """test create_instance with a cache file"""
+        with patch('azfilebak.azurevminstancemetadata.AzureVMInstanceMetadata.request_metadata',
+                   return_value=self.data):
+            meta = AzureVMInstanceMetadata.create_instance(cache_filename=self.filename, cache_ttl_seconds=300)
+            self.assertEqual(meta.vm_name, 'hec99v106014')
+        self.assertTrue(os.path.isfile(self.filename))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,6 +6,10 @@
 """Unit tests for backupagent."""
 
 import json
+import shutil
+import tempfile
+import subprocess
+import datetime
 import unittest
 from mock import patch
 from azfilebak import backupconfiguration
@@ -14,6 +18,7 @@ from azfilebak.azurevminstancemetadata import AzureVMInstanceMetadata
 from azfilebak.businesshours import BusinessHours
 from azfilebak.scheduleparser import ScheduleParser
 from azfilebak.naming import Naming
+from azfilebak.timing import Timing
 from tests.loggedtestcase import LoggedTestCase
 from azfilebak.backupexception import BackupException
 
@@ -31,6 +36,12 @@ class TestBackupAgent(LoggedTestCase):
                               return_value=self.meta)
         self.patcher1.start()
 
+        # Token caches and other local caches go to a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_patcher = patch('azfilebak.backupconfiguration.BackupConfiguration.get_cache_directory',
+                                   return_value=self.tmpdir)
+        self.cache_patcher.start()
+
         # Mock `dmidecode` execution
         self.patcher2 = patch('subprocess.check_output',
                               return_value='UUID000')
@@ -148,6 +159,32 @@ class TestBackupAgent(LoggedTestCase):
             db_backup_interval_min=db_backup_interval_min,
             db_backup_interval_max=db_backup_interval_max))
 
+    def test_next_full_backup_time(self):
+        """Test next_full_backup_time agrees with should_run_full_backup"""
+        business_hours = BusinessHours.parse_tag_str(
+            "bkp_fs_schedule:"
+            "mo:111111 111000 000000 011111, "
+            "tu:111111 111000 000000 011111, "
+            "we:111111 111000 000000 011111, "
+            "th:111111 111000 000000 011111, "
+            "fr:000000 000000 000000 000000, "
+            "sa:000000 000000 000000 000000, "
+            "su:000000 000000 000000 000000, "
+            "min:1d, "
+            "max:3d")
+        interval_min = ScheduleParser.parse_timedelta("1d")
+        interval_max = ScheduleParser.parse_timedelta("3d")
+        one_second = datetime.timedelta(seconds=1)
+        for latest in ["20180604_100000", "20180606_230000", "20180607_200000", "20180608_120000"]:
+            due = self.agent.next_full_backup_time(latest, business_hours, interval_min, interval_max)
+            for (now, expected) in [(due - one_second, False), (due, True)]:
+                self.assertEqual(self.agent.should_run_full_backup(
+                    now_time=now.strftime(Timing.time_format), force=False,
+                    latest_full_backup_timestamp=latest,
+                    business_hours=business_hours,
+                    db_backup_interval_min=interval_min,
+                    db_backup_interval_max=interval_max), expected)
+
     def test_backup_single_fileset(self):
         """Test backup single fileset."""
         # Force a full backup
@@ -250,9 +287,43 @@ class TestBackupAgent(LoggedTestCase):
         obj = json.loads(json_str)
         self.assertEqual(obj["system-id"], "AZ3")
         self.assertEqual(obj["hostname"], "hec99v106014")
+        self.assertEqual(obj["instance-id"], "AFD83530-840D-11E8-9E6C-FC820C452436")
+        self.assertEqual(obj["s3-path"], "sahec99az1backup0001.blob.core.windows.net/container/blob.tar.gz")
+        self.assertEqual(obj["state"], "success")
+        self.assertEqual(obj["level"], "full")
+        self.assertEqual(obj["backup-size"], 42)
+        self.assertEqual(obj["error-message"], "")
+        self.assertEqual(len(obj), 21)
+
+    def test_notification_context_computed_once(self):
+        """Test dmidecode runs at most once for many messages and configurations."""
+        # No 'Serial' tag, the identifier comes from dmidecode
+        metadata = json.loads(self.json_meta)
+        metadata['compute']['tags'] = ";".join(
+            t for t in metadata['compute']['tags'].split(";") if not t.startswith("Serial:"))
+        self.patcher1.stop()
+        self.patcher1 = patch('azfilebak.azurevminstancemetadata.AzureVMInstanceMetadata.create_instance',
+                              return_value=AzureVMInstanceMetadata(lambda: metadata))
+        self.patcher1.start()
+        backupconfiguration.BackupConfiguration._dmi_system_uuid = None
+        try:
+            for _ in range(2):
+                agent = backupagent.BackupAgent(
+                    backupconfiguration.BackupConfiguration(config_filename="sample_backup.conf"))
+                for fileset in ['a', 'b', 'c']:
+                    obj = json.loads(agent.get_notification_message(
+                        False, "20180601_112429", "20180601_112430", False, 0, '/c/' + fileset, 'failed'))
+                    self.assertEqual(obj["instance-id"], "UUID000")
+                    self.assertEqual(obj["level"], "incr")
+                    self.assertEqual(obj["error-message"], "failed")
+            self.assertEqual(subprocess.check_output.call_count, 1)
+        finally:
+            backupconfiguration.BackupConfiguration._dmi_system_uuid = None
 
     def tearDown(self):
         self.patcher1.stop()
+        self.cache_patcher.stop()
+        shutil.rmtree(self.tmpdir)
         self.patcher2.stop()
 
 if __name__ == '__main__':
@@ -7,9 +7,12 @@
 
 import os
 import json
+import shutil
+import tempfile
 import unittest
 from mock import patch
 from azfilebak.backupconfiguration import BackupConfiguration
+from azfilebak.httpsession import HttpSession
 from azfilebak.azurevminstancemetadata import AzureVMInstanceMetadata
 from tests.loggedtestcase import LoggedTestCase
 
@@ -27,6 +30,12 @@ class TestBackupConfiguration(LoggedTestCase):
                               return_value=self.meta)
         self.patcher1.start()
 
+        # Token caches and other local caches go to a temporary directory
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_patcher = patch('azfilebak.backupconfiguration.BackupConfiguration.get_cache_directory',
+                                   return_value=self.tmpdir)
+        self.cache_patcher.start()
+
         # Mock `dmidecode` execution
         self.patcher2 = patch('subprocess.check_output',
                               return_value='UUID000')
@@ -86,6 +95,51 @@ class TestBackupConfiguration(LoggedTestCase):
         client = self.cfg.storage_client
         self.assertEqual(client.protocol, 'https')
 
+    def test_storage_client_endpoint(self):
+        """Test storage_client with azure.blob.endpoint, as used with the blob emulator."""
+        self.assertIsNone(self.cfg.get_azure_storage_endpoint())
+        with patch.dict(os.environ, {'STORAGE_KEY': 'a2V5'}), \
+                patch.object(BackupConfiguration, 'get_azure_storage_endpoint',
+                             return_value='http://127.0.0.1:10000'):
+            client = self.cfg.storage_client
+        self.assertEqual(client.protocol, 'http')
+        self.assertEqual(client.primary_endpoint, '127.0.0.1:10000')
+        # Its own session, on the connection pool of the process
+        self.assertIsNot(client.request_session, HttpSession.get())
+        self.assertIs(client.request_session.get_adapter('https://x'), HttpSession.get().get_adapter('https://x'))
+        self.assertEqual(client.socket_timeout, (20.0, 120.0))
+
+    def test_storage_client_tokens(self):
+        """Test clients of different accounts never send the bearer token of another one."""
+        import requests
+        from requests.adapters import HTTPAdapter
+        sent = []
+        def send(_adapter, request, **_kwargs):
+            """Record the account and token of a request, and succeed."""
+            sent.append((request.url.split('.')[0], request.headers.get('Authorization')))
+            response = requests.Response()
+            (response.status_code, response.request, response._content) = (200, request, '')
+            return response
+
+        tokens = iter(['token1', 'token2'])
+        with patch('azfilebak.backupconfiguration.TokenCache') as token_cache:
+            token_cache.return_value.get_token.side_effect = lambda: next(tokens)
+            (client1, _cache) = self.cfg.create_storage_client('sa1')
+            (client2, _cache) = self.cfg.create_storage_client('sa2')
+        # A request of the other client signed between the signature and the request
+        signed_session = client1.authentication.signed_session
+        def concurrent(session):
+            """Sign, then let the other client sign and send a request."""
+            session = signed_session(session)
+            client2.get_container_metadata('c')
+            return session
+        client1.authentication.signed_session = concurrent
+        with patch.object(HTTPAdapter, 'send', send):
+            client1.get_container_metadata('c')
+            client2.get_container_metadata('c')
+        self.assertEqual(sent, [('https://sa2', 'Bearer token2'), ('https://sa1', 'Bearer token1'),
+                                ('https://sa2', 'Bearer token2')])
+
     def test_get_system_uuid_from_metadata(self):
         """Test get_system_uuid."""
         uuid = self.cfg.get_system_uuid()
@@ -103,8 +157,14 @@ class TestBackupConfiguration(LoggedTestCase):
         uuid = self.cfg.get_notification_command()
         self.assertEqual(uuid, 'tee')
 
+    def test_validate(self):
+        """Test validate."""
+        self.cfg.validate()
+
     def tearDown(self):
         self.patcher1.stop()
+        self.cache_patcher.stop()
+        shutil.rmtree(self.tmpdir)
 
 if __name__ == '__main__':
     unittest.main()
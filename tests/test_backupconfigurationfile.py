@@ -5,8 +5,12 @@
 
 """Unit tests for backupconfigurationfile."""
 
+import os
+import shutil
+import tempfile
 import unittest
 from azfilebak import backupconfigurationfile
+from azfilebak.backupexception import BackupException
 from tests.loggedtestcase import LoggedTestCase
 
 class TestBackupConfigurationFile(LoggedTestCase):
@@ -31,5 +35,46 @@ class TestBackupConfigurationFile(LoggedTestCase):
         self.assertTrue(config.key_exists('local_temp_directory'))
         self.assertFalse(config.key_exists('XXX_NOT_A_KEY'))
 
+    def test_get_keys_prefix(self):
+        """Test get_keys_prefix"""
+        config = backupconfigurationfile.BackupConfigurationFile(filename="sample_backup.conf")
+        self.assertEqual(sorted(config.get_keys_prefix('command.restore')), [
+            'command.restore.osdisk', 'command.restore.testecho', 'command.restore.tmpdir'])
+        self.assertEqual(config.get_keys_prefix('XXX_NOT_A_KEY'), [])
+
+    def test_reload_on_change(self):
+        """Test the file is only parsed again when it changes"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'backup.conf')
+            shutil.copy('sample_backup.conf', filename)
+            config = backupconfigurationfile.BackupConfigurationFile(filename=filename)
+            snapshot = config.snapshot
+            self.assertIs(config.snapshot, snapshot)
+            self.assertFalse(config.key_exists('new_key'))
+
+            with open(filename, 'at') as config_file:
+                config_file.write('new_key="new value"\n')
+            self.assertEqual(config.get_value('new_key'), 'new value')
+            self.assertIsNot(config.snapshot, snapshot)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_report_all_errors(self):
+        """Test all syntax errors are reported at load time"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'backup.conf')
+            with open(filename, 'wt') as config_file:
+                config_file.write('good="1"\nbad line\n="x"\nother bad line\n')
+            with self.assertRaises(BackupException) as context:
+                backupconfigurationfile.BackupConfigurationFile(filename=filename)
+            message = str(context.exception)
+            self.assertIn('line 2', message)
+            self.assertIn('line 3', message)
+            self.assertIn('line 4', message)
+        finally:
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,177 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for bandwidth."""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from mock import patch
+from azfilebak import bandwidth
+from azfilebak.bandwidth import BandwidthGovernor, ThrottledReader, MB
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.timing import Timing
+from azfilebak.backupconfiguration import BackupConfiguration
+from azfilebak.backupagent import BackupAgent
+from azfilebak.backupexception import BackupException
+from tests.loggedtestcase import LoggedTestCase
+from tests.localbackuptestcase import LocalBackupTestCase
+
+class TestBandwidthGovernor(LoggedTestCase):
+    """Unit tests for the BandwidthGovernor class."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmpdir, 'bandwidth.json')
+
+    def state(self):
+        """The entries of the state file."""
+        with open(self.state_file) as state:
+            return json.load(state)
+
+    def test_throttle(self):
+        """Test transfers are limited to the allocation of the process."""
+        governor = BandwidthGovernor(self.state_file, 2 * MB, 'backup')
+        reader = governor.reader(StringIO('x' * MB))
+        start = time.time()
+        while reader.read(64 * 1024):
+            pass
+        # Alone, the process gets the whole limit
+        self.assertEqual(governor.rate, 2 * MB)
+        self.assertGreater(time.time() - start, 0.4)
+        self.assertEqual(governor.bytes, MB)
+        self.assertEqual(self.state().keys(), [governor.key])
+        self.assertRaises(BackupException, BandwidthGovernor, self.state_file, MB, 'prune')
+
+    def test_priorities(self):
+        """Test the limit is shared by the throttled processes by priority, and released."""
+        restore = BandwidthGovernor(self.state_file, 100 * MB, 'restore')
+        backup = BandwidthGovernor(self.state_file, 100 * MB, 'backup')
+        now = time.time()
+        backup.allocate(now)
+        restore.allocate(now)
+        backup.allocate(now)
+        self.assertEqual((restore.rate, backup.rate), (75 * MB, 25 * MB))
+
+        # A restore that needs less leaves the rest to the backup
+        restore.interval_bytes = 10 * MB
+        restore.allocate(now + 1)
+        backup.throttled = True
+        backup.allocate(now + 1)
+        self.assertAlmostEqual(restore.rate, 12.5 * MB)
+        self.assertAlmostEqual(backup.rate, 87.5 * MB)
+
+        restore.release()
+        backup.throttled = True
+        backup.allocate(now + 2)
+        self.assertEqual(backup.rate, 100 * MB)
+        self.assertEqual(self.state().keys(), [backup.key])
+
+    def test_large_consume(self):
+        """Test a transfer much larger than the allocation keeps the entry of the process fresh."""
+        clock = [1000.0]
+        sleeps = []
+
+        def sleep(seconds):
+            """Advance the clock instead of sleeping."""
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        governor = BandwidthGovernor(self.state_file, MB, 'backup')
+        with patch.object(bandwidth.time, 'time', side_effect=lambda: clock[0]), \
+                patch.object(bandwidth.time, 'sleep', side_effect=sleep):
+            governor.last = clock[0]
+            with patch.object(governor, 'allocate', wraps=governor.allocate) as allocate:
+                governor.consume(100 * MB)
+        self.assertEqual(governor.bytes, 100 * MB)
+        self.assertAlmostEqual(sum(sleeps), 100, delta=1)
+        # No wait is longer than an allocation interval, and the allocation is renewed between them
+        self.assertLessEqual(max(sleeps), bandwidth.ALLOCATION_INTERVAL_SECONDS)
+        self.assertGreaterEqual(allocate.call_count, 99)
+        self.assertGreater(self.state()[governor.key]['updated'], clock[0] - bandwidth.STALE_SECONDS)
+
+    def test_stale_processes(self):
+        """Test processes that exited or stopped transferring are left out."""
+        now = time.time()
+        with open(self.state_file, 'w') as state:
+            json.dump({'999999-restore': {'priority': 'restore', 'updated': now, 'demand': None},
+                       '{}-restore'.format(os.getppid()): {'priority': 'restore', 'updated': now - 60,
+                                                           'demand': None}}, state)
+        governor = BandwidthGovernor(self.state_file, 100 * MB, 'backup')
+        with patch.object(bandwidth, 'is_alive', side_effect=lambda pid: pid != 999999):
+            governor.allocate(now)
+        self.assertEqual(governor.rate, 100 * MB)
+        self.assertEqual(self.state().keys(), [governor.key])
+
+    def test_report(self):
+        """Test the allocations are in the instrumentation output."""
+        Instrumentation.reset()
+        governor = BandwidthGovernor(self.state_file, 10 * MB, 'restore')
+        governor.writer(StringIO()).write('x' * 1000)
+        report = Instrumentation.report()['bandwidth']
+        self.assertEqual(report['limit_mb_per_second'], 10)
+        self.assertEqual(report['bytes'], 1000)
+        self.assertEqual(report['allocations'][governor.key]['priority'], 'restore')
+        self.assertEqual(report['allocations'][governor.key]['rate_mb_per_second'], 10)
+        Instrumentation.reset()
+
+    def test_no_state_file(self):
+        """Test a process keeps its allocation when the state file cannot be written."""
+        governor = BandwidthGovernor(os.path.join(self.tmpdir, 'missing', 'bandwidth.json'), 4 * MB, 'backup')
+        governor.consume(1000)
+        self.assertEqual(governor.rate, MB)
+        self.assertEqual(governor.allocations, {})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class TestThrottledRestore(LocalBackupTestCase):
+    """Backup and restore within the host bandwidth limit, with the local storage backend."""
+
+    def config_lines(self):
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.src)
+        with open(os.path.join(self.src, 'a'), 'wb') as out:
+            out.write(os.urandom(100000))
+        return ['command.backup.data="tar czf - -C {} ."'.format(self.src),
+                'host_rate_limit="100"']
+
+    def patchers(self):
+        return LocalBackupTestCase.patchers(self) + [
+            patch.object(Timing, 'now_localtime', return_value='20181001_100000'),
+            patch.object(BackupAgent, 'should_run_backup', return_value=True)
+        ]
+
+    def test_config(self):
+        """Test the host limit and the governors of the process."""
+        self.assertEqual(self.cfg.get_host_rate_limit(), 100 * MB)
+        self.assertIs(self.cfg.get_bandwidth_governor('backup'), self.cfg.get_bandwidth_governor('backup'))
+        self.assertIsInstance(self.cfg.throttled_reader(StringIO(), 'backup'), ThrottledReader)
+        with open(self.config_file) as config:
+            content = config.read()
+        with open(self.config_file, 'wt') as config:
+            config.write(content.replace('host_rate_limit="100"', 'host_rate_limit="0"'))
+        cfg = BackupConfiguration(self.config_file)
+        self.assertIsNone(cfg.get_bandwidth_governor('restore'))
+        stream = StringIO()
+        self.assertIs(cfg.throttled_reader(stream, 'backup'), stream)
+
+    def test_backup_and_restore(self):
+        """Test the transfers go through the governors, which are released at the end."""
+        blob_name = self.agent.backup_single_fileset('data', is_full=True, force=True)
+        self.agent.restore_blob(blob_name, self.tmpdir)
+        with open(os.path.join(self.tmpdir, blob_name), 'rb') as restored:
+            size = len(restored.read())
+        self.assertEqual(self.cfg.get_bandwidth_governor('backup').bytes, size)
+        self.assertEqual(self.cfg.get_bandwidth_governor('restore').bytes, size)
+        with open(self.cfg.get_bandwidth_state_file()) as state:
+            self.assertEqual(json.load(state), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for businesshours."""
+
+import random
+import datetime
+import unittest
+from azfilebak.businesshours import BusinessHours
+from azfilebak.backupexception import BackupException
+from tests.loggedtestcase import LoggedTestCase
+
+def random_schedule(rnd, density):
+    """Create a schedule tag with random hours."""
+    days = ['mo', 'tu', 'we', 'th', 'fr', 'sa', 'su']
+    return "bkp_fs_schedule:" + ", ".join(
+        ["{}:{}".format(d, "".join(rnd.choice("1" * density + "0" * (10 - density)) for _ in range(24)))
+         for d in days] + ["min:1d", "max:3d"])
+
+class TestBusinessHours(LoggedTestCase):
+    """Unit tests for class BusinessHours, checked against a naive hour by hour scan."""
+
+    def setUp(self):
+        self.rnd = random.Random(42)
+        self.start = datetime.datetime(2018, 6, 4)
+
+    def random_time(self):
+        """A random point in time within two weeks."""
+        return self.start + datetime.timedelta(seconds=self.rnd.randint(0, 14 * 24 * 3600))
+
+    def test_next_allowed_time(self):
+        """Test next_allowed_time."""
+        for density in [1, 5, 9]:
+            hours = BusinessHours.parse_tag_str(random_schedule(self.rnd, density))
+            for _ in range(100):
+                t = self.random_time()
+                expected = t
+                while not hours.is_backup_allowed_time(expected):
+                    expected = expected.replace(minute=0, second=0) + datetime.timedelta(hours=1)
+                self.assertEqual(hours.next_allowed_time(t), expected)
+
+    def test_remaining_window(self):
+        """Test remaining_window."""
+        for density in [1, 5, 9]:
+            hours = BusinessHours.parse_tag_str(random_schedule(self.rnd, density))
+            for _ in range(100):
+                t = self.random_time()
+                end = t
+                while hours.is_backup_allowed_time(end):
+                    end = end.replace(minute=0, second=0) + datetime.timedelta(hours=1)
+                self.assertEqual(hours.remaining_window(t), end - t)
+
+    def test_allowed_time_between(self):
+        """Test allowed_time_between."""
+        hours = BusinessHours.parse_tag_str(random_schedule(self.rnd, 5))
+        for _ in range(50):
+            t1 = self.random_time()
+            t2 = t1 + datetime.timedelta(seconds=self.rnd.randint(0, 20 * 24 * 3600))
+            expected = datetime.timedelta(0)
+            t = t1
+            while t < t2:
+                next_hour = min(t.replace(minute=0, second=0) + datetime.timedelta(hours=1), t2)
+                if hours.is_backup_allowed_time(t):
+                    expected += next_hour - t
+                t = next_hour
+            self.assertEqual(hours.allowed_time_between(t1, t2), expected)
+
+    def test_no_allowed_hours(self):
+        """Test schedules without any allowed hour."""
+        hours = BusinessHours.parse_tag_str(random_schedule(self.rnd, 0))
+        self.assertIsNone(hours.next_allowed_time(self.start))
+        self.assertEqual(hours.allowed_time_between(self.start, self.start + datetime.timedelta(days=30)),
+                         datetime.timedelta(0))
+
+    def test_always_allowed(self):
+        """Test schedules allowing all hours."""
+        hours = BusinessHours.parse_tag_str(random_schedule(self.rnd, 10))
+        self.assertIsNone(hours.remaining_window(self.start))
+
+    def test_short_day(self):
+        """Test days with a wrong number of hours are rejected."""
+        self.assertRaises(BackupException, BusinessHours.parse_tag_str,
+                          random_schedule(self.rnd, 5).replace("mo:", "mo:0"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for compression."""
+
+import os
+import gzip
+import json
+import random
+import shutil
+import tempfile
+import unittest
+import subprocess
+from StringIO import StringIO
+from mock import patch
+from azfilebak import compression
+from azfilebak.compression import AdaptiveCompressor, GzipWriter, ParallelDecompressor, compress_block, \
+    encode_member, decode_member, parse_header
+from azfilebak.timing import Timing
+from azfilebak.backupconfiguration import BackupConfiguration
+from azfilebak.backupagent import BackupAgent
+from azfilebak.backupexception import BackupException
+from tests.loggedtestcase import LoggedTestCase
+from tests.localbackuptestcase import LocalBackupTestCase
+
+def text(size, seed=1):
+    """Compressible data."""
+    rand = random.Random(seed)
+    words = ['backup', 'restore', 'azure', 'blob', 'tar', 'gzip', 'fileset', 'stripe']
+    return ' '.join(rand.choice(words) for _ in range(size // 4))[:size]
+
+def gzip_members(*blocks):
+    """A gzip stream of one member per block, as written by gzip."""
+    output = StringIO()
+    for block in blocks:
+        member = gzip.GzipFile(fileobj=output, mode='wb')
+        member.write(block)
+        member.close()
+    return output.getvalue()
+
+def decompress(archive, chunk_size, threads=3):
+    """Write an archive to a ParallelDecompressor in chunks; returns (uncompressed data, decompressor)."""
+    output = StringIO()
+    decompressor = ParallelDecompressor(output, threads=threads)
+    try:
+        for offset in range(0, len(archive), chunk_size):
+            decompressor.write(archive[offset:offset + chunk_size])
+        decompressor.flush()
+    finally:
+        decompressor.close()
+    return (output.getvalue(), decompressor)
+
+def gunzip(data):
+    """Decompress all the members of a gzip stream."""
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+class TestCompression(LoggedTestCase):
+    """Unit tests for adaptive compression."""
+
+    def setUp(self):
+        # Text, random (incompressible) and text blocks again
+        self.data = text(300000) + os.urandom(200000) + text(100000, seed=2)
+
+    def test_members(self):
+        """Test every codec round trips, and deflate members are standard gzip."""
+        data = text(50000)
+        codecs = [('deflate', 0), ('deflate', 9), ('bz2', 9)]
+        if compression.lzma is not None:
+            codecs.append(('lzma', 6))
+        for (codec, level) in codecs:
+            member = encode_member(data, codec, level)
+            self.assertEqual(parse_header(member)[:2], (codec, level))
+            self.assertEqual(decode_member(member), data)
+        self.assertEqual(gunzip(encode_member(data, 'deflate', 6)), data)
+        corrupted = encode_member(data, 'bz2', 9)[:-8] + '\0' * 8
+        self.assertRaises(BackupException, decode_member, corrupted)
+
+    def test_compress_block(self):
+        """Test incompressible blocks are stored, and the policy chooses the codec of the others."""
+        self.assertEqual(compress_block(os.urandom(100000), 'balanced')[1:3], ('deflate', 0))
+        self.assertEqual(compress_block(text(100000), 'balanced')[1:3], ('deflate', 6))
+        self.assertEqual(compress_block(text(100000), 'fast')[1:3], ('deflate', 1))
+        self.assertEqual(compress_block(text(100000), 'small')[1:3], ('bz2', 9))
+
+    def test_compressor(self):
+        """Test the archive of the balanced policy is a standard gzip stream, read in any sizes."""
+        compressor = AdaptiveCompressor(StringIO(self.data), block_size=100000, threads=3)
+        chunks = []
+        for size in [10, 70000, 1, 250000] * 100:
+            chunk = compressor.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(gunzip(''.join(chunks)), self.data)
+        self.assertEqual(compressor.stats['blocks'], {'deflate-0': 2, 'deflate-6': 4})
+        self.assertEqual(compressor.stats['bytes_in'], len(self.data))
+        self.assertEqual(compressor.stats['bytes_out'], len(''.join(chunks)))
+        self.assertLess(compressor.ratio(), 0.7)
+        self.assertIsNone(compressor.pool)
+        self.assertRaises(BackupException, AdaptiveCompressor, StringIO(), policy='best')
+
+    def test_gzip_writer(self):
+        """Test restore converts bz2 members to gzip, and leaves other data unchanged."""
+        archive = AdaptiveCompressor(StringIO(self.data), policy='small', block_size=100000).read()
+        self.assertEqual(parse_header(archive)[:2], ('bz2', 9))
+        output = StringIO()
+        writer = GzipWriter(output)
+        for offset in range(0, len(archive), 7777):
+            writer.write(archive[offset:offset + 7777])
+        writer.flush()
+        self.assertEqual(gunzip(output.getvalue()), self.data)
+
+        output = StringIO()
+        writer = GzipWriter(output)
+        writer.write(archive[:-10])
+        self.assertRaises(BackupException, writer.flush)
+
+        for data in ['short', os.urandom(100000)]:
+            output = StringIO()
+            writer = GzipWriter(output)
+            writer.write(data[:10])
+            writer.write(data[10:])
+            writer.flush()
+            self.assertEqual(output.getvalue(), data)
+
+    def test_parallel_decompressor(self):
+        """Test the members of an adaptive archive are decompressed in parallel, in order."""
+        for policy in ['balanced', 'small']:
+            archive = AdaptiveCompressor(StringIO(self.data), policy=policy, block_size=10000).read()
+            for chunk_size in [7777, 100000]:
+                (data, decompressor) = decompress(archive, chunk_size)
+                self.assertTrue(data == self.data)
+                self.assertTrue(decompressor.adaptive)
+                self.assertEqual(decompressor.members, 60)
+                self.assertIsNone(decompressor.pool)
+        self.assertRaises(BackupException, decompress, archive[:-10], 7777)
+        self.assertRaises(BackupException, decompress, archive[:50000] + 'x' * 30 + archive[50000:], 7777)
+
+    def test_gzip_fallback(self):
+        """Test other gzip archives, of one or more members, are decompressed on one thread."""
+        for archive in [gzip_members(self.data), gzip_members(self.data[:1000], '', self.data[1000:])]:
+            for chunk_size in [1, 7777, len(archive)]:
+                if chunk_size == 1 and len(archive) > 100000:
+                    continue
+                (data, decompressor) = decompress(archive, chunk_size)
+                self.assertTrue(data == self.data)
+                self.assertFalse(decompressor.adaptive)
+                self.assertIsNone(decompressor.pool)
+        self.assertEqual(decompress(gzip_members('a', 'b', 'c'), 1)[0], 'abc')
+        self.assertEqual(decompress(gzip_members('a', 'b', 'c'), 1)[1].members, 3)
+        self.assertRaises(BackupException, decompress, 'not an archive, but long enough', 7777)
+
+    def test_save_stats(self):
+        """Test the statistics of the last backups are kept."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'compression_fs.json')
+            with patch.object(compression, 'STATS_HISTORY', 2):
+                for i in range(3):
+                    compressor = AdaptiveCompressor(StringIO(self.data), block_size=100000)
+                    compressor.read()
+                    compressor.save_stats(filename, 'backup{}'.format(i))
+            with open(filename) as stats_file:
+                history = json.load(stats_file)
+            self.assertEqual([stats['blob'] for stats in history], ['backup1', 'backup2'])
+            self.assertEqual(history[0]['bytes_in'], len(self.data))
+            self.assertEqual(history[0]['policy'], 'balanced')
+            self.assertGreater(history[0]['cpu_seconds'], 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestCompressedBackup(LocalBackupTestCase):
+    """Backups with adaptive compression and the local storage backend."""
+
+    def config_lines(self):
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.src)
+        with open(os.path.join(self.src, 'text'), 'wb') as out:
+            out.write(text(3000000))
+        with open(os.path.join(self.src, 'random.gz'), 'wb') as out:
+            out.write(os.urandom(2000000))
+        return ['command.backup.data="tar cf - -C {} ."'.format(self.src),
+                'compression.data="adaptive"',
+                'compression_policy="small"']
+
+    def patchers(self):
+        return LocalBackupTestCase.patchers(self) + [
+            patch.object(Timing, 'now_localtime', return_value='20181001_100000'),
+            patch.object(BackupAgent, 'should_run_backup', return_value=True)
+        ]
+
+    def test_config(self):
+        """Test the compression settings."""
+        self.assertEqual(self.cfg.get_compression('data'), 'adaptive')
+        self.assertEqual(self.cfg.get_compression('fs'), 'gzip')
+        self.assertEqual(self.cfg.get_compression_policy(), 'small')
+        self.assertIsNone(self.cfg.get_compression_threads())
+        self.assertIsNone(self.cfg.get_restore_threads())
+
+    def test_backup_and_restore(self):
+        """Test a backup is compressed by azfilebak, and restored as a standard .tar.gz file."""
+        blob_name = self.agent.backup_single_fileset('data', is_full=True, force=True)
+        stored = os.path.join(self.tmpdir, 'storage', self.cfg.azure_storage_container_name, blob_name)
+        self.assertLess(os.path.getsize(stored), 3000000)
+
+        output_dir = os.path.join(self.tmpdir, 'restore')
+        os.mkdir(output_dir)
+        self.agent.restore_blob(blob_name, output_dir)
+        subprocess.check_call(['tar', 'xzf', os.path.join(output_dir, blob_name), '-C', output_dir])
+        for name in ['text', 'random.gz']:
+            with open(os.path.join(self.src, name), 'rb') as original, \
+                    open(os.path.join(output_dir, name), 'rb') as restored:
+                self.assertTrue(original.read() == restored.read())
+
+        # Extracted by azfilebak, the members are decompressed in parallel
+        extract_dir = os.path.join(self.tmpdir, 'extract')
+        os.mkdir(extract_dir)
+        self.agent.restore_blob(blob_name, extract_dir, extract=True)
+        self.assertEqual(sorted(os.listdir(extract_dir)), ['random.gz', 'text'])
+        with open(os.path.join(self.src, 'text'), 'rb') as original, \
+                open(os.path.join(extract_dir, 'text'), 'rb') as restored:
+            self.assertTrue(original.read() == restored.read())
+
+        with open(os.path.join(self.tmpdir, 'compression_data.json')) as stats_file:
+            stats = json.load(stats_file)[-1]
+        self.assertEqual(stats['blob'], blob_name)
+        self.assertGreater(stats['blocks']['deflate-0'], 0)
+        self.assertGreater(stats['blocks']['bz2-9'], 0)
+
+    def test_extract_gzip(self):
+        """Test a backup compressed by tar is extracted, or streamed uncompressed."""
+        with open(self.config_file, 'at') as config:
+            config.write('command.backup.gz="tar czf - -C {} ."\nrestore_threads="2"\n'.format(self.src))
+        cfg = BackupConfiguration(self.config_file)
+        self.assertEqual(cfg.get_restore_threads(), 2)
+        agent = BackupAgent(cfg)
+        blob_name = agent.backup_single_fileset('gz', is_full=True, force=True)
+        agent.restore_blob(blob_name, self.tmpdir, extract=True)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'random.gz')))
+
+        stdout = StringIO()
+        with patch('sys.stdout', stdout):
+            agent.restore_blob(blob_name, None, stream=True, extract=True)
+        listing = subprocess.Popen(['tar', 'tf', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.assertEqual(sorted(listing.communicate(stdout.getvalue())[0].split()),
+                         ['./', './random.gz', './text'])
+
+        self.assertRaises(BackupException, agent.restore_blob, blob_name, os.path.join(self.tmpdir, 'missing'),
+                          extract=True)
+
+if __name__ == '__main__':
+    unittest.main()
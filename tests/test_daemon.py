@@ -0,0 +1,182 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for daemon."""
+
+import os
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import threading
+import unittest
+from mock import patch, MagicMock, PropertyMock
+from azfilebak import daemon
+from azfilebak.daemon import BackupDaemon
+from azfilebak.backupagent import BackupAgent
+from azfilebak.azurevminstancemetadata import AzureVMInstanceMetadata
+from tests.loggedtestcase import LoggedTestCase
+
+class FakeResults(list):
+    """A list of blobs that looks like a single page of list_blobs results."""
+    next_marker = None
+
+def fake_blob(name):
+    """Create a blob-like object."""
+    blob = MagicMock()
+    blob.name = name
+    return blob
+
+class TestBackupDaemon(LoggedTestCase):
+    """Unit tests for class BackupDaemon."""
+
+    def setUp(self):
+        self.json_meta = open('sample_instance_metadata.json').read()
+        self.meta = AzureVMInstanceMetadata(
+            lambda: (json.JSONDecoder()).decode(self.json_meta)
+        )
+        self.patcher1 = patch('azfilebak.azurevminstancemetadata.AzureVMInstanceMetadata.create_instance',
+                              return_value=self.meta)
+        self.patcher1.start()
+
+        vmname = self.meta.vm_name
+        self.blobs = [fake_blob('fs_{}_full_20180604_220000.tar.gz'.format(vmname))]
+        self.client = MagicMock()
+        self.client.list_blobs.side_effect = lambda **kwargs: FakeResults(self.blobs)
+        self.patcher2 = patch('azfilebak.backupconfiguration.BackupConfiguration.storage_client',
+                              new_callable=PropertyMock, return_value=self.client)
+        self.patcher2.start()
+
+        # Do not touch the system PID file directory
+        self.patcher3 = patch('pid.PidFile')
+        self.patcher3.start()
+        self.patcher4 = patch.multiple('azfilebak.notificationspool.NotificationSpool',
+                                       start_worker_thread=MagicMock(), stop_worker_thread=MagicMock())
+        self.patcher4.start()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.status_file = os.path.join(self.tmpdir, 'status.json')
+        self.daemon = BackupDaemon('sample_backup.conf', status_file=self.status_file)
+        self.daemon.load_configuration()
+        self.daemon.refresh_catalog()
+
+    def test_catalog(self):
+        """Test the latest backup is read from the container once."""
+        self.assertEqual(self.daemon.catalog, {'fs': '20180604_220000'})
+        self.assertEqual(self.client.list_blobs.call_count, 1)
+
+    def test_schedule(self):
+        """Test backups are queued when due and the daemon sleeps until then."""
+        due = self.daemon.next_due('fs')
+        sleep = self.daemon.schedule(due - datetime.timedelta(minutes=10))
+        self.assertEqual(sleep, 600)
+        self.assertTrue(self.daemon.jobs.empty())
+
+        self.daemon.schedule(due)
+        self.assertEqual(self.daemon.jobs.get_nowait(), 'fs')
+        # Already queued, not queued again
+        self.daemon.schedule(due)
+        self.assertTrue(self.daemon.jobs.empty())
+
+    def test_max_sleep(self):
+        """Test the daemon wakes up regularly even if nothing is due."""
+        due = self.daemon.next_due('fs')
+        sleep = self.daemon.schedule(due - datetime.timedelta(days=1))
+        self.assertEqual(sleep, daemon.MAX_SLEEP_SECONDS)
+
+    @patch.object(BackupAgent, 'backup_default')
+    def test_run_job(self, backup_default):
+        """Test a backup updates the catalog and the status file without listing again."""
+        backup_default.return_value = 'fs_{}_full_20180610_010000.tar.gz'.format(self.meta.vm_name)
+        self.daemon.queued.add('fs')
+        self.daemon.run_job('fs')
+        backup_default.assert_called_once_with(is_full=True, force=True, rate=None)
+        self.assertEqual(self.daemon.catalog['fs'], '20180610_010000')
+        self.assertEqual(self.client.list_blobs.call_count, 1)
+        with open(self.status_file) as status_file:
+            status = json.load(status_file)
+        self.assertEqual(status['last_results']['fs']['result'], 'success')
+        self.assertEqual(status['latest_full_backups']['fs'], '20180610_010000')
+        self.assertEqual(status['running'], None)
+        self.assertEqual(status['queued'], [])
+
+    @patch.object(BackupAgent, 'backup_default')
+    def test_run_job_unchanged(self, backup_default):
+        """Test the next backup of an unchanged fileset is due one interval after the check."""
+        latest = 'fs_{}_full_20180604_220000.tar.gz'.format(self.meta.vm_name)
+
+        def unchanged(**_kwargs):
+            """Record the check as backup_single_fileset does, and return the latest backup."""
+            self.daemon.backup_agent.save_unchanged_check('fs', latest, '20180610_010000')
+            return latest
+
+        backup_default.side_effect = unchanged
+        with patch('azfilebak.backupconfiguration.BackupConfiguration.get_cache_directory',
+                   return_value=self.tmpdir):
+            self.daemon.run_job('fs')
+            self.assertEqual(self.daemon.catalog['fs'], '20180610_010000')
+            self.assertTrue(self.daemon.next_due('fs') > datetime.datetime(2018, 6, 11, 1, 0))
+            # Also after listing the container again
+            self.daemon.refresh_catalog()
+            self.assertEqual(self.daemon.catalog['fs'], '20180610_010000')
+
+    @patch.object(BackupAgent, 'backup_default')
+    def test_failed_job(self, backup_default):
+        """Test a failed backup is retried later."""
+        backup_default.side_effect = Exception("tar failed")
+        self.daemon.run_job('fs')
+        self.assertTrue(self.daemon.last_results['fs']['result'].startswith('failed'))
+        self.assertTrue(self.daemon.next_due('fs') > datetime.datetime.now())
+        self.assertEqual(self.daemon.catalog['fs'], '20180604_220000')
+
+    @patch.object(BackupAgent, 'backup_default')
+    def test_retry_failed_job(self, backup_default):
+        """Test the main loop wakes up when a job fails, and retries it after RETRY_SECONDS."""
+        backup_default.side_effect = Exception("tar failed")
+        # While the fileset is queued, only the periodic wakeup is scheduled
+        self.assertEqual(self.daemon.schedule(self.daemon.next_due('fs')), daemon.MAX_SLEEP_SECONDS)
+        self.daemon.run_job(self.daemon.jobs.get_nowait())
+        start = time.time()
+        self.daemon.sleep(5)
+        self.assertLess(time.time() - start, 1)
+        sleep = self.daemon.schedule(datetime.datetime.now())
+        self.assertAlmostEqual(sleep, daemon.RETRY_SECONDS, delta=5)
+
+    def test_reload(self):
+        """Test a reload keeps the storage client and an invalid file is ignored."""
+        previous = self.daemon.backup_configuration
+        previous._block_blob_service = self.client
+        self.daemon.load_configuration()
+        self.assertFalse(self.daemon.backup_configuration is previous)
+        self.assertTrue(self.daemon.backup_configuration._block_blob_service is self.client)
+
+        current = self.daemon.backup_configuration
+        self.daemon.config_file = os.path.join(self.tmpdir, 'invalid.conf')
+        with open(self.daemon.config_file, 'wt') as config:
+            config.write('DEFAULT.CID: "ABC"\n')
+        self.daemon.load_configuration()
+        self.assertTrue(self.daemon.backup_configuration is current)
+
+    @patch.object(BackupAgent, 'backup_default')
+    def test_drain(self, backup_default):
+        """Test queued backups are not started once a stop is requested."""
+        self.daemon.worker = threading.Thread(target=self.daemon.work)
+        self.daemon.stop_requested = True
+        self.daemon.jobs.put('fs')
+        self.daemon.worker.start()
+        self.daemon.drain()
+        self.assertFalse(backup_default.called)
+        self.assertEqual(self.daemon.status()['state'], 'stopped')
+
+    def tearDown(self):
+        self.patcher1.stop()
+        self.patcher2.stop()
+        self.patcher3.stop()
+        self.patcher4.stop()
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
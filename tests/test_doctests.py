@@ -13,6 +13,20 @@ from azfilebak import naming
 from azfilebak import scheduleparser
 from azfilebak import timing
 from azfilebak import backupagent
+from azfilebak import fleet
+from azfilebak import instrumentation
+from azfilebak import simulator
+from azfilebak import notificationspool
+from azfilebak import httpsession
+from azfilebak import uploader
+from azfilebak import mounttable
+from azfilebak import striping
+from azfilebak import fileorder
+from azfilebak import fingerprint
+from azfilebak import replication
+from azfilebak import fanout
+from azfilebak import compression
+from azfilebak import bandwidth
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(azurevminstancemetadata))
@@ -23,4 +37,18 @@ def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(scheduleparser))
     tests.addTests(doctest.DocTestSuite(timing))
     tests.addTests(doctest.DocTestSuite(backupagent))
+    tests.addTests(doctest.DocTestSuite(fleet))
+    tests.addTests(doctest.DocTestSuite(instrumentation))
+    tests.addTests(doctest.DocTestSuite(simulator))
+    tests.addTests(doctest.DocTestSuite(notificationspool))
+    tests.addTests(doctest.DocTestSuite(httpsession))
+    tests.addTests(doctest.DocTestSuite(uploader))
+    tests.addTests(doctest.DocTestSuite(mounttable))
+    tests.addTests(doctest.DocTestSuite(striping))
+    tests.addTests(doctest.DocTestSuite(fileorder))
+    tests.addTests(doctest.DocTestSuite(fingerprint))
+    tests.addTests(doctest.DocTestSuite(replication))
+    tests.addTests(doctest.DocTestSuite(fanout))
+    tests.addTests(doctest.DocTestSuite(compression))
+    tests.addTests(doctest.DocTestSuite(bandwidth))
     return tests
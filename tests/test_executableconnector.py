@@ -5,13 +5,26 @@
 
 """Unit tests for executableconnector."""
 
-import os
-import subprocess
+import shlex
 import unittest
+from mock import patch
 from azfilebak import backupconfiguration
 from azfilebak import executableconnector
+from azfilebak.mounttable import MountTable, Mount
 from tests.loggedtestcase import LoggedTestCase
 
+MOUNTS = [
+    Mount('proc', '/proc', 'proc'),
+    Mount('sysfs', '/sys', 'sysfs'),
+    Mount('devtmpfs', '/dev', 'devtmpfs'),
+    Mount('tmpfs', '/dev/shm', 'tmpfs'),
+    Mount('/dev/sda1', '/', 'ext4'),
+    Mount('server:/export', '/mnt/nfs', 'nfs4'),
+    Mount('u@host:', '/home/u/remote', 'fuse.sshfs'),
+    Mount('/dev/sdc1', '/data', 'xfs'),
+    Mount('overlay', '/var/lib/docker/overlay2/x/merged', 'overlay'),
+]
+
 class TestExecutableConnector(LoggedTestCase):
     """Unit tests for class ExecutableConnector."""
 
@@ -28,40 +41,59 @@ class TestExecutableConnector(LoggedTestCase):
         self.assertEqual(proc.returncode, 0)
 
     def test_assemble_backup_command(self):
-        """
-        Test assemble_backup_command
-        The tests are different if run within a Docker container,
-        a development machine, or a generic Linux box,
-        since the list of proc file systems is different.
-        TODO: should mock the whole thing
-        """
-        is_darwin = subprocess.check_output('uname').strip() == 'Darwin'
-        is_docker = os.path.exists('/.dockerenv')
-        is_linux = subprocess.check_output('uname').strip() == 'Linux'
-        if is_docker:
-            # We are in the matrix
-            cmd = self.connector.assemble_backup_command('/', '/dev')
-            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource --exclude /proc --exclude /proc/bus --exclude /proc/fs --exclude /proc/irq --exclude /proc/sys --exclude /proc/sysrq-trigger /')
-            cmd = self.connector.assemble_backup_command('/', '/proc,/dev')
-            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /proc --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource --exclude /proc --exclude /proc/bus --exclude /proc/fs --exclude /proc/irq --exclude /proc/sys --exclude /proc/sysrq-trigger /')
-            cmd = self.connector.assemble_backup_command('/', '/foo,/bar')
-            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /foo --exclude /bar --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource --exclude /proc --exclude /proc/bus --exclude /proc/fs --exclude /proc/irq --exclude /proc/sys --exclude /proc/sysrq-trigger /')
-        elif is_darwin:
-            # We are on a Mac dev machine
+        """Test assemble_backup_command excludes pseudo and network mounts inside the sources."""
+        with patch.object(MountTable, '_mounts', MOUNTS):
             cmd = self.connector.assemble_backup_command('/', '/dev')
-            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource /')
+            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource --exclude /proc --exclude /mnt/nfs --exclude /home/u/remote --exclude /var/lib/docker/overlay2/x/merged /')
             cmd = self.connector.assemble_backup_command('/', '/proc,/dev')
-            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /proc --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource /')
-            cmd = self.connector.assemble_backup_command('/', '/foo,/bar')
-            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /foo --exclude /bar --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource /')
-        elif is_linux:
-            # We are on a generic Linux machine, e.g. VSTS build agent
+            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /proc --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource --exclude /mnt/nfs --exclude /home/u/remote --exclude /var/lib/docker/overlay2/x/merged /')
+            cmd = self.connector.assemble_backup_command('/home /data', '/foo,/bar')
+            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /foo --exclude /bar --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource --exclude /home/u/remote /home /data')
+
+    def test_assemble_backup_command_empty_exclude(self):
+        """Test an empty exclude, or a trailing comma, does not exclude everything."""
+        with patch.object(MountTable, '_mounts', MOUNTS):
+            for exclude in ['', '/foo,']:
+                args = shlex.split(self.connector.assemble_backup_command('/', exclude))
+                self.assertNotIn('', args)
+                self.assertIn('/proc', args)
+                self.assertIn('/mnt/nfs', args)
+            self.assertEqual(MountTable.exclusions(['/'], excluded=['', '/dev']),
+                             ['/proc', '/sys', '/mnt/nfs', '/home/u/remote', '/var/lib/docker/overlay2/x/merged'])
+
+    def test_assemble_backup_command_fstypes(self):
+        """Test the allow and deny lists of file system types, and one-file-system mode."""
+        with patch.object(MountTable, '_mounts', MOUNTS), \
+                patch.object(self.cfg, 'get_include_fstypes', return_value=['nfs4', 'overlay']), \
+                patch.object(self.cfg, 'get_exclude_fstypes', return_value=['xfs']), \
+                patch.object(self.cfg, 'get_one_file_system', return_value=True):
             cmd = self.connector.assemble_backup_command('/', '/dev')
-            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource --exclude /proc /')
-            cmd = self.connector.assemble_backup_command('/', '/proc,/dev')
-            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /proc --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource --exclude /proc /')
-            cmd = self.connector.assemble_backup_command('/', '/foo,/bar')
-            self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /foo --exclude /bar --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource --exclude /proc /')
+        self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /dev --exclude /run --exclude /sys --exclude /mnt/resource --exclude /proc --exclude /home/u/remote --exclude /data --one-file-system /')
+
+    def test_assemble_backup_command_spaces(self):
+        """Test a mount point with a space (\\040 in the mount table) stays one excluded path."""
+        mounts = MOUNTS + [Mount('//srv/share', '/data/a b', 'cifs')]
+        with patch.object(MountTable, '_mounts', mounts):
+            args = shlex.split(self.connector.assemble_backup_command('/data', '/foo'))
+        self.assertIn('/data/a b', args)
+        self.assertEqual(args[args.index('/data/a b') - 1], '--exclude')
+        self.assertEqual(args[-1], '/data')
+
+    def test_assemble_backup_command_files_from(self):
+        """Test tar reads a sorted list instead of walking the sources."""
+        cmd = self.connector.assemble_backup_command('/home', '/foo', excluded=['/foo'],
+                                                     files_from='/var/cache/azfilebak/files_fs.lst')
+        self.assertEquals(cmd, 'tar cpzf - --hard-dereference --sparse --exclude /foo --null --no-recursion --files-from /var/cache/azfilebak/files_fs.lst')
+
+    def test_assemble_backup_command_uncompressed(self):
+        """Test tar does not gzip the archive when azfilebak compresses it."""
+        cmd = self.connector.assemble_backup_command('/home', '/foo', excluded=['/foo'], compress=False)
+        self.assertEquals(cmd, 'tar cpf - --hard-dereference --sparse --exclude /foo /home')
+
+    def test_used_bytes(self):
+        """Test the size of excluded file systems is reported, if they answer."""
+        self.assertGreater(MountTable.used_bytes('/'), 0)
+        self.assertIsNone(MountTable.used_bytes('/does/not/exist'))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,193 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for fanout."""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from mock import patch
+from azfilebak import fanout
+from azfilebak.fanout import FanOut, write_file
+from azfilebak.timing import Timing
+from azfilebak.backupconfiguration import BackupConfiguration
+from azfilebak.backupagent import BackupAgent
+from azfilebak.storagebackend import LocalStorageBackend
+from azfilebak.backupexception import BackupException
+from tests.loggedtestcase import LoggedTestCase
+from tests.localbackuptestcase import LocalBackupTestCase
+
+def read_all(stream):
+    """A sink that reads the whole stream in uneven pieces."""
+    data = []
+    while True:
+        chunk = stream.read(3000)
+        if not chunk:
+            return ''.join(data)
+        data.append(chunk)
+
+def fail_after(size):
+    """A sink that fails after reading some data."""
+    def consume(stream):
+        """Read, then fail."""
+        stream.read(size)
+        raise IOError("disk full")
+    return consume
+
+class CountingStream(StringIO):
+    """Remember how much of the source was read."""
+
+    def __init__(self, data):
+        StringIO.__init__(self, data)
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return StringIO.read(self, size)
+
+class TestFanOut(LoggedTestCase):
+    """Unit tests for the FanOut class."""
+
+    def setUp(self):
+        self.data = os.urandom(10 * 1024) * 50
+        self.patcher = patch.object(fanout, 'CHUNK_SIZE', 4096)
+        self.patcher.start()
+
+    def test_all_sinks(self):
+        """Test every sink gets the whole stream, which is read once."""
+        source = CountingStream(self.data)
+        fan = FanOut(source, queue_size=4 * 4096)
+        for name in ['a', 'b', 'c']:
+            fan.add_sink(name, read_all, required=(name == 'a'))
+        results = fan.run()
+        self.assertEqual(results, {'a': self.data, 'b': self.data, 'c': self.data})
+        # Every chunk, and the end of the stream
+        self.assertEqual(source.reads, (len(self.data) + 4095) // 4096 + 1)
+
+    def test_failed_sink(self):
+        """Test a failed optional sink is dropped, and the others get all the data."""
+        fan = FanOut(StringIO(self.data), queue_size=2 * 4096)
+        fan.add_sink('blob', read_all, required=True)
+        fan.add_sink('local', fail_after(5000))
+        with patch.object(fanout, 'PUT_INTERVAL_SECONDS', 0.01):
+            self.assertEqual(fan.run(), {'blob': self.data})
+        self.assertTrue(fan.sinks[1].dropped)
+        self.assertIsInstance(fan.sinks[1].error, IOError)
+
+    def test_failed_required_sink(self):
+        """Test a failed required sink fails the fan-out and stops the others."""
+        fan = FanOut(StringIO(self.data), queue_size=2 * 4096)
+        fan.add_sink('blob', fail_after(5000), required=True)
+        fan.add_sink('local', read_all)
+        with patch.object(fanout, 'PUT_INTERVAL_SECONDS', 0.01):
+            self.assertRaises(IOError, fan.run)
+        self.assertTrue(fan.sinks[1].dropped)
+
+    def test_strict(self):
+        """Test every sink is required with the strict policy."""
+        fan = FanOut(StringIO(self.data), policy='strict')
+        fan.add_sink('blob', read_all, required=True)
+        fan.add_sink('local', fail_after(5000))
+        self.assertRaises(IOError, fan.run)
+        self.assertRaises(BackupException, FanOut, StringIO(), policy='fastest')
+
+    def test_slow_sink(self):
+        """Test a slow sink holds the others with the wait policy, and is dropped with the drop policy."""
+        def slow(stream):
+            """Read slowly."""
+            while stream.read(4096):
+                time.sleep(0.05)
+            return 'done'
+
+        data = self.data[:10 * 4096]
+        for (policy, sinks) in [('wait', ['blob', 'slow']), ('drop', ['blob'])]:
+            fan = FanOut(StringIO(data), policy=policy, queue_size=4096, max_wait=0.02)
+            fan.add_sink('blob', read_all, required=True)
+            fan.add_sink('slow', slow)
+            with patch.object(fanout, 'PUT_INTERVAL_SECONDS', 0.01):
+                results = fan.run()
+            self.assertEqual(sorted(results), sinks)
+            self.assertTrue(results['blob'] == data)
+
+    def test_write_file(self):
+        """Test a file only appears under its name once complete."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'fs_vm1_full_20181001_100000.tar.gz')
+            fan = FanOut(StringIO(self.data))
+            fan.add_sink('local', write_file(path), required=True)
+            self.assertEqual(fan.run(), {'local': path})
+            with open(path, 'rb') as written:
+                self.assertEqual(written.read(), self.data)
+
+            fan = FanOut(StringIO(self.data))
+            fan.add_sink('local', write_file(os.path.join(tmpdir, 'missing', 'a.tar.gz')), required=True)
+            self.assertRaises(BackupException, fan.run)
+            self.assertEqual(os.listdir(tmpdir), [os.path.basename(path)])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+class TestFanOutBackup(LocalBackupTestCase):
+    """Backups to several targets with the local storage backend."""
+
+    def config_lines(self):
+        self.src = os.path.join(self.tmpdir, 'src')
+        self.local_dir = os.path.join(self.tmpdir, 'backup_fs')
+        self.target = os.path.join(self.tmpdir, 'secondary')
+        os.mkdir(self.src)
+        os.mkdir(self.local_dir)
+        with open(os.path.join(self.src, 'a'), 'wb') as out:
+            out.write(os.urandom(100000))
+        return ['command.backup.data="tar czf - -C {} ."'.format(self.src),
+                'local_backup_dir.data="{}"'.format(self.local_dir),
+                'fanout_targets="local:{}"'.format(self.target)]
+
+    def patchers(self):
+        return LocalBackupTestCase.patchers(self) + [
+            patch.object(Timing, 'now_localtime', return_value='20181001_100000'),
+            patch.object(BackupAgent, 'should_run_backup', return_value=True)
+        ]
+
+    def test_config(self):
+        """Test the local directories and the fan-out settings."""
+        self.assertEqual(self.cfg.get_local_backup_directory('fs'), '/install/backup_fs')
+        self.assertEqual(self.cfg.get_local_backup_directory('data'), self.local_dir)
+        self.assertIsNone(self.cfg.get_local_backup_directory('tmpdir'))
+        self.assertEqual(self.cfg.get_fanout_policy(), 'wait')
+        self.assertEqual(self.cfg.get_fanout_queue_size(), 64 * 1024 * 1024)
+        self.assertEqual(self.cfg.get_fanout_max_wait().total_seconds(), 60)
+
+    def test_backup(self):
+        """Test one backup command writes the blob, the local copy and the secondary blob."""
+        blob_name = self.agent.backup_single_fileset('data', is_full=True, force=True)
+        with self.cfg.storage_backend.open_blob(self.container, blob_name) as blob:
+            data = blob.read()
+        with LocalStorageBackend(self.target).open_blob(self.container, blob_name) as blob:
+            self.assertEqual(blob.read(), data)
+        with open(os.path.join(self.local_dir, blob_name), 'rb') as local:
+            self.assertEqual(local.read(), data)
+
+    def test_failed_target(self):
+        """Test the backup succeeds without a target that fails, unless the policy is strict."""
+        shutil.rmtree(self.local_dir)
+        blob_name = self.agent.backup_single_fileset('data', is_full=True, force=True)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'storage', self.container, blob_name)))
+        with LocalStorageBackend(self.target).open_blob(self.container, blob_name):
+            pass
+
+        with open(self.config_file, 'at') as config:
+            config.write('fanout_policy="strict"\n')
+        agent = BackupAgent(BackupConfiguration(self.config_file))
+        Timing.now_localtime.return_value = '20181002_100000'
+        self.assertRaises(BackupException, agent.backup_single_fileset, 'data', is_full=True, force=True)
+
+if __name__ == '__main__':
+    unittest.main()
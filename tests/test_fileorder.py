@@ -0,0 +1,142 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for fileorder."""
+
+import os
+import errno
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+from mock import patch
+from azfilebak.fileorder import FileOrder, Readahead
+from azfilebak.backupexception import BackupException
+from tests.loggedtestcase import LoggedTestCase
+from tests.localbackuptestcase import LocalBackupTestCase
+
+class TestFileOrder(LoggedTestCase):
+    """Unit tests for class FileOrder."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        names = ['{}/f{}'.format(d, i) for d in 'abc' for i in range(10)]
+        for d in 'abc':
+            os.makedirs(os.path.join(self.src, d))
+        # Create the files in random order, so that inode order is not name order
+        random.Random(1).shuffle(names)
+        for name in names:
+            with open(os.path.join(self.src, name), 'wb') as out:
+                out.write('x' * 1000)
+        os.symlink('a', os.path.join(self.src, 'link'))
+
+    def test_inode_order(self):
+        """Test directories come first, then files by inode."""
+        (dirs, files) = FileOrder.collect([self.src], [os.path.join(self.src, 'c')], 'inode')
+        self.assertEqual(sorted(dirs), [self.src, os.path.join(self.src, 'a'), os.path.join(self.src, 'b')])
+        self.assertEqual(dirs[0], self.src)
+        paths = [path for (path, _size) in files]
+        self.assertEqual(len(paths), 21)
+        self.assertIn(os.path.join(self.src, 'link'), paths)
+        self.assertEqual(paths, sorted(paths, key=lambda p: os.lstat(p).st_ino))
+        self.assertEqual(dict(files)[os.path.join(self.src, 'a', 'f0')], 1000)
+
+    def test_one_file_system(self):
+        """Test mount points of other file systems are listed without their content."""
+        mount_point = os.path.join(self.src, 'b')
+        with patch.object(FileOrder, 'device', side_effect=lambda path: -1 if path == mount_point
+                          else os.lstat(path).st_dev):
+            (dirs, files) = FileOrder.collect([self.src], [], 'inode', one_file_system=True)
+        self.assertIn(mount_point, dirs)
+        paths = [path for (path, _size) in files]
+        self.assertEqual(len(paths), 21)
+        self.assertFalse([path for path in paths if path.startswith(mount_point + '/')])
+        self.assertEqual(len(FileOrder.collect([self.src], [], 'inode')[1]), 31)
+
+    def test_extent_order(self):
+        """Test extent order lists every file, even where FIEMAP is not supported."""
+        (_dirs, files) = FileOrder.collect([self.src], [], 'extent')
+        self.assertEqual(len(files), 31)
+        with patch.object(FileOrder, 'physical_offset', side_effect=IOError(95, 'Not supported')) as offset:
+            (_dirs, files) = FileOrder.collect([self.src], [], 'extent')
+        self.assertEqual(offset.call_count, 1)
+        paths = [path for (path, _size) in files]
+        self.assertEqual(paths, sorted(paths, key=lambda p: os.lstat(p).st_ino))
+
+    def test_invalid_order(self):
+        """Test readdir order does not need a list."""
+        with self.assertRaises(BackupException):
+            FileOrder.collect([self.src], [], 'readdir')
+
+    def test_write_list(self):
+        """Test the list is null separated, directories first."""
+        filename = os.path.join(self.tmpdir, 'files.lst')
+        FileOrder.write_list(['/d'], [('/d/a b', 1), ('/d/c\nd', 2)], filename)
+        with open(filename, 'rb') as list_file:
+            self.assertEqual(list_file.read(), '/d\0/d/a b\0/d/c\nd\0')
+
+    def test_readahead(self):
+        """Test files are advised up to the window ahead of the process, until it ends."""
+        files = [('/f{}'.format(i), 1000) for i in range(10)]
+        readahead = Readahead(files, 1, 5000)
+        with patch.object(Readahead, 'progress', side_effect=[0, 3000, None]), \
+                patch.object(Readahead, 'advise') as advise:
+            readahead.start()
+            readahead.join()
+        self.assertEqual(advise.call_count, 8)
+        self.assertEqual(advise.call_args[0][0], '/f7')
+        self.assertEqual(readahead.advised, 8)
+
+    def test_advise(self):
+        """Test posix_fadvise is found and accepts a file."""
+        readahead = Readahead([], 1, 0)
+        self.assertTrue(Readahead.fadvise())
+        readahead.advise(os.path.join(self.src, 'a', 'f0'))
+        readahead.advise(os.path.join(self.src, 'missing'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class TestOrderedBackup(LocalBackupTestCase):
+    """Backup with a sorted file list and the local storage backend."""
+
+    def config_lines(self):
+        self.src = os.path.join(self.tmpdir, 'src')
+        for d in 'ab':
+            os.makedirs(os.path.join(self.src, d))
+            for i in range(5):
+                with open(os.path.join(self.src, d, 'f{}'.format(i)), 'wb') as out:
+                    out.write(os.urandom(1000))
+        return ['fs.ase.sources="{}"'.format(self.src),
+                'fs.ase.exclude="{}"'.format(os.path.join(self.src, 'b', 'f0')),
+                'fs.ase.order="inode"']
+
+    def test_backup_in_inode_order(self):
+        """Test tar archives the directories, then the files by inode."""
+        blob_name = self.agent.backup_default(is_full=True, force=True)
+        self.agent.restore_blob(blob_name, self.tmpdir)
+        with tarfile.open(os.path.join(self.tmpdir, blob_name)) as archive:
+            members = archive.getmembers()
+        prefix = self.src.lstrip('/')
+        self.assertEqual([m.name for m in members if m.isdir()][0], prefix)
+        self.assertEqual(sorted(m.name for m in members if m.isdir()), [prefix, prefix + '/a', prefix + '/b'])
+        names = [m.name for m in members if m.isfile()]
+        self.assertEqual(len(names), 9)
+        self.assertEqual(names, sorted(names, key=lambda n: os.lstat('/' + n).st_ino))
+        self.assertTrue(os.path.exists(os.path.join(self.cfg.get_cache_directory(), 'files_fs.lst')))
+
+    def test_failed_command(self):
+        """Test the error of a backup command that cannot start is raised, with a file list."""
+        with patch.object(self.agent.executable_connector, 'run_backup_command',
+                          side_effect=OSError(errno.ENOENT, "No such file or directory")):
+            with self.assertRaises(OSError) as context:
+                self.agent.backup_single_fileset('fs', is_full=True, force=True, command='tar cf - /x',
+                                                 readahead_files=[('/x/a', 10)])
+        self.assertEqual(context.exception.errno, errno.ENOENT)
+
+if __name__ == '__main__':
+    unittest.main()
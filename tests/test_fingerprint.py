@@ -0,0 +1,136 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for fingerprint."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from azfilebak.fingerprint import Fingerprint
+from azfilebak.timing import Timing
+from tests.loggedtestcase import LoggedTestCase
+from tests.localbackuptestcase import LocalBackupTestCase
+
+class TestFingerprint(LoggedTestCase):
+    """Unit tests for class Fingerprint."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for d in ['a', 'b/c']:
+            os.makedirs(os.path.join(self.tmpdir, d))
+            with open(os.path.join(self.tmpdir, d, 'f'), 'w') as out:
+                out.write('hello')
+
+    def test_unchanged(self):
+        """Test the fingerprint only depends on the files and the salt."""
+        first = Fingerprint.compute([self.tmpdir], salt='tar')
+        self.assertEqual(Fingerprint.compute([self.tmpdir], salt='tar', threads=1), first)
+        self.assertNotEqual(Fingerprint.compute([self.tmpdir], salt='tar -v'), first)
+
+    def test_changes(self):
+        """Test new files, content and time changes and missing sources change the fingerprint."""
+        path = os.path.join(self.tmpdir, 'b', 'c', 'f')
+        fingerprints = [Fingerprint.compute([self.tmpdir])]
+        os.utime(path, (0, 1000))
+        fingerprints.append(Fingerprint.compute([self.tmpdir]))
+        with open(path, 'a') as out:
+            out.write('!')
+        os.utime(path, (0, 1000))
+        fingerprints.append(Fingerprint.compute([self.tmpdir]))
+        open(os.path.join(self.tmpdir, 'b', 'new'), 'w').close()
+        fingerprints.append(Fingerprint.compute([self.tmpdir]))
+        fingerprints.append(Fingerprint.compute([self.tmpdir, os.path.join(self.tmpdir, 'missing')]))
+        self.assertEqual(len(set(fingerprints)), len(fingerprints))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class TestUnchangedBackup(LocalBackupTestCase):
+    """Skipping the backup of unchanged filesets, with the local storage backend."""
+
+    def config_lines(self):
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.src)
+        with open(os.path.join(self.src, 'profile'), 'w') as out:
+            out.write('SAPSYSTEM=00\n')
+        return ['command.backup.profiles="tar czf - -C {} ."'.format(self.src),
+                'fingerprint.profiles="{}"'.format(self.src)]
+
+    def patchers(self):
+        return LocalBackupTestCase.patchers(self) + [
+            patch.object(Timing, 'now_localtime', return_value='20181001_100000')
+        ]
+
+    def backup(self, timestamp):
+        """Backup the fileset at the given time; returns the blob holding it."""
+        Timing.now_localtime.return_value = timestamp
+        return self.agent.backup_single_fileset('profiles', is_full=True, force=True)
+
+    def backups(self):
+        """Names of the stored backups."""
+        return [b[0] for b in self.agent.existing_backups(container=self.container)]
+
+    def test_skip_unchanged(self):
+        """Test an unchanged fileset is not archived again, and a changed one is."""
+        first = self.backup('20181001_100000')
+        metadata = self.cfg.storage_backend.get_blob_properties(self.container, first).metadata
+        self.assertEqual(len(metadata['fingerprint']), 64)
+
+        with patch.object(self.agent.executable_connector, 'run_backup_command') as run:
+            self.assertEqual(self.backup('20181002_100000'), first)
+        run.assert_not_called()
+        self.assertEqual(self.backups(), [first])
+        self.assertTrue(self.agent.send_notification.call_args[1]['success'])
+
+        with open(os.path.join(self.src, 'profile'), 'a') as out:
+            out.write('SAPLOCALHOST=vm1\n')
+        second = self.backup('20181003_100000')
+        self.assertNotEqual(second, first)
+        self.assertEqual(self.backups(), [first, second])
+
+    def test_unchanged_checked_once_per_interval(self):
+        """Test an unchanged fileset is checked and notified once per interval, not on every run."""
+        first = self.backup('20181001_100000')
+        runs = ['20181002_110000', '20181002_120000', '20181002_130000', '20181003_120000']
+        for timestamp in runs:
+            Timing.now_localtime.return_value = timestamp
+            with patch.object(self.agent.executable_connector, 'run_backup_command') as run:
+                self.agent.backup_single_fileset('profiles', is_full=True, force=False)
+            run.assert_not_called()
+        # The first backup, and the checks one day apart
+        self.assertEqual(self.agent.send_notification.call_count, 3)
+        self.assertEqual(self.agent.latest_checked_timestamp('profiles', is_full=True), '20181003_120000')
+        self.assertEqual(self.backups(), [first])
+
+        # Until the maximum interval since the backup
+        Timing.now_localtime.return_value = '20181004_130000'
+        second = self.agent.backup_single_fileset('profiles', is_full=True, force=False)
+        self.assertEqual(self.backups(), [first, second])
+        self.assertEqual(self.agent.latest_checked_timestamp('profiles', is_full=True), '20181004_130000')
+
+    def test_unchanged_too_old(self):
+        """Test a full backup is taken after the maximum interval, even if nothing changed."""
+        first = self.backup('20181001_100000')
+        second = self.backup('20181101_100000')
+        self.assertEqual(self.backups(), [first, second])
+
+    def test_server_side_copy(self):
+        """Test an unchanged fileset can be recorded as a copy of the previous backup."""
+        with patch.object(self.cfg, 'get_fingerprint_copy', return_value=True):
+            first = self.backup('20181001_100000')
+            with patch.object(self.agent.executable_connector, 'run_backup_command') as run:
+                second = self.backup('20181101_100000')
+            run.assert_not_called()
+        self.assertEqual(self.backups(), [first, second])
+        storage_backend = self.cfg.storage_backend
+        self.assertEqual(storage_backend.get_blob_properties(self.container, second).metadata,
+                         storage_backend.get_blob_properties(self.container, first).metadata)
+        self.assertEqual(storage_backend.get_blob_properties(self.container, second).size,
+                         storage_backend.get_blob_properties(self.container, first).size)
+
+if __name__ == '__main__':
+    unittest.main()
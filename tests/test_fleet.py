@@ -0,0 +1,110 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for fleet."""
+
+import json
+import datetime
+import unittest
+from mock import patch, MagicMock, PropertyMock
+from azfilebak import backupconfiguration
+from azfilebak import backupagent
+from azfilebak.fleet import Fleet
+from azfilebak.azurevminstancemetadata import AzureVMInstanceMetadata
+from azfilebak.scheduleparser import ScheduleParser
+from azfilebak.backupexception import BackupException
+from tests.loggedtestcase import LoggedTestCase
+
+class FakeResults(list):
+    """A list of blobs that looks like a single page of list_blobs results."""
+    next_marker = None
+
+def fake_blob(name, length=100):
+    """Create a blob-like object."""
+    blob = MagicMock()
+    blob.name = name
+    blob.properties.creation_time = datetime.datetime(2018, 11, 21)
+    blob.properties.content_length = length
+    return blob
+
+class TestFleet(LoggedTestCase):
+    """Unit tests for class Fleet."""
+
+    def setUp(self):
+        self.json_meta = open('sample_instance_metadata.json').read()
+
+        self.meta = AzureVMInstanceMetadata(
+            lambda: (json.JSONDecoder()).decode(self.json_meta)
+        )
+
+        self.patcher1 = patch('azfilebak.azurevminstancemetadata.AzureVMInstanceMetadata.create_instance',
+                              return_value=self.meta)
+        self.patcher1.start()
+
+        self.blobs = {
+            'vm1': [fake_blob('fs_vm1_full_20180101_010000.tar.gz'),
+                    fake_blob('fs_vm1_full_20180201_010000.tar.gz'),
+                    fake_blob('fs_vm1_incr_20180202_010000.tar.gz', 10)],
+            'vm2': [fake_blob('fs_vm2_full_20180301_010000.tar.gz'),
+                    fake_blob('not-a-backup.txt')]
+        }
+
+        self.client = MagicMock()
+        self.client.list_blobs.side_effect = lambda container_name, **kwargs: FakeResults(self.blobs[container_name])
+        self.client.list_containers.return_value = [MagicMock(), MagicMock()]
+        self.client.list_containers.return_value[0].name = 'vm1'
+        self.client.list_containers.return_value[1].name = 'vm2'
+
+        self.patcher2 = patch('azfilebak.backupconfiguration.BackupConfiguration.storage_client',
+                              new_callable=PropertyMock, return_value=self.client)
+        self.patcher2.start()
+
+        self.cfg = backupconfiguration.BackupConfiguration(config_filename="sample_backup.conf")
+        self.agent = backupagent.BackupAgent(self.cfg)
+
+    def test_get_containers(self):
+        """Test explicit and enumerated containers."""
+        self.assertEqual(Fleet(self.agent, containers=['vm2']).get_containers(), ['vm2'])
+        self.assertEqual(Fleet(self.agent).get_containers(), ['vm1', 'vm2'])
+
+    def test_existing_backups(self):
+        """Test backups are aggregated per VM."""
+        per_vm = Fleet(self.agent, workers=2).existing_backups()
+        self.assertEqual(sorted(per_vm.keys()), ['vm1', 'vm2'])
+        self.assertEqual(len(per_vm['vm1']), 3)
+        self.assertEqual(per_vm['vm2'][0][0:2], ('vm2', 'fs_vm2_full_20180301_010000.tar.gz'))
+
+    def test_summary(self):
+        """Test per-VM summary."""
+        summary = Fleet.summarize(Fleet(self.agent).existing_backups())
+        self.assertEqual(summary['vm1']['full'], 2)
+        self.assertEqual(summary['vm1']['incr'], 1)
+        self.assertEqual(summary['vm1']['bytes'], 210)
+        self.assertEqual(summary['vm1']['latest_full'], '20180201_010000')
+        self.assertEqual(summary['vm2']['latest_incr'], None)
+
+    def test_prune_old_backups(self):
+        """Test prune runs in every container."""
+        # Mock call recording is not thread safe, record deletions separately
+        deleted = []
+        self.client.delete_blob.side_effect = lambda container_name, blob_name: deleted.append(
+            container_name + '/' + blob_name)
+        Fleet(self.agent).prune_old_backups(ScheduleParser.parse_timedelta('8d'), ['fs'])
+        self.assertEqual(sorted(deleted), [
+            'vm1/fs_vm1_full_20180101_010000.tar.gz',
+            'vm1/fs_vm1_full_20180201_010000.tar.gz',
+            'vm1/fs_vm1_incr_20180202_010000.tar.gz',
+            'vm2/fs_vm2_full_20180301_010000.tar.gz'])
+
+    def test_failed_container(self):
+        """Test a failing container is reported after the others are processed."""
+        self.assertRaises(BackupException, Fleet(self.agent, containers=['vm1', 'missing']).existing_backups)
+
+    def tearDown(self):
+        self.patcher1.stop()
+        self.patcher2.stop()
+
+if __name__ == '__main__':
+    unittest.main()
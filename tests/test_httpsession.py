@@ -0,0 +1,93 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for httpsession."""
+
+import threading
+import unittest
+import BaseHTTPServer
+from azfilebak.httpsession import HttpSession
+from azfilebak.instrumentation import Instrumentation
+from tests.loggedtestcase import LoggedTestCase
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer every GET with a short body, keeping the connection open."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+class TestHttpSession(LoggedTestCase):
+    """Unit tests for class HttpSession."""
+
+    def setUp(self):
+        HttpSession.reset()
+        Instrumentation.reset()
+
+    def test_shared_session(self):
+        """Test the session is created once and its pool only grows."""
+        session = HttpSession.get(pool_size=2)
+        self.assertIs(HttpSession.get(pool_size=1), session)
+        self.assertEqual(session.get_adapter('https://x')._pool_maxsize, 2)
+        HttpSession.resize(8)
+        self.assertEqual(session.get_adapter('https://x')._pool_maxsize, 8)
+        self.assertEqual(session.get_adapter('http://x')._pool_maxsize, 8)
+        HttpSession.resize(4)
+        self.assertEqual(session.get_adapter('https://x')._pool_maxsize, 8)
+        self.assertEqual(Instrumentation.report()['gauges']['http.pool_size'], 8)
+
+    def test_close_previous_adapter(self):
+        """Test the connection pools of the replaced adapter are closed."""
+        session = HttpSession.client_session(pool_size=2)
+        previous = session.get_adapter('https://x')
+        previous.get_connection('https://x')
+        self.assertEqual(len(previous.poolmanager.pools), 1)
+        HttpSession.resize(8)
+        self.assertEqual(len(previous.poolmanager.pools), 0)
+
+    def test_client_sessions(self):
+        """Test client sessions share the connection pool, also once it grows, but not their headers."""
+        session1 = HttpSession.client_session(pool_size=2)
+        session2 = HttpSession.client_session()
+        session1.headers['Authorization'] = 'Bearer token1'
+        self.assertNotIn('Authorization', session2.headers)
+        self.assertNotIn('Authorization', HttpSession.get().headers)
+        HttpSession.resize(8)
+        for session in [session1, session2]:
+            self.assertIs(session.get_adapter('https://x'), HttpSession.get().get_adapter('https://x'))
+            self.assertEqual(session.get_adapter('http://x')._pool_maxsize, 8)
+
+    def test_connection_reuse_counters(self):
+        """Test new and reused connections are counted."""
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            session = HttpSession.get()
+            url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+            for _ in range(3):
+                self.assertEqual(session.get(url, timeout=(5, 5)).content, 'ok')
+        finally:
+            # The server handles one connection at a time, close the kept-alive one first
+            HttpSession.reset()
+            server.shutdown()
+            server.server_close()
+        counters = Instrumentation.report()['counters']
+        self.assertEqual(counters['http.connections.new'], 1)
+        self.assertEqual(counters['http.connections.reused'], 2)
+
+    def tearDown(self):
+        HttpSession.reset()
+
+if __name__ == '__main__':
+    unittest.main()
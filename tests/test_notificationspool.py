@@ -0,0 +1,139 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for notificationspool."""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from azfilebak import notificationspool
+from azfilebak.notificationspool import NotificationSpool
+from tests.loggedtestcase import LoggedTestCase
+
+class TestNotificationSpool(LoggedTestCase):
+    """Unit tests for class NotificationSpool."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, 'spool')
+        self.output = os.path.join(self.tmpdir, 'received')
+
+    def spool(self, command=None, **kwargs):
+        """Create a spool that does not start drainer processes."""
+        command = command or "sh -c 'cat >> {}; echo >> {}'".format(self.output, self.output)
+        return NotificationSpool(self.directory, command, background=None, **kwargs)
+
+    def received(self):
+        """Lines received by the notification command."""
+        with open(self.output) as output:
+            return [line for line in output.read().split('\n') if line]
+
+    def test_enqueue_and_drain(self):
+        """Test messages are spooled, then delivered and removed."""
+        spool = self.spool()
+        spool.enqueue('{"a": 1}')
+        spool.enqueue('{"a": 2}')
+        self.assertEqual(len(spool.envelopes()), 2)
+        self.assertFalse(os.path.exists(self.output))
+
+        self.assertTrue(spool.drain())
+        self.assertEqual(sorted(self.received()), ['{"a": 1}', '{"a": 2}'])
+        self.assertEqual(spool.envelopes(), [])
+        self.assertEqual(spool.seconds_until_next_attempt(), None)
+
+    def test_batches(self):
+        """Test several messages are passed to one command."""
+        counter = os.path.join(self.tmpdir, 'calls')
+        spool = self.spool(command="sh -c 'cat > /dev/null; echo x >> {}'".format(counter), batch_size=3)
+        for i in range(7):
+            spool.enqueue(str(i))
+        spool.drain()
+        with open(counter) as calls:
+            self.assertEqual(len(calls.readlines()), 3)
+
+    def test_retry_with_backoff(self):
+        """Test a failed delivery is rescheduled, then given up."""
+        spool = self.spool(command='false')
+        filename = spool.enqueue('{}')
+        spool.drain()
+        (_, envelope) = spool.envelopes()[0]
+        self.assertEqual(envelope['attempts'], 1)
+        self.assertTrue(envelope['next_attempt'] > time.time() + 5)
+        self.assertTrue(spool.seconds_until_next_attempt() > 5)
+
+        # Not due yet: nothing happens
+        spool.drain()
+        self.assertEqual(spool.envelopes()[0][1]['attempts'], 1)
+
+        envelope['attempts'] = notificationspool.MAX_ATTEMPTS - 1
+        envelope['next_attempt'] = 0
+        spool.write_envelope(filename, envelope)
+        spool.drain()
+        self.assertEqual(spool.envelopes(), [])
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'failed')), [os.path.basename(filename)])
+
+    def test_missing_command(self):
+        """Test messages are dropped if the notification command does not exist."""
+        spool = self.spool(command='/nonexistent/notify --stdin')
+        spool.enqueue('{}')
+        spool.drain()
+        self.assertEqual(spool.envelopes(), [])
+
+    def test_timeout(self):
+        """Test a hung notification command is killed."""
+        spool = self.spool(command="sleep 30", timeout_seconds=0.2)
+        spool.enqueue('{}')
+        start = time.time()
+        spool.drain()
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(spool.envelopes()[0][1]['attempts'], 1)
+
+    def test_single_drainer(self):
+        """Test a second drainer does not run while the spool is locked."""
+        spool = self.spool()
+        spool.enqueue('{}')
+        lock_file = spool.lock()
+        try:
+            self.assertFalse(self.spool().drain())
+        finally:
+            lock_file.close()
+        self.assertEqual(len(spool.envelopes()), 1)
+
+    def test_no_drainer_while_locked(self):
+        """Test a drainer process is only started when no drainer holds the spool lock."""
+        spool = NotificationSpool(self.directory, 'true')
+        with patch.object(spool, 'spawn_drainer') as spawn_drainer:
+            lock_file = self.spool().lock()
+            try:
+                spool.enqueue('{}')
+            finally:
+                lock_file.close()
+            spawn_drainer.assert_not_called()
+            spool.enqueue('{}')
+            spawn_drainer.assert_called_once_with()
+
+    def test_worker_thread(self):
+        """Test the drainer thread delivers messages as they are spooled."""
+        spool = self.spool()
+        spool.start_worker_thread()
+        try:
+            spool.enqueue('{"thread": true}')
+            for _ in range(50):
+                if not spool.envelopes():
+                    break
+                time.sleep(0.1)
+        finally:
+            spool.stop_worker_thread()
+        self.assertEqual(self.received(), ['{"thread": true}'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
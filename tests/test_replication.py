@@ -0,0 +1,131 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for replication."""
+
+import os
+import unittest
+from mock import patch, MagicMock
+from azfilebak.backupconfiguration import BackupConfiguration
+from azfilebak.storagebackend import AzureStorageBackend, LocalStorageBackend
+from azfilebak.replication import Replicator
+from azfilebak.backupexception import BackupException
+from tests.localbackuptestcase import LocalBackupTestCase
+
+class TestReplication(LocalBackupTestCase):
+    """Replication between local storage directories."""
+
+    def config_lines(self):
+        self.targets = [os.path.join(self.tmpdir, 'dr1'), os.path.join(self.tmpdir, 'dr2')]
+        return ['replication_targets="{}"'.format(", ".join('local:' + target for target in self.targets)),
+                'replication_workers="3"']
+
+    def setUp(self):
+        LocalBackupTestCase.setUp(self)
+        self.storage = self.cfg.storage_backend
+        self.blobs = {
+            'data_vm1_full_20181001_100000.tar.gz': os.urandom(3000),
+            'data_vm1_incr_20181002_100000.tar.gz': os.urandom(1000),
+            'db_vm1_full_20181002_100000.1of2.tar.gz': os.urandom(2000),
+            'db_vm1_full_20181002_100000.2of2.tar.gz': os.urandom(2000),
+            'db_vm1_full_20181002_100000.manifest.json': '{"stripes": 2}'
+        }
+        for (name, data) in self.blobs.items():
+            self.storage.create_blob_from_bytes(self.container, name, data, metadata={'name': name})
+
+    def content(self, root, name):
+        """Content of a blob of the container in a local storage directory."""
+        with LocalStorageBackend(root).open_blob(self.container, name) as blob_file:
+            return blob_file.read()
+
+    def test_replicate(self):
+        """Test the blobs and their metadata are copied to every target, and only once."""
+        replicator = Replicator(self.cfg)
+        self.assertEqual(replicator.workers, 3)
+        reports = replicator.replicate()
+        self.assertEqual([r['target'] for r in reports], ['local:' + t for t in self.targets])
+        for (report, root) in zip(reports, self.targets):
+            self.assertEqual(report['blobs'], 5)
+            self.assertEqual(report['bytes'], sum(len(data) for data in self.blobs.values()))
+            self.assertEqual(report['failed'], [])
+            self.assertGreaterEqual(report['lag_seconds'], 0)
+            for (name, data) in self.blobs.items():
+                self.assertEqual(self.content(root, name), data)
+                self.assertEqual(LocalStorageBackend(root).get_blob_properties(self.container, name).metadata,
+                                 {'name': name})
+
+        # Replicated blobs are not copied again, new and changed ones are
+        self.assertEqual([r['blobs'] for r in Replicator(self.cfg).replicate()], [0, 0])
+        self.storage.create_blob_from_bytes(self.container, 'data_vm1_incr_20181003_100000.tar.gz', 'new')
+        LocalStorageBackend(self.targets[1]).create_blob_from_bytes(
+            self.container, 'data_vm1_full_20181001_100000.tar.gz', 'partial')
+        reports = Replicator(self.cfg).replicate()
+        self.assertEqual([r['blobs'] for r in reports], [1, 2])
+        self.assertEqual(self.content(self.targets[1], 'data_vm1_full_20181001_100000.tar.gz'),
+                         self.blobs['data_vm1_full_20181001_100000.tar.gz'])
+
+    def test_manifests_last(self):
+        """Test manifests are copied once all the data of every target is."""
+        copied = []
+        replicator = Replicator(self.cfg)
+        copy = replicator.copy
+        def record(target, blob):
+            """Copy and remember the order."""
+            copied.append(blob.name)
+            return copy(target, blob)
+        with patch.object(replicator, 'copy', side_effect=record):
+            replicator.replicate()
+        self.assertEqual(len(copied), 10)
+        self.assertEqual([name.endswith('.manifest.json') for name in copied], [False] * 8 + [True] * 2)
+
+    def test_filesets(self):
+        """Test only the backups of the selected filesets are copied."""
+        reports = Replicator(self.cfg).replicate(filesets=['db'])
+        self.assertEqual([r['blobs'] for r in reports], [3, 3])
+        self.assertEqual(sorted(b.name for b in LocalStorageBackend(self.targets[0]).list_blobs(self.container)),
+                         sorted(n for n in self.blobs if n.startswith('db_')))
+
+    def test_failures(self):
+        """Test a failed copy is reported, and does not stop the others."""
+        failing = LocalStorageBackend(self.targets[1])
+        failing.start_copy = MagicMock(return_value=('failed', 'source not found'))
+        targets = [('dr1', LocalStorageBackend(self.targets[0]), self.container),
+                   ('dr2', failing, self.container)]
+        replicator = Replicator(self.cfg, targets=targets, workers=2)
+        reports = replicator.replicate()
+        self.assertEqual(reports[0]['blobs'], 5)
+        self.assertEqual((reports[1]['blobs'], reports[1]['bytes']), (0, 0))
+        self.assertEqual(sorted(reports[1]['failed']), sorted(self.blobs))
+        self.assertRaises(BackupException, Replicator(self.cfg, targets=targets).show_report)
+
+    def test_azure_targets(self):
+        """Test storage accounts are targets with their own client, and copies are polled."""
+        with open(self.config_file, 'at') as config:
+            config.write('replication_targets="sadr0001/backups, sadr0002"\n')
+        cfg = BackupConfiguration(self.config_file)
+        clients = [MagicMock(), MagicMock()]
+        with patch.object(BackupConfiguration, 'create_storage_client',
+                          side_effect=[(client, None) for client in clients]) as create:
+            targets = cfg.get_replication_backends()
+        self.assertEqual([c[0][0] for c in create.call_args_list], ['sadr0001', 'sadr0002'])
+        self.assertEqual([(name, container) for (name, _backend, container) in targets],
+                         [('sadr0001/backups', 'backups'), ('sadr0002', self.container)])
+        self.assertIsInstance(targets[0][1], AzureStorageBackend)
+        self.assertIs(targets[1][1].client, clients[1])
+
+        # An empty container
+        clients[0].list_blobs.return_value = MagicMock(next_marker=None)
+        clients[0].copy_blob.return_value = MagicMock(status='pending')
+        clients[0].get_blob_properties.return_value.properties.copy = MagicMock(status='success')
+        with patch('azfilebak.storagebackend.time.sleep'):
+            reports = Replicator(cfg, targets=targets[:1]).replicate()
+        self.assertEqual(reports[0]['blobs'], 5)
+        # The service reads the source, the data does not go through the VM
+        source_urls = sorted(c[0][2] for c in clients[0].copy_blob.call_args_list)
+        self.assertEqual(source_urls, sorted(self.storage.source_url(self.container, n) for n in self.blobs))
+        self.assertEqual(clients[0].get_blob_properties.call_count, 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for simulator."""
+
+import datetime
+import unittest
+from azfilebak.businesshours import BusinessHours
+from azfilebak.simulator import ScheduleSimulator, BackupModel, FakeContainer
+from tests.loggedtestcase import LoggedTestCase
+
+WORK_HOURS = "111111111000000000011111"
+NO_HOURS = "000000000000000000000000"
+
+def schedule(weekday_hours, weekend_hours, interval_min="1d", interval_max="3d"):
+    """Build business hours with the same hours for weekdays and for weekends."""
+    days = ["{}:{}".format(d, weekday_hours) for d in ['mo', 'tu', 'we', 'th', 'fr']]
+    days += ["{}:{}".format(d, weekend_hours) for d in ['sa', 'su']]
+    tag = "bkp_fs_schedule:" + ", ".join(days + ["min:" + interval_min, "max:" + interval_max])
+    return BusinessHours.parse_tag_str(tag)
+
+class TestScheduleSimulator(LoggedTestCase):
+    """Unit tests for class ScheduleSimulator."""
+
+    def simulate(self, business_hours, model, days=28, tran_interval_min=None):
+        """Run a simulation starting on a Monday."""
+        simulator = ScheduleSimulator(
+            business_hours=business_hours,
+            interval_min=datetime.timedelta(days=1),
+            interval_max=datetime.timedelta(days=3),
+            model=model,
+            tran_interval_min=tran_interval_min)
+        start = datetime.datetime(2018, 6, 4)
+        return simulator.run(start, start + datetime.timedelta(days=days))
+
+    def test_daily_full_backups(self):
+        """Test short backups run once per day within the allowed hours."""
+        report = self.simulate(schedule(WORK_HOURS, WORK_HOURS), BackupModel(full_size=1024 ** 3))
+        self.assertEqual(report['ticks'], 28 * 24 * 60)
+        self.assertEqual(report['full_backups'], 28)
+        self.assertEqual(report['full_backups_outside_allowed_hours'], 0)
+        self.assertEqual(report['gaps_over_max'], [])
+        self.assertEqual(report['peak_concurrent_jobs'], 1)
+
+    def test_max_interval(self):
+        """Test the maximum interval forces backups when no hours are allowed."""
+        report = self.simulate(schedule(NO_HOURS, NO_HOURS), BackupModel(full_size=1024 ** 3))
+        self.assertEqual(report['full_backups'], 10)
+        self.assertEqual(report['full_backups_outside_allowed_hours'], 10)
+        self.assertEqual(report['gaps_over_max'], [])
+
+    def test_long_backups_exceed_max(self):
+        """Test backups longer than the maximum interval are reported as gaps."""
+        model = BackupModel(full_size=1024 ** 4, throughput=1024 ** 2)
+        report = self.simulate(schedule(WORK_HOURS, WORK_HOURS), model)
+        self.assertTrue(report['gaps_over_max'])
+        self.assertEqual(report['peak_concurrent_jobs'], 1)
+
+    def test_incremental_backups(self):
+        """Test incremental backups run alongside full backups."""
+        report = self.simulate(schedule(WORK_HOURS, WORK_HOURS), BackupModel(full_size=100 * 1024 ** 3),
+                               days=7, tran_interval_min=datetime.timedelta(hours=1))
+        # The age must exceed the minimum interval, so backups start every 61 minutes
+        self.assertEqual(report['incr_backups'], 7 * 24 * 60 // 61 + 1)
+        self.assertEqual(report['peak_concurrent_jobs'], 2)
+
+class TestFakeContainer(LoggedTestCase):
+    """Unit tests for class FakeContainer."""
+
+    def test_visible_when_complete(self):
+        """Test a backup is listed under its start time once complete."""
+        container = FakeContainer()
+        start = datetime.datetime(2018, 6, 4, 1)
+        container.start_backup(True, start, start + datetime.timedelta(hours=2), 42)
+        container.advance(start + datetime.timedelta(hours=1))
+        self.assertEqual(container.latest_backup_timestamp(True).year, 1900)
+        self.assertEqual(container.running(is_full=True), 1)
+        container.advance(start + datetime.timedelta(hours=2))
+        self.assertEqual(container.latest_backup_timestamp(True), start)
+        self.assertEqual(container.running(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for storagebackend."""
+
+import os
+import shutil
+import tempfile
+import subprocess
+import unittest
+from StringIO import StringIO
+from mock import patch, MagicMock
+from azfilebak import storagebackend
+from azfilebak.storagebackend import LocalStorageBackend, AzureStorageBackend, copy_fd
+from azfilebak.backupconfiguration import BackupConfiguration
+from azfilebak.backupagent import BackupAgent
+from azfilebak.scheduleparser import ScheduleParser
+from azfilebak.backupexception import BackupException
+from tests.loggedtestcase import LoggedTestCase
+from tests.localbackuptestcase import LocalBackupTestCase
+
+class TestLocalStorageBackend(LoggedTestCase):
+    """Unit tests for class LocalStorageBackend."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.backend = LocalStorageBackend(self.tmpdir)
+
+    def test_stream_and_read(self):
+        """Test upload from a stream, properties and ranged reads."""
+        self.backend.create_blob_from_stream('c1', 'blob1', StringIO('0123456789'), metadata={'k': 'v'})
+        info = self.backend.get_blob_properties('c1', 'blob1')
+        self.assertEqual((info.name, info.size, info.metadata), ('blob1', 10, {'k': 'v'}))
+        self.assertEqual(self.backend.get_blob_range('c1', 'blob1', 2, 4), '234')
+        self.assertEqual(self.backend.list_containers(), ['c1'])
+
+    def test_stream_from_pipe(self):
+        """Test upload from the output of a command."""
+        proc = subprocess.Popen(['head', '-c', '100000', '/dev/zero'], stdout=subprocess.PIPE)
+        self.backend.create_blob_from_stream('c1', 'blob1', proc.stdout)
+        proc.wait()
+        self.assertEqual(self.backend.get_blob_properties('c1', 'blob1').size, 100000)
+
+    def test_blocks(self):
+        """Test staged blocks are committed in order and uncommitted ones discarded."""
+        self.backend.put_block('c1', 'blob1', 'AAA=', 'world')
+        self.backend.put_block('c1', 'blob1', 'AAE=', 'hello ')
+        self.backend.put_block('c1', 'blob1', 'AAI=', 'unused')
+        self.assertEqual(self.backend.list_blobs('c1'), [])
+        self.backend.put_block_list('c1', 'blob1', ['AAE=', 'AAA='])
+        out = StringIO()
+        self.backend.get_blob_to_stream('c1', 'blob1', out)
+        self.assertEqual(out.getvalue(), 'hello world')
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'c1', '.azfilebak', 'blocks', 'blob1')))
+        self.assertRaises(BackupException, self.backend.put_block_list, 'c1', 'blob1', ['AAA='])
+
+    def test_paging(self):
+        """Test listings are paginated and filtered by prefix."""
+        for i in range(5):
+            self.backend.create_blob_from_stream('c1', 'fs_{}'.format(i), StringIO('x'))
+        self.backend.create_blob_from_stream('c1', 'other', StringIO('x'))
+        page = self.backend.list_blobs('c1', prefix='fs_', page_size=2)
+        self.assertEqual([b.name for b in page], ['fs_0', 'fs_1'])
+        page = self.backend.list_blobs('c1', prefix='fs_', marker=page.next_marker, page_size=2)
+        self.assertEqual([b.name for b in page], ['fs_2', 'fs_3'])
+        self.assertEqual([b.name for b in self.backend.iter_blobs('c1', prefix='fs_')],
+                         ['fs_0', 'fs_1', 'fs_2', 'fs_3', 'fs_4'])
+
+    def test_metadata_and_delete(self):
+        """Test metadata updates and deletes."""
+        self.backend.create_blob_from_stream('c1', 'blob1', StringIO('x'))
+        self.assertEqual(self.backend.get_blob_properties('c1', 'blob1').metadata, {})
+        self.backend.set_blob_metadata('c1', 'blob1', {'a': '1'})
+        self.assertEqual(list(self.backend.iter_blobs('c1', include_metadata=True))[0].metadata, {'a': '1'})
+        self.backend.delete_blob('c1', 'blob1')
+        self.assertEqual(self.backend.list_blobs('c1'), [])
+        self.assertRaises(BackupException, self.backend.delete_blob, 'c1', 'blob1')
+        self.assertRaises(BackupException, self.backend.get_blob_properties, 'c1', '../x')
+
+    def test_get_blob_to_path(self):
+        """Test download to a file."""
+        self.backend.create_blob_from_stream('c1', 'blob1', StringIO('content'))
+        path = os.path.join(self.tmpdir, 'restored')
+        self.backend.get_blob_to_path('c1', 'blob1', path)
+        with open(path) as restored:
+            self.assertEqual(restored.read(), 'content')
+
+    def test_copy_fd_kernel(self):
+        """Test files are copied inside the kernel, without reading them in the process."""
+        src = os.path.join(self.tmpdir, 'src')
+        data = os.urandom(storagebackend.COPY_BUFFER_SIZE + 10)
+        with open(src, 'wb') as src_file:
+            src_file.write(data)
+        self.assertIsNotNone(storagebackend.kernel_copy('sendfile'))
+        dst = os.path.join(self.tmpdir, 'dst')
+        with patch.object(storagebackend.os, 'read', side_effect=AssertionError("buffered copy")):
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                self.assertEqual(copy_fd(src_file.fileno(), dst_file.fileno(), 20), 20)
+                self.assertEqual(copy_fd(src_file.fileno(), dst_file.fileno()), len(data) - 20)
+        with open(dst, 'rb') as dst_file:
+            self.assertEqual(dst_file.read(), data)
+
+    def test_copy_fd_fallback(self):
+        """Test the buffered copy used when the kernel cannot copy."""
+        src = os.path.join(self.tmpdir, 'src')
+        with open(src, 'wb') as src_file:
+            src_file.write('y' * (storagebackend.COPY_BUFFER_SIZE + 10))
+        with patch.object(storagebackend, 'kernel_copy', return_value=None):
+            with open(src, 'rb') as src_file, open(os.path.join(self.tmpdir, 'dst'), 'wb') as dst_file:
+                self.assertEqual(copy_fd(src_file.fileno(), dst_file.fileno(), 20), 20)
+                self.assertEqual(copy_fd(src_file.fileno(), dst_file.fileno()), storagebackend.COPY_BUFFER_SIZE - 10)
+        # From a pipe, as the output of the backup command
+        (read_fd, write_fd) = os.pipe()
+        os.write(write_fd, 'z' * 1000)
+        os.close(write_fd)
+        with open(os.path.join(self.tmpdir, 'dst'), 'wb') as dst_file:
+            self.assertEqual(copy_fd(read_fd, dst_file.fileno()), 1000)
+        os.close(read_fd)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class TestAzureStorageBackend(LoggedTestCase):
+    """Unit tests for class AzureStorageBackend."""
+
+    def test_list_blobs(self):
+        """Test SDK results are converted."""
+        blob = MagicMock()
+        blob.name = 'fs_vm_full_20180101_000000.tar.gz'
+        blob.properties.content_length = 42
+        results = [blob]
+        client = MagicMock()
+        client.list_blobs.return_value = MagicMock(__iter__=lambda _: iter(results), next_marker='m')
+        configuration = MagicMock()
+        configuration.storage_client = client
+        page = AzureStorageBackend(configuration).list_blobs('c1', prefix='fs_')
+        self.assertEqual((page[0].name, page[0].size, page.next_marker), (blob.name, 42, 'm'))
+
+    def test_copy_blob(self):
+        """Test a pending copy is waited for, and a failed copy raises."""
+        client = MagicMock()
+        client.copy_blob.return_value = MagicMock(status='pending')
+        client.get_blob_properties.return_value.properties.copy = MagicMock(status='success')
+        configuration = MagicMock()
+        configuration.storage_client = client
+        backend = AzureStorageBackend(configuration)
+        with patch.object(storagebackend, 'COPY_POLL_SECONDS', 0):
+            backend.copy_blob('c1', 'b2', 'b1', metadata={'k': 'v'})
+            client.get_blob_properties.return_value.properties.copy = MagicMock(status='failed')
+            with self.assertRaises(BackupException):
+                backend.copy_blob('c1', 'b2', 'b1')
+        self.assertEqual(client.copy_blob.call_args_list[0][1], {'metadata': {'k': 'v'}})
+
+    def test_source_url(self):
+        """Test source URLs are signed with the account key, or a user delegation key, and reused."""
+        client = MagicMock()
+        client.make_blob_url.side_effect = lambda c, b, sas_token: 'https://a/{}/{}?{}'.format(c, b, sas_token)
+        client.generate_blob_shared_access_signature.return_value = 'sig'
+        configuration = MagicMock()
+        configuration.storage_client = client
+        backend = AzureStorageBackend(configuration)
+        self.assertEqual(backend.source_url('c1', 'b1'), 'https://a/c1/b1?sig')
+        backend.source_url('c1', 'b1')
+        self.assertEqual(client.generate_blob_shared_access_signature.call_count, 1)
+        client.get_user_delegation_key.assert_not_called()
+
+        client.account_key = None
+        backend.put_block_from_blob('c1', 'b2', 'id', 'b0', 0, 99)
+        backend.source_url('c1', 'b3')
+        self.assertEqual(client.get_user_delegation_key.call_count, 1)
+        self.assertEqual(client.put_block_from_url.call_args,
+                         (('c1', 'b2', 'https://a/c1/b0?sig', 'id'), {'source_range_start': 0, 'source_range_end': 99}))
+
+class TestLocalBackup(LocalBackupTestCase):
+    """Backup, list, restore and prune with the local storage backend."""
+
+    def config_lines(self):
+        return ['command.backup.hello="echo hallo"']
+
+    def test_backup_and_restore(self):
+        """Test a fileset round trip without Azure."""
+        blob_name = self.agent.backup_single_fileset('hello', is_full=True, force=True)
+        container = self.cfg.azure_storage_container_name
+        backups = self.agent.existing_backups(container=container)
+        self.assertEqual([b[0] for b in backups], [blob_name])
+        self.assertEqual(backups[0][2], len('hallo\n'))
+
+        self.agent.restore_blob(blob_name, self.tmpdir)
+        with open(os.path.join(self.tmpdir, blob_name)) as restored:
+            self.assertEqual(restored.read(), 'hallo\n')
+
+        # Too recent to be pruned
+        self.agent.prune_old_backups(ScheduleParser.parse_timedelta('8d'), ['hello'])
+        self.assertEqual(len(self.agent.existing_backups(container=container)), 1)
+        # Not used at all
+        self.assertFalse(self.cfg.storage_client.called)
+
+    def test_failed_upload(self):
+        """Test the backup command, and the command pv reads from, are stopped when the upload fails."""
+        procs = []
+        run_backup_command = self.agent.executable_connector.run_backup_command
+        def run(command, rate=None):
+            """Run the command like pv would, through a second process."""
+            backup_command = run_backup_command(command, rate)
+            proc = subprocess.Popen(['cat'], stdin=backup_command.stdout, stdout=subprocess.PIPE)
+            proc.backup_command = backup_command
+            procs.extend([proc, backup_command])
+            return proc
+        def upload(container_name, blob_name, stream, metadata=None):
+            """Read some data, then fail."""
+            stream.read(1024 * 1024)
+            raise IOError("connection reset")
+
+        with open(self.config_file, 'at') as config:
+            config.write('command.backup.zero="cat /dev/zero"\n')
+        agent = BackupAgent(BackupConfiguration(self.config_file))
+        with patch.object(agent.executable_connector, 'run_backup_command', side_effect=run), \
+                patch('azfilebak.uploader.StreamUploader.upload', side_effect=upload):
+            self.assertRaises(IOError, agent.backup_single_fileset, 'zero', is_full=True, force=True)
+        self.assertEqual(len(procs), 2)
+        # Both were killed and reaped
+        self.assertTrue(all(proc.returncode is not None for proc in procs))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for striping."""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from azfilebak.striping import Striping
+from azfilebak.naming import Naming
+from azfilebak.backupexception import BackupException
+from tests.loggedtestcase import LoggedTestCase
+from tests.localbackuptestcase import LocalBackupTestCase
+
+def write_file(path, size):
+    """Create a file of size bytes (not sparse) and its directory."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as out:
+        out.write(os.urandom(size))
+
+class TestStriping(LoggedTestCase):
+    """Unit tests for class Striping."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        # One large directory and a few small ones
+        for i in range(4):
+            write_file(os.path.join(self.src, 'big', 'f{}'.format(i)), 256 * 1024)
+        for name in ['a', 'b', 'c']:
+            write_file(os.path.join(self.src, name, 'f'), 64 * 1024)
+        write_file(os.path.join(self.src, 'skip', 'f'), 1024 * 1024)
+
+    def test_partition_balances_stripes(self):
+        """Test the stripes have similar sizes and cover every path once."""
+        shards = Striping.partition([self.src], [os.path.join(self.src, 'skip')], 2)
+        self.assertEqual(len(shards), 2)
+        sizes = sorted(shard.size for shard in shards)
+        self.assertLess(sizes[1] - sizes[0], 256 * 1024 + 8192)
+        paths = sum([shard.paths for shard in shards], [])
+        self.assertEqual(len(paths), len(set(paths)))
+        self.assertNotIn(os.path.join(self.src, 'skip'), paths)
+        # The large directory was split, and is archived without content once
+        self.assertIn(os.path.join(self.src, 'big', 'f0'), paths)
+        self.assertEqual(shards[0].directories, sorted([self.src, os.path.join(self.src, 'big')]))
+        self.assertEqual(shards[1].directories, [])
+
+    def test_partition_small_sources(self):
+        """Test there are no empty stripes, and small sources are not split."""
+        source = os.path.join(self.src, 'a')
+        shards = Striping.partition([source, os.path.join(self.tmpdir, 'missing')], [], 4)
+        self.assertEqual([(shard.paths, shard.directories) for shard in shards], [([source], [])])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class TestStripedBackup(LocalBackupTestCase):
+    """Striped backup and restore with the local storage backend."""
+
+    def config_lines(self):
+        self.src = os.path.join(self.tmpdir, 'src')
+        for name in ['a', 'b', 'c', 'd']:
+            write_file(os.path.join(self.src, name, 'f'), 128 * 1024)
+        return ['fs.ase.sources="{}"'.format(self.src),
+                'fs.ase.exclude="{}"'.format(os.path.join(self.src, 'd')),
+                'fs.ase.stripes="3"']
+
+    def test_backup_and_restore(self):
+        """Test a striped backup is listed and restored as one backup."""
+        blob_name = self.agent.backup_default(is_full=True, force=True)
+        blobs = [b.name for b in self.cfg.storage_backend.iter_blobs(container_name=self.container)]
+        self.assertEqual(len(blobs), 4)
+        self.assertIn(Naming.construct_manifest_name(blob_name), blobs)
+        self.assertEqual([b[0] for b in self.agent.existing_backups(container=self.container)], [blob_name])
+
+        output_dir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(output_dir)
+        self.agent.restore_blob(blob_name, output_dir)
+        members = []
+        for name in sorted(os.listdir(output_dir)):
+            self.assertEqual(Naming.logical_blobname(name), blob_name)
+            with tarfile.open(os.path.join(output_dir, name)) as archive:
+                members.extend(m.name for m in archive.getmembers() if m.isfile())
+        prefix = self.src.lstrip('/')
+        self.assertEqual(sorted(members), [prefix + '/{}/f'.format(n) for n in 'abc'])
+
+    def test_incomplete_backup(self):
+        """Test a striped backup with a missing stripe is neither listed nor restored."""
+        blob_name = self.agent.backup_default(is_full=True, force=True)
+        stripe = Naming.construct_stripe_blobname('fs', True, Naming.parse_blobname(blob_name)[2],
+                                                  self.cfg.get_vm_name(), 2, 3)
+        self.cfg.storage_backend.delete_blob(self.container, stripe)
+        self.assertEqual(self.agent.existing_backups(container=self.container), [])
+        with self.assertRaises(BackupException):
+            self.agent.restore_blob(blob_name, self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for synthetic full backups."""
+
+import os
+import subprocess
+import unittest
+from mock import patch
+from azfilebak import backupagent
+from azfilebak.timing import Timing
+from azfilebak.backupagent import BackupAgent
+from azfilebak.backupexception import BackupException
+from tests.localbackuptestcase import LocalBackupTestCase
+
+class TestSyntheticFull(LocalBackupTestCase):
+    """Synthetic full backups with the local storage backend."""
+
+    def config_lines(self):
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.src)
+        return ['command.backup.data="tar czf - -C {} ."'.format(self.src)]
+
+    def patchers(self):
+        return LocalBackupTestCase.patchers(self) + [
+            patch.object(Timing, 'now_localtime', return_value='20181001_100000'),
+            # Backups are taken when the test says so
+            patch.object(BackupAgent, 'should_run_backup', return_value=True)
+        ]
+
+    def write(self, name, content):
+        """Create or replace a file of the fileset."""
+        with open(os.path.join(self.src, name), 'wb') as out:
+            out.write(content)
+
+    def backup(self, timestamp, is_full):
+        """Backup the fileset at the given time."""
+        Timing.now_localtime.return_value = timestamp
+        return self.agent.backup_single_fileset('data', is_full=is_full, force=True)
+
+    def test_synthetic_full(self):
+        """Test the chain is compacted into a full backup that restores to the latest state."""
+        self.write('a', os.urandom(5000))
+        full = self.backup('20181001_100000', True)
+        self.write('b', 'second')
+        self.backup('20181002_100000', False)
+        self.write('a', 'third')
+        last = self.backup('20181003_100000', False)
+        # An incremental backup from before the full one is not part of the chain
+        self.backup('20180930_100000', False)
+
+        Timing.now_localtime.return_value = '20181003_120000'
+        with patch.object(backupagent, 'MAX_BLOCK_SIZE', 1000):
+            synthetic = self.agent.synthesize_full('data')
+        self.assertEqual(synthetic, last.replace('_incr_', '_full_'))
+        self.assertEqual(self.agent.latest_backup_timestamp('data', is_full=True), '20181003_100000')
+        metadata = self.cfg.storage_backend.get_blob_properties(self.container, synthetic).metadata
+        self.assertEqual(metadata, {'synthetic_base': full, 'synthetic_count': '3'})
+        self.assertGreater(len(self.cfg.storage_backend.get_block_list(self.container, synthetic)), 5)
+
+        self.agent.restore_blob(synthetic, self.tmpdir)
+        output_dir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(output_dir)
+        subprocess.check_call(['tar', 'xzif', os.path.join(self.tmpdir, synthetic), '-C', output_dir])
+        self.assertEqual(sorted(os.listdir(output_dir)), ['a', 'b'])
+        with open(os.path.join(output_dir, 'a')) as restored:
+            self.assertEqual(restored.read(), 'third')
+
+        # Nothing left to compact
+        self.assertIsNone(self.agent.synthesize_full('data'))
+
+    def test_compression_change(self):
+        """Test the chain ends before the first backup compressed differently than the full backup."""
+        self.write('a', 'first')
+        full = self.backup('20181001_100000', True)
+        self.write('b', 'second')
+        second = self.backup('20181002_100000', False)
+        with patch.object(self.cfg, 'get_compression', return_value='adaptive'):
+            Timing.now_localtime.return_value = '20181003_100000'
+            self.agent.backup_single_fileset('data', is_full=False, force=True,
+                                             command='tar cf - -C {} .'.format(self.src))
+        self.backup('20181004_100000', False)
+
+        Timing.now_localtime.return_value = '20181004_120000'
+        synthetic = self.agent.synthesize_full('data')
+        self.assertEqual(synthetic, second.replace('_incr_', '_full_'))
+        metadata = self.cfg.storage_backend.get_blob_properties(self.container, synthetic).metadata
+        self.assertEqual(metadata, {'synthetic_base': full, 'synthetic_count': '2'})
+        self.agent.restore_blob(synthetic, self.tmpdir)
+        output_dir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(output_dir)
+        subprocess.check_call(['tar', 'xzif', os.path.join(self.tmpdir, synthetic), '-C', output_dir])
+        self.assertEqual(sorted(os.listdir(output_dir)), ['a', 'b'])
+
+        # An adaptive full backup followed by a gzip one: nothing to compact
+        with patch.object(self.cfg, 'get_compression', return_value='adaptive'):
+            Timing.now_localtime.return_value = '20181005_100000'
+            self.agent.backup_single_fileset('data', is_full=True, force=True,
+                                             command='tar cf - -C {} .'.format(self.src))
+        self.backup('20181006_100000', False)
+        self.assertIsNone(self.agent.synthesize_full('data'))
+
+    def test_nothing_to_compact(self):
+        """Test there is no synthetic full without a full backup, or without incremental backups."""
+        self.write('a', 'first')
+        self.backup('20181001_100000', False)
+        self.assertIsNone(self.agent.synthesize_full('data'))
+        self.backup('20181002_100000', True)
+        self.assertIsNone(self.agent.synthesize_full('data'))
+
+    def test_too_many_blocks(self):
+        """Test a chain that does not fit in the blocks of a blob is rejected."""
+        self.write('a', os.urandom(5000))
+        self.backup('20181001_100000', True)
+        self.backup('20181002_100000', False)
+        with patch.object(backupagent, 'MAX_BLOCK_SIZE', 1000), \
+                patch.object(self.cfg.storage_backend, 'max_blocks', 3):
+            self.assertRaises(BackupException, self.agent.synthesize_full, 'data')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for tokencache."""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock
+from azfilebak.tokencache import TokenCache
+from azfilebak.instrumentation import Instrumentation
+from azfilebak.backupexception import BackupException
+from tests.loggedtestcase import LoggedTestCase
+
+RESOURCE = 'https://sahec99az1backup0001.blob.core.windows.net'
+
+class TestTokenCache(LoggedTestCase):
+    """Unit tests for class TokenCache."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'cache', 'token.json')
+        self.tokens = iter(['token1', 'token2', 'token3'])
+        self.fetch = MagicMock(side_effect=lambda resource: {
+            'access_token': next(self.tokens),
+            'expires_on': int(time.time()) + 3600})
+        Instrumentation.reset()
+
+    def test_cold_and_warm(self):
+        """Test a second process reuses the cached token."""
+        self.assertEqual(TokenCache(self.filename, RESOURCE, self.fetch).get_token(), 'token1')
+        self.assertEqual(TokenCache(self.filename, RESOURCE, self.fetch).get_token(), 'token1')
+        self.assertEqual(self.fetch.call_count, 1)
+        timers = Instrumentation.report()['timers']
+        self.assertEqual(timers['token.cold']['count'], 1)
+        self.assertEqual(timers['token.warm']['count'], 1)
+        self.assertEqual(os.stat(self.filename).st_mode & 0o777, 0o600)
+
+    def test_expiring_token(self):
+        """Test a token close to expiry is renewed."""
+        cache = TokenCache(self.filename, RESOURCE, self.fetch, refresh_margin_seconds=4000)
+        self.assertEqual(cache.get_token(), 'token1')
+        self.assertEqual(cache.get_token(), 'token2')
+
+    def test_other_resource(self):
+        """Test tokens for another resource are not used."""
+        TokenCache(self.filename, RESOURCE, self.fetch).get_token()
+        self.assertEqual(TokenCache(self.filename, 'https://other', self.fetch).get_token(), 'token2')
+
+    def test_refresh_thread(self):
+        """Test the background thread updates the credential."""
+        cache = TokenCache(self.filename, RESOURCE, self.fetch, refresh_margin_seconds=4000)
+        credential = MagicMock()
+        credential.token = cache.get_token()
+        cache.start_refresh_thread(credential)
+        for _ in range(50):
+            if credential.token != 'token1':
+                break
+            time.sleep(0.1)
+        cache.stop_refresh_thread()
+        self.assertEqual(credential.token, 'token2')
+
+    def test_fetch_failure(self):
+        """Test errors from the token endpoint."""
+        self.fetch.side_effect = Exception("endpoint down")
+        self.assertRaises(BackupException, TokenCache(self.filename, RESOURCE, self.fetch).get_token)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
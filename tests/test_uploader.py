@@ -0,0 +1,122 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# --------------------------------------------------------------------------
+
+"""Unit tests for uploader."""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from mock import patch
+from azfilebak.uploader import StreamUploader, DeltaUploader, MB
+from azfilebak.storagebackend import LocalStorageBackend
+from azfilebak.backupexception import BackupException
+from tests.loggedtestcase import LoggedTestCase
+
+class TestStreamUploader(LoggedTestCase):
+    """Unit tests for class StreamUploader."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Local storage with the block limit of the blob service
+        self.backend = LocalStorageBackend(os.path.join(self.tmpdir, 'storage'))
+        self.backend.max_blocks = 50000
+        self.state_file = os.path.join(self.tmpdir, 'upload_fs.json')
+        self.uploader = StreamUploader(self.backend, state_file=self.state_file, max_connections=2)
+
+    def content(self, blob_name):
+        """Content of an uploaded blob."""
+        size = self.backend.get_blob_properties('c1', blob_name).size
+        return self.backend.get_blob_range('c1', blob_name, 0, size - 1)
+
+    def test_small_stream_single_put(self):
+        """Test a stream smaller than a block is uploaded with one request."""
+        with patch.object(self.backend, 'put_block') as put_block:
+            result = self.uploader.upload('c1', 'blob1', StringIO('hello'), metadata={'k': 'v'})
+        put_block.assert_not_called()
+        self.assertEqual(result['blocks'], 0)
+        self.assertEqual(self.content('blob1'), 'hello')
+        self.assertEqual(self.backend.get_blob_properties('c1', 'blob1').metadata, {'k': 'v'})
+
+    def test_blocks_in_order(self):
+        """Test a larger stream is uploaded in blocks and committed in order."""
+        data = ''.join(chr(65 + i % 26) * 100 for i in range(10 * MB // 100))
+        result = self.uploader.upload('c1', 'blob1', StringIO(data))
+        self.assertEqual(result['blocks'], 3)
+        self.assertEqual(result['block_size'], 4 * MB)
+        self.assertEqual(result['size'], len(data))
+        self.assertEqual(self.content('blob1'), data)
+        with open(self.state_file) as state_file:
+            self.assertEqual(json.load(state_file)['size'], len(data))
+
+    def test_starts_from_previous_upload(self):
+        """Test the first block size comes from the previous upload of the fileset."""
+        with open(self.state_file, 'w') as state_file:
+            json.dump({'size': 10 * 1024 * MB}, state_file)
+        result = self.uploader.upload('c1', 'blob1', StringIO('x' * (5 * MB)))
+        self.assertEqual(result['block_size'], 11 * MB)
+        self.assertEqual(result['blocks'], 0)
+
+    def test_too_many_blocks(self):
+        """Test a stream that does not fit in the blocks of a blob is rejected."""
+        self.backend.max_blocks = 2
+        self.assertRaises(BackupException, self.uploader.upload, 'c1', 'blob1', StringIO('x' * (10 * MB)))
+
+    def test_block_error(self):
+        """Test a failed block fails the upload without committing."""
+        with patch.object(self.backend, 'put_block', side_effect=IOError('boom')):
+            self.assertRaises(IOError, self.uploader.upload, 'c1', 'blob1', StringIO('x' * (10 * MB)))
+        self.assertRaises(BackupException, self.backend.get_blob_properties, 'c1', 'blob1')
+
+    def test_backend_without_block_limit(self):
+        """Test backends without a block limit get the stream as is."""
+        del self.backend.max_blocks
+        self.assertIsNone(self.uploader.upload('c1', 'blob1', StringIO('x' * (5 * MB))))
+        self.assertEqual(self.backend.get_blob_properties('c1', 'blob1').size, 5 * MB)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class TestDeltaUploader(LoggedTestCase):
+    """Unit tests for class DeltaUploader."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.backend = LocalStorageBackend(os.path.join(self.tmpdir, 'storage'))
+        self.blocks = [chr(65 + i) * MB for i in range(4)]
+
+    def upload(self, blob_name, blocks, previous=None):
+        """Delta upload of the concatenated blocks."""
+        uploader = DeltaUploader(self.backend, previous_blob=previous, block_size=MB, max_connections=2)
+        return uploader.upload('c1', blob_name, StringIO(''.join(blocks)))
+
+    def test_reuse_unchanged_blocks(self):
+        """Test only the changed block is sent, and the others are copied from the previous blob."""
+        self.upload('blob1', self.blocks)
+        self.assertEqual([size for (_id, size) in self.backend.get_block_list('c1', 'blob1')], [MB] * 4)
+        changed = self.blocks[:2] + ['x' * MB, self.blocks[3][:1000]]
+        with patch.object(self.backend, 'put_block', wraps=self.backend.put_block) as put_block, \
+                patch.object(self.backend, 'put_block_from_blob', wraps=self.backend.put_block_from_blob) as copy:
+            result = self.upload('blob2', changed, previous='blob1')
+        self.assertEqual(put_block.call_count, 2)
+        self.assertEqual(sorted(c[0][4:] for c in copy.call_args_list), [(0, MB - 1), (MB, 2 * MB - 1)])
+        self.assertEqual(result['reused'], 2 * MB)
+        self.assertEqual(self.backend.get_blob_range('c1', 'blob2', 0, 3 * MB + 999), ''.join(changed))
+
+    def test_repeated_blocks(self):
+        """Test identical blocks are staged once, and the blob is complete."""
+        with patch.object(self.backend, 'put_block', wraps=self.backend.put_block) as put_block:
+            result = self.upload('blob1', [self.blocks[0]] * 3)
+        self.assertEqual(put_block.call_count, 1)
+        self.assertEqual(result['blocks'], 3)
+        self.assertEqual(self.backend.get_blob_properties('c1', 'blob1').size, 3 * MB)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()